@@ -45,12 +45,13 @@ async def _quick_kb_search(gpt_id: str, userId: str, query: str, is_hybrid: bool
     """
     try:
         from Rag.Rag import _search_collection, _hybrid_search_rrf, check_kb_collection_exists
+        from Rag.kb_index import kb_collection_name
         
         if not gpt_id or not userId:
             print(f"[SimpleLLM-KB] Missing gpt_id or userId")
             return []
         
-        collection_name = f"kb_{gpt_id}_{userId}"
+        collection_name = kb_collection_name(gpt_id, userId)
         
         # Check if collection exists in Qdrant directly
         collection_exists, has_data = await check_kb_collection_exists(gpt_id, userId)
@@ -98,7 +99,9 @@ async def SimpleLLm(state: GraphState) -> GraphState:
             
             # Retrieve JSON KB documents (even if no embedded chunks found)
             from Rag.Rag import get_json_documents
-            kb_json_content = await get_json_documents(is_kb=True, gpt_id=gpt_id, userId=userId)
+            from api_keys_util import get_api_keys_from_session
+            json_api_keys = await get_api_keys_from_session(state.get("session_id")) if state else {}
+            kb_json_content = await get_json_documents(is_kb=True, gpt_id=gpt_id, userId=userId, query=user_query, api_keys=json_api_keys)
             if kb_json_content:
                 print(f"[SimpleLLM-KB] Retrieved {len(kb_json_content)} JSON KB documents")
             elif not kb_chunks:
@@ -153,6 +156,14 @@ async def SimpleLLm(state: GraphState) -> GraphState:
 **{timestamp} - Assistant:**
 {content}
 """))
+        from Rag.context_packer import pack_texts, pack_documents, record_packed_tokens
+        if kb_chunks:
+            kb_chunks, pack_stats = pack_texts(kb_chunks, "simple_kb")
+            record_packed_tokens(state, "simple_kb", pack_stats)
+        if kb_json_content:
+            kb_json_content, pack_stats = pack_documents(kb_json_content, "simple_json")
+            record_packed_tokens(state, "simple_json", pack_stats)
+
         kb_context = ""
         if kb_chunks:
             kb_context = f"\n\n# AVAILABLE KNOWLEDGE BASE CONTEXT:\n{chr(10).join(kb_chunks)}"
@@ -3,10 +3,10 @@ from langchain_core.prompts import ChatPromptTemplate
 from typing import Optional, Dict, Any
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_openai import ChatOpenAI
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
 from langchain_groq import ChatGroq
 import uuid  
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import os
 import asyncio
 from qdrant_client import QdrantClient, models
@@ -15,27 +15,126 @@ from rank_bm25 import BM25Okapi
 import re
 from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
 from prompt_cache import normalize_prefix
-from redis_client import ensure_redis_client, ensure_redis_client_binary
+from redis_client import ensure_redis_client, ensure_redis_client_binary, mget as redis_mget
 import dill
 from thinking_states import send_thinking_state, RAG_THINKING_STATES
-
-QDRANT_URL = os.getenv("QDRANT_URL", ":memory:")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-QDRANT_TIMEOUT = float(os.getenv("QDRANT_TIMEOUT", "60"))
+from Rag.kb_manifest import (
+    content_hash,
+    get_manifest_file_urls,
+    kb_manifest_ready,
+    record_kb_files,
+    clear_kb_manifest,
+    get_kb_version,
+    set_kb_version,
+    clear_kb_version,
+    get_kb_manifest,
+)
+from Rag.kb_sync import (
+    plan_kb_sync,
+    delete_kb_files,
+    delete_kb_json_documents,
+    json_document_stored,
+    build_sync_report,
+    record_sync_report,
+)
+from Rag.kb_index import (
+    kb_owner,
+    kb_collection_name,
+    kb_version,
+    kb_index_lock,
+)
+from Rag.chunk_registry import (
+    chunk_source_key,
+    register_chunks,
+    get_chunk_sources,
+    get_point_ids_for_sources,
+    get_doc_index_map,
+    clear_chunk_registry,
+)
+from Rag.session_gc import track_session_resources
+from Rag.summary_tree import (
+    SECTION_PROMPT,
+    MERGE_PROMPT,
+    SUMMARY_TREE_FOR_KB,
+    summary_tree_key,
+    schedule_summary_tree_build,
+    get_valid_summary_tree,
+)
+from Rag.chunker import chunk_document
+from Rag.key_registry import (
+    KEY_REGISTRY_PREFIX,
+    user_json_scope,
+    kb_json_scope,
+    registry_key,
+    register_keys,
+    unregister_keys,
+    get_registered_keys,
+    has_registered_keys,
+    pop_registry,
+    scan_keys,
+)
+from Rag.sparse_hybrid import (
+    SPARSE_HYBRID_ENABLED,
+    sparse_vectors_config,
+    point_vector,
+    has_sparse_vectors,
+    forget_collection,
+    server_hybrid_search,
+)
+from Rag.local_vectors import dense_search, forget_collection as forget_local_vectors
+from Rag.near_dup import (
+    NEAR_DUP_MODE,
+    near_dup_keys,
+    find_near_duplicates,
+    record_canonical,
+    build_report as build_near_dup_report,
+    clear_near_dup_index,
+)
+from Rag.mmr import (
+    MMR_ENABLED,
+    candidate_pool_size,
+    dense_vector,
+    mmr_rerank,
+    rank_relevance,
+)
+from Rag.bm25_index import (
+    bm25_keys,
+    bm25_search,
+    clear_bm25_index,
+    index_chunks as index_bm25_chunks,
+)
+from Rag.json_index import (
+    is_indexed_json,
+    should_index_json,
+    json_index_key,
+    json_units_collection,
+    build_json_index,
+    query_json_index,
+    delete_json_index_points,
+)
+from Rag.context_packer import (
+    context_budget,
+    pack_items,
+    pack_texts,
+    pack_documents,
+    record_packed_tokens,
+)
+from Rag.llm_scheduler import llm_slot, invoke_llm, OrderedStream
+from Rag.session_docs import (
+    doc_generation_key,
+    get_doc_generation,
+    bump_doc_generation,
+    get_cached_doc_state,
+    set_cached_doc_state,
+    drop_cached_doc_state,
+)
+
+from Rag.qdrant_store import QDRANT_URL, QDRANT_API_KEY, QDRANT_TIMEOUT, open_qdrant_client
 from llm import get_llm, stream_with_token_tracking, _extract_usage
 from embeddings import embed_chunks_parallel, embed_query
 
-try:
-    if QDRANT_URL == ":memory:":
-        QDRANT_CLIENT = QdrantClient(":memory:", timeout=QDRANT_TIMEOUT)
-    else:
-        QDRANT_CLIENT = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=QDRANT_TIMEOUT)
-        # Test the connection
-        QDRANT_CLIENT.get_collections()
-        print(f"[RAG] Connected to remote Qdrant at {QDRANT_URL}")
-except Exception as e:
-    print(f"[RAG] Remote Qdrant failed, falling back to in-memory: {e}")
-    QDRANT_CLIENT = QdrantClient(":memory:")
+# Remote server, embedded on-disk storage (QDRANT_PATH) or in-memory; see Rag.qdrant_store
+QDRANT_CLIENT = open_qdrant_client()
 
 VECTOR_SIZE = 1536
 QDRANT_UPSERT_BATCH_SIZE = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", "64"))
@@ -86,17 +185,22 @@ async def clear_json_documents(session_id: str = None, gpt_id: str = None, userI
     
     # Clear user JSON documents
     if session_id:
-        user_json_keys = await redis_client.keys(f"user_json:{session_id}:*")
+        user_json_keys = await pop_registry(user_json_scope(session_id))
         if user_json_keys:
-            await redis_client.delete(*user_json_keys)
+            await redis_client.delete(*user_json_keys, *[json_index_key(k) for k in user_json_keys])
+            for k in user_json_keys:
+                await delete_json_index_points(k)
             deleted_count += len(user_json_keys)
+            await bump_doc_generation(session_id)
             print(f"[RAG] Cleared {len(user_json_keys)} user JSON documents for session {session_id}")
     
     # Clear KB JSON documents (if gpt_id and userId provided)
     if gpt_id and userId:
-        kb_json_keys = await redis_client.keys(f"kb_json:{gpt_id}_{userId}:*")
+        kb_json_keys = await pop_registry(kb_json_scope(gpt_id, kb_owner(userId)))
         if kb_json_keys:
-            await redis_client.delete(*kb_json_keys)
+            await redis_client.delete(*kb_json_keys, *[json_index_key(k) for k in kb_json_keys])
+            for k in kb_json_keys:
+                await delete_json_index_points(k)
             deleted_count += len(kb_json_keys)
             print(f"[RAG] Cleared {len(kb_json_keys)} KB JSON documents for gpt_id={gpt_id}, userId={userId}")
     
@@ -106,50 +210,50 @@ async def clear_json_documents(session_id: str = None, gpt_id: str = None, userI
 async def clear_user_doc_cache(session_id: str = None):
     """Clear user document embedding cache for a specific session or all sessions"""
     redis_client = await ensure_redis_client()
-    redis_client_binary = await ensure_redis_client_binary()
     if not redis_client:
         return
     if session_id:
-        keys_to_delete = await redis_client.keys(f"user_doc_cache:{session_id}:*")
-        if redis_client_binary:
-            binary_keys = await redis_client_binary.keys(f"bm25_index:user_docs_{session_id}")
-            keys_to_delete.extend(binary_keys)
-        if keys_to_delete:
-            await redis_client.delete(*keys_to_delete)
+        await clear_bm25_index(f"user_docs_{session_id}")
+        await clear_near_dup_index(f"user_docs_{session_id}")
         
         # Also clear user JSON documents for this session
         await clear_json_documents(session_id=session_id)
+        await bump_doc_generation(session_id)
+        drop_cached_doc_state(session_id)
         
         print(f"[RAG] Cleared user doc cache (embeddings, BM25, JSON) for session {session_id}")
     else:
-        keys_to_delete = await redis_client.keys("user_doc_cache:*")
-        if redis_client_binary:
-            binary_keys = await redis_client_binary.keys("bm25_index:*")
-            keys_to_delete.extend(binary_keys)
-        if keys_to_delete:
-            await redis_client.delete(*keys_to_delete)
+        # Admin wipe of every session: incremental SCAN instead of KEYS
+        keys_to_delete = await scan_keys("user_doc_cache:*")
+        keys_to_delete.extend(await scan_keys("bm25_index:*"))
+        keys_to_delete.extend(await scan_keys("bm25:*"))
+        for i in range(0, len(keys_to_delete), 1000):
+            await redis_client.delete(*keys_to_delete[i:i + 1000])
         
         # Clear all user JSON documents
-        all_user_json_keys = await redis_client.keys("user_json:*")
+        all_user_json_keys = await scan_keys("user_json:*")
+        all_user_json_keys.extend(await scan_keys(f"{KEY_REGISTRY_PREFIX}:user_json:*"))
+        for i in range(0, len(all_user_json_keys), 1000):
+            await redis_client.delete(*all_user_json_keys[i:i + 1000])
         if all_user_json_keys:
-            await redis_client.delete(*all_user_json_keys)
-            print(f"[RAG] Cleared {len(all_user_json_keys)} user JSON documents")
+            print(f"[RAG] Cleared {len(all_user_json_keys)} user JSON documents and registries")
         
         print("[RAG] Cleared all user document caches (embeddings, BM25, JSON)")
 
 
-async def cleanup_expired_user_docs(session_id: str) -> bool:
+async def cleanup_expired_user_docs(session_id: str, cache: Optional[Dict[str, str]] = None) -> bool:
     """
     Delete user document embeddings and cache data if they have expired.
+    `cache` is the already fetched user_doc_cache hash, if the caller has it.
     Returns True if cleanup was performed.
     """
     redis_client = await ensure_redis_client()
-    redis_client_binary = await ensure_redis_client_binary()
     if not redis_client or not session_id:
         return False
 
     cache_key = f"user_doc_cache:{session_id}"
-    cache = await redis_client.hgetall(cache_key)
+    if cache is None:
+        cache = await redis_client.hgetall(cache_key)
     if not cache:
         return False
 
@@ -162,9 +266,13 @@ async def cleanup_expired_user_docs(session_id: str) -> bool:
                 print(f"[RAG] Deleted expired Qdrant collection {collection_name}")
             except Exception as e:
                 print(f"[RAG] Error deleting expired collection {collection_name}: {e}")
+            await clear_chunk_registry(collection_name)
+            forget_local_vectors(collection_name)
         await redis_client.delete(cache_key, f"doc_order:{session_id}")
-        if redis_client_binary and collection_name:
-            await redis_client_binary.delete(f"bm25_index:{collection_name}")
+        if collection_name:
+            await clear_bm25_index(collection_name)
+            await clear_near_dup_index(collection_name)
+        await bump_doc_generation(session_id)
         print(f"[RAG] Cleared expired user document cache for session {session_id}")
         return True
     return False
@@ -179,9 +287,9 @@ async def clear_image_cache(session_id: str = None):
         await redis_client.delete(f"image_cache:{session_id}")
         print(f"[RAG] Cleared image analysis cache for session {session_id}")
     else:
-        keys_to_delete = await redis_client.keys("image_cache:*")
-        if keys_to_delete:
-            await redis_client.delete(*keys_to_delete)
+        keys_to_delete = await scan_keys("image_cache:*")
+        for i in range(0, len(keys_to_delete), 1000):
+            await redis_client.delete(*keys_to_delete[i:i + 1000])
         print("[RAG] Cleared all image analysis cache")
 
 def is_json_document(doc: dict) -> bool:
@@ -247,19 +355,36 @@ async def store_json_document(doc: dict, is_kb: bool, gpt_id: str = None, userId
             if not gpt_id or not userId:
                 print(f"[RAG] Warning: Missing gpt_id or userId for KB JSON document")
                 return False
-            key = f"kb_json:{gpt_id}_{userId}:{doc.get('file_url', doc.get('id', ''))}"
+            key = f"kb_json:{gpt_id}_{kb_owner(userId)}:{doc.get('file_url', doc.get('id', ''))}"
         else:
             if not session_id:
                 print(f"[RAG] Warning: Missing session_id for user JSON document")
                 return False
             key = f"user_json:{session_id}:{doc.get('file_url', doc.get('id', ''))}"
         
+        ttl = 86400 * 7 if is_kb else USER_DOC_TTL_SECONDS  # 7 days for KB, same TTL as user docs otherwise
+        # Large JSON files are indexed by structure; the key then holds only the schema summary
+        if should_index_json(content):
+            from api_keys_util import get_api_keys_from_session
+            api_keys = await get_api_keys_from_session(session_id) if session_id else {}
+            try:
+                summary = await build_json_index(key, content, doc.get("filename", "unknown"), ttl=ttl, api_keys=api_keys)
+            except Exception as e:
+                print(f"[RAG] JSON indexing failed, storing whole document instead: {e}")
+                summary = None
+            if summary:
+                content = summary
+
         # Store the JSON content
-        await redis_client.set(key, content)
-        if is_kb:
-            await redis_client.expire(key, 86400 * 7)  # 7 days for KB
-        else:
-            await redis_client.expire(key, USER_DOC_TTL_SECONDS)  # Same TTL as user docs
+        await redis_client.set(key, content, ex=ttl)
+        scope = kb_json_scope(gpt_id, kb_owner(userId)) if is_kb else user_json_scope(session_id)
+        await register_keys(scope, [key], ttl=ttl)
+        if not is_kb:
+            await track_session_resources(
+                session_id,
+                collections=[json_units_collection(key)] if is_indexed_json(content) else [],
+                redis_keys=[key, json_index_key(key), registry_key(scope)]
+            )
         
         print(f"[RAG] Stored JSON document: {doc.get('filename', 'unknown')} (key: {key})")
         return True
@@ -267,8 +392,54 @@ async def store_json_document(doc: dict, is_kb: bool, gpt_id: str = None, userId
         print(f"[RAG] Error storing JSON document: {e}")
         return False
 
-async def get_json_documents(is_kb: bool, gpt_id: str = None, userId: str = None, session_id: str = None) -> List[str]:
-    """Retrieve all JSON document contents from Redis"""
+async def _get_session_json_keys(session_id: Optional[str]) -> List[str]:
+    """user_json keys of a session, cached in-process until its documents change."""
+    if not session_id:
+        return []
+    generation = await get_doc_generation(session_id)
+    cached = get_cached_doc_state(session_id, "json_keys", generation)
+    if cached is not None:
+        return list(cached)
+    keys = await get_registered_keys(user_json_scope(session_id))
+    set_cached_doc_state(session_id, "json_keys", generation, list(keys))
+    return keys
+
+async def _hydrate_session_docs(session_id: Optional[str]) -> Dict[str, Any]:
+    """
+    Document state of a session for this turn in one pipelined round trip: the
+    user doc cache hash, the document generation and the JSON key registry.
+    Also primes the in-process JSON key cache for that generation.
+    """
+    state = {"cache": {}, "generation": 0, "json_keys": []}
+    redis_client = await ensure_redis_client()
+    if not session_id or not redis_client:
+        return state
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(f"user_doc_cache:{session_id}")
+        pipe.get(doc_generation_key(session_id))
+        pipe.smembers(registry_key(user_json_scope(session_id)))
+        cache, generation, json_keys = await pipe.execute()
+    state["cache"] = cache or {}
+    state["generation"] = int(generation) if generation else 0
+    state["json_keys"] = sorted(json_keys or [])
+    set_cached_doc_state(session_id, "json_keys", state["generation"], list(state["json_keys"]))
+    return state
+
+async def render_json_document(key: str, content: str, query: Optional[str] = None, api_keys: dict = None) -> str:
+    """Prompt text of a stored JSON document: whole file, or schema + matching subtrees if indexed."""
+    if not is_indexed_json(content):
+        return content
+    try:
+        return await query_json_index(key, content, query, api_keys=api_keys)
+    except Exception as e:
+        print(f"[RAG] Error querying JSON index for {key}: {e}")
+        return content
+
+async def get_json_documents(is_kb: bool, gpt_id: str = None, userId: str = None, session_id: str = None, query: Optional[str] = None, api_keys: dict = None) -> List[str]:
+    """
+    Retrieve all JSON document contents from Redis. Indexed (large) documents
+    are rendered as their schema plus the subtrees matching the query.
+    """
     redis_client = await ensure_redis_client()
     if not redis_client:
         return []
@@ -277,75 +448,118 @@ async def get_json_documents(is_kb: bool, gpt_id: str = None, userId: str = None
         if is_kb:
             if not gpt_id or not userId:
                 return []
-            pattern = f"kb_json:{gpt_id}_{userId}:*"
+            scope = kb_json_scope(gpt_id, kb_owner(userId))
         else:
             if not session_id:
                 return []
-            pattern = f"user_json:{session_id}:*"
+            scope = user_json_scope(session_id)
         
-        keys = await redis_client.keys(pattern)
-        if not keys:
-            return []
+        generation = None
+        stored = None
+        if not is_kb:
+            generation = await get_doc_generation(session_id)
+            stored = get_cached_doc_state(session_id, "json_documents", generation)
         
-        contents = []
-        for key in keys:
-            content = await redis_client.get(key)
-            if content:
-                contents.append(content.decode('utf-8') if isinstance(content, bytes) else content)
+        if stored is None:
+            keys = await get_registered_keys(scope) if is_kb else await _get_session_json_keys(session_id)
+            stored = []
+            expired = []
+            for key, content in zip(keys, await redis_mget(keys)):
+                if content:
+                    stored.append((key, content.decode('utf-8') if isinstance(content, bytes) else content))
+                else:
+                    expired.append(key)
+            if expired:
+                await unregister_keys(scope, expired)
+            if generation is not None:
+                set_cached_doc_state(session_id, "json_documents", generation, list(stored))
         
-        print(f"[RAG] Retrieved {len(contents)} JSON documents ({'KB' if is_kb else 'user'})")
+        contents = [await render_json_document(key, content, query, api_keys) for key, content in stored]
+        if contents:
+            print(f"[RAG] Retrieved {len(contents)} JSON documents ({'KB' if is_kb else 'user'})")
         return contents
     except Exception as e:
         print(f"[RAG] Error retrieving JSON documents: {e}")
         return []
 
+async def _backfill_kb_manifest(collection_name: str) -> set:
+    """
+    Build the KB manifest for a collection indexed before manifests existed.
+    Pages through the whole collection once (no 10k cap), then records the result
+    so later checks never scroll again.
+    """
+    chunk_counts: Dict[str, int] = {}
+    offset = None
+    while True:
+        scroll_out, offset = await asyncio.to_thread(
+            QDRANT_CLIENT.scroll,
+            collection_name=collection_name,
+            limit=1000,
+            offset=offset,
+            with_payload=["file_url"],
+            with_vectors=False
+        )
+        for point in scroll_out:
+            file_url = (point.payload or {}).get("file_url")
+            if file_url:
+                chunk_counts[file_url] = chunk_counts.get(file_url, 0) + 1
+        if offset is None:
+            break
+    await record_kb_files(collection_name, {
+        file_url: {"content_hash": "", "chunk_count": count}
+        for file_url, count in chunk_counts.items()
+    })
+    print(f"[RAG] Backfilled KB manifest for {collection_name} with {len(chunk_counts)} files")
+    return set(chunk_counts.keys())
+
 async def get_existing_kb_file_urls(gpt_id: str, userId: str) -> set:
     """
     Get set of file_urls that are already embedded in the KB collection.
+    Served from the Redis KB manifest; falls back to a one-time backfill scroll
+    for collections indexed before the manifest existed.
     Returns empty set if collection doesn't exist or on error.
     """
     if not gpt_id or not userId:
         return set()
     
-    collection_name = f"kb_{gpt_id}_{userId}"
-    existing_file_urls = set()
+    collection_name = kb_collection_name(gpt_id, userId)
     
     try:
-        collections_response = await asyncio.to_thread(QDRANT_CLIENT.get_collections)
-        collections = [c.name for c in collections_response.collections]
-        if collection_name in collections:
-            scroll_out, _ = await asyncio.to_thread(
-                QDRANT_CLIENT.scroll,
-                collection_name=collection_name,
-                limit=10000,  
-                with_payload=True,
-                with_vectors=False
-            )
-            for point in scroll_out:
-                payload = point.payload or {}
-                file_url = payload.get("file_url")
-                if file_url:
-                    existing_file_urls.add(file_url)
+        collection_exists = await asyncio.to_thread(QDRANT_CLIENT.collection_exists, collection_name)
+        if not collection_exists:
+            # Drop any stale manifest (e.g. in-memory Qdrant restarted)
+            await clear_kb_manifest(collection_name)
+            return set()
+        manifest_urls = await get_manifest_file_urls(collection_name)
+        if manifest_urls is not None:
+            return manifest_urls
+        return await _backfill_kb_manifest(collection_name)
     except Exception as e:
         print(f"[RAG] Error checking existing KB files: {e}")
-    
-    return existing_file_urls
+        return set()
 
 async def check_kb_collection_exists(gpt_id: str, userId: str) -> tuple[bool, bool]:
     """
     Check if KB collection exists in Qdrant and whether it contains any points.
+    A manifest recording points skips the scroll, but Qdrant still confirms the
+    collection exists; a stale manifest (collection gone) is cleared. Without
+    a manifest, or with one recording no points, Qdrant is asked.
     Returns (collection_exists, has_data).
     """
     if not gpt_id or not userId:
         return (False, False)
     
-    collection_name = f"kb_{gpt_id}_{userId}"
+    collection_name = kb_collection_name(gpt_id, userId)
     
     try:
-        collections_response = await asyncio.to_thread(QDRANT_CLIENT.get_collections)
-        collections = [c.name for c in collections_response.collections]
+        if await kb_manifest_ready(collection_name):
+            if await asyncio.to_thread(QDRANT_CLIENT.collection_exists, collection_name):
+                return (True, True)
+            print(f"[RAG] KB manifest of {collection_name} is stale (collection missing), clearing it")
+            await clear_kb_manifest(collection_name)
+            return (False, False)
         
-        if collection_name not in collections:
+        if not await asyncio.to_thread(QDRANT_CLIENT.collection_exists, collection_name):
             return (False, False)
         
         # Quickly verify collection has data
@@ -362,63 +576,117 @@ async def check_kb_collection_exists(gpt_id: str, userId: str) -> tuple[bool, bo
         print(f"[RAG] Error checking KB collection: {e}")
         return (False, False)
 
-async def preprocess_kb_documents(kb_docs: List[dict], gpt_id: str, userId: str, is_hybrid: bool = False):
+async def _kb_version_current(collection_name: str, version: str) -> bool:
+    """
+    True if the index was synced to this KB version and still exists. A manifest
+    recording points for a missing collection (in-memory Qdrant restarted) is
+    stale: it is cleared so the KB is indexed again.
+    """
+    if await get_kb_version(collection_name) != version:
+        return False
+    if await kb_manifest_ready(collection_name) and not await asyncio.to_thread(QDRANT_CLIENT.collection_exists, collection_name):
+        print(f"[RAG] KB collection {collection_name} is gone, dropping its stale manifest")
+        await clear_kb_manifest(collection_name)
+        return False
+    return True
+
+async def preprocess_kb_documents(kb_docs: List[dict], gpt_id: str, userId: str, is_hybrid: bool = False, replace: bool = False):
     """
     Pre-process KB documents when custom GPT is loaded.
-    Generate embeddings once per gpt_id+userId combination.
-    Only embeds files that haven't been embedded yet (checked by file_url).
-    JSON documents are stored separately without embeddings.
+    The index is shared by every user of the GPT (see Rag.kb_index). With
+    replace, kb_docs is the GPT's complete KB: unlisted files are deleted and the
+    sync is skipped when the KB version is unchanged. Otherwise documents are
+    only added or changed.
+    Returns the sync report (None when the index was already up to date).
     """
     if not kb_docs:
         return
     
-    collection_name = f"kb_{gpt_id}_{userId}"
-    cache_key = f"kb_cache:{collection_name}"
-    existing_file_urls = await get_existing_kb_file_urls(gpt_id, userId)
-    new_kb_docs = []
-    for doc in kb_docs:
-        if isinstance(doc, dict):
-            file_url = doc.get("file_url")
-            if file_url and file_url not in existing_file_urls:
-                new_kb_docs.append(doc)
-            elif not file_url:
-                new_kb_docs.append(doc)
-        else:
-            new_kb_docs.append(doc)
-    
-    if not new_kb_docs:
-        print(f"[RAG] All KB documents already embedded for gpt_id={gpt_id}, userId={userId}")
+    collection_name = kb_collection_name(gpt_id, userId)
+    version = kb_version(kb_docs) if replace else None
+    if replace and await _kb_version_current(collection_name, version):
+        print(f"[RAG] KB index {collection_name} already at version {version}")
         return
-    
-    print(f"[RAG] Pre-processing {len(new_kb_docs)} new KB documents (out of {len(kb_docs)} total) for gpt_id={gpt_id}, userId={userId}")
+    async with kb_index_lock(gpt_id):
+        # Another worker may have synced the same version while we waited
+        if replace and await _kb_version_current(collection_name, version):
+            return
+        report = await _sync_kb_documents(kb_docs, gpt_id, userId, is_hybrid, replace=replace)
+        if replace:
+            await set_kb_version(collection_name, version)
+        elif report["added"] or report["changed"] or report["unkeyed"] or report["json_stored"]:
+            # The index now holds files outside the last full list
+            await clear_kb_version(collection_name)
+        return report
+
+async def _sync_kb_documents(kb_docs: List[dict], gpt_id: str, userId: str, is_hybrid: bool = False, replace: bool = False) -> Dict[str, Any]:
+    """
+    Bring the KB index in line with kb_docs (see Rag.kb_sync): new and changed
+    files are embedded, the old chunks of changed files are deleted and, on a
+    replace sync, so are unlisted files. JSON documents are stored separately
+    without embeddings.
+    """
+    start = time.time()
+    collection_name = kb_collection_name(gpt_id, userId)
+    json_scope = kb_json_scope(gpt_id, kb_owner(userId))
+    cache_key = f"kb_cache:{collection_name}"
+    # Drops manifests of vanished collections and backfills collections indexed before the manifest
+    await get_existing_kb_file_urls(gpt_id, userId)
+    json_docs = [doc for doc in kb_docs if is_json_document(doc)]
+    manifest = await get_kb_manifest(collection_name) or {}
+    plan = plan_kb_sync([doc for doc in kb_docs if not is_json_document(doc)], manifest, replace=replace)
+
+    stale_urls = plan["removed"] + [doc["file_url"] for doc in plan["changed"]]
+    points_deleted = await delete_kb_files(collection_name, stale_urls) if stale_urls else 0
+    json_deleted = 0
+    if replace:
+        json_deleted = await delete_kb_json_documents(
+            json_scope, [doc.get("file_url") for doc in kb_docs if isinstance(doc, dict) and doc.get("file_url")]
+        )
+    if plan["rehash"]:
+        await record_kb_files(collection_name, {
+            doc["file_url"]: {
+                **manifest[doc["file_url"]],
+                "content_hash": manifest[doc["file_url"]].get("content_hash") or content_hash(doc.get("content")),
+                "source_hash": doc.get("source_hash") or manifest[doc["file_url"]].get("source_hash", ""),
+                "source_version": doc.get("source_version") or manifest[doc["file_url"]].get("source_version", ""),
+            }
+            for doc in plan["rehash"]
+        })
 
-    # Separate JSON documents from non-JSON documents
-    json_docs = []
-    non_json_docs = []
-    
-    for doc in new_kb_docs:
-        if is_json_document(doc):
-            json_docs.append(doc)
-        else:
-            non_json_docs.append(doc)
-    
-    # Store JSON documents directly without embeddings
+    # Store JSON documents directly without embeddings (placeholders of stored ones are skipped)
     json_count = 0
     for doc in json_docs:
+        if not doc.get("content") and doc.get("file_url") and await json_document_stored(json_scope, doc["file_url"]):
+            continue
         if await store_json_document(doc, is_kb=True, gpt_id=gpt_id, userId=userId):
             json_count += 1
     
     if json_count > 0:
         print(f"[RAG] Stored {json_count} JSON KB documents without embeddings")
     
-    # Process non-JSON documents with embeddings
-    if not non_json_docs:
-        print(f"[RAG] All new KB documents are JSON, skipping embeddings")
-        return
+    non_json_docs = plan["added"] + plan["changed"] + plan["unkeyed"]
+    print(
+        f"[RAG] KB sync for gpt_id={gpt_id}: {len(plan['added'])} added, {len(plan['changed'])} changed, "
+        f"{len(plan['removed'])} removed, {len(plan['unchanged'])} unchanged"
+    )
+    points = await _embed_kb_documents(non_json_docs, collection_name, cache_key, is_hybrid) if non_json_docs else []
 
+    report = build_sync_report(
+        collection_name, plan, start,
+        points_added=len(points), points_deleted=points_deleted,
+        json_stored=json_count, json_deleted=json_deleted,
+    )
+    await record_sync_report(collection_name, report)
+    return report
+
+async def _embed_kb_documents(non_json_docs: List[Any], collection_name: str, cache_key: str, is_hybrid: bool) -> list:
+    """Chunk, embed and store KB documents, then record them in the manifest."""
     kb_texts = []
     kb_metadatas = []
+    kb_blocks = []
     for doc in non_json_docs:
+        kb_blocks.append(doc.get("blocks") if isinstance(doc, dict) else None)
         if isinstance(doc, dict) and "content" in doc:
             kb_texts.append(doc["content"])
             kb_metadatas.append({
@@ -431,27 +699,48 @@ async def preprocess_kb_documents(kb_docs: List[dict], gpt_id: str, userId: str,
             kb_texts.append(str(doc))
             kb_metadatas.append({})
 
-    await retreive_docs(
+    points = await retreive_docs(
         kb_texts, 
         collection_name, 
         is_hybrid=is_hybrid, 
         clear_existing=False, 
         is_kb=True, 
         session_id=None, 
-        metadatas=kb_metadatas
+        metadatas=kb_metadatas,
+        blocks=kb_blocks
     )
     
+    chunk_counts: Dict[str, int] = {}
+    for point in points or []:
+        file_url = (point.payload or {}).get("file_url")
+        if file_url:
+            chunk_counts[file_url] = chunk_counts.get(file_url, 0) + 1
+    await record_kb_files(collection_name, {
+        doc["file_url"]: {
+            "content_hash": content_hash(doc.get("content")),
+            "source_hash": doc.get("source_hash", ""),
+            "source_version": doc.get("source_version", ""),
+            "chunk_count": chunk_counts.get(doc["file_url"], 0),
+            "filename": doc.get("filename"),
+        }
+        for doc in non_json_docs
+        if isinstance(doc, dict) and doc.get("file_url")
+    })
+    
     redis_client = await ensure_redis_client()
     if redis_client:
-        await redis_client.hset(cache_key, mapping={
-            "collection_name": collection_name,
-            "is_hybrid": str(is_hybrid),
-            "processed_at": str(asyncio.get_event_loop().time()),
-            "document_count": len(kb_texts)
-        })
-        await redis_client.expire(cache_key, 86400)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(cache_key, mapping={
+                "collection_name": collection_name,
+                "is_hybrid": str(is_hybrid),
+                "processed_at": str(asyncio.get_event_loop().time()),
+                "document_count": len(kb_texts)
+            })
+            pipe.expire(cache_key, 86400)
+            await pipe.execute()
     
-    print(f"[RAG] Pre-processed and cached {len(kb_texts)} new KB documents (non-JSON) for gpt_id={gpt_id}, userId={userId}")
+    print(f"[RAG] Pre-processed and cached {len(kb_texts)} new KB documents (non-JSON) in {collection_name}")
+    return points or []
 
 async def preprocess_user_documents(docs: List[dict], session_id: str, is_hybrid: bool = False, is_new_upload: bool = False):
     """
@@ -508,10 +797,10 @@ async def preprocess_user_documents(docs: List[dict], session_id: str, is_hybrid
     if not non_json_docs:
         print(f"[RAG] All new user documents are JSON, skipping embeddings")
         # Still store document order for JSON docs
-        if redis_client:
-            for doc in json_docs:
-                if isinstance(doc, dict) and doc.get("id"):
-                    await redis_client.rpush(order_key, doc.get("id"))
+        json_doc_ids = [doc.get("id") for doc in json_docs if isinstance(doc, dict) and doc.get("id")]
+        if redis_client and json_doc_ids:
+            await redis_client.rpush(order_key, *json_doc_ids)
+        await bump_doc_generation(session_id)
         return
 
     doc_texts = []
@@ -542,24 +831,28 @@ async def preprocess_user_documents(docs: List[dict], session_id: str, is_hybrid
         is_user_doc=True,
         session_id=session_id,
         metadatas=doc_metas,
+        blocks=[doc.get("blocks") if isinstance(doc, dict) else None for doc in non_json_docs],
     )
 
     # Store document order in Redis (similar to images) - include both JSON and non-JSON
     if redis_client:
-        for doc in docs:
-            if isinstance(doc, dict) and doc.get("id"):
-                await redis_client.rpush(order_key, doc.get("id"))
-        
+        doc_ids = [doc.get("id") for doc in docs if isinstance(doc, dict) and doc.get("id")]
         expires_at = time.time() + USER_DOC_TTL_SECONDS
-        await redis_client.hset(cache_key, mapping={
-            "collection_name": collection_name,
-            "is_hybrid": str(is_hybrid),
-            "processed_at": str(asyncio.get_event_loop().time()),
-            "document_count": len(doc_texts) + current_doc_index,
-            "expires_at": str(expires_at)
-        })
-        await redis_client.expire(cache_key, USER_DOC_TTL_SECONDS)
-        await redis_client.expire(order_key, USER_DOC_TTL_SECONDS)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if doc_ids:
+                pipe.rpush(order_key, *doc_ids)
+            pipe.hset(cache_key, mapping={
+                "collection_name": collection_name,
+                "is_hybrid": str(is_hybrid),
+                "processed_at": str(asyncio.get_event_loop().time()),
+                "document_count": len(doc_texts) + current_doc_index,
+                "expires_at": str(expires_at)
+            })
+            pipe.expire(cache_key, USER_DOC_TTL_SECONDS)
+            pipe.expire(order_key, USER_DOC_TTL_SECONDS)
+            await pipe.execute()
+        await track_session_resources(session_id, redis_keys=[cache_key, order_key])
+    await bump_doc_generation(session_id)
     
     print(f"[RAG] Pre-processed and cached {len(doc_texts)} NEW user documents (non-JSON) for session {session_id} (total documents in session: {len(doc_texts) + current_doc_index})")
 
@@ -574,13 +867,18 @@ async def preprocess_images(uploaded_images: List[Dict[str, Any]], state: GraphS
     session_id = state.get("session_id")
     session_cache_key = f"image_cache:{session_id}"
     order_key = f"image_order:{session_id}"
+    images_added = 0
+    # One HMGET tells which images were already analysed
+    filenames = [image_data.get("filename") for image_data in uploaded_images if image_data.get("filename")]
+    analyses = await redis_client.hmget(session_cache_key, filenames) if filenames else []
+    already_processed = {name for name, analysis in zip(filenames, analyses) if analysis is not None}
 
     for image_data in uploaded_images:
         filename = image_data.get("filename", "")
         if not filename:
             continue
 
-        if await redis_client.hexists(session_cache_key, filename):
+        if filename in already_processed:
             print(f"[ImagePreprocessor] Image '{filename}' already processed for session {session_id}.")
             continue
 
@@ -607,9 +905,12 @@ async def preprocess_images(uploaded_images: List[Dict[str, Any]], state: GraphS
         await send_status_update(state, f"🖼️ Analyzing image: {filename}...", progress=None)
         
         analysis = await extract_text_from_image(file_content, filename, state)
-        await redis_client.hset(session_cache_key, filename, analysis)
-        await redis_client.rpush(order_key, filename)
-        image_index = await redis_client.llen(order_key)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(session_cache_key, filename, analysis)
+            pipe.rpush(order_key, filename)
+            _, image_index = await pipe.execute()
+        already_processed.add(filename)
+        images_added += 1
 
         print(f"[ImagePreprocessor] Cached analysis for '{filename}' in session {session_id}")
         try:
@@ -673,25 +974,35 @@ async def preprocess_images(uploaded_images: List[Dict[str, Any]], state: GraphS
                 "size": image_data.get("size", 0),
                 "image_index": image_index,  
                 "source": "image",
+                "chunk_index": 0,
             }
+            point = models.PointStruct(
+                id=str(uuid.uuid4()),
+                vector=embs[0],
+                payload=payload,
+            )
             await asyncio.to_thread(
                 QDRANT_CLIENT.upsert,
                 collection_name=collection_name,
-                points=[
-                    models.PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector=embs[0],
-                        payload=payload,
-                    )
-                ],
+                points=[point],
+            )
+            await register_chunks(collection_name, [point], ttl=USER_DOC_TTL_SECONDS, id_field="id", index_field="image_index")
+            await track_session_resources(
+                session_id,
+                collections=[collection_name],
+                redis_keys=[session_cache_key, order_key]
             )
             print(f"[ImagePreprocessor] Upserted image analysis embedding for {filename} (index {image_index})")
         except Exception as e:
             print(f"[ImagePreprocessor] Failed to embed/upsert image analysis for {filename}: {e}")
 
     if redis_client and uploaded_images:
-        await redis_client.expire(session_cache_key, 86400) 
-        await redis_client.expire(order_key, 86400) 
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.expire(session_cache_key, 86400)
+            pipe.expire(order_key, 86400)
+            await pipe.execute()
+    if images_added:
+        await bump_doc_generation(session_id)
     if "uploaded_images" in state:
         state["uploaded_images"] = []
 
@@ -708,16 +1019,25 @@ async def send_status_update(state: GraphState, message: str, progress: int = No
                 "progress": progress
             }
         })
-async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clear_existing: bool = False, is_kb: bool = False, is_user_doc: bool = False, session_id: str = "default", metadatas: Optional[List[Dict[str, Any]]] = None):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    if metadatas and len(metadatas) == len(doc):
-        chunked_docs = text_splitter.create_documents(doc, metadatas=metadatas)
-    else:
-        chunked_docs = text_splitter.create_documents(doc)
+async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clear_existing: bool = False, is_kb: bool = False, is_user_doc: bool = False, session_id: str = "default", metadatas: Optional[List[Dict[str, Any]]] = None, blocks: Optional[List[Optional[List[Dict[str, Any]]]]] = None):
+    if not metadatas or len(metadatas) != len(doc):
+        metadatas = [{} for _ in doc]
+    if not blocks or len(blocks) != len(doc):
+        blocks = [None] * len(doc)
+    # Structure-aware, token-sized chunks with page ranges and heading paths
+    chunked_docs = []
+    for text, metadata, doc_blocks in zip(doc, metadatas, blocks):
+        for chunk in await asyncio.to_thread(chunk_document, text, doc_blocks):
+            chunk_meta = {k: v for k, v in chunk.items() if k != "text"}
+            chunked_docs.append(Document(page_content=chunk["text"], metadata={**metadata, **chunk_meta}))
     chunk_texts = [doc.page_content for doc in chunked_docs]
     from api_keys_util import get_api_keys_from_session
     api_keys = await get_api_keys_from_session(session_id) if session_id and session_id != "default" else {}
-    embeddings = await embed_chunks_parallel(chunk_texts, batch_size=200, api_keys=api_keys)
+    if clear_existing:
+        await clear_near_dup_index(name)
+    # Near-duplicates of earlier chunks (this upload or already stored) are not embedded
+    links, signatures = await find_near_duplicates(name, chunk_texts)
+    embeddings = await _embed_with_near_duplicates(name, chunk_texts, links, api_keys)
     
     collections_response = await asyncio.to_thread(QDRANT_CLIENT.get_collections)
     collections = [c.name for c in collections_response.collections]
@@ -725,13 +1045,18 @@ async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clea
     if clear_existing and name in collections:
         print(f"[RAG] Clearing existing collection: {name}")
         await asyncio.to_thread(QDRANT_CLIENT.delete_collection, collection_name=name)
+        await clear_bm25_index(name)
+        forget_collection(name)
+        forget_local_vectors(name)
         collections.remove(name)  
     
     if name not in collections:
+        forget_collection(name)
         await asyncio.to_thread(
             QDRANT_CLIENT.recreate_collection,
             collection_name=name,
             vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE, on_disk=True),
+            sparse_vectors_config=sparse_vectors_config() if is_hybrid and SPARSE_HYBRID_ENABLED else None,
         )
         await asyncio.to_thread(
             QDRANT_CLIENT.create_payload_index,
@@ -802,20 +1127,38 @@ async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clea
             if "already exists" not in str(e).lower():
                 print(f"[RAG] Note: Could not create index for 'file_url': {e}")
     
-    async def extract_heading(txt):
-        lines = txt.split("\n")
-        for l in lines:
-            l = l.strip()
-            if re.match(r"^(UNIT[\s–-]*[IVXLC0-9]+|CHAPTER[\s–-]*\d+|^\d+(\.\d+)+|[A-Z][A-Za-z\s]{4,})", l):
-                return re.sub(r"^[\d.:\s–-]+", "", l).strip(":–- ")
-        return None
+    # Collections created with the named sparse vector also get BM25 term weights per point
+    use_sparse = is_hybrid and await has_sparse_vectors(name)
     points = []
+    source_chunk_counts: Dict[str, int] = {}
+    source_ordinals: Dict[str, int] = {}
+    point_ids: List[Optional[str]] = [None] * len(chunked_docs)
+    canonical_chunks = []
+    duplicate_links: Dict[str, str] = {}
     for i, (d, embedding) in enumerate(zip(chunked_docs, embeddings)):
+        source = chunk_source_key(d.metadata)
+        ordinal = source_ordinals.get(source, 0)
+        source_ordinals[source] = ordinal + 1
+        link = links[i]
+        canonical_id = None
+        if link is not None:
+            canonical_id = point_ids[link[1]] if link[0] == "batch" else link[1]
+            # Only duplicates within one source are dropped: they share its lifetime
+            if NEAR_DUP_MODE == "skip" and link[0] == "batch" and chunk_source_key(chunked_docs[link[1]].metadata) == source:
+                duplicate_links[f"{source}#{ordinal}"] = canonical_id
+                continue
+        # chunk_index is per source document so the chunk registry can address neighbours
+        chunk_index = source_chunk_counts.get(source, 0)
+        source_chunk_counts[source] = chunk_index + 1
+        heading_path = d.metadata.get("heading_path") or []
         payload = {
             "text": d.page_content,
-            "page": d.metadata.get("page", 0),
-            "chunk_index": i,
-            "heading": await extract_heading(d.page_content),
+            "page": d.metadata.get("page_start") or 0,
+            "page_end": d.metadata.get("page_end") or 0,
+            "chunk_index": chunk_index,
+            "heading": heading_path[-1] if heading_path else None,
+            "heading_path": heading_path,
+            "token_count": d.metadata.get("token_count"),
             "doc_id": d.metadata.get("doc_id"),
             "filename": d.metadata.get("filename"),
             "file_type": d.metadata.get("file_type"),
@@ -824,10 +1167,17 @@ async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clea
             payload["file_url"] = d.metadata.get("file_url", "")
         if is_user_doc and d.metadata.get("doc_index"):
             payload["doc_index"] = d.metadata.get("doc_index")
+        point_id = str(uuid.uuid4())
+        point_ids[i] = point_id
+        if canonical_id is not None:
+            payload["canonical_id"] = canonical_id
+            duplicate_links[point_id] = canonical_id
+        elif signatures[i] is not None:
+            canonical_chunks.append((point_id, signatures[i]))
         points.append(
             models.PointStruct(
-                id=str(uuid.uuid4()),
-                vector=embedding,
+                id=point_id,
+                vector=point_vector(embedding, tokenize(d.page_content)) if use_sparse else embedding,
                 payload=payload,
             )
         )
@@ -839,30 +1189,123 @@ async def retreive_docs(doc: List[str], name: str, is_hybrid: bool = False, clea
             collection_name=name,
             points=batch
         )
+    await register_chunks(name, points, ttl=USER_DOC_TTL_SECONDS if is_user_doc else None)
+    near_dup_report = build_near_dup_report(name, links, [d.metadata.get("token_count") or 0 for d in chunked_docs])
+    await record_canonical(
+        name, canonical_chunks, duplicate_links, near_dup_report, ttl=USER_DOC_TTL_SECONDS if is_user_doc else None
+    )
+    if near_dup_report["chunks"] > near_dup_report["unique"]:
+        print(f"[NEAR-DUP] {near_dup_report}")
+    if is_user_doc:
+        await track_session_resources(
+            session_id,
+            collections=[name],
+            redis_keys=[summary_tree_key(name)] + list(near_dup_keys(name).values())
+            + (list(bm25_keys(name).values()) if is_hybrid else [])
+        )
+    if is_user_doc or (is_kb and SUMMARY_TREE_FOR_KB):
+        schedule_summary_tree_build(
+            name,
+            [p.payload for p in points],
+            api_keys=api_keys,
+            ttl=USER_DOC_TTL_SECONDS if is_user_doc else None
+        )
     if is_hybrid:
-        tokenized_docs = [tokenize(doc.page_content) for doc in chunked_docs]
-        bm25 = await asyncio.to_thread(BM25Okapi, tokenized_docs)
-        redis_client_binary = await ensure_redis_client_binary()
-        if redis_client_binary:
-            try:
-                serialized_bm25 = dill.dumps({
-                    "bm25": bm25,
-                    "docs": {str(i): doc.page_content for i, doc in enumerate(chunked_docs)},
-                    "tokens": tokenized_docs
-                })
-                redis_key = f"bm25_index:{name}"
-                await redis_client_binary.set(redis_key, serialized_bm25)
-                await redis_client_binary.expire(redis_key, 86400)
-                print(f"[RAG] Stored BM25 index in Redis for {name}")
-            except Exception as e:
-                print(f"[RAG] ERROR: Failed to serialize and store BM25 index in Redis: {e}")
-    
-        print(f"[RAG] Stored {len(chunked_docs)} chunks in {name} (Vector + BM25)")
+        # Append to the collection's inverted index; re-ingested sources replace their old postings
+        await index_bm25_chunks(
+            name,
+            [(p.id, chunk_source_key(p.payload), tokenize(p.payload["text"])) for p in points],
+            ttl=USER_DOC_TTL_SECONDS if is_user_doc else None
+        )
+        print(f"[RAG] Stored {len(points)} chunks in {name} (Vector + BM25)")
+    else:
+        print(f"[RAG] Stored {len(points)} chunks in {name} (Vector only)")
+    return points
+async def _embed_with_near_duplicates(collection_name: str, texts: List[str], links: List[Any], api_keys: dict = None) -> List[Optional[List[float]]]:
+    """
+    Embed only chunks without a near-duplicate link; duplicates reuse their
+    canonical chunk's vector (skip mode only drops duplicates within one source
+    later, so the others are stored). Links to points that no longer exist are
+    dropped (links[i] set to None) and those chunks are embedded as well.
+    """
+    existing_ids = list(dict.fromkeys(link[1] for link in links if link and link[0] == "point"))
+    if existing_ids:
+        try:
+            found = await asyncio.to_thread(
+                QDRANT_CLIENT.retrieve,
+                collection_name=collection_name,
+                ids=existing_ids,
+                with_payload=False,
+                with_vectors=True,
+            )
+            canonical_vectors = {str(p.id): dense_vector(p.vector) for p in found}
+        except Exception as e:
+            print(f"[NEAR-DUP] Could not fetch canonical chunks of {collection_name}: {e}")
+            canonical_vectors = {}
+        for i, link in enumerate(links):
+            if link and link[0] == "point" and canonical_vectors.get(link[1]) is None:
+                links[i] = None
     else:
-        print(f"[RAG] Stored {len(chunked_docs)} chunks in {name} (Vector only)")
+        canonical_vectors = {}
+
+    unique = [i for i, link in enumerate(links) if link is None]
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    for i, embedding in zip(unique, await embed_chunks_parallel([texts[i] for i in unique], batch_size=200, api_keys=api_keys)):
+        embeddings[i] = embedding
+    for i, link in enumerate(links):
+        if link:
+            embeddings[i] = embeddings[link[1]] if link[0] == "batch" else canonical_vectors[link[1]]
+    return embeddings
+
 def tokenize(text: str):
     tokens = re.findall(r"\w+", text.lower())
     return [t for t in tokens if t not in ENGLISH_STOP_WORDS]
+
+async def _fetch_registered_chunks(collection_name: str) -> List[Dict[str, Any]]:
+    """
+    Ordered chunk payloads of a collection, resolved through the chunk registry
+    (source order, then chunk_index) with direct point lookups instead of a scroll.
+    Returns [] when the collection has no registry entries.
+    """
+    sources = await get_chunk_sources(collection_name)
+    if not sources:
+        return []
+    id_lists = await get_point_ids_for_sources(collection_name, list(sources.keys()))
+    ordered_ids = [pid for source in sources for pid in id_lists.get(source, [])]
+    payloads: List[Dict[str, Any]] = []
+    for i in range(0, len(ordered_ids), 1000):
+        batch_ids = ordered_ids[i:i + 1000]
+        records = await asyncio.to_thread(
+            QDRANT_CLIENT.retrieve,
+            collection_name=collection_name,
+            ids=batch_ids,
+            with_payload=True,
+            with_vectors=False
+        )
+        by_id = {str(r.id): r.payload or {} for r in records}
+        payloads.extend(by_id[pid] for pid in batch_ids if "text" in by_id.get(pid, {}))
+    return payloads
+
+async def _get_index_to_id_map(collection_name: str, id_field: str = "doc_id", index_field: str = "doc_index") -> Dict[int, str]:
+    """
+    Map 1-based document/image indices to ids. Uses the chunk registry and only
+    falls back to scrolling Qdrant for collections ingested before the registry.
+    """
+    index_to_id_map = await get_doc_index_map(collection_name)
+    if index_to_id_map:
+        return index_to_id_map
+    scroll_out, _ = await asyncio.to_thread(
+        QDRANT_CLIENT.scroll,
+        collection_name=collection_name,
+        limit=1000
+    )
+    for point in scroll_out:
+        payload = point.payload or {}
+        item_id = payload.get(id_field)
+        item_index = payload.get(index_field)
+        if item_id and item_index:
+            index_to_id_map[item_index] = item_id
+    return index_to_id_map
 async def _search_collection(collection_name: str, query: str, limit: int, api_keys: dict = None) -> List[str]:
     """
     Helper function to perform a semantic search on a Qdrant collection and return the text of the top results.
@@ -880,11 +1323,10 @@ async def _search_collection(collection_name: str, query: str, limit: int, api_k
     try:
         query_embedding = await embed_query(query, api_keys=api_keys)
         
-        search_results = await asyncio.to_thread(
-            QDRANT_CLIENT.search,
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            limit=limit
+        search_results = await dense_search(collection_name, query_embedding, candidate_pool_size(limit), with_vectors=MMR_ENABLED)
+        # Diverse top results instead of neighbouring chunks with the same content
+        search_results = mmr_rerank(
+            query_embedding, search_results, [p.vector for p in search_results], limit, tag="SEARCH"
         )
         result = [result.payload["text"] for result in search_results]
         
@@ -1001,7 +1443,79 @@ async def _search_image_collection(
     
     return blocks
 
-async def _hybrid_search_rrf(collection_name: str, query: str, limit: int, k: int = 60, api_keys: dict = None) -> List[str]:
+async def _load_bm25_data(collection_name: str, tag: str = "HYBRID") -> Optional[Dict[str, Any]]:
+    """
+    Load the pickled BM25 index of a collection. Session document indexes are kept
+    deserialized in-process for as long as the session's document generation holds.
+    """
+    session_id = None
+    if collection_name.startswith("user_docs_"):
+        session_id = collection_name[len("user_docs_"):]
+        generation = await get_doc_generation(session_id)
+        cached = get_cached_doc_state(session_id, "bm25", generation)
+        if cached is not None:
+            print(f"[{tag}] Reusing BM25 index for {collection_name} (generation {generation})")
+            return cached
+
+    redis_client_binary = await ensure_redis_client_binary()
+    if not redis_client_binary:
+        return None
+    try:
+        serialized_data = await redis_client_binary.get(f"bm25_index:{collection_name}")
+        if not serialized_data:
+            return None
+        bm25_data = dill.loads(serialized_data)
+        print(f"[{tag}] Loaded BM25 index from Redis for {collection_name}")
+    except Exception as e:
+        print(f"[{tag}] ERROR: Failed to load BM25 index from Redis: {e}")
+        return None
+    if session_id:
+        set_cached_doc_state(session_id, "bm25", generation, bm25_data)
+    return bm25_data
+
+
+async def _bm25_rank(collection_name: str, query: str, limit: int, tag: str = "HYBRID", vectors: Optional[Dict[str, Any]] = None) -> Optional[Tuple[List[Tuple[str, float]], float]]:
+    """
+    Top BM25 matches of a collection as ([(text, score)] best first, mean score
+    over all chunks). Uses the incremental inverted index and falls back to a
+    legacy pickled index; None when the collection has neither.
+    If `vectors` is given, the matches' dense vectors are added to it by text.
+    """
+    tokenized_query = tokenize(query)
+    try:
+        result = await bm25_search(collection_name, tokenized_query, limit)
+    except Exception as e:
+        print(f"[{tag}] ERROR: BM25 search failed for {collection_name}: {e}")
+        result = None
+    if result is not None:
+        ranked, mean_score = result
+        if not ranked:
+            return [], mean_score
+        points = await asyncio.to_thread(
+            QDRANT_CLIENT.retrieve,
+            collection_name=collection_name,
+            ids=[pid for pid, _ in ranked],
+            with_payload=["text"],
+            with_vectors=vectors is not None,
+        )
+        texts = {str(p.id): (p.payload or {}).get("text", "") for p in points}
+        if vectors is not None:
+            for p in points:
+                vectors.setdefault(texts[str(p.id)], dense_vector(p.vector))
+        return [(texts[pid], score) for pid, score in ranked if texts.get(pid)], mean_score
+
+    bm25_data = await _load_bm25_data(collection_name, tag=tag)
+    if not bm25_data:
+        return None
+    docs = bm25_data["docs"]
+    bm25_scores = await _bm25_scores(bm25_data["bm25"], tokenized_query)
+    if len(bm25_scores) == 0:
+        return [], 0.0
+    order = sorted(range(len(bm25_scores)), key=lambda i: bm25_scores[i], reverse=True)[:limit]
+    return [(docs[str(i)], float(bm25_scores[i])) for i in order], float(sum(bm25_scores) / len(bm25_scores))
+
+
+async def _hybrid_search_rrf(collection_name: str, query: str, limit: int, k: int = 60, api_keys: dict = None, server_side: Optional[bool] = None) -> List[str]:
     """
     Hybrid RAG with RRF: Combines vector search (semantic) and BM25 (keyword) using RRF.
     
@@ -1021,6 +1535,8 @@ async def _hybrid_search_rrf(collection_name: str, query: str, limit: int, k: in
         query: Search query
         limit: Number of final results to return
         k: RRF constant (default 60, recommended in literature)
+        server_side: Fuse in Qdrant (Query API, one round trip) when the collection
+            has the sparse vector; None = whenever possible, False = always client-side
     
     Returns:
         List of top documents based on RRF fusion
@@ -1037,49 +1553,49 @@ async def _hybrid_search_rrf(collection_name: str, query: str, limit: int, k: in
     
     try:
         query_embedding = await embed_query(query, api_keys=api_keys)
-        vector_results = await asyncio.to_thread(
-            QDRANT_CLIENT.search,
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            limit=limit * 3
-        )
-        vector_ranking = [result.payload["text"] for result in vector_results]
-
-        bm25_data = None
-        redis_client_binary = await ensure_redis_client_binary()
-        if redis_client_binary:
+        if server_side is not False and await has_sparse_vectors(collection_name):
             try:
-                serialized_data = await redis_client_binary.get(f"bm25_index:{collection_name}")
-                if serialized_data:
-                    bm25_data = dill.loads(serialized_data)
-                    print(f"[HYBRID-RRF] Loaded BM25 index from Redis for {collection_name}")
+                # Same pool size and MMR stage as the client-side path below
+                points = await server_hybrid_search(
+                    collection_name, query_embedding, tokenize(query), candidate_pool_size(limit),
+                    prefetch_limit=limit * 3, with_vectors=MMR_ENABLED,
+                )
+                pool = [p.payload["text"] for p in points]
+                top_results = mmr_rerank(
+                    None, pool, [p.vector for p in points], limit,
+                    relevance=rank_relevance(len(pool)), tag="HYBRID-RRF"
+                )
+                print(f"[HYBRID-RRF] Server-side fusion (dense + sparse) → {len(top_results)} results")
+                return top_results
             except Exception as e:
-                print(f"[HYBRID-RRF] ERROR: Failed to load BM25 index from Redis: {e}")
+                print(f"[HYBRID-RRF] Server-side fusion failed, using client-side RRF: {e}")
+        vector_results = await dense_search(collection_name, query_embedding, limit * 3, with_vectors=MMR_ENABLED)
+        vector_ranking = [result.payload["text"] for result in vector_results]
+        text_vectors = {result.payload["text"]: result.vector for result in vector_results} if MMR_ENABLED else None
 
-        if not bm25_data:
+        bm25_result = await _bm25_rank(collection_name, query, limit * 3, tag="HYBRID-RRF", vectors=text_vectors)
+
+        if bm25_result is None:
             print(f"[HYBRID-RRF] No BM25 index for {collection_name}, falling back to vector only")
-            return vector_ranking[:limit]
-        
-        bm25 = bm25_data["bm25"]
-        docs = bm25_data["docs"]
-        
-        tokenized_query = tokenize(query)
-        bm25_scores = await _bm25_scores(bm25, tokenized_query)
-        scored_docs = [(score, docs[str(idx)]) for idx, score in enumerate(bm25_scores)]
+            return mmr_rerank(query_embedding, vector_ranking, [r.vector for r in vector_results], limit, tag="HYBRID-RRF")
 
-       
-        if len(bm25_scores) > 0:
-            max_score = max(bm25_scores)
-            mean_score = sum(bm25_scores) / len(bm25_scores)
+        scored_docs, mean_score = bm25_result
+        if scored_docs:
+            max_score = scored_docs[0][1]
             bm25_threshold = max(max_score * 0.2, mean_score * 0.5, 0.1)
         else:
             bm25_threshold = 0.1
-        bm25_ranking = [doc for score, doc in scored_docs if score > bm25_threshold]
+        bm25_ranking = [doc for doc, score in scored_docs if score > bm25_threshold]
 
         bm25_ranking = bm25_ranking[:limit * 3]
         
         fused_ranking = await _reciprocal_rank_fusion([vector_ranking[:limit*3], bm25_ranking[:limit*3]], k=k)
-        top_results = fused_ranking[:limit]
+        # MMR over the fused pool, with relevance following the fused order
+        pool = fused_ranking[:candidate_pool_size(limit)]
+        top_results = mmr_rerank(
+            None, pool, [(text_vectors or {}).get(t) for t in pool], limit,
+            relevance=rank_relevance(len(pool)), tag="HYBRID-RRF"
+        )
         
         print(f"[HYBRID-RRF] Fused {len(vector_ranking)} vector + {len(bm25_ranking)} BM25 → {len(top_results)} results (k={k})")
         return top_results
@@ -1107,45 +1623,31 @@ async def _hybrid_search_intersection(collection_name: str, query: str, limit: i
     
     try:
         query_embedding = await embed_query(query, api_keys=api_keys)
-        vector_results = await asyncio.to_thread(
-            QDRANT_CLIENT.search,
-            collection_name=collection_name,
-            query_vector=query_embedding,
-            limit=limit * 5
-        )
+        vector_results = await dense_search(collection_name, query_embedding, limit * 5, with_vectors=MMR_ENABLED)
         vector_docs = {result.payload["text"] for result in vector_results}
+        text_vectors = {result.payload["text"]: result.vector for result in vector_results} if MMR_ENABLED else None
 
-        bm25_data = None
-        redis_client_binary = await ensure_redis_client_binary()
-        if redis_client_binary:
-            try:
-                serialized_data = await redis_client_binary.get(f"bm25_index:{collection_name}")
-                if serialized_data:
-                    bm25_data = dill.loads(serialized_data)
-                    print(f"[HYBRID-INTERSECTION] Loaded BM25 index from Redis for {collection_name}")
-            except Exception as e:
-                print(f"[HYBRID-INTERSECTION] ERROR: Failed to load BM25 index from Redis: {e}")
-
+        bm25_result = await _bm25_rank(collection_name, query, limit * 5, tag="HYBRID-INTERSECTION", vectors=text_vectors)
 
-        if not bm25_data:
+        if bm25_result is None:
             print(f"[HYBRID-INTERSECTION] No BM25 index for {collection_name}, falling back to vector only")
-            return list(vector_docs)[:limit]
+            vector_ranking = [result.payload["text"] for result in vector_results]
+            return mmr_rerank(query_embedding, vector_ranking, [r.vector for r in vector_results], limit, tag="HYBRID-INTERSECTION")
 
-        bm25 = bm25_data["bm25"]
-        docs = bm25_data["docs"]
-
-        tokenized_query = tokenize(query)
-        bm25_scores = await _bm25_scores(bm25, tokenized_query)
-        bm25_ranked = [docs[str(idx)] for idx in sorted(
-            range(len(bm25_scores)), key=lambda x: bm25_scores[x], reverse=True
-        )[:limit * 5]]
+        bm25_ranked = [doc for doc, _ in bm25_result[0]]
         bm25_docs = set(bm25_ranked)
         common_docs = list(vector_docs.intersection(bm25_docs))
         if len(common_docs) < limit:
             print(f"[HYBRID-INTERSECTION] Too few common docs, falling back to union")
             common_docs = list(vector_docs.union(bm25_docs))
 
-        top_results = common_docs[:limit]
+        if MMR_ENABLED:
+            top_results = mmr_rerank(
+                query_embedding, common_docs, [text_vectors.get(t) for t in common_docs], limit,
+                tag="HYBRID-INTERSECTION"
+            )
+        else:
+            top_results = common_docs[:limit]
         print(f"[HYBRID-INTERSECTION] Found {len(top_results)} common results")
         return top_results
     except Exception as e:
@@ -1307,19 +1809,29 @@ async def intelligent_image_selection(
     all_images_info = []
     try:
         collection_name = f"user_images_{session_id}"
-        scroll_out, _ = await asyncio.to_thread(
-            QDRANT_CLIENT.scroll,
-            collection_name=collection_name,
-            limit=1000
-        )
-        for point in scroll_out:
-            payload = point.payload or {}
-            all_images_info.append({
-                "id": payload.get("id", ""),
-                "filename": payload.get("filename", "unknown"),
-                "image_index": payload.get("image_index", 0),
-                "is_newly_uploaded": payload.get("id") in new_image_ids if new_image_ids else False
-            })
+        registered_images = await get_chunk_sources(collection_name)
+        if registered_images:
+            for meta in registered_images.values():
+                all_images_info.append({
+                    "id": meta.get("doc_id") or "",
+                    "filename": meta.get("filename") or "unknown",
+                    "image_index": meta.get("doc_index") or 0,
+                    "is_newly_uploaded": meta.get("doc_id") in new_image_ids if new_image_ids else False
+                })
+        else:
+            scroll_out, _ = await asyncio.to_thread(
+                QDRANT_CLIENT.scroll,
+                collection_name=collection_name,
+                limit=1000
+            )
+            for point in scroll_out:
+                payload = point.payload or {}
+                all_images_info.append({
+                    "id": payload.get("id", ""),
+                    "filename": payload.get("filename", "unknown"),
+                    "image_index": payload.get("image_index", 0),
+                    "is_newly_uploaded": payload.get("id") in new_image_ids if new_image_ids else False
+                })
         all_images_info.sort(key=lambda x: x.get("image_index", 0))
     except Exception as e:
         print(f"[IMAGE-ORCHESTRATOR] Error getting all images from Qdrant: {e}")
@@ -1576,25 +2088,38 @@ async def intelligent_document_selection(
     all_docs_info = []
     try:
         collection_name = f"user_docs_{session_id}"
-        scroll_out, _ = await asyncio.to_thread(
-            QDRANT_CLIENT.scroll,
-            collection_name=collection_name,
-            limit=1000
-        )
-        # Get unique documents by doc_id
-        seen_doc_ids = set()
-        for point in scroll_out:
-            payload = point.payload or {}
-            doc_id = payload.get("doc_id")
-            if doc_id and doc_id not in seen_doc_ids:
-                seen_doc_ids.add(doc_id)
-                all_docs_info.append({
-                    "id": doc_id,
-                    "filename": payload.get("filename", "unknown"),
-                    "doc_index": payload.get("doc_index", 0),
-                    "file_type": payload.get("file_type", "unknown"),
-                    "is_newly_uploaded": doc_id in new_doc_ids if new_doc_ids else False
-                })
+        registered_docs = await get_chunk_sources(collection_name)
+        if registered_docs:
+            for meta in registered_docs.values():
+                doc_id = meta.get("doc_id")
+                if doc_id:
+                    all_docs_info.append({
+                        "id": doc_id,
+                        "filename": meta.get("filename") or "unknown",
+                        "doc_index": meta.get("doc_index") or 0,
+                        "file_type": meta.get("file_type") or "unknown",
+                        "is_newly_uploaded": doc_id in new_doc_ids if new_doc_ids else False
+                    })
+        else:
+            scroll_out, _ = await asyncio.to_thread(
+                QDRANT_CLIENT.scroll,
+                collection_name=collection_name,
+                limit=1000
+            )
+            # Get unique documents by doc_id
+            seen_doc_ids = set()
+            for point in scroll_out:
+                payload = point.payload or {}
+                doc_id = payload.get("doc_id")
+                if doc_id and doc_id not in seen_doc_ids:
+                    seen_doc_ids.add(doc_id)
+                    all_docs_info.append({
+                        "id": doc_id,
+                        "filename": payload.get("filename", "unknown"),
+                        "doc_index": payload.get("doc_index", 0),
+                        "file_type": payload.get("file_type", "unknown"),
+                        "is_newly_uploaded": doc_id in new_doc_ids if new_doc_ids else False
+                    })
         all_docs_info.sort(key=lambda x: x.get("doc_index", 0))
     except Exception as e:
         print(f"[DOC-ORCHESTRATOR] Error getting all documents from Qdrant: {e}")
@@ -1604,7 +2129,7 @@ async def intelligent_document_selection(
     try:
         redis_client = await ensure_redis_client()
         if redis_client:
-            json_keys = await redis_client.keys(f"user_json:{session_id}:*")
+            json_keys = await _get_session_json_keys(session_id)
             if json_keys:
                 # Extract doc info from Redis keys: user_json:{session_id}:{file_url_or_id}
                 max_doc_index = max([doc.get("doc_index", 0) for doc in all_docs_info]) if all_docs_info else 0
@@ -1950,227 +2475,65 @@ async def extract_text_from_image(file_content: bytes, filename: str = "", state
     
 
 
-async def hierarchical_summarize(state, batch_size: int = 10):
-    """
-    🧠 Hierarchical Summarizer for Custom GPTs
-    ------------------------------------------
-    - Auto-adapts between Brief / Normal / Hierarchical modes.
-    - Fully async (map–reduce summarization with recursion).
-    - Honors Custom GPT instructions (from gpt_config["instruction"]).
-    - Streams output progressively through callbacks.
-    """
-
-    session_id = state.get("session_id")
-    redis_client = await ensure_redis_client()
-    cache = await redis_client.hgetall(f"user_doc_cache:{session_id}")
-    if not cache:
-        raise Exception("No cached document found. Please upload a document first.")
-
-    collection_name = cache["collection_name"]
-    scroll_out, _ = await asyncio.to_thread(
-        QDRANT_CLIENT.scroll,
-        collection_name=collection_name,
-        limit=10000
-    )
-
-    chunks = [p.payload for p in scroll_out if "text" in p.payload]
-    if not chunks:
-        raise Exception("No chunks found in Qdrant collection.")
-    chunks.sort(key=lambda x: (x.get("page", 0), x.get("chunk_index", 0)))
-
+async def _summarize_from_tree(state, tree: Dict[str, Any]) -> str:
+    """Answer a summary request from precomputed summary nodes with one LLM call."""
     chunk_callback = state.get("_chunk_callback")
     llm_model = state.get("llm_model", "gpt-4o-mini")
-    gpt_config = state.get("gpt_config", {})
-    custom_prompt = gpt_config.get("instruction", "").strip()
+    custom_prompt = state.get("gpt_config", {}).get("instruction", "").strip()
+    custom_prefix = f"\n---\n# CUSTOM GPT INSTRUCTION\n{custom_prompt}\n---\n" if custom_prompt else ""
 
     from api_keys_util import get_api_keys_from_session
     api_keys = await get_api_keys_from_session(state.get("session_id")) if state else {}
-    map_llm = get_llm("google/gemini-2.5-flash-lite", 0.2, api_keys=api_keys)
     reduce_llm = get_llm(llm_model, 0.3, api_keys=api_keys)
-    total_tokens = sum(len(c["text"].split()) for c in chunks)
-    if total_tokens < 1200:
-        mode = "brief"
-    elif total_tokens < 12000:
-        mode = "normal"
-    else:
-        mode = "hierarchical"
-    custom_prefix = f"\n---\n# CUSTOM GPT INSTRUCTION\n{custom_prompt}\n---\n" if custom_prompt else ""
-    def extract_heading(txt: str):
-        lines = txt.split("\n")
-        for l in lines:
-            l = l.strip()
-            if re.match(r"^(UNIT[\s–-]*[IVXLC0-9]+|CHAPTER[\s–-]*\d+|^\d+(\.\d+)+|[A-Z][A-Za-z\s]{4,})", l):
-                return re.sub(r"^[\d.:\s–-]+", "", l).strip(":–- ")
-        return None
-    docs_by_id: Dict[str, Dict[str, Any]] = {}
-    for payload in chunks:
-        did = payload.get("doc_id") or payload.get("filename") or "unknown"
-        grp = docs_by_id.setdefault(did, {
-            "filename": payload.get("filename") or "unknown",
-            "file_type": payload.get("file_type") or "unknown",
-            "chunks": []
-        })
-        grp["chunks"].append(payload)
-    if len(docs_by_id) > 1:
-        await send_status_update(state, "🧠 Summarizing each document separately...", 40)
-        combined_outputs: list[str] = []
-        for idx, (did, info) in enumerate(docs_by_id.items(), start=1):
-            doc_chunks = info.get("chunks", [])
-            if not doc_chunks:
-                continue
-            doc_total_tokens = sum(len(c.get("text", "").split()) for c in doc_chunks)
-            if doc_total_tokens < 1200:
-                doc_mode = "brief"
-            elif doc_total_tokens < 12000:
-                doc_mode = "normal"
-            else:
-                doc_mode = "hierarchical"
-
-            header = f"\n**Document {idx}: {info.get('filename', 'unknown')} ({info.get('file_type', 'unknown')})**\n"
-            if chunk_callback:
-                await chunk_callback(header)
-
-            if doc_mode == "brief":
-                text = "\n".join(c.get("text", "") for c in doc_chunks)
-                prompt = f"""
-You are a professional summarizer.
-Summarize the document in detail while preserving the flow and factual integrity.
-
-### Guidelines:
-- Maintain original heading flow and key examples.
-- Include definitions and technical details.
-- Avoid repetition or generic statements.
-{text[:16000]}
-"""
-                resp, _ = await stream_with_token_tracking(
-                    reduce_llm,
-                    [HumanMessage(content=prompt)],
-                    chunk_callback=chunk_callback,
-                    state=state
-                )
-                combined_outputs.append(f"{header}{resp.strip()}")
-                continue
-
-            if doc_mode == "normal":
-                text = "\n".join(c.get("text", "") for c in doc_chunks)
-                prompt = f"""
-
-You are a professional summarizer.
-Summarize the document in detail while preserving the flow and factual integrity.
-
-### Guidelines:
-- Maintain original heading flow and key examples.
-- Include definitions and technical details.
-- Avoid repetition or generic statements.
-- Whole summary must be between 500 and 1000 words.
----
-{text[:32000]}
-"""
-                resp, _ = await stream_with_token_tracking(
-                    reduce_llm,
-                    [HumanMessage(content=prompt)],
-                    chunk_callback=chunk_callback,
-                    state=state
-                )
-                combined_outputs.append(f"{header}{resp.strip()}")
-                continue
-
-            # hierarchical per-document
-            avg_len = max(1, sum(len(c.get("text", "")) for c in doc_chunks) // len(doc_chunks))
-            doc_batch_size = min(10, max(3, 8000 // avg_len))
-            doc_batches = [doc_chunks[i:i + doc_batch_size] for i in range(0, len(doc_chunks), doc_batch_size)]
 
-            async def summarize_batch(batch):
-                combined_text = "\n".join([f"{(b.get('heading') or '')}\n{b.get('text', '')}" for b in batch])
-                sub_prompt = f"""
-
-You are summarizing a structured academic document.
-
-### Task:
-- Automatically detect and preserve natural headings (UNIT, CHAPTER, etc.).
-- Summarize each section clearly and concisely (~200-300 words total).
-- **Even within the word limit, do not merge or remove distinct sections.**
----
-{combined_text}
-"""
-                resp = await map_llm.ainvoke([HumanMessage(content=sub_prompt)])
-                if state:
-                    token_usage = _extract_usage(resp)
-                    if "token_usage" not in state or state["token_usage"] is None:
-                        state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-                    state["token_usage"]["input_tokens"] += token_usage["input_tokens"]
-                    state["token_usage"]["output_tokens"] += token_usage["output_tokens"]
-                    state["token_usage"]["total_tokens"] += token_usage["total_tokens"]
-                return resp.content.strip()
-
-            map_results = await asyncio.gather(*[summarize_batch(b) for b in doc_batches])
-
-            async def recursive_reduce(summaries: list[str]) -> str:
-                if len(summaries) <= 5:
-                    block = "\n\n".join(summaries)
-                    reduce_prompt = f"""
-You are merging partial summaries of a structured textbook/document.
-
-### Task:
-- Combine them while preserving all detected headings, subheadings, and their order.
-- If similar headings appear across summaries, merge their content intelligently under one heading.
-- Ensure the final text reads like a clean, organized outline with clear section boundaries.
-- Keep the merged summary between **350 and 600 words**.
-
----
-{block}
-"""
-                    resp = await map_llm.ainvoke([HumanMessage(content=reduce_prompt)])
-                    if state:
-                        token_usage = _extract_usage(resp)
-                        if "token_usage" not in state or state["token_usage"] is None:
-                            state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-                        state["token_usage"]["input_tokens"] += token_usage["input_tokens"]
-                        state["token_usage"]["output_tokens"] += token_usage["output_tokens"]
-                        state["token_usage"]["total_tokens"] += token_usage["total_tokens"]
-                    return resp.content.strip()
-                merged = []
-                for i in range(0, len(summaries), 5):
-                    partial = await recursive_reduce(summaries[i:i + 5])
-                    merged.append(partial)
-                return await recursive_reduce(merged)
-
-            reduced_summary = await recursive_reduce(map_results)
-            final_prompt = f"""
+    documents = tree["documents"]
+    blocks = []
+    for idx, node in enumerate(documents, start=1):
+        parts = [f"## Document {idx}: {node.get('filename', 'unknown')} ({node.get('file_type', 'unknown')})"]
+        if node.get("verbatim"):
+            parts.append(node.get("summary", "")[:16000])
+        else:
+            parts.append(node.get("summary", ""))
+            sections = "\n\n".join(
+                f"### {s.get('title') or 'Section'}\n{s.get('summary', '')}" for s in node.get("sections", [])
+            )
+            if sections:
+                parts.append(f"Section summaries:\n{sections[:24000]}")
+        blocks.append("\n\n".join(parts))
+    if tree.get("collection"):
+        blocks.insert(0, f"## Overview of all documents\n{tree['collection']}")
+    documents_block = "\n\n".join(blocks)
+
+    per_document = "- Write a separate section per document, titled **Document N: filename (type)**, in the given order.\n" if len(documents) > 1 else ""
+    final_prompt = f"""
 {custom_prefix} 
 - **Only use the  custom gpt instructions when relevant to summarization.**
-You are writing the final comprehensive summary of a structured document.
+You are writing the final comprehensive summary of structured document(s) from precomputed summaries.
 
 ### Rules:
 - Retain headings/subheadings automatically detected.
 - Format them clearly (bold or sectioned).
-- The total length should be about **1000-2000 words**.
+{per_document}- The total length should be about **1000-2000 words**.
 - Focus on clarity and coverage rather than repetition.
 
 
 ---
-{reduced_summary}
+{documents_block}
 """
-            await send_status_update(state, "✍️ Writing per-document detailed summary...", 75)
-            final_output, _ = await stream_with_token_tracking(
-                reduce_llm,
-                [HumanMessage(content=final_prompt)],
-                chunk_callback=chunk_callback,
-                state=state
-            )
-            if chunk_callback:
-                await chunk_callback("\n\n")
-            combined_outputs.append(f"{header}{final_output.strip()}")
-        if chunk_callback:
-            await chunk_callback("\n\n")
-        return "\n\n".join(combined_outputs)
-    avg_len = max(1, sum(len(c["text"]) for c in chunks) // len(chunks))
-    batch_size = min(10, max(3, 8000 // avg_len))
-    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
-    print(f"mode:", mode)
-    if mode == "brief":
-        text = "\n".join(c["text"] for c in chunks)
-        prompt = f"""
+    print(f"[Summarizer] Using precomputed summary tree for {len(documents)} document(s)")
+    await send_status_update(state, "✍️ Writing final detailed summary...", 90)
+    async with llm_slot():
+        final_output, _ = await stream_with_token_tracking(
+            reduce_llm,
+            [HumanMessage(content=final_prompt)],
+            chunk_callback=chunk_callback,
+            state=state
+        )
+    if chunk_callback:
+        await chunk_callback("\n\n")
+    return final_output.strip()
+
+BRIEF_SUMMARY_PROMPT = """
 You are a professional summarizer.
 Summarize the document in detail while preserving the flow and factual integrity.
 
@@ -2178,21 +2541,10 @@ Summarize the document in detail while preserving the flow and factual integrity
 - Maintain original heading flow and key examples.
 - Include definitions and technical details.
 - Avoid repetition or generic statements.
-{text[:16000]}
+{text}
 """
-        resp, _ = await stream_with_token_tracking(
-            reduce_llm,
-            [HumanMessage(content=prompt)],
-            chunk_callback=chunk_callback,
-            state=state
-        )
-        if chunk_callback:
-            await chunk_callback("\n\n")
-        return resp.strip()
-    print(f"mode: {mode}, total_tokens: {total_tokens}, batches: {len(batches)}, batch_size: {batch_size}")
-    if mode == "normal":
-        text = "\n".join(c["text"] for c in chunks)
-        prompt = f"""
+
+NORMAL_SUMMARY_PROMPT = """
 
 You are a professional summarizer.
 Summarize the document in detail while preserving the flow and factual integrity.
@@ -2203,76 +2555,10 @@ Summarize the document in detail while preserving the flow and factual integrity
 - Avoid repetition or generic statements.
 - Whole summary must be between 500 and 1000 words.
 ---
-{text[:32000]}
-"""
-        resp, _ = await stream_with_token_tracking(
-            reduce_llm,
-            [HumanMessage(content=prompt)],
-            chunk_callback=chunk_callback,
-            state=state
-        )
-        if chunk_callback:
-            await chunk_callback("\n\n")
-        return resp.strip()
-    async def summarize_batch(batch):
-        combined_text = "\n".join([f"{b['heading'] or ''}\n{b['text']}" for b in batch])
-        prompt = f"""
-
-You are summarizing a structured academic document.
-
-### Task:
-- Automatically detect and preserve natural headings (UNIT, CHAPTER, etc.).
-- Summarize each section clearly and concisely (~200-300 words total).
-- **Even within the word limit, do not merge or remove distinct sections.**
----
-{combined_text}
-"""
-
-
-        resp = await map_llm.ainvoke([HumanMessage(content=prompt)])
-        if state:
-            token_usage = _extract_usage(resp)
-            if "token_usage" not in state or state["token_usage"] is None:
-                state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-            state["token_usage"]["input_tokens"] += token_usage["input_tokens"]
-            state["token_usage"]["output_tokens"] += token_usage["output_tokens"]
-            state["token_usage"]["total_tokens"] += token_usage["total_tokens"]
-        return resp.content.strip()
-
-    map_results = await asyncio.gather(*[summarize_batch(b) for b in batches])
-    async def recursive_reduce(summaries: list[str]) -> str:
-        if len(summaries) <= 5:
-            block = "\n\n".join(summaries)
-            prompt = f"""
-You are merging partial summaries of a structured textbook/document.
-
-### Task:
-- Combine them while preserving all detected headings, subheadings, and their order.
-- If similar headings appear across summaries, merge their content intelligently under one heading.
-- Ensure the final text reads like a clean, organized outline with clear section boundaries.
-- Keep the merged summary between **350 and 600 words**.
-
----
-{block}
+{text}
 """
 
-            resp = await map_llm.ainvoke([HumanMessage(content=prompt)])
-            if state:
-                token_usage = _extract_usage(resp)
-                if "token_usage" not in state or state["token_usage"] is None:
-                    state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-                state["token_usage"]["input_tokens"] += token_usage["input_tokens"]
-                state["token_usage"]["output_tokens"] += token_usage["output_tokens"]
-                state["token_usage"]["total_tokens"] += token_usage["total_tokens"]
-            return resp.content.strip()
-        merged = []
-        for i in range(0, len(summaries), 5):
-            partial = await recursive_reduce(summaries[i:i + 5])
-            merged.append(partial)
-        return await recursive_reduce(merged)
-
-    reduced_summary = await recursive_reduce(map_results)
-    final_prompt = f"""
+FINAL_SUMMARY_PROMPT = """
 {custom_prefix} 
 - **Only use the  custom gpt instructions when relevant to summarization.**
 You are writing the final comprehensive summary of a structured document.
@@ -2285,24 +2571,156 @@ You are writing the final comprehensive summary of a structured document.
 
 
 ---
-{reduced_summary}
+{text}
 """
 
+def _summary_mode(doc_chunks: List[Dict[str, Any]]) -> str:
+    total_tokens = sum(len(c.get("text", "").split()) for c in doc_chunks)
+    if total_tokens < 1200:
+        return "brief"
+    if total_tokens < 12000:
+        return "normal"
+    return "hierarchical"
+
+async def _send_partial_summary(state, filename: str, section: int, total: int, summary: str):
+    """Stream a finished section summary to the client as a status event."""
+    status_callback = state.get("_status_callback") if state else None
+    if not status_callback:
+        return
+    try:
+        await status_callback({
+            "type": "status",
+            "data": {
+                "status": "summarizing",
+                "message": f"Summarized part {section}/{total} of {filename}",
+                "current_node": "RAG",
+                "progress": None,
+                "partial_summary": {"filename": filename, "section": section, "total": total, "text": summary}
+            }
+        })
+    except Exception as e:
+        print(f"[Summarizer] Could not stream partial summary: {e}")
 
-    await send_status_update(state, "✍️ Writing final detailed summary...", 90)
-    final_output, _ = await stream_with_token_tracking(
-        reduce_llm,
-        [HumanMessage(content=final_prompt)],
-        chunk_callback=chunk_callback,
-        state=state
-    )
-    if chunk_callback:
-        await chunk_callback("\n\n")
+async def hierarchical_summarize(state, batch_size: int = 10):
+    """
+    🧠 Hierarchical Summarizer for Custom GPTs
+    ------------------------------------------
+    - Auto-adapts between Brief / Normal / Hierarchical modes per document.
+    - Map and reduce stages of all documents run concurrently, bounded by the
+      global summarization scheduler (Rag/llm_scheduler.py).
+    - Honors Custom GPT instructions (from gpt_config["instruction"]).
+    - Streams partial section summaries as status events and the final
+      per-document summaries in document order.
+    """
 
-    print("[Summarizer] ✅ Hierarchical summarization complete.")
-    return final_output.strip()
+    session_id = state.get("session_id")
+    redis_client = await ensure_redis_client()
+    cache = await redis_client.hgetall(f"user_doc_cache:{session_id}")
+    if not cache:
+        raise Exception("No cached document found. Please upload a document first.")
+
+    collection_name = cache["collection_name"]
+    tree = await get_valid_summary_tree(collection_name)
+    if tree:
+        return await _summarize_from_tree(state, tree)
+
+    # Registry gives chunks already ordered by document and chunk_index
+    chunks = await _fetch_registered_chunks(collection_name)
+    if not chunks:
+        scroll_out, _ = await asyncio.to_thread(
+            QDRANT_CLIENT.scroll,
+            collection_name=collection_name,
+            limit=10000
+        )
+        chunks = [p.payload for p in scroll_out if "text" in p.payload]
+        chunks.sort(key=lambda x: (x.get("page", 0), x.get("chunk_index", 0)))
+    if not chunks:
+        raise Exception("No chunks found in Qdrant collection.")
+
+    chunk_callback = state.get("_chunk_callback")
+    llm_model = state.get("llm_model", "gpt-4o-mini")
+    gpt_config = state.get("gpt_config", {})
+    custom_prompt = gpt_config.get("instruction", "").strip()
+
+    from api_keys_util import get_api_keys_from_session
+    api_keys = await get_api_keys_from_session(state.get("session_id")) if state else {}
+    map_llm = get_llm("google/gemini-2.5-flash-lite", 0.2, api_keys=api_keys)
+    reduce_llm = get_llm(llm_model, 0.3, api_keys=api_keys)
+    custom_prefix = f"\n---\n# CUSTOM GPT INSTRUCTION\n{custom_prompt}\n---\n" if custom_prompt else ""
+
+    docs_by_id: Dict[str, Dict[str, Any]] = {}
+    for payload in chunks:
+        did = payload.get("doc_id") or payload.get("filename") or "unknown"
+        grp = docs_by_id.setdefault(did, {
+            "filename": payload.get("filename") or "unknown",
+            "file_type": payload.get("file_type") or "unknown",
+            "chunks": []
+        })
+        grp["chunks"].append(payload)
+    documents = [info for info in docs_by_id.values() if info["chunks"]]
+    multi_doc = len(documents) > 1
 
+    async def reduce_summaries(summaries: List[str]) -> str:
+        # Groups of five are merged concurrently at every level
+        if len(summaries) <= 5:
+            return await invoke_llm(map_llm, MERGE_PROMPT.format(text="\n\n".join(summaries)), state=state)
+        merged = await asyncio.gather(*[
+            reduce_summaries(summaries[i:i + 5]) for i in range(0, len(summaries), 5)
+        ])
+        return await reduce_summaries(list(merged))
+
+    async def map_reduce(info: Dict[str, Any]) -> str:
+        doc_chunks = info["chunks"]
+        avg_len = max(1, sum(len(c.get("text", "")) for c in doc_chunks) // len(doc_chunks))
+        doc_batch_size = min(10, max(3, 8000 // avg_len))
+        batches = [doc_chunks[i:i + doc_batch_size] for i in range(0, len(doc_chunks), doc_batch_size)]
+
+        async def summarize_batch(n: int, batch) -> str:
+            # Chunk text already starts with its heading path
+            combined_text = "\n".join(b.get("text", "") for b in batch)
+            summary = await invoke_llm(map_llm, SECTION_PROMPT.format(text=combined_text), state=state)
+            await _send_partial_summary(state, info["filename"], n, len(batches), summary)
+            return summary
+
+        map_results = await asyncio.gather(*[summarize_batch(n, b) for n, b in enumerate(batches, start=1)])
+        return await reduce_summaries(list(map_results))
+
+    stream = OrderedStream(chunk_callback, len(documents))
+
+    async def summarize_document(slot: int, info: Dict[str, Any]) -> str:
+        mode = _summary_mode(info["chunks"])
+        print(f"[Summarizer] {info['filename']}: mode={mode}, chunks={len(info['chunks'])}")
+        callback = stream.callback(slot)
+        header = f"\n**Document {slot + 1}: {info['filename']} ({info['file_type']})**\n" if multi_doc else ""
+        try:
+            if header and callback:
+                await callback(header)
+            text = "\n".join(c.get("text", "") for c in info["chunks"])
+            if mode == "brief":
+                prompt = BRIEF_SUMMARY_PROMPT.format(text=text[:16000])
+            elif mode == "normal":
+                prompt = NORMAL_SUMMARY_PROMPT.format(text=text[:32000])
+            else:
+                reduced_summary = await map_reduce(info)
+                prompt = FINAL_SUMMARY_PROMPT.format(custom_prefix=custom_prefix, text=reduced_summary)
+            async with llm_slot():
+                output, _ = await stream_with_token_tracking(
+                    reduce_llm,
+                    [HumanMessage(content=prompt)],
+                    chunk_callback=callback,
+                    state=state
+                )
+            if callback:
+                await callback("\n\n")
+            return f"{header}{output.strip()}"
+        finally:
+            await stream.finish(slot)
 
+    if multi_doc:
+        await send_status_update(state, "🧠 Summarizing all documents in parallel...", 40)
+    outputs = await asyncio.gather(*[summarize_document(slot, info) for slot, info in enumerate(documents)])
+    print(f"[Summarizer] ✅ Summarized {len(documents)} document(s).")
+    return "\n\n".join(outputs) if multi_doc else outputs[0]
 
 
 async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optional[List[str]] = None, filter_doc_indices: Optional[List[int]] = None):
@@ -2314,17 +2732,16 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
     
     await send_status_update(state, "🔍 Searching user documents...", 50)
     
-    await cleanup_expired_user_docs(session_id)
-
     redis_client = await ensure_redis_client()
-    cache_data = {}
-    if redis_client:
-        cache_data = await redis_client.hgetall(f"user_doc_cache:{session_id}")
+    session_docs = await _hydrate_session_docs(session_id)
+    cache_data = session_docs["cache"]
+    if await cleanup_expired_user_docs(session_id, cache=cache_data):
+        cache_data = {}
 
     # Check if we have JSON documents even if no cache_data (JSON-only documents)
     has_json_docs = False
     if redis_client and not cache_data:
-        json_keys = await redis_client.keys(f"user_json:{session_id}:*")
+        json_keys = session_docs["json_keys"]
         has_json_docs = len(json_keys) > 0
         if has_json_docs:
             print(f"[RAG] No embedded documents found, but {len(json_keys)} JSON documents exist. Returning empty chunks (JSON will be added separately).")
@@ -2361,19 +2778,7 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
     # Map indices to IDs if needed
     if filter_doc_indices and not filter_doc_ids:
         try:
-            scroll_out, _ = await asyncio.to_thread(
-                QDRANT_CLIENT.scroll,
-                collection_name=collection_name,
-                limit=1000
-            )
-            index_to_id_map = {}
-            for point in scroll_out:
-                payload = point.payload or {}
-                doc_id = payload.get("doc_id")
-                doc_index = payload.get("doc_index")
-                if doc_id and doc_index:
-                    index_to_id_map[doc_index] = doc_id
-            
+            index_to_id_map = await _get_index_to_id_map(collection_name)
             filter_doc_ids = [index_to_id_map[idx] for idx in filter_doc_indices if idx in index_to_id_map]
             print(f"[DOC-SEARCH] Mapped indices {filter_doc_indices} to IDs: {filter_doc_ids}")
         except Exception as e:
@@ -2397,30 +2802,9 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
             query_embedding = await embed_query(query, api_keys=api_keys)
             
             # If filtering by doc IDs, search with filter
+            candidates = await dense_search(collection_name, query_embedding, max_candidates, doc_ids=filter_doc_ids or None)
             if filter_doc_ids:
-                query_filter = models.Filter(
-                    must=[
-                        models.FieldCondition(
-                            key="doc_id",
-                            match=models.MatchAny(any=filter_doc_ids)
-                        )
-                    ]
-                )
-                candidates = await asyncio.to_thread(
-                    QDRANT_CLIENT.search,
-                    collection_name=collection_name,
-                    query_vector=query_embedding,
-                    limit=max_candidates,
-                    query_filter=query_filter
-                )
                 print(f"[PER-DOC-SEARCH] Filtered search by doc_ids: {filter_doc_ids}")
-            else:
-                candidates = await asyncio.to_thread(
-                    QDRANT_CLIENT.search,
-                    collection_name=collection_name,
-                    query_vector=query_embedding,
-                    limit=max_candidates
-                )
         except Exception as e:
             print(f"[PER-DOC-SEARCH] Error searching collection: {e}")
             return []
@@ -2441,21 +2825,16 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
                 break
         # Fetch top per_doc for each doc using a filter
         async def fetch_for_doc(did: str, fname: str, ftype: str):
-            flt = models.Filter(
-                must=[models.FieldCondition(key="doc_id", match=models.MatchValue(value=did))]
-            )
-            res = await asyncio.to_thread(
-                QDRANT_CLIENT.search,
-                collection_name=collection_name,
-                query_vector=query_embedding,
-                limit=per_doc,
-                query_filter=flt
-            )
+            res = await dense_search(collection_name, query_embedding, per_doc, doc_ids=[did])
             return {
                 "doc_id": did,
                 "filename": fname,
                 "file_type": ftype,
-                "chunks": [p.payload.get("text", "") for p in res if p.payload and p.payload.get("text")]
+                "chunks": [p.payload.get("text", "") for p in res if p.payload and p.payload.get("text")],
+                "items": [
+                    {"text": p.payload["text"], "score": p.score, "source": did, "chunk_index": p.payload.get("chunk_index")}
+                    for p in res if p.payload and p.payload.get("text")
+                ]
             }
         per_doc_results = await asyncio.gather(*[fetch_for_doc(*t) for t in doc_keys])
         return [r for r in per_doc_results if r.get("chunks")]
@@ -2466,25 +2845,11 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
     if not per_doc_sets:
         # Fallback to previous behavior with filtering
         if filter_doc_ids:
-            query_filter = models.Filter(
-                must=[
-                    models.FieldCondition(
-                        key="doc_id",
-                        match=models.MatchAny(any=filter_doc_ids)
-                    )
-                ]
-            )
             if is_hybrid:
                 # For hybrid, we need to search with filter
                 try:
                     query_embedding = await embed_query(user_query, api_keys=api_keys)
-                    vector_results = await asyncio.to_thread(
-                        QDRANT_CLIENT.search,
-                        collection_name=collection_name,
-                        query_vector=query_embedding,
-                        limit=20,
-                        query_filter=query_filter
-                    )
+                    vector_results = await dense_search(collection_name, query_embedding, 20, doc_ids=filter_doc_ids)
                     res = [result.payload["text"] for result in vector_results]
                 except Exception as e:
                     print(f"[DOC-SEARCH] Error in filtered hybrid search: {e}")
@@ -2492,13 +2857,7 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
             else:
                 try:
                     query_embedding = await embed_query(user_query, api_keys=api_keys)
-                    search_results = await asyncio.to_thread(
-                        QDRANT_CLIENT.search,
-                        collection_name=collection_name,
-                        query_vector=query_embedding,
-                        limit=20,
-                        query_filter=query_filter
-                    )
+                    search_results = await dense_search(collection_name, query_embedding, 20, doc_ids=filter_doc_ids)
                     res = [result.payload["text"] for result in search_results]
                 except Exception as e:
                     print(f"[DOC-SEARCH] Error in filtered search: {e}")
@@ -2508,13 +2867,25 @@ async def _process_user_docs(state, docs, user_query, rag, filter_doc_ids: Optio
                 res = await _hybrid_search_rrf(collection_name, user_query, limit=20, k=60, api_keys=api_keys)
             else:
                 res = await _search_collection(collection_name, user_query, limit=20, api_keys=api_keys)
+        res, pack_stats = pack_texts(res, "rag_user")
+        record_packed_tokens(state, "rag_user", pack_stats)
         return ("user", res)
 
+    # Pack all documents' chunks into one budget, then regroup per document in reading order
+    packed, pack_stats = pack_items([item for entry in per_doc_sets for item in entry["items"]], context_budget("rag_user"))
+    record_packed_tokens(state, "rag_user", pack_stats)
+    packed_by_doc: Dict[str, List[Dict[str, Any]]] = {}
+    for item in packed:
+        packed_by_doc.setdefault(item["source"], []).append(item)
+
     # Build grouped blocks with filename/type headers
     grouped_blocks: List[str] = []
     for entry in per_doc_sets:
+        doc_items = sorted(packed_by_doc.get(entry["doc_id"], []), key=lambda i: i.get("chunk_index") or 0)
+        if not doc_items:
+            continue
         header = f"=== Document: {entry['filename']} ({entry['file_type']}) ==="
-        body = "\n".join(entry["chunks"]) if entry.get("chunks") else ""
+        body = "\n".join(item["text"] for item in doc_items)
         grouped_blocks.append(f"{header}\n{body}")
     return ("user", grouped_blocks)
 
@@ -2538,7 +2909,7 @@ async def _process_kb_docs(state, kb_docs, user_query, rag):
         raise Exception(f"KB not pre-processed for this GPT. Please load custom GPT first.")
     
     await send_status_update(state, "🔍 Searching knowledge base...", 70)
-    collection_name = f"kb_{gpt_id}_{userId}"
+    collection_name = kb_collection_name(gpt_id, userId)
     
     # Hybrid flag now comes from GPT configuration
     is_hybrid = gpt_config.get("hybridRag", False)
@@ -2554,6 +2925,8 @@ async def _process_kb_docs(state, kb_docs, user_query, rag):
     else:
         res = await _hybrid_search_rrf(collection_name, user_query, limit=5, k=60, api_keys=api_keys)
     
+    res, pack_stats = pack_texts(res, "rag_kb")
+    record_packed_tokens(state, "rag_kb", pack_stats)
     print(f"[RAG] Retrieved {len(res)} chunks from KB")
     return ("kb", res)
 
@@ -2632,14 +3005,15 @@ async def Rag(state: GraphState) -> GraphState:
         has_images = False
         has_regular_docs = False  # Track regular documents separately from images
         if redis_client:
-            user_doc_cache_exists = await redis_client.exists(f"user_doc_cache:{session_id}")
-            has_user_docs = bool(user_doc_cache_exists)
+            # Doc cache, generation and JSON key registry in a single round trip
+            session_docs = await _hydrate_session_docs(session_id)
+            has_user_docs = bool(session_docs["cache"])
             has_regular_docs = has_user_docs  # Regular docs use cache
             if has_user_docs:
                 print(f"[RAG] Found user document cache in Redis for session {session_id}")
             
             # Check for JSON documents in Redis
-            json_keys = await redis_client.keys(f"user_json:{session_id}:*")
+            json_keys = session_docs["json_keys"]
             has_json_docs = len(json_keys) > 0
             if has_json_docs:
                 print(f"[RAG] Found {len(json_keys)} JSON user documents in Redis for session {session_id}")
@@ -2689,10 +3063,9 @@ async def Rag(state: GraphState) -> GraphState:
             
             # Check for JSON KB documents in Redis
             if redis_client:
-                kb_json_keys = await redis_client.keys(f"kb_json:{gpt_id}_{userId}:*")
-                has_kb_json = len(kb_json_keys) > 0
+                has_kb_json = await has_registered_keys(kb_json_scope(gpt_id, kb_owner(userId)))
                 if has_kb_json:
-                    print(f"[RAG] Found {len(kb_json_keys)} JSON KB documents in Redis for gpt_id={gpt_id}, userId={userId}")
+                    print(f"[RAG] Found JSON KB documents in Redis for gpt_id={gpt_id}, userId={userId}")
             
             # has_kb should be True if either embedded docs or JSON docs exist
             has_kb = has_kb or has_kb_json
@@ -2792,19 +3165,7 @@ async def Rag(state: GraphState) -> GraphState:
             if not filter_doc_ids and filter_doc_indices:
                 try:
                     collection_name = f"user_docs_{session_id}"
-                    scroll_out, _ = await asyncio.to_thread(
-                        QDRANT_CLIENT.scroll,
-                        collection_name=collection_name,
-                        limit=1000
-                    )
-                    index_to_id_map = {}
-                    for point in scroll_out:
-                        payload = point.payload or {}
-                        doc_id = payload.get("doc_id")
-                        doc_index = payload.get("doc_index")
-                        if doc_id and doc_index:
-                            index_to_id_map[doc_index] = doc_id
-                    
+                    index_to_id_map = await _get_index_to_id_map(collection_name)
                     for idx in filter_doc_indices:
                         if idx in index_to_id_map:
                             filter_doc_ids.append(index_to_id_map[idx])
@@ -2837,19 +3198,7 @@ async def Rag(state: GraphState) -> GraphState:
             if not filter_ids and filter_indices:
                 try:
                     collection_name = f"user_images_{session_id}"
-                    scroll_out, _ = await asyncio.to_thread(
-                        QDRANT_CLIENT.scroll,
-                        collection_name=collection_name,
-                        limit=1000
-                    )
-                    index_to_id_map = {}
-                    for point in scroll_out:
-                        payload = point.payload or {}
-                        img_id = payload.get("id")
-                        img_index = payload.get("image_index")
-                        if img_id and img_index:
-                            index_to_id_map[img_index] = img_id
-                    
+                    index_to_id_map = await _get_index_to_id_map(collection_name, id_field="id", index_field="image_index")
                     for idx in filter_indices:
                         if idx in index_to_id_map:
                             filter_ids.append(index_to_id_map[idx])
@@ -2862,18 +3211,8 @@ async def Rag(state: GraphState) -> GraphState:
             if filter_ids:
                 try:
                     collection_name = f"user_images_{session_id}"
-                    scroll_out, _ = await asyncio.to_thread(
-                        QDRANT_CLIENT.scroll,
-                        collection_name=collection_name,
-                        limit=1000
-                    )
-                    for point in scroll_out:
-                        payload = point.payload or {}
-                        img_id = payload.get("id")
-                        if img_id in filter_ids:
-                            idx = payload.get("image_index")
-                            if idx:
-                                actual_indices.append(idx)
+                    index_to_id_map = await _get_index_to_id_map(collection_name, id_field="id", index_field="image_index")
+                    actual_indices = [idx for idx, img_id in index_to_id_map.items() if img_id in filter_ids]
                     print(f"[RAG] Mapped IDs to actual indices from Qdrant: {actual_indices}")
                 except Exception as e:
                     print(f"[RAG] Error getting actual indices from Qdrant: {e}")
@@ -2945,14 +3284,16 @@ async def Rag(state: GraphState) -> GraphState:
         kb_json_content = []
         user_json_content = []
         
+        from api_keys_util import get_api_keys_from_session
+        json_api_keys = await get_api_keys_from_session(session_id) if session_id else {}
         if use_kb and gpt_id and userId:
-            kb_json_content = await get_json_documents(is_kb=True, gpt_id=gpt_id, userId=userId)
+            kb_json_content = await get_json_documents(is_kb=True, gpt_id=gpt_id, userId=userId, query=user_query, api_keys=json_api_keys)
             if kb_json_content:
                 print(f"[RAG] Retrieved {len(kb_json_content)} JSON KB documents")
         
         if use_user_docs and session_id:
             # Get all JSON documents first
-            all_user_json = await get_json_documents(is_kb=False, session_id=session_id)
+            all_user_json = await get_json_documents(is_kb=False, session_id=session_id, query=user_query, api_keys=json_api_keys)
             
             # Apply document selection filtering if available
             if doc_selection_result and all_user_json:
@@ -2964,7 +3305,8 @@ async def Rag(state: GraphState) -> GraphState:
                     redis_client = await ensure_redis_client()
                     if redis_client:
                         filtered_json_content = []
-                        json_keys = await redis_client.keys(f"user_json:{session_id}:*")
+                        selected_keys = []
+                        json_keys = await _get_session_json_keys(session_id)
                         
                         # Get document order to map indices
                         order_key = f"doc_order:{session_id}"
@@ -3006,11 +3348,14 @@ async def Rag(state: GraphState) -> GraphState:
                                             pass
                                 
                                 if should_include:
-                                    content = await redis_client.get(key)
-                                    if content:
-                                        filtered_json_content.append(
-                                            content.decode('utf-8') if isinstance(content, bytes) else content
-                                        )
+                                    selected_keys.append(key)
+                        
+                        for key, content in zip(selected_keys, await redis_mget(selected_keys)):
+                            if content:
+                                content = content.decode('utf-8') if isinstance(content, bytes) else content
+                                filtered_json_content.append(
+                                    await render_json_document(key, content, user_query, json_api_keys)
+                                )
                         
                         user_json_content = filtered_json_content
                         print(f"[RAG] Filtered JSON user documents: {len(user_json_content)}/{len(all_user_json)} selected")
@@ -3026,6 +3371,16 @@ async def Rag(state: GraphState) -> GraphState:
             if user_json_content:
                 print(f"[RAG] Retrieved {len(user_json_content)} JSON user documents")
         
+        # JSON documents share one token budget, user documents first
+        json_budget = context_budget("rag_json")
+        if user_json_content and use_user_docs:
+            user_json_content, json_stats = pack_documents(user_json_content, "rag_json", json_budget)
+            record_packed_tokens(state, "rag_json", json_stats)
+            json_budget -= json_stats["packed_tokens"]
+        if kb_json_content and use_kb:
+            kb_json_content, json_stats = pack_documents(kb_json_content, "rag_json", json_budget)
+            record_packed_tokens(state, "rag_json", json_stats)
+
         if user_result and use_user_docs:
             context_parts.append(f"\nUSER DOCUMENT CONTEXT:\n{chr(10).join(user_result)}")
         
@@ -0,0 +1,489 @@
+"""
+Persistent, appendable BM25 inverted index kept in Redis.
+
+Replaces the pickled BM25Okapi per collection (which every upload batch
+overwrote). Chunks are appended and removed per source document, and scores
+are computed at query time from the stored statistics. Each worker keeps
+deserialized indexes in an LRU keyed by collection and index version, as a
+precomputed BM25 weight matrix (terms x chunks, CSR) scored with a sparse dot
+product and argpartition for top-k.
+
+Layout (per collection):
+    bm25:{collection}:meta      hash  docs, total_len, next_doc, version
+    bm25:{collection}:postings  hash  term -> "docno:tf docno:tf ..."
+    bm25:{collection}:lengths   hash  docno -> token count
+    bm25:{collection}:ids       hash  docno -> Qdrant point id
+    bm25:{collection}:sources   hash  source -> JSON {docno: "unique terms"}
+
+Internal integer docnos keep postings compact. IDF uses the non-negative
+Lucene form log(1 + (N - df + 0.5) / (df + 0.5)), so scores never depend on
+statistics of terms outside the query.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from redis_client import ensure_redis_client
+
+BM25_PREFIX = "bm25"
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Worker-local cache of deserialized indexes (approximate in-memory size)
+BM25_CACHE_MAX_BYTES = int(float(os.getenv("BM25_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+# collection -> (version, index, approx bytes), least recently used first
+_index_cache: "OrderedDict[str, Tuple[int, Dict[str, Any], int]]" = OrderedDict()
+_index_cache_bytes = 0
+# collection -> pinned until (epoch seconds); pinned indexes are skipped by LRU eviction
+_pinned: Dict[str, float] = {}
+BM25_PIN_MAX_BYTES = int(float(os.getenv("BM25_PIN_MAX_MB", "128")) * 1024 * 1024)
+BM25_CACHE_METRICS = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def bm25_keys(collection_name: str) -> Dict[str, str]:
+    base = f"{BM25_PREFIX}:{collection_name}"
+    return {
+        "meta": f"{base}:meta",
+        "postings": f"{base}:postings",
+        "lengths": f"{base}:lengths",
+        "ids": f"{base}:ids",
+        "sources": f"{base}:sources",
+    }
+
+
+def _parse_postings(raw: Optional[str]) -> Dict[int, int]:
+    postings = {}
+    if raw:
+        for entry in raw.split():
+            docno, _, tf = entry.partition(":")
+            postings[int(docno)] = int(tf)
+    return postings
+
+
+def _format_postings(postings: Dict[int, int]) -> str:
+    return " ".join(f"{docno}:{tf}" for docno, tf in postings.items())
+
+
+async def _update_index(
+    collection_name: str,
+    add: Dict[str, List[Tuple[str, List[str]]]],
+    remove: Iterable[str],
+    ttl: Optional[int] = None,
+) -> int:
+    """
+    Transactionally remove sources and (re)add chunks per source.
+    add: {source: [(point_id, tokens), ...]}; re-added sources replace their old chunks.
+    Returns the new index version.
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return 0
+    keys = bm25_keys(collection_name)
+    drop_sources = list(dict.fromkeys(list(remove) + list(add.keys())))
+    new_version = 0
+
+    async def _apply(pipe):
+        nonlocal new_version
+        meta = await pipe.hgetall(keys["meta"])
+        docs = int(meta.get("docs", 0) or 0)
+        total_len = int(meta.get("total_len", 0) or 0)
+        next_doc = int(meta.get("next_doc", 0) or 0)
+
+        # Chunks of replaced/removed sources
+        removed: Dict[int, List[str]] = {}
+        if drop_sources:
+            for raw in await pipe.hmget(keys["sources"], drop_sources):
+                if raw:
+                    for docno, terms in json.loads(raw).items():
+                        removed[int(docno)] = terms.split()
+        removed_lengths = await pipe.hmget(keys["lengths"], list(removed)) if removed else []
+
+        added_terms: Dict[int, Counter] = {}
+        source_entries: Dict[str, Dict[str, str]] = {}
+        point_ids: Dict[int, str] = {}
+        for source, chunks in add.items():
+            entry = {}
+            for point_id, tokens in chunks:
+                docno = next_doc
+                next_doc += 1
+                counts = Counter(tokens)
+                added_terms[docno] = counts
+                point_ids[docno] = point_id
+                entry[str(docno)] = " ".join(counts)
+            source_entries[source] = entry
+
+        touched = set(t for terms in removed.values() for t in terms)
+        touched.update(t for counts in added_terms.values() for t in counts)
+        touched = list(touched)
+        postings = dict(zip(touched, await pipe.hmget(keys["postings"], touched))) if touched else {}
+        parsed = {term: _parse_postings(raw) for term, raw in postings.items()}
+        for docno, terms in removed.items():
+            for term in terms:
+                parsed.get(term, {}).pop(docno, None)
+        for docno, counts in added_terms.items():
+            for term, tf in counts.items():
+                parsed.setdefault(term, {})[docno] = tf
+
+        docs += len(added_terms) - len(removed)
+        total_len += sum(sum(c.values()) for c in added_terms.values())
+        total_len -= sum(int(l or 0) for l in removed_lengths)
+        new_version = int(meta.get("version", 0) or 0) + 1
+
+        pipe.multi()
+        non_empty = {term: _format_postings(p) for term, p in parsed.items() if p}
+        emptied = [term for term, p in parsed.items() if not p]
+        if non_empty:
+            pipe.hset(keys["postings"], mapping=non_empty)
+        if emptied:
+            pipe.hdel(keys["postings"], *emptied)
+        if removed:
+            pipe.hdel(keys["lengths"], *removed)
+            pipe.hdel(keys["ids"], *removed)
+        if added_terms:
+            pipe.hset(keys["lengths"], mapping={d: sum(c.values()) for d, c in added_terms.items()})
+            pipe.hset(keys["ids"], mapping=point_ids)
+        gone = [s for s in drop_sources if s not in source_entries]
+        if gone:
+            pipe.hdel(keys["sources"], *gone)
+        if source_entries:
+            pipe.hset(keys["sources"], mapping={s: json.dumps(e) for s, e in source_entries.items()})
+        pipe.hset(keys["meta"], mapping={
+            "docs": max(docs, 0),
+            "total_len": max(total_len, 0),
+            "next_doc": next_doc,
+            "version": new_version,
+        })
+        if ttl:
+            for key in keys.values():
+                pipe.expire(key, ttl)
+
+    await redis_client.transaction(_apply, keys["meta"], keys["sources"])
+    return new_version
+
+
+async def index_chunks(
+    collection_name: str,
+    chunks: Iterable[Tuple[str, str, List[str]]],
+    ttl: Optional[int] = None,
+) -> int:
+    """Append (point_id, source, tokens) chunks; sources already indexed are replaced."""
+    add: Dict[str, List[Tuple[str, List[str]]]] = {}
+    for point_id, source, tokens in chunks:
+        add.setdefault(source, []).append((point_id, tokens))
+    if not add:
+        return 0
+    try:
+        version = await _update_index(collection_name, add, [], ttl=ttl)
+        print(f"[BM25] Indexed {sum(len(c) for c in add.values())} chunks from {len(add)} source(s) in {collection_name} (version {version})")
+        return version
+    except Exception as e:
+        print(f"[BM25] Error indexing chunks for {collection_name}: {e}")
+        return 0
+
+
+async def remove_sources(collection_name: str, sources: Iterable[str]) -> int:
+    """Delete every chunk of the given source documents from the index."""
+    sources = [s for s in sources if s]
+    if not sources:
+        return 0
+    try:
+        return await _update_index(collection_name, {}, sources)
+    except Exception as e:
+        print(f"[BM25] Error removing sources from {collection_name}: {e}")
+        return 0
+
+
+async def clear_bm25_index(collection_name: str):
+    """Drop the whole inverted index of a collection (and the legacy pickled index)."""
+    redis_client = await ensure_redis_client()
+    _evict_cached_index(collection_name)
+    if not redis_client:
+        return
+    await redis_client.delete(*bm25_keys(collection_name).values(), f"bm25_index:{collection_name}")
+
+
+async def get_bm25_version(collection_name: str) -> Optional[int]:
+    """Current index version, or None when the collection has no inverted index."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    version = await redis_client.hget(bm25_keys(collection_name)["meta"], "version")
+    return int(version) if version is not None else None
+
+
+def _evict_cached_index(collection_name: str):
+    global _index_cache_bytes
+    entry = _index_cache.pop(collection_name, None)
+    _pinned.pop(collection_name, None)
+    if entry:
+        _index_cache_bytes -= entry[2]
+
+
+def _index_nbytes(index: Dict[str, Any]) -> int:
+    matrix = index["matrix"]
+    arrays = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes + index["idf"].nbytes
+    return arrays + len(index["vocab"]) * 96 + len(index["ids"]) * 96
+
+
+def _cache_index(collection_name: str, version: int, index: Dict[str, Any]):
+    """Keep a loaded index for its version, evicting least recently used ones over the memory cap."""
+    global _index_cache_bytes
+    pinned_until = _pinned.get(collection_name)
+    _evict_cached_index(collection_name)
+    size = _index_nbytes(index)
+    if size > BM25_CACHE_MAX_BYTES:
+        return
+    if pinned_until:
+        # A newer version of a pinned index stays pinned
+        _pinned[collection_name] = pinned_until
+    _index_cache[collection_name] = (version, index, size)
+    _index_cache_bytes += size
+    while _index_cache_bytes > BM25_CACHE_MAX_BYTES:
+        now = time.time()
+        victim = next((name for name in _index_cache if _pinned.get(name, 0) <= now and name != collection_name), None)
+        if victim is None:
+            break
+        _index_cache_bytes -= _index_cache.pop(victim)[2]
+        _pinned.pop(victim, None)
+        BM25_CACHE_METRICS["evictions"] += 1
+
+
+def pin_index(collection_name: str, seconds: float) -> bool:
+    """Exempt a cached index from eviction for a while, within BM25_PIN_MAX_MB of pinned indexes."""
+    entry = _index_cache.get(collection_name)
+    if entry is None:
+        return False
+    now = time.time()
+    pinned_bytes = sum(
+        e[2] for name, e in _index_cache.items() if name != collection_name and _pinned.get(name, 0) > now
+    )
+    if pinned_bytes + entry[2] > BM25_PIN_MAX_BYTES:
+        return False
+    _pinned[collection_name] = max(_pinned.get(collection_name, 0), now + seconds)
+    return True
+
+
+def weight_matrix(tf: sparse.csr_matrix, doc_lengths: np.ndarray, n_docs: int, avgdl: float) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    """
+    Precompute BM25 weights from a term x chunk tf matrix: the saturated,
+    length-normalised tf of every posting, and the IDF of every term row.
+    """
+    tf = tf.tocsr()
+    tf.sum_duplicates()
+    values = tf.data.astype(np.float64)
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[tf.indices] / avgdl)
+    weights = sparse.csr_matrix((values * (BM25_K1 + 1) / (values + norm), tf.indices, tf.indptr), shape=tf.shape)
+    df = np.diff(tf.indptr)
+    idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+    return weights, idf
+
+
+def _tf_matrix(postings: Dict[str, str], columns: Dict[int, int]) -> Tuple[List[str], sparse.csr_matrix]:
+    """Term x column tf matrix from raw postings strings ("docno:tf docno:tf ...")."""
+    terms = list(postings)
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    indices: List[np.ndarray] = []
+    data: List[np.ndarray] = []
+    for row, term in enumerate(terms):
+        pairs = np.array(postings[term].replace(":", " ").split(), dtype=np.int64).reshape(-1, 2)
+        cols = np.array([columns.get(int(d), -1) for d in pairs[:, 0]], dtype=np.int64)
+        keep = cols >= 0
+        indices.append(cols[keep])
+        data.append(pairs[keep, 1])
+        indptr[row + 1] = indptr[row] + int(keep.sum())
+    matrix = sparse.csr_matrix(
+        (
+            np.concatenate(data) if data else np.zeros(0, dtype=np.int64),
+            np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64),
+            indptr,
+        ),
+        shape=(len(terms), len(columns)),
+    )
+    return terms, matrix
+
+
+async def _load_index(redis_client, collection_name: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """
+    Read a whole index in one MULTI (meta, postings and ids of the same version)
+    and precompute its BM25 weight matrix (terms x chunks, CSR).
+    """
+    keys = bm25_keys(collection_name)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(keys["meta"])
+        pipe.hgetall(keys["postings"])
+        pipe.hgetall(keys["lengths"])
+        pipe.hgetall(keys["ids"])
+        meta, postings, lengths, ids = await pipe.execute()
+    if not meta:
+        return None
+
+    def _build():
+        docnos = sorted(int(d) for d in lengths)
+        columns = {docno: col for col, docno in enumerate(docnos)}
+        doc_lengths = np.array([int(lengths[str(d)]) for d in docnos], dtype=np.float64)
+        n_docs = len(docnos)
+        avgdl = (float(doc_lengths.sum()) / n_docs if n_docs else 0.0) or 1.0
+        terms, tf = _tf_matrix(postings, columns)
+        matrix, idf = weight_matrix(tf, doc_lengths, n_docs, avgdl)
+        return {
+            "docs": n_docs,
+            "vocab": {term: row for row, term in enumerate(terms)},
+            "matrix": matrix,
+            "idf": idf,
+            "ids": [ids.get(str(d)) for d in docnos],
+        }
+
+    index = await asyncio.to_thread(_build)
+    return int(meta.get("version", 0) or 0), index
+
+
+async def get_bm25_index(collection_name: str) -> Optional[Dict[str, Any]]:
+    """
+    Deserialized index of a collection from the worker cache; one HGET checks the
+    cached version against Redis and a full reload happens only after writes.
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    version = await redis_client.hget(bm25_keys(collection_name)["meta"], "version")
+    if version is None:
+        _evict_cached_index(collection_name)
+        return None
+    entry = _index_cache.get(collection_name)
+    if entry and entry[0] == int(version):
+        _index_cache.move_to_end(collection_name)
+        BM25_CACHE_METRICS["hits"] += 1
+        return entry[1]
+
+    BM25_CACHE_METRICS["misses"] += 1
+    loaded = await _load_index(redis_client, collection_name)
+    if loaded is None:
+        return None
+    loaded_version, index = loaded
+    _cache_index(collection_name, loaded_version, index)
+    print(f"[BM25] Loaded index for {collection_name} (version {loaded_version}, {index['docs']} chunks, {len(index['vocab'])} terms)")
+    return index
+
+
+def score_matrix(
+    matrix: sparse.csr_matrix,
+    idf: np.ndarray,
+    rows: List[int],
+    limit: int,
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    Sparse dot product of the query's IDF weights with the selected term rows:
+    the rows' postings are gathered, weighted and reduced per chunk column, so
+    cost follows the matched postings rather than the collection size.
+    Returns (top columns, their scores) best first, ties by column, and the sum of all scores.
+    """
+    starts, ends = matrix.indptr[rows], matrix.indptr[np.asarray(rows) + 1]
+    columns = np.concatenate([matrix.indices[s:e] for s, e in zip(starts, ends)])
+    weights = np.concatenate([matrix.data[s:e] * idf[r] for r, s, e in zip(rows, starts, ends)])
+    columns, inverse = np.unique(columns, return_inverse=True)
+    scores = np.bincount(inverse, weights=weights, minlength=len(columns))
+    if len(scores) > limit:
+        # Keep everything tied with the k-th score so ties resolve by column, as in a full sort
+        threshold = scores[np.argpartition(-scores, limit - 1)[limit - 1]]
+        top = np.flatnonzero(scores >= threshold)
+        columns_part, scores_part = columns[top], scores[top]
+    else:
+        columns_part, scores_part = columns, scores
+    order = np.lexsort((columns_part, -scores_part))[:limit]
+    return columns_part[order], scores_part[order], float(scores.sum())
+
+
+async def bm25_search(collection_name: str, query_tokens: List[str], limit: int) -> Optional[Tuple[List[Tuple[str, float]], float]]:
+    """
+    Score chunks matching any query term.
+    Returns ([(point_id, score)] best first, mean score over all indexed chunks),
+    or None when the collection has no inverted index.
+    """
+    index = await get_bm25_index(collection_name)
+    if index is None:
+        return None
+    n_docs = index["docs"]
+    rows = [index["vocab"][t] for t in dict.fromkeys(query_tokens) if t in index["vocab"]]
+    if not rows or n_docs <= 0 or limit <= 0:
+        return [], 0.0
+    columns, scores, total = score_matrix(index["matrix"], index["idf"], rows, limit)
+    ids = index["ids"]
+    ranked = [(ids[c], float(score)) for c, score in zip(columns.tolist(), scores.tolist()) if ids[c]]
+    return ranked, total / n_docs
+
+
+def _reference_scores(postings: Dict[str, Dict[int, int]], doc_lengths: np.ndarray, idf: Dict[str, float], avgdl: float) -> Dict[int, float]:
+    """Term-at-a-time scoring over postings dicts (the previous implementation), for benchmarks."""
+    scores: Dict[int, float] = {}
+    for term, term_postings in postings.items():
+        for col, tf in term_postings.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths[col] / avgdl)
+            scores[col] = scores.get(col, 0.0) + tf * (BM25_K1 + 1) / (tf + norm) * idf[term]
+    return scores
+
+
+def benchmark_scoring(sizes: Iterable[int] = (10_000, 100_000, 1_000_000), queries: int = 50, limit: int = 20, seed: int = 7) -> List[Dict[str, Any]]:
+    """
+    Microbenchmark on synthetic Zipf-distributed corpora: previous term-at-a-time
+    scoring with a full sort vs. the sparse dot product with argpartition.
+    Reports mean per-query latency and whether both return identical rankings.
+    """
+    rng = np.random.default_rng(seed)
+    vocab_size = 50_000
+    results = []
+    for n_docs in sizes:
+        lengths = np.maximum(rng.poisson(60, n_docs), 1)
+        doc_of_token = np.repeat(np.arange(n_docs), lengths)
+        term_of_token = (rng.zipf(1.15, int(lengths.sum())) - 1) % vocab_size
+        tf = sparse.csr_matrix(
+            (np.ones(len(term_of_token), dtype=np.int64), (term_of_token, doc_of_token)),
+            shape=(vocab_size, n_docs),
+        )
+        doc_lengths = lengths.astype(np.float64)
+        avgdl = float(doc_lengths.mean())
+        matrix, idf = weight_matrix(tf, doc_lengths, n_docs, avgdl)
+        tf.sum_duplicates()
+
+        present = np.flatnonzero(np.diff(tf.indptr))
+        baseline_s = vectorized_s = 0.0
+        identical = 0
+        for _ in range(queries):
+            rows = sorted(set(rng.choice(present[: max(len(present) // 4, 1)], size=4).tolist()))
+            postings = {
+                str(r): dict(zip(tf.indices[tf.indptr[r]:tf.indptr[r + 1]].tolist(), tf.data[tf.indptr[r]:tf.indptr[r + 1]].tolist()))
+                for r in rows
+            }
+            term_idf = {str(r): float(idf[r]) for r in rows}
+
+            start = time.perf_counter()
+            scores = _reference_scores(postings, doc_lengths, term_idf, avgdl)
+            expected = [c for c, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+            baseline_s += time.perf_counter() - start
+
+            start = time.perf_counter()
+            columns, _, _ = score_matrix(matrix, idf, rows, limit)
+            vectorized_s += time.perf_counter() - start
+            identical += int(columns.tolist() == expected)
+
+        result = {
+            "chunks": n_docs,
+            "baseline_ms": round(baseline_s / queries * 1000, 3),
+            "vectorized_ms": round(vectorized_s / queries * 1000, 3),
+            "speedup": round(baseline_s / vectorized_s, 1) if vectorized_s else None,
+            "identical_rankings": f"{identical}/{queries}",
+        }
+        print(f"[BM25-BENCH] {result}")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark_scoring([int(n) for n in sys.argv[1:]] or (10_000, 100_000, 1_000_000))
@@ -0,0 +1,94 @@
+"""
+Running headers/footers, page numbers and repeated legal text, removed from
+extracted PDF text before chunking (see document_processor).
+
+Lines are compared across pages by signature (case and whitespace ignored, in
+the margins digits too), separately in the top/bottom margins ("edge") and in
+the page body:
+
+    edge  repeats on BOILERPLATE_EDGE_PAGE_RATIO of the pages (at least 2), so
+          running heads that alternate between odd and even pages still count;
+          bare page numbers ("4", "Page 4 of 12", "- 4 -") always go
+    body  repeats on BOILERPLATE_BODY_PAGE_RATIO of the pages and on at least
+          BOILERPLATE_BODY_MIN_PAGES of them, and is at least
+          BOILERPLATE_BODY_MIN_CHARS long: a sentence repeated on every page of
+          a short document is more likely content than boilerplate
+"""
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+BOILERPLATE_STRIP_ENABLED = os.getenv("BOILERPLATE_STRIP_ENABLED", "true").lower() == "true"
+BOILERPLATE_MIN_PAGES = int(os.getenv("BOILERPLATE_MIN_PAGES", "3"))
+BOILERPLATE_BODY_MIN_PAGES = int(os.getenv("BOILERPLATE_BODY_MIN_PAGES", "6"))
+BOILERPLATE_EDGE_PAGE_RATIO = float(os.getenv("BOILERPLATE_EDGE_PAGE_RATIO", "0.3"))
+BOILERPLATE_BODY_PAGE_RATIO = float(os.getenv("BOILERPLATE_BODY_PAGE_RATIO", "0.6"))
+BOILERPLATE_EDGE_ZONE = float(os.getenv("BOILERPLATE_EDGE_ZONE", "0.12"))
+BOILERPLATE_BODY_MIN_CHARS = int(os.getenv("BOILERPLATE_BODY_MIN_CHARS", "20"))
+_PAGE_NUMBER_RE = re.compile(r"^(?:page\s*)?#+(?:\s*(?:of|/)\s*#+)?$|^[-–]\s*#+\s*[-–]$")
+
+
+def _boilerplate_signature(line: str, zone: str = "edge") -> str:
+    """
+    Line identity across pages: case and whitespace ignored; in the margins also
+    digits (page numbers, dates). Body lines differing only in numbers are content.
+    """
+    normalized = " ".join(line.lower().split())
+    return re.sub(r"\d+", "#", normalized) if zone == "edge" else normalized
+
+
+def strip_boilerplate(pages: List[List[Tuple[str, float]]]) -> Tuple[List[List[bool]], Dict[str, Any]]:
+    """
+    Detect boilerplate in a document given per page its lines as (text, relative
+    vertical position 0..1). Returns per-page keep masks and stats
+    {pages, bytes_before, bytes_removed, lines_removed, top_patterns}.
+    """
+    n_pages = len(pages)
+    keep = [[True] * len(lines) for lines in pages]
+    stats = {"pages": n_pages, "bytes_before": 0, "bytes_removed": 0, "lines_removed": 0, "top_patterns": []}
+    for lines in pages:
+        stats["bytes_before"] += sum(len(text.encode("utf-8")) + 1 for text, _ in lines)
+    if not BOILERPLATE_STRIP_ENABLED or n_pages < BOILERPLATE_MIN_PAGES:
+        return keep, stats
+
+    def zone(position: float) -> str:
+        return "edge" if position <= BOILERPLATE_EDGE_ZONE or position >= 1 - BOILERPLATE_EDGE_ZONE else "body"
+
+    page_sets: Dict[Tuple[str, str], set] = {}
+    for page_idx, lines in enumerate(pages):
+        for text, position in lines:
+            line_zone = zone(position)
+            sig = _boilerplate_signature(text, line_zone)
+            if sig:
+                page_sets.setdefault((line_zone, sig), set()).add(page_idx)
+    min_edge = max(2, int(n_pages * BOILERPLATE_EDGE_PAGE_RATIO + 0.999))
+    min_body = max(BOILERPLATE_BODY_MIN_PAGES, int(n_pages * BOILERPLATE_BODY_PAGE_RATIO + 0.999))
+    repeated = {
+        key for key, found in page_sets.items()
+        if len(found) >= (min_edge if key[0] == "edge" else min_body)
+        and (key[0] == "edge" or len(key[1]) >= BOILERPLATE_BODY_MIN_CHARS)
+    }
+
+    removed: Dict[str, int] = {}
+    for page_idx, lines in enumerate(pages):
+        for line_idx, (text, position) in enumerate(lines):
+            line_zone = zone(position)
+            sig = _boilerplate_signature(text, line_zone)
+            key = (line_zone, sig)
+            if key in repeated or (key[0] == "edge" and _PAGE_NUMBER_RE.match(sig)):
+                keep[page_idx][line_idx] = False
+                stats["lines_removed"] += 1
+                stats["bytes_removed"] += len(text.encode("utf-8")) + 1
+                removed[sig] = removed.get(sig, 0) + 1
+    stats["top_patterns"] = [sig for sig, _ in sorted(removed.items(), key=lambda kv: -kv[1])[:5]]
+    return keep, stats
+
+
+def log_boilerplate_stats(stats: Dict[str, Any]):
+    if stats.get("bytes_removed"):
+        share = stats["bytes_removed"] / max(stats["bytes_before"], 1) * 100
+        print(
+            f"[PDF] Stripped {stats['lines_removed']} boilerplate lines "
+            f"({stats['bytes_removed']} of {stats['bytes_before']} bytes, {share:.1f}%) "
+            f"across {stats['pages']} pages: {stats['top_patterns']}"
+        )
@@ -0,0 +1,173 @@
+"""
+Persistent (collection, source, chunk_index) -> point_id registry, kept in Redis.
+
+Layout:
+    chunk_ids:{collection}:{source}  list  point ids, list position == chunk_index
+    chunk_sources:{collection}       hash  source -> JSON {doc_id, doc_index, filename, file_type, count, content_hash, ingested_at}
+
+Written once at ingestion so ordered reconstruction (summaries) and index -> id
+mapping are direct lookups instead of scrolling the Qdrant collection on every
+request.
+"""
+import json
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from redis_client import ensure_redis_client
+from Rag.kb_manifest import content_hash
+
+CHUNK_IDS_PREFIX = "chunk_ids"
+CHUNK_SOURCES_PREFIX = "chunk_sources"
+
+
+def chunk_ids_key(collection_name: str, source: str) -> str:
+    return f"{CHUNK_IDS_PREFIX}:{collection_name}:{source}"
+
+
+def chunk_sources_key(collection_name: str) -> str:
+    return f"{CHUNK_SOURCES_PREFIX}:{collection_name}"
+
+
+def chunk_source_key(payload: Dict[str, Any], id_field: str = "doc_id") -> str:
+    """Stable identity of the document a chunk belongs to."""
+    payload = payload or {}
+    return str(payload.get("file_url") or payload.get(id_field) or payload.get("filename") or "unknown")
+
+
+async def register_chunks(
+    collection_name: str,
+    points: Iterable[Any],
+    ttl: Optional[int] = None,
+    id_field: str = "doc_id",
+    index_field: str = "doc_index",
+) -> int:
+    """
+    Record point ids for freshly upserted points.
+
+    Points must carry a per-source ``chunk_index`` in their payload. A source that is
+    registered again replaces its previous id list.
+    Returns the number of sources registered.
+    """
+    by_source: Dict[str, List[Any]] = {}
+    for point in points or []:
+        payload = point.payload or {}
+        by_source.setdefault(chunk_source_key(payload, id_field), []).append(point)
+    if not by_source:
+        return 0
+
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return 0
+
+    sources_key = chunk_sources_key(collection_name)
+    now = time.time()
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for source, source_points in by_source.items():
+                source_points.sort(key=lambda p: (p.payload or {}).get("chunk_index", 0))
+                first = source_points[0].payload or {}
+                ids_key = chunk_ids_key(collection_name, source)
+                pipe.delete(ids_key)
+                pipe.rpush(ids_key, *[str(p.id) for p in source_points])
+                pipe.hset(sources_key, source, json.dumps({
+                    "doc_id": first.get(id_field),
+                    "doc_index": first.get(index_field),
+                    "filename": first.get("filename"),
+                    "file_type": first.get("file_type"),
+                    "count": len(source_points),
+                    "content_hash": content_hash("\n".join((p.payload or {}).get("text", "") for p in source_points)),
+                    "ingested_at": now,
+                }))
+                if ttl:
+                    pipe.expire(ids_key, ttl)
+            if ttl:
+                pipe.expire(sources_key, ttl)
+            await pipe.execute()
+        return len(by_source)
+    except Exception as e:
+        print(f"[CHUNK-REGISTRY] Error registering chunks for {collection_name}: {e}")
+        return 0
+
+
+async def get_chunk_sources(collection_name: str) -> Dict[str, Dict[str, Any]]:
+    """Return {source: meta} ordered by doc_index, then ingestion time."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return {}
+    try:
+        raw = await redis_client.hgetall(chunk_sources_key(collection_name))
+    except Exception as e:
+        print(f"[CHUNK-REGISTRY] Error reading sources for {collection_name}: {e}")
+        return {}
+    sources = {}
+    for source, value in raw.items():
+        try:
+            sources[source] = json.loads(value)
+        except (TypeError, ValueError):
+            continue
+    ordered = sorted(
+        sources.items(),
+        key=lambda item: (item[1].get("doc_index") or float("inf"), item[1].get("ingested_at") or 0)
+    )
+    return dict(ordered)
+
+
+async def get_point_ids_for_sources(collection_name: str, sources: List[str]) -> Dict[str, List[str]]:
+    """Fetch the full ordered id list of several sources in one round trip."""
+    if not sources:
+        return {}
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return {}
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for source in sources:
+                pipe.lrange(chunk_ids_key(collection_name, source), 0, -1)
+            id_lists = await pipe.execute()
+        return dict(zip(sources, id_lists))
+    except Exception as e:
+        print(f"[CHUNK-REGISTRY] Error reading point ids for {collection_name}: {e}")
+        return {}
+
+
+async def get_doc_index_map(collection_name: str) -> Dict[int, str]:
+    """Map 1-based doc_index -> doc_id from the registry (empty if not registered)."""
+    sources = await get_chunk_sources(collection_name)
+    index_map = {}
+    for meta in sources.values():
+        doc_index = meta.get("doc_index")
+        doc_id = meta.get("doc_id")
+        if doc_index and doc_id:
+            index_map[int(doc_index)] = doc_id
+    return index_map
+
+
+async def unregister_sources(collection_name: str, sources: Iterable[str]):
+    """Drop the id lists and metadata of deleted source documents."""
+    sources = [s for s in sources if s]
+    if not sources:
+        return
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(*[chunk_ids_key(collection_name, s) for s in sources])
+            pipe.hdel(chunk_sources_key(collection_name), *sources)
+            await pipe.execute()
+    except Exception as e:
+        print(f"[CHUNK-REGISTRY] Error unregistering sources for {collection_name}: {e}")
+
+
+async def clear_chunk_registry(collection_name: str):
+    """Remove all registry keys of a collection."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    sources_key = chunk_sources_key(collection_name)
+    try:
+        sources = await redis_client.hkeys(sources_key)
+        keys = [chunk_ids_key(collection_name, s) for s in sources] + [sources_key]
+        await redis_client.delete(*keys)
+    except Exception as e:
+        print(f"[CHUNK-REGISTRY] Error clearing registry for {collection_name}: {e}")
@@ -0,0 +1,255 @@
+"""
+Structure-aware, token-sized chunking.
+
+Consumes the block-level output of document_processor.extract_blocks_from_pdf /
+extract_blocks_from_docx (or plain text, split into paragraphs) and produces
+chunks that never cross a heading, keep tables whole where they fit, and carry
+their page range and heading path. Every chunk's text starts with its heading
+path, so heading text is searchable and never lost (a heading without body
+text becomes a chunk of its own). Sizes are measured in tokens (tiktoken
+cl100k_base) so chunks track LLM budgets instead of characters.
+"""
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+
+_MARKDOWN_HEADING_RE = re.compile(r"^(#{1,6})\s+\S")
+_HEADING_RE = re.compile(r"^(UNIT[\s–-]*[IVXLC0-9]+|CHAPTER[\s–-]*\d+)\b", re.IGNORECASE)
+# Numbered headings ("2.1 Payment terms") must look like titles: capitalized after the number
+_NUMBERED_HEADING_RE = re.compile(r"^(\d+(\.\d+)+)\.?\s+[A-Z]")
+_HEADING_MAX_WORDS = 12
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            print(f"[CHUNKER] tiktoken unavailable, approximating tokens by words: {e}")
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Exact token count with tiktoken (word-based estimate if it is not installed)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return int(len(text.split()) * 1.3) + 1
+
+
+def split_by_tokens(text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    """Cut text into windows of at most max_tokens tokens."""
+    encoding = _get_encoding()
+    step = max(1, max_tokens - overlap_tokens)
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, max(len(tokens) - overlap_tokens, 1), step)]
+    words = text.split()
+    max_words = max(1, int(max_tokens / 1.3))
+    step = max(1, max_words - int(overlap_tokens / 1.3))
+    return [" ".join(words[i:i + max_words]) for i in range(0, max(len(words) - int(overlap_tokens / 1.3), 1), step)]
+
+
+def _heading_level(line: str) -> Optional[int]:
+    """Level of a plain-text heading line, or None for body text."""
+    if len(line) > 120:
+        return None
+    markdown = _MARKDOWN_HEADING_RE.match(line)
+    if markdown:
+        return len(markdown.group(1))
+    # Anything sentence-like (terminal punctuation, a sentence break, many words) is body text
+    title = re.sub(r"^\d+(\.\d+)*\.?\s+", "", line)
+    if line.endswith((".", ",", ";")) or _SENTENCE_RE.search(title) or len(line.split()) > _HEADING_MAX_WORDS:
+        return None
+    numbered = _NUMBERED_HEADING_RE.match(line)
+    if numbered:
+        return numbered.group(1).count(".") + 1
+    return 1 if _HEADING_RE.match(line) else None
+
+
+def blocks_from_text(text: str) -> List[Dict[str, Any]]:
+    """Paragraph blocks from plain text; form feeds mark pages, heading-like lines become headings."""
+    blocks: List[Dict[str, Any]] = []
+    for page_num, page_text in enumerate((text or "").split("\f"), start=1):
+        for paragraph in re.split(r"\n\s*\n", page_text):
+            lines = [l.strip() for l in paragraph.split("\n") if l.strip()]
+            body: List[str] = []
+            for line in lines:
+                level = _heading_level(line)
+                if level:
+                    if body:
+                        blocks.append({"type": "paragraph", "text": "\n".join(body), "page": page_num, "level": None})
+                        body = []
+                    blocks.append({"type": "heading", "text": line.lstrip("# ").strip(), "page": page_num, "level": level})
+                else:
+                    body.append(line)
+            if body:
+                blocks.append({"type": "paragraph", "text": "\n".join(body), "page": page_num, "level": None})
+    return blocks
+
+
+def _split_block(block: Dict[str, Any], max_tokens: int, overlap_tokens: int) -> List[str]:
+    """Split an oversized block: tables by rows (repeating the header row), text by sentences."""
+    text = block["text"]
+    if block["type"] == "table":
+        rows = text.split("\n")
+        header, pieces, current = rows[0], [], [rows[0]]
+        for row in rows[1:]:
+            if count_tokens("\n".join(current + [row])) > max_tokens and len(current) > 1:
+                pieces.append("\n".join(current))
+                current = [header]
+            current.append(row)
+        pieces.append("\n".join(current))
+        return [p for piece in pieces for p in (split_by_tokens(piece, max_tokens) if count_tokens(piece) > max_tokens else [piece])]
+
+    pieces, current = [], ""
+    for sentence in _SENTENCE_RE.split(text):
+        candidate = f"{current} {sentence}".strip() if current else sentence
+        if count_tokens(candidate) <= max_tokens:
+            current = candidate
+            continue
+        if current:
+            pieces.append(current)
+        if count_tokens(sentence) > max_tokens:
+            windows = split_by_tokens(sentence, max_tokens, overlap_tokens)
+            pieces.extend(windows[:-1])
+            current = windows[-1]
+        else:
+            current = sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _tail(text: str, overlap_tokens: int) -> str:
+    """Last overlap_tokens tokens of a paragraph, used to seed the next chunk."""
+    if overlap_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return encoding.decode(tokens[-overlap_tokens:]) if len(tokens) > overlap_tokens else ""
+    words = text.split()
+    n = max(1, int(overlap_tokens / 1.3))
+    return " ".join(words[-n:]) if len(words) > n else ""
+
+
+def _section_prefix(heading_path: List[Dict[str, Any]], max_tokens: int) -> List[Dict[str, Any]]:
+    """Headings written at the top of a section's chunks: the whole path, or the last heading if that is too long."""
+    if heading_path and count_tokens(" > ".join(h["text"] for h in heading_path)) > max_tokens // 2:
+        return heading_path[-1:]
+    return heading_path
+
+
+def chunk_blocks(
+    blocks: List[Dict[str, Any]],
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[Dict[str, Any]]:
+    """
+    Pack blocks into chunks of at most max_tokens tokens.
+
+    A heading always starts a new chunk and updates the heading path; paragraphs
+    are packed greedily with a small token overlap inside a section; tables are
+    never merged with surrounding text. Chunk text starts with the section's
+    heading path ("Chapter 1 > 1.2 Scope"); a heading followed directly by a
+    sibling or the end of the document is emitted as a chunk of its own.
+    Returns [{"text", "page_start", "page_end", "heading_path", "block_types", "token_count"}].
+    """
+    chunks: List[Dict[str, Any]] = []
+    heading_path: List[Dict[str, Any]] = []
+    prefix_headings: List[Dict[str, Any]] = []
+    prefix = ""
+    budget = max_tokens
+    # The last heading has not appeared in any chunk yet
+    pending = False
+    parts: List[str] = []
+    pages: List[int] = []
+    types: List[str] = []
+    tokens = 0
+
+    def emit(text: str, chunk_pages: List[int], chunk_types: List[str]):
+        nonlocal pending
+        text = f"{prefix}\n\n{text}" if prefix and text else (text or prefix)
+        chunks.append({
+            "text": text,
+            "page_start": min(chunk_pages) if chunk_pages else None,
+            "page_end": max(chunk_pages) if chunk_pages else None,
+            "heading_path": [h["text"] for h in heading_path],
+            "block_types": sorted(set(chunk_types)),
+            "token_count": count_tokens(text),
+        })
+        pending = False
+
+    def flush():
+        nonlocal parts, pages, types, tokens
+        if parts:
+            text = "\n\n".join(parts).strip()
+            if text:
+                emit(text, pages, types)
+        parts, pages, types, tokens = [], [], [], 0
+
+    for block in blocks:
+        text = (block.get("text") or "").strip()
+        if not text:
+            continue
+        page = block.get("page")
+        if block.get("type") == "heading" and count_tokens(text) <= max_tokens // 2:
+            flush()
+            level = block.get("level") or 1
+            new_path = [h for h in heading_path if h["level"] < level] + [{"level": level, "text": text, "page": page}]
+            new_prefix = _section_prefix(new_path, max_tokens)
+            if pending and heading_path[-1] not in new_prefix:
+                emit("", [heading_path[-1]["page"]] if heading_path[-1]["page"] else [], ["heading"])
+            heading_path, prefix_headings, pending = new_path, new_prefix, True
+            prefix = " > ".join(h["text"] for h in prefix_headings)
+            budget = max(1, max_tokens - count_tokens(prefix) - 1)
+            continue
+
+        block_tokens = count_tokens(text)
+        is_table = block.get("type") == "table"
+        if block_tokens > budget:
+            flush()
+            for piece in _split_block(block, budget, overlap_tokens):
+                parts, pages, types, tokens = [piece], [page] if page else [], [block.get("type", "paragraph")], 0
+                flush()
+            continue
+        if is_table or (parts and "table" in types):
+            flush()
+        elif tokens + block_tokens > budget:
+            seed = _tail(parts[-1], overlap_tokens) if parts else ""
+            seed_page = pages[-1] if pages else None
+            flush()
+            if seed and count_tokens(seed) + block_tokens <= budget:
+                parts, pages, types, tokens = [seed], [seed_page] if seed_page else [], ["paragraph"], count_tokens(seed)
+        parts.append(text)
+        if page:
+            pages.append(page)
+        types.append(block.get("type", "paragraph"))
+        tokens += block_tokens
+    flush()
+    if pending:
+        emit("", [heading_path[-1]["page"]] if heading_path[-1]["page"] else [], ["heading"])
+    return chunks
+
+
+def chunk_document(
+    content: str,
+    blocks: Optional[List[Dict[str, Any]]] = None,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+) -> List[Dict[str, Any]]:
+    """Chunk one document from its extracted blocks, or from plain text when none are available."""
+    return chunk_blocks(blocks or blocks_from_text(content), max_tokens=max_tokens, overlap_tokens=overlap_tokens)
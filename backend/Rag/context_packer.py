@@ -0,0 +1,189 @@
+"""
+Token-budget context packing for retrieved chunks.
+
+Retrieval paths hand over scored items; the packer removes duplicate and
+overlapping chunks, merges runs of adjacent chunk_index neighbours from the same
+document into one passage, then fills a per-route token budget by score.
+Packed token counts are added to the turn's token_usage["context_tokens"].
+
+Item: {"text": str, "score": float, "source": str | None, "chunk_index": int | None, ...}
+"""
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from Rag.chunker import count_tokens, split_by_tokens
+
+# Per-route budgets (tokens of retrieved context placed in the prompt)
+CONTEXT_BUDGETS: Dict[str, int] = {
+    "rag_user": int(os.getenv("CONTEXT_BUDGET_RAG_USER", "6000")),
+    "rag_kb": int(os.getenv("CONTEXT_BUDGET_RAG_KB", "3000")),
+    "rag_json": int(os.getenv("CONTEXT_BUDGET_RAG_JSON", "12000")),
+    "simple_kb": int(os.getenv("CONTEXT_BUDGET_SIMPLE_KB", "1500")),
+    "simple_json": int(os.getenv("CONTEXT_BUDGET_SIMPLE_JSON", "8000")),
+}
+# Below this many remaining tokens, a non-fitting item is dropped instead of truncated
+MIN_TRUNCATED_TOKENS = int(os.getenv("CONTEXT_MIN_TRUNCATED_TOKENS", "64"))
+TRUNCATION_MARKER = "\n...[truncated to fit the context budget]"
+
+
+def context_budget(route: str) -> int:
+    return CONTEXT_BUDGETS.get(route, CONTEXT_BUDGETS["rag_kb"])
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+def _join_overlapping(left: str, right: str, max_overlap: int = 600) -> str:
+    """Concatenate two neighbouring chunks, dropping the text they share at the seam."""
+    limit = min(len(left), len(right), max_overlap)
+    for size in range(limit, 15, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return f"{left}\n{right}"
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Prefix of text with at most max_tokens tokens (re-encoding a cut can add a token)."""
+    while max_tokens > 0:
+        cut = split_by_tokens(text, max_tokens)[0]
+        if count_tokens(cut) <= max_tokens:
+            return cut
+        max_tokens -= 1
+    return ""
+
+
+def ranked_items(texts: List[str], **fields) -> List[Dict[str, Any]]:
+    """Wrap an already ranked list of texts as items scored by rank."""
+    return [{"text": t, "score": 1.0 / (rank + 1), **fields} for rank, t in enumerate(texts) if t]
+
+
+def dedupe_items(items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """Drop exact duplicates and chunks fully contained in a higher-scored one."""
+    kept: List[Dict[str, Any]] = []
+    kept_norm: List[str] = []
+    dropped = 0
+    for item in sorted(items, key=lambda i: i.get("score", 0), reverse=True):
+        norm = _normalize(item.get("text", ""))
+        if not norm or any(norm in other for other in kept_norm):
+            dropped += 1
+            continue
+        kept.append(item)
+        kept_norm.append(norm)
+    return kept, dropped
+
+
+def merge_neighbours(items: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+    """Merge consecutive chunk_index runs of the same source into single passages."""
+    by_source: Dict[str, List[Dict[str, Any]]] = {}
+    passthrough: List[Dict[str, Any]] = []
+    for item in items:
+        if item.get("source") is not None and item.get("chunk_index") is not None:
+            by_source.setdefault(item["source"], []).append(item)
+        else:
+            passthrough.append(item)
+
+    merged_items: List[Dict[str, Any]] = []
+    merges = 0
+    for source_items in by_source.values():
+        source_items.sort(key=lambda i: i["chunk_index"])
+        run = dict(source_items[0], chunk_end=source_items[0]["chunk_index"])
+        for item in source_items[1:]:
+            if item["chunk_index"] == run["chunk_end"] + 1:
+                run["text"] = _join_overlapping(run["text"], item["text"])
+                run["score"] = max(run.get("score", 0), item.get("score", 0))
+                run["chunk_end"] = item["chunk_index"]
+                merges += 1
+            else:
+                merged_items.append(run)
+                run = dict(item, chunk_end=item["chunk_index"])
+        merged_items.append(run)
+    return merged_items + passthrough, merges
+
+
+def pack_items(items: List[Dict[str, Any]], budget_tokens: int) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Dedupe, merge neighbours and fill budget_tokens by score (highest first).
+    Returns (packed items in score order, stats).
+    """
+    deduped, duplicates = dedupe_items(items)
+    merged, merges = merge_neighbours(deduped)
+    packed: List[Dict[str, Any]] = []
+    used = 0
+    truncated = 0
+    for item in sorted(merged, key=lambda i: i.get("score", 0), reverse=True):
+        tokens = count_tokens(item["text"])
+        remaining = budget_tokens - used
+        if tokens <= remaining:
+            packed.append({**item, "tokens": tokens})
+            used += tokens
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            text = _truncate(item["text"], remaining)
+            tokens = count_tokens(text)
+            packed.append({**item, "text": text, "tokens": tokens, "truncated": True})
+            used += tokens
+            truncated += 1
+    stats = {
+        "items_in": len(items),
+        "duplicates_dropped": duplicates,
+        "neighbours_merged": merges,
+        "items_packed": len(packed),
+        "items_truncated": truncated,
+        "packed_tokens": used,
+        "budget_tokens": budget_tokens,
+    }
+    return packed, stats
+
+
+def pack_texts(texts: List[str], route: str, budget_tokens: Optional[int] = None) -> Tuple[List[str], Dict[str, int]]:
+    """Pack an already ranked list of texts; returns (texts, stats)."""
+    packed, stats = pack_items(ranked_items(texts), budget_tokens if budget_tokens is not None else context_budget(route))
+    return [item["text"] for item in packed], stats
+
+
+def pack_documents(documents: List[str], route: str, budget_tokens: Optional[int] = None) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Pack whole documents (e.g. JSON) in their given order: each one is kept intact
+    while it fits, the first that does not is truncated and the rest are dropped.
+    """
+    budget_tokens = budget_tokens if budget_tokens is not None else context_budget(route)
+    packed: List[str] = []
+    used = 0
+    truncated = 0
+    for document in documents:
+        tokens = count_tokens(document)
+        remaining = budget_tokens - used
+        if tokens <= remaining:
+            packed.append(document)
+            used += tokens
+            continue
+        if remaining >= MIN_TRUNCATED_TOKENS:
+            text = _truncate(document, remaining - count_tokens(TRUNCATION_MARKER)) + TRUNCATION_MARKER
+            packed.append(text)
+            used += count_tokens(text)
+            truncated += 1
+        break
+    stats = {
+        "items_in": len(documents),
+        "items_packed": len(packed),
+        "items_truncated": truncated,
+        "packed_tokens": used,
+        "budget_tokens": budget_tokens,
+    }
+    return packed, stats
+
+
+def record_packed_tokens(state: Optional[Dict[str, Any]], route: str, stats: Dict[str, int]):
+    """Add packed context tokens to the turn's token_usage and log the packing result."""
+    print(
+        f"[CONTEXT-PACKER] {route}: {stats.get('items_packed', 0)}/{stats.get('items_in', 0)} items, "
+        f"{stats.get('packed_tokens', 0)}/{stats.get('budget_tokens', 0)} tokens "
+        f"(dupes={stats.get('duplicates_dropped', 0)}, merged={stats.get('neighbours_merged', 0)}, "
+        f"truncated={stats.get('items_truncated', 0)})"
+    )
+    if state is None:
+        return
+    if "token_usage" not in state or state["token_usage"] is None:
+        state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    state["token_usage"]["context_tokens"] = state["token_usage"].get("context_tokens", 0) + stats.get("packed_tokens", 0)
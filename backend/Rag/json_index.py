@@ -0,0 +1,430 @@
+"""
+Structural index for large JSON documents.
+
+Small JSON files are still injected whole. Files above JSON_INDEX_MIN_TOKENS are
+split into path-addressable subtrees (JSONPath -> compact JSON), each embedded
+together with the key names it contains, plus a compact schema summary. Per
+query only the schema and the best matching subtrees reach the prompt.
+
+Layout:
+    user_json:{session_id}:{doc} / kb_json:{gpt}_{user}:{doc}
+        str  schema summary, starting with JSON_INDEX_HEADER (listing/selection keep working)
+    json_index:{that key}
+        bytes  zlib-compressed JSON {"schema": str, "units": [{"path", "json", "keys"}]}
+    Qdrant user_json_{session_id} / kb_json_{gpt}_{user}
+        one point per unit, payload {doc_key, unit_index, path}
+
+Benchmark (prompt tokens of a synthetic JSON export, whole vs. indexed):
+    python -m Rag.json_index [size_mb]
+"""
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from redis_client import ensure_redis_client_binary
+from Rag.chunker import count_tokens
+
+JSON_INDEX_HEADER = "[Indexed JSON document]"
+JSON_INDEX_PREFIX = "json_index"
+# Documents below this size are injected whole, as before
+JSON_INDEX_MIN_TOKENS = int(os.getenv("JSON_INDEX_MIN_TOKENS", "4000"))
+JSON_UNIT_MAX_CHARS = int(os.getenv("JSON_UNIT_MAX_CHARS", "1600"))
+JSON_SCHEMA_MAX_LINES = int(os.getenv("JSON_SCHEMA_MAX_LINES", "80"))
+JSON_INDEX_TOP_K = int(os.getenv("JSON_INDEX_TOP_K", "8"))
+
+_IDENTIFIER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def json_index_key(doc_key: str) -> str:
+    return f"{JSON_INDEX_PREFIX}:{doc_key}"
+
+
+def json_units_collection(doc_key: str) -> str:
+    """Qdrant collection holding unit embeddings for the scope of a JSON doc key."""
+    prefix, scope, _ = doc_key.split(":", 2)
+    return f"{prefix}_{scope}"
+
+
+def is_indexed_json(content: Optional[str]) -> bool:
+    return bool(content) and content.startswith(JSON_INDEX_HEADER)
+
+
+def _child_path(path: str, key: Any) -> str:
+    if isinstance(key, int):
+        return f"{path}[{key}]"
+    return f"{path}.{key}" if _IDENTIFIER_RE.match(str(key)) else f"{path}[{json.dumps(str(key))}]"
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _collect_keys(node: Any, keys: set, limit: int = 64):
+    if len(keys) >= limit:
+        return
+    if isinstance(node, dict):
+        for k, v in node.items():
+            keys.add(str(k))
+            _collect_keys(v, keys, limit)
+    elif isinstance(node, list):
+        for v in node[:20]:
+            _collect_keys(v, keys, limit)
+
+
+def flatten_records(node: Any, path: str = "$") -> List[Tuple[str, Any]]:
+    """All (JSONPath, scalar value) records of a document."""
+    if isinstance(node, dict):
+        return [r for k, v in node.items() for r in flatten_records(v, _child_path(path, k))]
+    if isinstance(node, list):
+        return [r for i, v in enumerate(node) for r in flatten_records(v, _child_path(path, i))]
+    return [(path, node)]
+
+
+def _part_paths(units: List[Dict[str, Any]], path: str):
+    """Give units that share one path a part suffix: $.config (part 1/3)."""
+    if len(units) > 1:
+        for n, unit in enumerate(units, start=1):
+            unit["path"] = f"{path} (part {n}/{len(units)})"
+
+
+def _split_scalar(value: Any, text: str, path: str) -> List[Dict[str, Any]]:
+    """Continuation units of a scalar larger than a unit (long strings are cut, nothing is dropped)."""
+    if isinstance(value, str):
+        pieces = [_dumps(value[i:i + JSON_UNIT_MAX_CHARS]) for i in range(0, len(value), JSON_UNIT_MAX_CHARS)]
+    else:
+        pieces = [text[i:i + JSON_UNIT_MAX_CHARS] for i in range(0, len(text), JSON_UNIT_MAX_CHARS)]
+    units = [{"path": path, "json": piece, "keys": []} for piece in pieces]
+    _part_paths(units, path)
+    return units
+
+
+def split_units(node: Any, path: str = "$") -> List[Dict[str, Any]]:
+    """
+    Cut a document into subtrees of at most JSON_UNIT_MAX_CHARS serialized chars.
+    Containers that fit become one unit; larger ones are descended, packing runs
+    of small members together (e.g. $.items[0:12]) so units stay near the limit.
+    Members of one object packed into several units, and scalars too long for
+    one unit, get part suffixes ($.config (part 2/3)), so every path is unique.
+    """
+    text = _dumps(node)
+    if not isinstance(node, (dict, list)) and len(text) > JSON_UNIT_MAX_CHARS:
+        return _split_scalar(node, text, path)
+    if len(text) <= JSON_UNIT_MAX_CHARS or not isinstance(node, (dict, list)):
+        keys: set = set()
+        _collect_keys(node, keys)
+        return [{"path": path, "json": text, "keys": sorted(keys)}]
+
+    is_dict = isinstance(node, dict)
+    units: List[Dict[str, Any]] = []
+    # Packed groups of this object's members, which all share its path
+    object_parts: List[Dict[str, Any]] = []
+    group: List[Tuple[Any, Any]] = []
+    group_chars = 0
+
+    def flush():
+        nonlocal group, group_chars
+        if not group:
+            return
+        if is_dict:
+            value = {str(k): v for k, v in group}
+            group_path = path
+        else:
+            value = [v for _, v in group]
+            first, last = group[0][0], group[-1][0]
+            group_path = f"{path}[{first}]" if first == last else f"{path}[{first}:{last + 1}]"
+        keys: set = set(value.keys()) if is_dict else set()
+        _collect_keys(value, keys)
+        units.append({"path": group_path, "json": _dumps(value), "keys": sorted(keys)})
+        if is_dict:
+            object_parts.append(units[-1])
+        group, group_chars = [], 0
+
+    for key, value in (node.items() if is_dict else enumerate(node)):
+        size = len(_dumps(value))
+        if size > JSON_UNIT_MAX_CHARS:
+            flush()
+            units.extend(split_units(value, _child_path(path, key)))
+            continue
+        # Serialized size inside the group: separator, plus the quoted key for objects
+        size += 1 + (len(_dumps(str(key))) + 1 if is_dict else 0)
+        if group and group_chars + size > JSON_UNIT_MAX_CHARS:
+            flush()
+        group.append((key, value))
+        group_chars += size
+    flush()
+    _part_paths(object_parts, path)
+    return units
+
+
+def schema_summary(node: Any) -> str:
+    """Compact schema: generalized paths ([*] for array items) with types, counts and an example."""
+    stats: Dict[str, Dict[str, Any]] = {}
+
+    def walk(value: Any, path: str):
+        entry = stats.setdefault(path, {"types": set(), "count": 0, "example": None, "length": 0})
+        entry["count"] += 1
+        if isinstance(value, dict):
+            entry["types"].add("object")
+            for k, v in value.items():
+                walk(v, _child_path(path, k))
+        elif isinstance(value, list):
+            entry["types"].add("array")
+            entry["length"] = max(entry["length"], len(value))
+            for v in value:
+                walk(v, f"{path}[*]")
+        else:
+            entry["types"].add(type(value).__name__ if value is not None else "null")
+            if entry["example"] is None and value is not None:
+                entry["example"] = _dumps(value)[:60]
+
+    walk(node, "$")
+    lines = []
+    for path, entry in stats.items():
+        line = f"{path}: {'|'.join(sorted(entry['types']))} ({entry['count']}x)"
+        if entry["length"]:
+            line += f", up to {entry['length']} items"
+        if entry["example"]:
+            line += f", e.g. {entry['example']}"
+        lines.append(line)
+    if len(lines) > JSON_SCHEMA_MAX_LINES:
+        lines = lines[:JSON_SCHEMA_MAX_LINES] + [f"... {len(lines) - JSON_SCHEMA_MAX_LINES} more paths"]
+    return "\n".join(lines)
+
+
+def should_index_json(content: str) -> bool:
+    return count_tokens(content) >= JSON_INDEX_MIN_TOKENS
+
+
+def _unit_embedding_text(unit: Dict[str, Any]) -> str:
+    return f"{unit['path']} | keys: {', '.join(unit['keys'][:30])} | {unit['json'][:500]}"
+
+
+async def build_json_index(
+    doc_key: str,
+    content: str,
+    filename: str,
+    ttl: Optional[int] = None,
+    api_keys: Optional[Dict[str, str]] = None,
+) -> Optional[str]:
+    """
+    Index a large JSON document. Returns the schema-summary text to store under
+    doc_key, or None when the content is not valid JSON (caller stores it raw).
+    """
+    from Rag.Rag import QDRANT_CLIENT, VECTOR_SIZE, models
+    from embeddings import embed_chunks_parallel
+
+    try:
+        data = await asyncio.to_thread(json.loads, content)
+    except (TypeError, ValueError):
+        return None
+
+    units = await asyncio.to_thread(split_units, data)
+    schema = await asyncio.to_thread(schema_summary, data)
+    records = await asyncio.to_thread(flatten_records, data)
+    summary = (
+        f"{JSON_INDEX_HEADER} {filename}\n"
+        f"{len(records)} values in {len(units)} indexed subtrees; only the parts relevant to the question are included.\n"
+        f"Schema:\n{schema}"
+    )
+
+    redis_client_binary = await ensure_redis_client_binary()
+    if not redis_client_binary:
+        return None
+    compressed = zlib.compress(json.dumps({"schema": schema, "units": units}).encode("utf-8"), 6)
+    await redis_client_binary.set(json_index_key(doc_key), compressed, ex=ttl or None)
+
+    collection_name = json_units_collection(doc_key)
+    embeddings = await embed_chunks_parallel([_unit_embedding_text(u) for u in units], batch_size=200, api_keys=api_keys)
+    if not await asyncio.to_thread(QDRANT_CLIENT.collection_exists, collection_name):
+        await asyncio.to_thread(
+            QDRANT_CLIENT.create_collection,
+            collection_name=collection_name,
+            vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE, on_disk=True),
+        )
+        await asyncio.to_thread(
+            QDRANT_CLIENT.create_payload_index,
+            collection_name=collection_name,
+            field_name="doc_key",
+            field_schema=models.PayloadSchemaType.KEYWORD
+        )
+    else:
+        await delete_json_index_points(doc_key)
+    points = [
+        models.PointStruct(
+            id=str(uuid.uuid4()),
+            vector=embedding,
+            payload={"doc_key": doc_key, "unit_index": i, "path": unit["path"]},
+        )
+        for i, (unit, embedding) in enumerate(zip(units, embeddings))
+    ]
+    for i in range(0, len(points), 256):
+        await asyncio.to_thread(QDRANT_CLIENT.upsert, collection_name=collection_name, points=points[i:i + 256])
+
+    print(
+        f"[JSON-INDEX] Indexed {filename}: {len(records)} records, {len(units)} subtrees, "
+        f"{len(content)} -> {len(compressed)} bytes compressed"
+    )
+    return summary
+
+
+async def delete_json_index_points(doc_key: str):
+    """Remove the unit embeddings of one JSON document."""
+    from Rag.Rag import QDRANT_CLIENT, models
+
+    try:
+        await asyncio.to_thread(
+            QDRANT_CLIENT.delete,
+            collection_name=json_units_collection(doc_key),
+            points_selector=models.FilterSelector(filter=models.Filter(
+                must=[models.FieldCondition(key="doc_key", match=models.MatchValue(value=doc_key))]
+            )),
+        )
+    except Exception as e:
+        print(f"[JSON-INDEX] Could not delete unit points for {doc_key}: {e}")
+
+
+async def query_json_index(
+    doc_key: str,
+    summary: str,
+    query: Optional[str],
+    api_keys: Optional[Dict[str, str]] = None,
+    top_k: int = JSON_INDEX_TOP_K,
+) -> str:
+    """Schema summary plus the subtrees that best match the query (document order)."""
+    if not query:
+        return summary
+    from Rag.Rag import QDRANT_CLIENT, models, tokenize
+    from embeddings import embed_query
+
+    redis_client_binary = await ensure_redis_client_binary()
+    raw = await redis_client_binary.get(json_index_key(doc_key)) if redis_client_binary else None
+    if not raw:
+        return summary
+    index = json.loads(zlib.decompress(raw).decode("utf-8"))
+    units = index.get("units", [])
+
+    scores: Dict[int, float] = {}
+    try:
+        query_embedding = await embed_query(query, api_keys=api_keys)
+        results = await asyncio.to_thread(
+            QDRANT_CLIENT.search,
+            collection_name=json_units_collection(doc_key),
+            query_vector=query_embedding,
+            limit=top_k * 3,
+            query_filter=models.Filter(
+                must=[models.FieldCondition(key="doc_key", match=models.MatchValue(value=doc_key))]
+            ),
+        )
+        for r in results:
+            scores[int(r.payload["unit_index"])] = float(r.score)
+    except Exception as e:
+        print(f"[JSON-INDEX] Vector search failed for {doc_key}, using key matches only: {e}")
+
+    # Key-level matches: query terms that name a key or path segment
+    terms = set(tokenize(query))
+    if terms:
+        for i, unit in enumerate(units):
+            path = unit["path"].split(" (part ")[0]
+            names = {k.lower() for k in unit.get("keys", [])} | set(re.findall(r"\w+", path.lower()))
+            hits = len(terms & names)
+            if hits:
+                scores[i] = scores.get(i, 0.0) + 0.1 * hits
+
+    selected = sorted(sorted(scores, key=scores.get, reverse=True)[:top_k])
+    if not selected:
+        return summary
+    subtrees = "\n".join(f"{units[i]['path']}: {units[i]['json']}" for i in selected if i < len(units))
+    return f"{summary}\n\nMatching subtrees:\n{subtrees}"
+
+
+BENCH_QUERIES = [
+    "What is the status of order 1234?",
+    "Which items did customer 42 buy and at what price?",
+    "Show the shipping address of order 777",
+    "What do the support notes say about refunds?",
+    "What is the export's schema version?",
+]
+
+
+def _bench_document(size_mb: float) -> str:
+    """Synthetic order export of about size_mb megabytes (every 50th order has long notes)."""
+    def order(i: int) -> Dict[str, Any]:
+        record = {
+            "id": i,
+            "status": ["pending", "shipped", "delivered", "refunded"][i % 4],
+            "customer": {"id": i % 997, "name": f"Customer {i % 997}", "email": f"customer{i % 997}@example.com"},
+            "shipping": {"street": f"{i} Market Street", "city": ["Berlin", "Austin", "Pune"][i % 3], "zip": f"{10000 + i}"},
+            "items": [{"sku": f"SKU-{(i * 7 + n) % 5000}", "qty": n + 1, "price": round(9.99 + n * 3.5, 2)} for n in range(i % 4 + 1)],
+        }
+        if i % 50 == 0:
+            record["notes"] = " ".join(f"Support note {n} for order {i}: customer asked about refunds and delivery times." for n in range(60))
+        return record
+
+    target = int(size_mb * 1024 * 1024)
+    sample = len(_dumps([order(i) for i in range(1, 101)])) / 100
+    count = max(1, int(target / sample))
+    return _dumps({"export": {"schema_version": "2.3", "source": "benchmark"}, "orders": [order(i) for i in range(1, count + 1)]})
+
+
+async def benchmark_json_index(
+    size_mb: float = 5.0,
+    queries: Optional[List[str]] = None,
+    doc_key: str = "user_json:json_index_bench:orders.json",
+) -> Dict[str, Any]:
+    """
+    Prompt tokens of a large JSON document injected whole vs. schema summary plus
+    matching subtrees, with indexing time and the compressed index size.
+    Uses the configured embeddings, Redis and Qdrant.
+    """
+    from Rag.Rag import QDRANT_CLIENT
+
+    queries = queries or BENCH_QUERIES
+    content = _bench_document(size_mb)
+    whole_tokens = count_tokens(content)
+    try:
+        start = time.perf_counter()
+        summary = await build_json_index(doc_key, content, "orders.json")
+        index_seconds = time.perf_counter() - start
+        if summary is None:
+            raise RuntimeError("JSON index could not be built (is Redis available?)")
+        redis_client_binary = await ensure_redis_client_binary()
+        compressed = await redis_client_binary.get(json_index_key(doc_key))
+
+        query_tokens, query_ms = [], []
+        for query in queries:
+            start = time.perf_counter()
+            rendered = await query_json_index(doc_key, summary, query)
+            query_ms.append((time.perf_counter() - start) * 1000)
+            query_tokens.append(count_tokens(rendered))
+    finally:
+        redis_client_binary = await ensure_redis_client_binary()
+        if redis_client_binary:
+            await redis_client_binary.delete(json_index_key(doc_key))
+        if await asyncio.to_thread(QDRANT_CLIENT.collection_exists, json_units_collection(doc_key)):
+            await asyncio.to_thread(QDRANT_CLIENT.delete_collection, json_units_collection(doc_key))
+
+    query_tokens.sort()
+    query_ms.sort()
+    result = {
+        "bytes": len(content),
+        "compressed_index_bytes": len(compressed),
+        "index_seconds": round(index_seconds, 2),
+        "whole_tokens": whole_tokens,
+        "query_tokens_median": query_tokens[len(query_tokens) // 2],
+        "query_tokens_max": query_tokens[-1],
+        "query_ms_median": round(query_ms[len(query_ms) // 2], 1),
+        "token_reduction": round(whole_tokens / max(1, query_tokens[-1]), 1),
+    }
+    print(f"[JSON-INDEX-BENCH] {result}")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    asyncio.run(benchmark_json_index(*[float(a) for a in sys.argv[1:2]]))
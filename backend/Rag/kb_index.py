@@ -0,0 +1,211 @@
+"""
+Shared per-GPT knowledge base index.
+
+Every user of a GPT reads the same KB, so it is indexed once per gpt_id under
+the pseudo-owner "shared" (collection kb_{gpt_id}_shared, KB JSON scope
+kb_json:{gpt_id}_shared) instead of once per user. Syncs run under a Redis
+lock so concurrent GPT loads do not embed twice, and full-list syncs are skipped
+while the KB version (fingerprint of its file set, kept in the KB manifest) is
+unchanged and the collection still exists.
+
+The userId in a GPT config is the GPT's owner, not the chatting user, so the
+backend has no per-user identity to check access against: reading a GPT's KB is
+governed by access to the GPT itself. migrate_per_user_kb_collections()
+collapses existing kb_{gpt_id}_{userId} copies into the shared collection
+without re-embedding.
+"""
+import asyncio
+import hashlib
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Iterable, List
+
+from redis_client import ensure_redis_client
+from Rag.kb_manifest import content_hash
+from Rag.qdrant_store import reset_collection
+
+KB_SHARED_INDEX = os.getenv("KB_SHARED_INDEX", "true").lower() == "true"
+KB_SHARED_OWNER = "shared"
+KB_INDEX_LOCK_TIMEOUT = int(os.getenv("KB_INDEX_LOCK_TIMEOUT", "900"))
+
+
+def kb_owner(userId: str) -> str:
+    """Owner segment of KB keys and collection names."""
+    return KB_SHARED_OWNER if KB_SHARED_INDEX else userId
+
+
+def kb_collection_name(gpt_id: str, userId: str) -> str:
+    return f"kb_{gpt_id}_{kb_owner(userId)}"
+
+
+def kb_version(kb_docs: Iterable[Any]) -> str:
+    """
+    Fingerprint of a KB's file set: file_url plus the content hash when content
+    is present (placeholders of already-embedded files carry none), or the
+    content alone for documents without a file_url.
+    """
+    identities = []
+    for doc in kb_docs or []:
+        if isinstance(doc, dict) and doc.get("file_url"):
+            content = doc.get("content")
+            identities.append(doc["file_url"] + ("#" + content_hash(content) if content else ""))
+        else:
+            content = doc.get("content", "") if isinstance(doc, dict) else str(doc)
+            identities.append("content:" + hashlib.sha256(str(content).encode("utf-8", errors="ignore")).hexdigest())
+    return hashlib.sha256("\n".join(sorted(identities)).encode("utf-8")).hexdigest()[:16]
+
+
+@asynccontextmanager
+async def kb_index_lock(gpt_id: str):
+    """Serialise KB syncs of one GPT across workers."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        yield
+        return
+    async with redis_client.lock(
+        f"kb_index_lock:{gpt_id}", timeout=KB_INDEX_LOCK_TIMEOUT, blocking_timeout=KB_INDEX_LOCK_TIMEOUT
+    ):
+        yield
+
+
+def _parse_per_user_collection(name: str) -> Any:
+    """(gpt_id, userId) of a per-user KB collection name, else None."""
+    if not name.startswith("kb_") or name.startswith("kb_json_"):
+        return None
+    gpt_id, _, userId = name[3:].rpartition("_")
+    if not gpt_id or not userId or userId == KB_SHARED_OWNER:
+        return None
+    return gpt_id, userId
+
+
+async def _copy_collection(source: str, target: str) -> List[Any]:
+    """Copy every point (ids, vectors, payloads) into a new collection with the same vector config."""
+    from qdrant_client import models
+    from Rag.Rag import QDRANT_CLIENT, QDRANT_UPSERT_BATCH_SIZE
+
+    info = await asyncio.to_thread(QDRANT_CLIENT.get_collection, source)
+    await asyncio.to_thread(
+        reset_collection,
+        QDRANT_CLIENT,
+        target,
+        vectors_config=info.config.params.vectors,
+        sparse_vectors_config=info.config.params.sparse_vectors,
+    )
+    for field in ("doc_id", "filename", "file_type", "file_url"):
+        await asyncio.to_thread(
+            QDRANT_CLIENT.create_payload_index,
+            collection_name=target,
+            field_name=field,
+            field_schema=models.PayloadSchemaType.KEYWORD,
+        )
+    copied = []
+    offset = None
+    while True:
+        points, offset = await asyncio.to_thread(
+            QDRANT_CLIENT.scroll,
+            collection_name=source,
+            limit=QDRANT_UPSERT_BATCH_SIZE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        if points:
+            await asyncio.to_thread(
+                QDRANT_CLIENT.upsert,
+                collection_name=target,
+                points=[models.PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+            )
+            copied.extend(points)
+        if offset is None:
+            break
+    return copied
+
+
+async def _drop_collection_state(collection_name: str):
+    """Delete a KB collection and every Redis structure derived from it."""
+    from Rag.Rag import QDRANT_CLIENT
+    from Rag.kb_manifest import clear_kb_manifest
+    from Rag.kb_sync import kb_sync_reports_key
+    from Rag.chunk_registry import clear_chunk_registry
+    from Rag.bm25_index import clear_bm25_index
+    from Rag.near_dup import clear_near_dup_index
+    from Rag.sparse_hybrid import forget_collection
+
+    await asyncio.to_thread(QDRANT_CLIENT.delete_collection, collection_name=collection_name)
+    await clear_kb_manifest(collection_name)
+    await clear_chunk_registry(collection_name)
+    await clear_bm25_index(collection_name)
+    await clear_near_dup_index(collection_name)
+    forget_collection(collection_name)
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.delete(f"kb_cache:{collection_name}", kb_sync_reports_key(collection_name))
+
+
+async def migrate_per_user_kb_collections(dry_run: bool = True) -> Dict[str, Any]:
+    """
+    Collapse kb_{gpt_id}_{userId} collections into kb_{gpt_id}_shared.
+
+    Per GPT, the copy with the most points is copied (vectors included, no
+    re-embedding) unless a shared collection already exists; its manifest,
+    chunk registry and BM25 index are rebuilt from the copied payloads, then
+    all per-user copies are deleted. KB JSON
+    documents are re-stored under the shared scope on the next GPT load.
+    """
+    from Rag.Rag import QDRANT_CLIENT, tokenize
+    from Rag.kb_manifest import get_kb_manifest, record_kb_files
+    from Rag.chunk_registry import chunk_source_key, register_chunks
+    from Rag.bm25_index import get_bm25_version, index_chunks
+
+    start = time.time()
+    report = {"dry_run": dry_run, "gpts": 0, "collections_collapsed": 0, "points_copied": 0, "points_freed": 0, "errors": []}
+    if not KB_SHARED_INDEX:
+        report["errors"].append("KB_SHARED_INDEX is disabled")
+        return report
+
+    collections = [c.name for c in (await asyncio.to_thread(QDRANT_CLIENT.get_collections)).collections]
+    by_gpt: Dict[str, Dict[str, int]] = {}
+    for name in collections:
+        parsed = _parse_per_user_collection(name)
+        if parsed:
+            info = await asyncio.to_thread(QDRANT_CLIENT.get_collection, name)
+            by_gpt.setdefault(parsed[0], {})[name] = info.points_count or 0
+
+    for gpt_id, copies in by_gpt.items():
+        shared = kb_collection_name(gpt_id, KB_SHARED_OWNER)
+        source = max(copies, key=copies.get)
+        report["gpts"] += 1
+        report["collections_collapsed"] += len(copies)
+        report["points_freed"] += sum(copies.values()) - (0 if shared in collections else copies[source])
+        if dry_run:
+            continue
+        try:
+            if shared not in collections:
+                points = await _copy_collection(source, shared)
+                report["points_copied"] += len(points)
+                await register_chunks(shared, points)
+                manifest = await get_kb_manifest(source)
+                if manifest:
+                    await record_kb_files(shared, manifest)
+                else:
+                    counts: Dict[str, int] = {}
+                    for p in points:
+                        url = (p.payload or {}).get("file_url")
+                        if url:
+                            counts[url] = counts.get(url, 0) + 1
+                    await record_kb_files(shared, {u: {"content_hash": "", "chunk_count": c} for u, c in counts.items()})
+                if await get_bm25_version(source) is not None:
+                    await index_chunks(shared, [
+                        (str(p.id), chunk_source_key(p.payload), tokenize((p.payload or {}).get("text", ""))) for p in points
+                    ])
+            for name in copies:
+                await _drop_collection_state(name)
+            print(f"[KB-INDEX] Collapsed {len(copies)} KB copies of {gpt_id} into {shared}")
+        except Exception as e:
+            print(f"[KB-INDEX] Migration of {gpt_id} failed: {e}")
+            report["errors"].append(f"{gpt_id}: {e}")
+
+    report["duration_seconds"] = round(time.time() - start, 2)
+    print(f"[KB-INDEX] Migration: {report}")
+    return report
@@ -0,0 +1,217 @@
+"""
+Authoritative per-collection manifest of indexed KB files, kept in Redis.
+
+Layout:
+    kb_manifest:{collection}       hash  file_url -> JSON {content_hash, source_hash, source_version, chunk_count, ingested_at}
+    kb_manifest_meta:{collection}  hash  points, files, updated_at, kb_version
+
+The manifest is written in the same Redis transaction for every ingested batch,
+so "which files are indexed" and "is this KB ready" are O(1) lookups instead of
+scrolling the Qdrant collection.
+"""
+import hashlib
+import json
+import time
+from typing import Any, Dict, Iterable, Optional, Set
+
+from redis_client import ensure_redis_client
+
+KB_MANIFEST_PREFIX = "kb_manifest"
+KB_MANIFEST_META_PREFIX = "kb_manifest_meta"
+
+
+def kb_manifest_key(collection_name: str) -> str:
+    return f"{KB_MANIFEST_PREFIX}:{collection_name}"
+
+
+def kb_manifest_meta_key(collection_name: str) -> str:
+    return f"{KB_MANIFEST_META_PREFIX}:{collection_name}"
+
+
+def content_hash(content: Any) -> str:
+    """Stable hash of a document's extracted content ("" for empty content)."""
+    if not content:
+        return ""
+    if isinstance(content, str):
+        content = content.encode("utf-8", errors="ignore")
+    return hashlib.sha256(content).hexdigest()
+
+
+async def get_kb_manifest(collection_name: str) -> Optional[Dict[str, Dict[str, Any]]]:
+    """
+    Return {file_url: entry} for a KB collection, or None when no manifest exists
+    (e.g. collections indexed before the manifest was introduced).
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    try:
+        if not await redis_client.exists(kb_manifest_meta_key(collection_name)):
+            return None
+        raw = await redis_client.hgetall(kb_manifest_key(collection_name))
+        manifest = {}
+        for file_url, value in raw.items():
+            try:
+                manifest[file_url] = json.loads(value)
+            except (TypeError, ValueError):
+                manifest[file_url] = {}
+        return manifest
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error reading manifest for {collection_name}: {e}")
+        return None
+
+
+async def get_manifest_file_urls(collection_name: str) -> Optional[Set[str]]:
+    """Return the set of indexed file_urls, or None when no manifest exists."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    try:
+        if not await redis_client.exists(kb_manifest_meta_key(collection_name)):
+            return None
+        return set(await redis_client.hkeys(kb_manifest_key(collection_name)))
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error reading file list for {collection_name}: {e}")
+        return None
+
+
+async def kb_manifest_ready(collection_name: str) -> Optional[bool]:
+    """
+    O(1) readiness check: True if the manifest records at least one indexed point.
+    Returns None when no manifest exists so callers can fall back to Qdrant.
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    try:
+        points = await redis_client.hget(kb_manifest_meta_key(collection_name), "points")
+        if points is None:
+            return None
+        return int(points) > 0
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error checking readiness for {collection_name}: {e}")
+        return None
+
+
+async def record_kb_files(collection_name: str, entries: Dict[str, Dict[str, Any]]) -> bool:
+    """
+    Transactionally add/replace manifest entries after their points were upserted.
+
+    Args:
+        collection_name: KB collection name
+        entries: {file_url: {"content_hash": str, "chunk_count": int, ...}}
+    """
+    if not entries:
+        return True
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return False
+
+    manifest_key = kb_manifest_key(collection_name)
+    meta_key = kb_manifest_meta_key(collection_name)
+    file_urls = list(entries.keys())
+    now = time.time()
+
+    async def _apply(pipe):
+        previous = await pipe.hmget(manifest_key, file_urls)
+        points_delta = 0
+        files_delta = 0
+        mapping = {}
+        for file_url, old_raw in zip(file_urls, previous):
+            entry = dict(entries[file_url])
+            entry.setdefault("ingested_at", now)
+            chunk_count = int(entry.get("chunk_count", 0) or 0)
+            if old_raw:
+                try:
+                    points_delta -= int(json.loads(old_raw).get("chunk_count", 0) or 0)
+                except (TypeError, ValueError):
+                    pass
+            else:
+                files_delta += 1
+            points_delta += chunk_count
+            mapping[file_url] = json.dumps(entry)
+        pipe.multi()
+        pipe.hset(manifest_key, mapping=mapping)
+        pipe.hincrby(meta_key, "points", points_delta)
+        pipe.hincrby(meta_key, "files", files_delta)
+        pipe.hset(meta_key, "updated_at", str(now))
+
+    try:
+        await redis_client.transaction(_apply, manifest_key)
+        print(f"[KB-MANIFEST] Recorded {len(entries)} file(s) in manifest for {collection_name}")
+        return True
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error recording manifest entries for {collection_name}: {e}")
+        return False
+
+
+async def remove_kb_files(collection_name: str, file_urls: Iterable[str]) -> bool:
+    """Transactionally drop manifest entries (after their points were deleted)."""
+    file_urls = [u for u in file_urls if u]
+    if not file_urls:
+        return True
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return False
+
+    manifest_key = kb_manifest_key(collection_name)
+    meta_key = kb_manifest_meta_key(collection_name)
+
+    async def _apply(pipe):
+        previous = await pipe.hmget(manifest_key, file_urls)
+        points_delta = 0
+        files_delta = 0
+        for old_raw in previous:
+            if not old_raw:
+                continue
+            files_delta -= 1
+            try:
+                points_delta -= int(json.loads(old_raw).get("chunk_count", 0) or 0)
+            except (TypeError, ValueError):
+                pass
+        pipe.multi()
+        pipe.hdel(manifest_key, *file_urls)
+        pipe.hincrby(meta_key, "points", points_delta)
+        pipe.hincrby(meta_key, "files", files_delta)
+        pipe.hset(meta_key, "updated_at", str(time.time()))
+
+    try:
+        await redis_client.transaction(_apply, manifest_key)
+        return True
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error removing manifest entries for {collection_name}: {e}")
+        return False
+
+
+async def get_kb_version(collection_name: str) -> Optional[str]:
+    """Fingerprint of the KB file set the collection was last synced to (None if never)."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    try:
+        return await redis_client.hget(kb_manifest_meta_key(collection_name), "kb_version")
+    except Exception as e:
+        print(f"[KB-MANIFEST] Error reading KB version for {collection_name}: {e}")
+        return None
+
+
+async def set_kb_version(collection_name: str, version: str):
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.hset(kb_manifest_meta_key(collection_name), "kb_version", version)
+
+
+async def clear_kb_version(collection_name: str):
+    """Forget the synced version (the index no longer matches any listed file set)."""
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.hdel(kb_manifest_meta_key(collection_name), "kb_version")
+
+
+async def clear_kb_manifest(collection_name: str):
+    """Drop the manifest entirely (collection deleted or found missing in Qdrant)."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    await redis_client.delete(kb_manifest_key(collection_name), kb_manifest_meta_key(collection_name))
+    print(f"[KB-MANIFEST] Cleared manifest for {collection_name}")
@@ -0,0 +1,388 @@
+"""
+KB index snapshots: export a collection with everything derived from it and
+restore it without a single embedding call.
+
+A snapshot is one gzipped JSON-lines file:
+
+    {"type": "header", "format": 1, "collection", "vectors", "sparse_vectors", "created_at"}
+    {"type": "redis", "role": "kb_manifest", "data": {...}}       one line per Redis hash
+    {"type": "point", "id", "vector", "payload"}                  one line per point
+    {"type": "footer", "points": n, "redis": {role: field count}}
+
+Dense vectors are stored as base64 float32, sparse vectors as indices/values.
+The Redis hashes are the KB manifest, the BM25 inverted index, the
+near-duplicate LSH index and the summary tree, copied verbatim (point ids are
+kept, so they stay valid). The chunk registry is rebuilt from the payloads.
+Snapshots are written to KB_SNAPSHOT_DIR and optionally uploaded to object
+storage under kb_snapshots/.
+
+Only KB collections (kb_*) are exported or restored into, and a snapshot
+source is a file name in KB_SNAPSHOT_DIR or a kb_snapshots/ storage key;
+anything else (other paths, other collections) is rejected with ValueError.
+
+CLI:
+    python -m Rag.kb_snapshot export <collection> [--upload]
+    python -m Rag.kb_snapshot restore <file name | kb_snapshots/key> [--collection name]
+    python -m Rag.kb_snapshot verify <file name | kb_snapshots/key> [--collection name]
+"""
+import asyncio
+import base64
+import gzip
+import json
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from qdrant_client import models
+
+from redis_client import ensure_redis_client
+from Rag.kb_manifest import kb_manifest_key, kb_manifest_meta_key
+from Rag.bm25_index import bm25_keys, get_bm25_version
+from Rag.near_dup import near_dup_keys
+from Rag.summary_tree import summary_tree_key
+from Rag.chunk_registry import clear_chunk_registry, register_chunks
+from Rag.qdrant_store import reset_collection
+
+KB_SNAPSHOT_DIR = os.getenv("KB_SNAPSHOT_DIR", "snapshots/kb")
+KB_SNAPSHOT_STORAGE_PREFIX = "kb_snapshots"
+KB_SNAPSHOT_BATCH_SIZE = int(os.getenv("KB_SNAPSHOT_BATCH_SIZE", "256"))
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUFFIX = ".jsonl.gz"
+
+_KB_COLLECTION_RE = re.compile(r"kb_[A-Za-z0-9_.-]{1,240}")
+
+
+def check_collection_name(collection_name: Any) -> str:
+    """The name itself if it is a KB collection name (no path separators); ValueError otherwise."""
+    if not isinstance(collection_name, str) or not _KB_COLLECTION_RE.fullmatch(collection_name):
+        raise ValueError(f"Not a KB collection name: {collection_name!r}")
+    return collection_name
+
+
+def snapshot_path(collection_name: str) -> str:
+    return os.path.join(KB_SNAPSHOT_DIR, f"{check_collection_name(collection_name)}{SNAPSHOT_SUFFIX}")
+
+
+def _redis_hashes(collection_name: str) -> Dict[str, str]:
+    """Snapshot role -> Redis hash key of every structure copied verbatim."""
+    near_dup = near_dup_keys(collection_name)
+    hashes = {
+        "kb_manifest": kb_manifest_key(collection_name),
+        "kb_manifest_meta": kb_manifest_meta_key(collection_name),
+        "summary_tree": summary_tree_key(collection_name),
+        "near_dup:bands": near_dup["bands"],
+        "near_dup:sigs": near_dup["sigs"],
+        "near_dup:links": near_dup["links"],
+    }
+    hashes.update({f"bm25:{name}": key for name, key in bm25_keys(collection_name).items()})
+    return hashes
+
+
+def _gpt_of(collection_name: str) -> Optional[str]:
+    """gpt_id of a KB collection name (kb_{gpt_id}_{owner}), for the sync lock."""
+    if not collection_name.startswith("kb_"):
+        return None
+    return collection_name[3:].rpartition("_")[0] or None
+
+
+def _encode_dense(vector: Any) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("ascii")
+
+
+def _decode_dense(data: str) -> List[float]:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32).tolist()
+
+
+def encode_vector(vector: Any) -> Dict[str, Any]:
+    """JSON form of a point vector (unnamed dense, or named dense and sparse vectors)."""
+    if not isinstance(vector, dict):
+        return {"dense": _encode_dense(vector)}
+    encoded: Dict[str, Any] = {"named": {}, "sparse": {}}
+    for name, value in vector.items():
+        if isinstance(value, models.SparseVector):
+            encoded["sparse"][name] = {"indices": list(value.indices), "values": list(value.values)}
+        else:
+            encoded["named"][name] = _encode_dense(value)
+    return encoded
+
+
+def decode_vector(encoded: Dict[str, Any]) -> Any:
+    if "dense" in encoded:
+        return _decode_dense(encoded["dense"])
+    vector: Dict[str, Any] = {name: _decode_dense(data) for name, data in encoded.get("named", {}).items()}
+    for name, sparse in encoded.get("sparse", {}).items():
+        vector[name] = models.SparseVector(indices=sparse["indices"], values=sparse["values"])
+    return vector
+
+
+def _dump_config(config: Any) -> Any:
+    if config is None:
+        return None
+    if isinstance(config, dict):
+        return {name: params.model_dump(mode="json", exclude_none=True) for name, params in config.items()}
+    return config.model_dump(mode="json", exclude_none=True)
+
+
+def _vectors_config(dumped: Dict[str, Any]) -> Any:
+    if "size" in dumped:
+        return models.VectorParams(**dumped)
+    return {name: models.VectorParams(**params) for name, params in dumped.items()}
+
+
+def _lock(collection_name: str):
+    from contextlib import nullcontext
+    from Rag.kb_index import kb_index_lock
+
+    gpt_id = _gpt_of(collection_name)
+    return kb_index_lock(gpt_id) if gpt_id else nullcontext()
+
+
+async def export_kb_snapshot(collection_name: str, path: Optional[str] = None, upload: bool = False) -> Dict[str, Any]:
+    """Write a snapshot of one collection; with upload=True also store it in object storage."""
+    from Rag.Rag import QDRANT_CLIENT
+
+    start = time.time()
+    check_collection_name(collection_name)
+    path = path or snapshot_path(collection_name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    redis_client = await ensure_redis_client()
+    points = 0
+    redis_counts: Dict[str, int] = {}
+
+    async with _lock(collection_name):
+        info = await asyncio.to_thread(QDRANT_CLIENT.get_collection, collection_name)
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "type": "header",
+                "format": SNAPSHOT_FORMAT,
+                "collection": collection_name,
+                "vectors": _dump_config(info.config.params.vectors),
+                "sparse_vectors": _dump_config(info.config.params.sparse_vectors),
+                "created_at": time.time(),
+            }) + "\n")
+            if redis_client:
+                for role, key in _redis_hashes(collection_name).items():
+                    data = await redis_client.hgetall(key)
+                    if data:
+                        redis_counts[role] = len(data)
+                        f.write(json.dumps({"type": "redis", "role": role, "data": data}) + "\n")
+            offset = None
+            while True:
+                batch, offset = await asyncio.to_thread(
+                    QDRANT_CLIENT.scroll,
+                    collection_name=collection_name,
+                    limit=KB_SNAPSHOT_BATCH_SIZE,
+                    offset=offset,
+                    with_payload=True,
+                    with_vectors=True,
+                )
+                lines = "".join(
+                    json.dumps({"type": "point", "id": p.id, "vector": encode_vector(p.vector), "payload": p.payload}) + "\n"
+                    for p in batch
+                )
+                await asyncio.to_thread(f.write, lines)
+                points += len(batch)
+                if offset is None:
+                    break
+            f.write(json.dumps({"type": "footer", "points": points, "redis": redis_counts}) + "\n")
+        os.replace(tmp_path, path)
+
+    report = {
+        "collection": collection_name,
+        "path": path,
+        "points": points,
+        "redis": redis_counts,
+        "bytes": os.path.getsize(path),
+        "duration_seconds": round(time.time() - start, 2),
+    }
+    if upload:
+        from storage import storage
+
+        key = f"{KB_SNAPSHOT_STORAGE_PREFIX}/{os.path.basename(path)}"
+        ok, location = await asyncio.to_thread(storage.upload_local_file, path, key)
+        report["uploaded"] = location if ok else None
+        if not ok:
+            print(f"[KB-SNAPSHOT] Upload of {path} failed: {location}")
+    print(f"[KB-SNAPSHOT] Exported {report}")
+    return report
+
+
+def _snapshot_name(source: Any) -> str:
+    """File name of a snapshot source: a bare *.jsonl.gz name or kb_snapshots/<name>."""
+    name = source
+    if isinstance(source, str) and source.startswith(f"{KB_SNAPSHOT_STORAGE_PREFIX}/"):
+        name = source[len(KB_SNAPSHOT_STORAGE_PREFIX) + 1:]
+    if (
+        not isinstance(name, str)
+        or not name.endswith(SNAPSHOT_SUFFIX)
+        or name != os.path.basename(name)
+        or "\\" in name
+        or name.startswith(".")
+    ):
+        raise ValueError(f"Snapshot source must be a file name in {KB_SNAPSHOT_DIR} or a {KB_SNAPSHOT_STORAGE_PREFIX}/ key: {source!r}")
+    return name
+
+
+async def _fetch(source: str) -> str:
+    """Local path of a snapshot in KB_SNAPSHOT_DIR, downloaded first when given as a storage key."""
+    name = _snapshot_name(source)
+    local = os.path.join(KB_SNAPSHOT_DIR, name)
+    if not source.startswith(f"{KB_SNAPSHOT_STORAGE_PREFIX}/"):
+        if not os.path.isfile(local):
+            raise FileNotFoundError(f"Snapshot {name} not found in {KB_SNAPSHOT_DIR}")
+        return local
+    from storage import storage
+
+    os.makedirs(KB_SNAPSHOT_DIR, exist_ok=True)
+    if not await asyncio.to_thread(storage.download_file, f"{KB_SNAPSHOT_STORAGE_PREFIX}/{name}", local):
+        raise FileNotFoundError(f"Snapshot {source} not found in storage")
+    return local
+
+
+def _read_lines(path: str):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+async def restore_kb_snapshot(source: str, collection_name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Recreate a collection (named as in the snapshot unless collection_name is
+    given) from a snapshot, replacing any existing one, then verify it.
+    """
+    from Rag.Rag import QDRANT_CLIENT
+    from Rag.sparse_hybrid import forget_collection
+
+    start = time.time()
+    if collection_name is not None:
+        check_collection_name(collection_name)
+    path = await _fetch(source)
+    lines = _read_lines(path)
+    header = next(lines, None)
+    if not header or header.get("type") != "header" or header.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a KB snapshot (format {SNAPSHOT_FORMAT})")
+    collection_name = check_collection_name(collection_name or header.get("collection"))
+    redis_client = await ensure_redis_client()
+    hashes = _redis_hashes(collection_name)
+    restored: List[models.Record] = []
+
+    async with _lock(collection_name):
+        sparse = header.get("sparse_vectors")
+        await asyncio.to_thread(
+            reset_collection,
+            QDRANT_CLIENT,
+            collection_name,
+            vectors_config=_vectors_config(header["vectors"]),
+            sparse_vectors_config={name: models.SparseVectorParams(**p) for name, p in sparse.items()} if sparse else None,
+        )
+        for field in ("doc_id", "filename", "file_type", "file_url"):
+            await asyncio.to_thread(
+                QDRANT_CLIENT.create_payload_index,
+                collection_name=collection_name,
+                field_name=field,
+                field_schema=models.PayloadSchemaType.KEYWORD,
+            )
+        forget_collection(collection_name)
+        if redis_client:
+            await redis_client.delete(*hashes.values())
+        await clear_chunk_registry(collection_name)
+
+        batch: List[models.PointStruct] = []
+        for record in lines:
+            kind = record.get("type")
+            if kind == "redis" and redis_client and record["role"] in hashes:
+                await redis_client.hset(hashes[record["role"]], mapping=record["data"])
+            elif kind == "point":
+                batch.append(models.PointStruct(id=record["id"], vector=decode_vector(record["vector"]), payload=record["payload"]))
+                restored.append(models.Record(id=record["id"], payload=record["payload"]))
+                if len(batch) >= KB_SNAPSHOT_BATCH_SIZE:
+                    await asyncio.to_thread(QDRANT_CLIENT.upsert, collection_name=collection_name, points=batch)
+                    batch = []
+        if batch:
+            await asyncio.to_thread(QDRANT_CLIENT.upsert, collection_name=collection_name, points=batch)
+        await register_chunks(collection_name, restored)
+        if redis_client and await get_bm25_version(collection_name) is not None:
+            # Workers cache BM25 matrices by version; a fresh version keeps them from serving an older copy
+            await redis_client.hincrby(bm25_keys(collection_name)["meta"], "version", 1)
+
+    report = await _verify(path, collection_name)
+    report["duration_seconds"] = round(time.time() - start, 2)
+    print(f"[KB-SNAPSHOT] Restored {report}")
+    return report
+
+
+async def verify_kb_snapshot(source: str, collection_name: Optional[str] = None) -> Dict[str, Any]:
+    """Compare a snapshot's point and Redis field counts with the live collection."""
+    return await _verify(await _fetch(source), collection_name)
+
+
+async def _verify(path: str, collection_name: Optional[str]) -> Dict[str, Any]:
+    from Rag.Rag import QDRANT_CLIENT
+
+    header, footer = None, None
+    for record in _read_lines(path):
+        if record.get("type") == "header":
+            header = record
+        elif record.get("type") == "footer":
+            footer = record
+    if not header or not footer:
+        return {"path": path, "ok": False, "error": "truncated snapshot (missing header or footer)"}
+    collection_name = check_collection_name(collection_name or header.get("collection"))
+    report: Dict[str, Any] = {"path": path, "collection": collection_name, "expected_points": footer["points"]}
+    try:
+        count = await asyncio.to_thread(QDRANT_CLIENT.count, collection_name=collection_name, exact=True)
+        report["points"] = count.count
+    except Exception as e:
+        report["points"] = None
+        report["error"] = str(e)
+    mismatched = {}
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        hashes = _redis_hashes(collection_name)
+        for role, expected in footer.get("redis", {}).items():
+            actual = await redis_client.hlen(hashes[role])
+            if actual != expected:
+                mismatched[role] = {"expected": expected, "actual": actual}
+    report["redis_mismatches"] = mismatched
+    report["ok"] = report["points"] == footer["points"] and not mismatched
+    return report
+
+
+async def export_all_kb_snapshots(upload: bool = False) -> List[Dict[str, Any]]:
+    """Snapshot every KB collection (kb_*)."""
+    from Rag.Rag import QDRANT_CLIENT
+
+    collections = (await asyncio.to_thread(QDRANT_CLIENT.get_collections)).collections
+    reports = []
+    for name in sorted(c.name for c in collections if c.name.startswith("kb_")):
+        try:
+            reports.append(await export_kb_snapshot(name, upload=upload))
+        except Exception as e:
+            print(f"[KB-SNAPSHOT] Export of {name} failed: {e}")
+            reports.append({"collection": name, "error": str(e)})
+    return reports
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export, restore and verify KB index snapshots")
+    parser.add_argument("action", choices=["export", "restore", "verify"])
+    parser.add_argument("target", help="collection name (export) or snapshot file / storage key")
+    parser.add_argument("--collection", help="collection to restore into or verify against")
+    parser.add_argument("--upload", action="store_true", help="also upload the export to object storage")
+    args = parser.parse_args()
+
+    if args.action == "export":
+        result = asyncio.run(export_kb_snapshot(args.target, upload=args.upload))
+    elif args.action == "restore":
+        result = asyncio.run(restore_kb_snapshot(args.target, args.collection))
+    else:
+        result = asyncio.run(verify_kb_snapshot(args.target, args.collection))
+    print(json.dumps(result, indent=2))
+    if args.action != "export" and not result.get("ok"):
+        raise SystemExit(1)
@@ -0,0 +1,266 @@
+"""
+Incremental KB synchronization against the KB manifest.
+
+The KB a GPT lists (file_url + content hash per document) is diffed against the
+collection's manifest:
+
+    added      file_url not in the manifest            -> ingested
+    changed    content hash differs from the manifest  -> old chunks deleted, re-ingested
+    removed    in the manifest but no longer listed    -> chunks deleted (replace syncs only)
+    unchanged  everything else                         -> not touched
+
+Removals are only planned when the listed documents are the GPT's complete KB
+(replace=True, e.g. the file list sent on GPT load). Incremental syncs (a
+session adding documents) only add and change, since the index is shared by
+every user of the GPT and a partial list says nothing about other files.
+
+Before a sync, check_kb_sources() decides which already-indexed files need
+their bytes at all. A cheap per-file change signal, the source version, is
+compared to the one in the manifest: a caller-supplied source_hash or
+updated_at, else the ETag / Last-Modified of a HEAD request. Only files whose
+version changed or is unknown are downloaded (at most KB_SOURCE_CHECK_CONCURRENCY
+at a time) and hashed. Documents listed without content (placeholders of
+unchanged files) and manifest entries without a hash (backfilled from Qdrant)
+count as unchanged; hashes and versions the manifest lacks are adopted from the
+listed document ("rehash"). Deleting a file removes its Qdrant
+points, BM25 postings, chunk registry lists, near-duplicate signatures,
+summary-tree node and manifest entry, so changing one file of a large KB only
+touches that file.
+
+    kb_sync:{collection}:reports  list  recent sync reports (JSON)
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from redis_client import ensure_redis_client
+from Rag.kb_manifest import content_hash, remove_kb_files
+from Rag.chunk_registry import unregister_sources
+from Rag.bm25_index import get_bm25_version, remove_sources
+from Rag.near_dup import forget_points
+from Rag.summary_tree import remove_document_nodes
+
+KB_SYNC_PREFIX = "kb_sync"
+KB_SYNC_REPORTS_KEPT = 20
+# Concurrent HEAD requests and downloads when checking already-indexed files for changes
+KB_SOURCE_CHECK_CONCURRENCY = int(os.getenv("KB_SOURCE_CHECK_CONCURRENCY", "8"))
+
+
+def kb_sync_reports_key(collection_name: str) -> str:
+    return f"{KB_SYNC_PREFIX}:{collection_name}:reports"
+
+
+def plan_kb_sync(kb_docs: Iterable[Any], manifest: Dict[str, Dict[str, Any]], replace: bool = False) -> Dict[str, List[Any]]:
+    """
+    Diff the listed documents against the manifest.
+    Returns {"added": [doc], "changed": [doc], "removed": [file_url],
+    "unchanged": [file_url], "rehash": [unchanged doc whose hashes the manifest lacks],
+    "unkeyed": [doc without file_url, always ingested]}. "removed" stays empty
+    unless replace is set.
+    """
+    plan: Dict[str, List[Any]] = {"added": [], "changed": [], "removed": [], "unchanged": [], "rehash": [], "unkeyed": []}
+    listed = set()
+    for doc in kb_docs or []:
+        file_url = doc.get("file_url") if isinstance(doc, dict) else None
+        if not file_url:
+            plan["unkeyed"].append(doc)
+            continue
+        if file_url in listed:
+            continue
+        listed.add(file_url)
+        entry = manifest.get(file_url)
+        if entry is None:
+            plan["added"].append(doc)
+            continue
+        indexed_hash = entry.get("content_hash")
+        if doc.get("content") and indexed_hash and content_hash(doc["content"]) != indexed_hash:
+            plan["changed"].append(doc)
+            continue
+        plan["unchanged"].append(file_url)
+        if (doc.get("content") and not indexed_hash) or any(
+            doc.get(field) and doc[field] != entry.get(field) for field in ("source_hash", "source_version")
+        ):
+            plan["rehash"].append(doc)
+    if replace:
+        plan["removed"] = [file_url for file_url in manifest if file_url not in listed]
+    return plan
+
+
+def listed_source_version(doc: Dict[str, Any]) -> str:
+    """Change signal supplied with a listed document ("" when it has none)."""
+    if doc.get("source_hash"):
+        return f"sha256:{doc['source_hash']}"
+    if doc.get("updated_at"):
+        return f"updated:{doc['updated_at']}"
+    return ""
+
+
+def response_source_version(headers: Mapping[str, str]) -> str:
+    """Change signal of a downloaded or HEAD-requested file ("" when the server sends no validator)."""
+    etag = headers.get("etag")
+    if etag:
+        return f"etag:{etag}"
+    last_modified = headers.get("last-modified")
+    if last_modified:
+        return f"modified:{last_modified}:{headers.get('content-length', '')}"
+    return ""
+
+
+async def check_kb_sources(
+    docs: List[Dict[str, Any]],
+    manifest: Dict[str, Dict[str, Any]],
+    head: Callable[[str], Awaitable[str]],
+    download: Callable[[str], Awaitable[Tuple[bytes, str]]],
+) -> Tuple[List[Dict[str, Any]], Dict[str, Tuple[bytes, str]]]:
+    """
+    Find which listed, already-indexed files are unchanged without downloading them.
+    head(file_url) returns the file's source version, download(file_url) its bytes
+    and version. Returns (unchanged docs with the manifest's source_hash and the
+    current source_version, {file_url: (bytes, version)} of changed files, reused by
+    processing). Files that cannot be checked are treated as changed.
+    """
+    semaphore = asyncio.Semaphore(KB_SOURCE_CHECK_CONCURRENCY)
+
+    async def _check(doc: Dict[str, Any]) -> Tuple[str, Dict[str, Any], Optional[Tuple[bytes, str]]]:
+        entry = manifest.get(doc["file_url"], {})
+        if doc.get("source_hash") and doc["source_hash"] == entry.get("source_hash"):
+            return "unchanged", {**doc, "source_version": entry.get("source_version", "")}, None
+        async with semaphore:
+            version = listed_source_version(doc)
+            if not version:
+                try:
+                    version = await head(doc["file_url"])
+                except Exception as e:
+                    print(f"[KB-SYNC] HEAD {doc['file_url']} failed, downloading instead: {e}")
+            if version and version == entry.get("source_version"):
+                return "unchanged", {**doc, "source_hash": entry.get("source_hash", ""), "source_version": version}, None
+            # Unknown or changed version: compare the bytes with what was embedded
+            try:
+                file_content, fetched_version = await download(doc["file_url"])
+            except Exception as e:
+                print(f"[KB-SYNC] Could not download {doc['file_url']}: {e}")
+                return "unreachable", doc, None
+        version = version or fetched_version
+        source_hash = content_hash(file_content)
+        if entry.get("source_hash") == source_hash:
+            return "unchanged", {**doc, "source_hash": source_hash, "source_version": version}, None
+        return "changed", doc, (file_content, version)
+
+    unchanged: List[Dict[str, Any]] = []
+    changed: Dict[str, Tuple[bytes, str]] = {}
+    for status, doc, fetched in await asyncio.gather(*[_check(doc) for doc in docs]):
+        if status == "unchanged":
+            unchanged.append(doc)
+        elif status == "changed":
+            changed[doc["file_url"]] = fetched
+    print(
+        f"[KB-SYNC] Checked {len(docs)} indexed files: {len(unchanged)} unchanged, {len(changed)} changed, "
+        f"{len(docs) - len(unchanged) - len(changed)} unreachable"
+    )
+    return unchanged, changed
+
+
+async def delete_kb_files(collection_name: str, file_urls: Iterable[str]) -> int:
+    """Delete every chunk of the given files and its derived state. Returns the number of points deleted."""
+    from qdrant_client import models
+    from Rag.Rag import QDRANT_CLIENT
+
+    file_urls = [u for u in file_urls if u]
+    if not file_urls:
+        return 0
+    file_filter = models.Filter(must=[models.FieldCondition(key="file_url", match=models.MatchAny(any=file_urls))])
+    point_ids = []
+    offset = None
+    while True:
+        points, offset = await asyncio.to_thread(
+            QDRANT_CLIENT.scroll,
+            collection_name=collection_name,
+            scroll_filter=file_filter,
+            limit=1000,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        point_ids.extend(str(p.id) for p in points)
+        if offset is None:
+            break
+    if point_ids:
+        await asyncio.to_thread(
+            QDRANT_CLIENT.delete,
+            collection_name=collection_name,
+            points_selector=models.FilterSelector(filter=file_filter),
+        )
+    if await get_bm25_version(collection_name) is not None:
+        await remove_sources(collection_name, file_urls)
+    await unregister_sources(collection_name, file_urls)
+    await forget_points(collection_name, point_ids, sources=file_urls)
+    await remove_document_nodes(collection_name, file_urls)
+    await remove_kb_files(collection_name, file_urls)
+    print(f"[KB-SYNC] Deleted {len(point_ids)} points of {len(file_urls)} file(s) from {collection_name}")
+    return len(point_ids)
+
+
+async def delete_kb_json_documents(scope: str, listed_urls: Iterable[str]) -> int:
+    """Delete KB JSON documents of a registry scope whose file is no longer listed."""
+    from Rag.key_registry import get_registered_keys, unregister_keys
+    from Rag.json_index import json_index_key, delete_json_index_points
+
+    listed = set(listed_urls)
+    prefix = f"{scope}:"
+    stale = [k for k in await get_registered_keys(scope) if k.startswith(prefix) and k[len(prefix):] not in listed]
+    if not stale:
+        return 0
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.delete(*stale, *[json_index_key(k) for k in stale])
+    for key in stale:
+        await delete_json_index_points(key)
+    await unregister_keys(scope, stale)
+    print(f"[KB-SYNC] Deleted {len(stale)} unlisted JSON documents of {scope}")
+    return len(stale)
+
+
+async def json_document_stored(scope: str, file_url: str) -> bool:
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return False
+    return bool(await redis_client.exists(f"{scope}:{file_url}"))
+
+
+async def record_sync_report(collection_name: str, report: Dict[str, Any]):
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    key = kb_sync_reports_key(collection_name)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, json.dumps(report))
+            pipe.ltrim(key, 0, KB_SYNC_REPORTS_KEPT - 1)
+            await pipe.execute()
+    except Exception as e:
+        print(f"[KB-SYNC] Could not store sync report of {collection_name}: {e}")
+
+
+async def get_sync_reports(collection_name: str) -> List[Dict[str, Any]]:
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    return [json.loads(r) for r in await redis_client.lrange(kb_sync_reports_key(collection_name), 0, -1)]
+
+
+def build_sync_report(collection_name: str, plan: Dict[str, List[Any]], start: float, **counts: Any) -> Dict[str, Any]:
+    """Diff summary of one sync; file lists are capped so reports stay small."""
+    return {
+        "collection": collection_name,
+        "added": [d.get("file_url") for d in plan["added"]][:50],
+        "changed": [d.get("file_url") for d in plan["changed"]][:50],
+        "removed": plan["removed"][:50],
+        "unchanged": len(plan["unchanged"]),
+        "rehashed": len(plan.get("rehash", [])),
+        "unkeyed": len(plan["unkeyed"]),
+        **counts,
+        "duration_seconds": round(time.time() - start, 2),
+        "at": time.time(),
+    }
@@ -0,0 +1,203 @@
+"""
+Maintained registries of document keys, replacing KEYS pattern scans.
+
+Every stored JSON document key is added to the set of its scope:
+    key_registry:user_json:{session_id}     members user_json:{session_id}:{doc}
+    key_registry:kb_json:{gpt_id}_{userId}  members kb_json:{gpt_id}_{userId}:{doc}
+
+Hot-path lookups are one SMEMBERS of a small set, independent of the size of
+the keyspace. scan_keys() (cursor-based SCAN, never KEYS) is kept for admin
+operations only: all-session wipes and rebuild_registries(), which repairs
+registries for keys written before they existed.
+"""
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from redis_client import ensure_redis_client
+
+KEY_REGISTRY_PREFIX = "key_registry"
+KEY_REGISTRY_SCAN_COUNT = int(os.getenv("KEY_REGISTRY_SCAN_COUNT", "1000"))
+# Document key families that have registries, scope = "<family>:<owner>"
+REGISTERED_FAMILIES = ("user_json", "kb_json")
+
+
+def user_json_scope(session_id: str) -> str:
+    return f"user_json:{session_id}"
+
+
+def kb_json_scope(gpt_id: str, userId: str) -> str:
+    return f"kb_json:{gpt_id}_{userId}"
+
+
+def registry_key(scope: str) -> str:
+    return f"{KEY_REGISTRY_PREFIX}:{scope}"
+
+
+def scope_of(key: str) -> Optional[str]:
+    """Scope of a registered document key (user_json:{sid}:{doc} -> user_json:{sid})."""
+    parts = key.split(":", 2)
+    if len(parts) < 3 or parts[0] not in REGISTERED_FAMILIES:
+        return None
+    return f"{parts[0]}:{parts[1]}"
+
+
+async def register_keys(scope: str, keys: Iterable[str], ttl: Optional[int] = None):
+    """Add document keys to their scope's registry (registry TTL follows the newest key)."""
+    keys = [k for k in keys if k]
+    if not keys:
+        return
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.sadd(registry_key(scope), *keys)
+        if ttl:
+            pipe.expire(registry_key(scope), ttl)
+        await pipe.execute()
+
+
+async def unregister_keys(scope: str, keys: Iterable[str]):
+    keys = [k for k in keys if k]
+    if not keys:
+        return
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.srem(registry_key(scope), *keys)
+
+
+async def get_registered_keys(scope: str) -> List[str]:
+    """Registered document keys of a scope, in stable order."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    return sorted(await redis_client.smembers(registry_key(scope)))
+
+
+async def has_registered_keys(scope: str) -> bool:
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return False
+    return await redis_client.scard(registry_key(scope)) > 0
+
+
+async def pop_registry(scope: str) -> List[str]:
+    """Return and delete a scope's registry (callers delete the member keys)."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.smembers(registry_key(scope))
+        pipe.delete(registry_key(scope))
+        members, _ = await pipe.execute()
+    return sorted(members)
+
+
+async def scan_keys(pattern: str, count: int = KEY_REGISTRY_SCAN_COUNT) -> List[str]:
+    """Admin only: incremental SCAN over the keyspace (does not block Redis like KEYS)."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    return [key async for key in redis_client.scan_iter(match=pattern, count=count)]
+
+
+async def rebuild_registries(dry_run: bool = True) -> Dict[str, Any]:
+    """
+    Admin repair: SCAN every registered key family, add keys missing from their
+    scope's registry and drop registry members whose key no longer exists.
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return {"error": "redis unavailable"}
+    start = time.time()
+    report = {"dry_run": dry_run, "keys_scanned": 0, "keys_added": 0, "stale_removed": 0, "scopes": 0}
+    by_scope: Dict[str, List[str]] = {}
+    for family in REGISTERED_FAMILIES:
+        for key in await scan_keys(f"{family}:*"):
+            scope = scope_of(key)
+            if scope:
+                by_scope.setdefault(scope, []).append(key)
+                report["keys_scanned"] += 1
+    for registry in await scan_keys(f"{KEY_REGISTRY_PREFIX}:*"):
+        by_scope.setdefault(registry[len(KEY_REGISTRY_PREFIX) + 1:], [])
+
+    for scope, keys in by_scope.items():
+        registered = set(await redis_client.smembers(registry_key(scope)))
+        missing = [k for k in keys if k not in registered]
+        stale = list(registered - set(keys))
+        report["keys_added"] += len(missing)
+        report["stale_removed"] += len(stale)
+        report["scopes"] += 1
+        if dry_run:
+            continue
+        if missing:
+            ttls = [t for t in [await redis_client.ttl(k) for k in missing] if t and t > 0]
+            await register_keys(scope, missing, ttl=max(ttls) if ttls else None)
+        if stale:
+            await unregister_keys(scope, stale)
+    report["duration_seconds"] = round(time.time() - start, 2)
+    print(f"[KEY-REGISTRY] Rebuild: {report}")
+    return report
+
+
+async def benchmark_lookup_latency(
+    sizes: Iterable[int] = (10_000, 100_000, 1_000_000),
+    lookups: int = 200,
+    prefix: str = "key_registry_bench",
+) -> List[Dict[str, Any]]:
+    """
+    Load test: grow the keyspace with filler keys and time a session's JSON key
+    lookup through its registry (SMEMBERS) against the previous KEYS pattern.
+    Filler keys live under `prefix`, carry a 1h TTL and are removed afterwards.
+    Run against a dedicated Redis; KEYS on millions of keys blocks the server.
+    """
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    session_id = f"{prefix}_session"
+    scope = user_json_scope(session_id)
+    doc_keys = [f"{scope}:doc{i}" for i in range(10)]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key in doc_keys:
+            pipe.set(key, "{}", ex=3600)
+        await pipe.execute()
+    await register_keys(scope, doc_keys, ttl=3600)
+
+    results = []
+    filled = 0
+    try:
+        for size in sorted(sizes):
+            while filled < size:
+                batch = min(10_000, size - filled)
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for i in range(filled, filled + batch):
+                        pipe.set(f"{prefix}:filler:{i}", "x", ex=3600)
+                    await pipe.execute()
+                filled += batch
+
+            start = time.perf_counter()
+            for _ in range(lookups):
+                await get_registered_keys(scope)
+            registry_ms = (time.perf_counter() - start) / lookups * 1000
+
+            keys_runs = max(1, lookups // 50)
+            start = time.perf_counter()
+            for _ in range(keys_runs):
+                await redis_client.keys(f"{scope}:*")
+            keys_ms = (time.perf_counter() - start) / keys_runs * 1000
+
+            result = {"keyspace": size, "registry_ms": round(registry_ms, 3), "keys_ms": round(keys_ms, 3)}
+            print(f"[KEY-REGISTRY-BENCH] {result}")
+            results.append(result)
+    finally:
+        for i in range(0, filled, 10_000):
+            await redis_client.unlink(*[f"{prefix}:filler:{j}" for j in range(i, min(i + 10_000, filled))])
+        await redis_client.unlink(*doc_keys, registry_key(scope))
+    return results
+
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+
+    asyncio.run(benchmark_lookup_latency([int(n) for n in sys.argv[1:]] or (10_000, 100_000, 1_000_000)))
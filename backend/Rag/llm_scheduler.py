@@ -0,0 +1,110 @@
+"""
+Process-wide scheduling of summarization LLM calls.
+
+Every map/reduce/final call made by the summarizers goes through ``llm_slot()``,
+which enforces a global concurrency cap and a provider request rate, so work for
+many documents can be started at once without overrunning the provider.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+
+SUMMARY_LLM_CONCURRENCY = int(os.getenv("SUMMARY_LLM_CONCURRENCY", "8"))
+# Requests per minute across the worker; 0 disables rate limiting
+SUMMARY_LLM_RPM = int(os.getenv("SUMMARY_LLM_RPM", "300"))
+
+
+class _RateLimiter:
+    """Spaces request starts evenly to stay under a requests-per-minute budget."""
+
+    def __init__(self, rpm: int):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_at - now
+            self._next_at = max(now, self._next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_semaphore = asyncio.Semaphore(SUMMARY_LLM_CONCURRENCY)
+_rate_limiter = _RateLimiter(SUMMARY_LLM_RPM)
+
+
+@asynccontextmanager
+async def llm_slot():
+    """Hold one scheduled LLM slot for the duration of a call (including streaming)."""
+    await _rate_limiter.acquire()
+    async with _semaphore:
+        yield
+
+
+def add_token_usage(state: Optional[Dict[str, Any]], resp):
+    """Accumulate a response's usage into state["token_usage"]."""
+    if not state:
+        return
+    from llm import _extract_usage
+
+    usage = _extract_usage(resp)
+    if "token_usage" not in state or state["token_usage"] is None:
+        state["token_usage"] = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    state["token_usage"]["input_tokens"] += usage["input_tokens"]
+    state["token_usage"]["output_tokens"] += usage["output_tokens"]
+    state["token_usage"]["total_tokens"] += usage["total_tokens"]
+
+
+async def invoke_llm(llm, prompt: str, state: Optional[Dict[str, Any]] = None) -> str:
+    """Non-streaming scheduled call; returns the stripped response text."""
+    async with llm_slot():
+        resp = await llm.ainvoke([HumanMessage(content=prompt)])
+    add_token_usage(state, resp)
+    return resp.content.strip()
+
+
+class OrderedStream:
+    """
+    Lets several concurrently generated outputs share one chunk callback while
+    keeping their order: slot 0 streams live, later slots are buffered and
+    flushed as soon as every slot before them has finished.
+    """
+
+    def __init__(self, chunk_callback: Optional[Callable[[str], Awaitable[None]]], slots: int):
+        self.chunk_callback = chunk_callback
+        self.buffers: List[List[str]] = [[] for _ in range(slots)]
+        self.finished = [False] * slots
+        self.current = 0
+        self._lock = asyncio.Lock()
+
+    def callback(self, slot: int) -> Optional[Callable[[str], Awaitable[None]]]:
+        if not self.chunk_callback:
+            return None
+
+        async def _emit(chunk: str):
+            async with self._lock:
+                if slot == self.current:
+                    await self.chunk_callback(chunk)
+                else:
+                    self.buffers[slot].append(chunk)
+        return _emit
+
+    async def finish(self, slot: int):
+        """Mark a slot complete and flush every following slot that became current."""
+        async with self._lock:
+            self.finished[slot] = True
+            while self.current < len(self.finished) and self.finished[self.current]:
+                self.current += 1
+                if self.current < len(self.buffers):
+                    pending, self.buffers[self.current] = self.buffers[self.current], []
+                    if self.chunk_callback:
+                        for chunk in pending:
+                            await self.chunk_callback(chunk)
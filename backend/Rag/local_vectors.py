@@ -0,0 +1,287 @@
+"""
+In-process dense search for small session collections.
+
+A user_docs_{session} collection with at most LOCAL_VECTOR_MAX_POINTS chunks is
+loaded once into worker memory as an L2-normalised float32 matrix and queried
+with a matrix-vector product, skipping the Qdrant round trip and thread hop.
+Matrices are tagged with the session's document generation (bumped on every
+upload and cleanup), so ingest invalidates them in every worker. Larger
+collections, other collections and sessions without a generation go to Qdrant.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from qdrant_client import models
+
+from Rag.session_docs import get_doc_generation
+from Rag.qdrant_store import reset_collection
+
+LOCAL_VECTOR_SEARCH_ENABLED = os.getenv("LOCAL_VECTOR_SEARCH", "true").lower() == "true"
+LOCAL_VECTOR_MAX_POINTS = int(os.getenv("LOCAL_VECTOR_MAX_POINTS", "5000"))
+LOCAL_VECTOR_CACHE_MAX_BYTES = int(float(os.getenv("LOCAL_VECTOR_CACHE_MAX_MB", "256")) * 1024 * 1024)
+USER_DOCS_PREFIX = "user_docs_"
+
+# collection -> (generation, matrix entry or None if above the threshold, bytes), least recently used first
+_matrix_cache: "OrderedDict[str, Tuple[int, Optional[Dict[str, Any]], int]]" = OrderedDict()
+_matrix_cache_bytes = 0
+_load_locks: Dict[str, asyncio.Lock] = {}
+LOCAL_VECTOR_METRICS = {"local_queries": 0, "qdrant_queries": 0, "loads": 0, "evictions": 0}
+
+
+def _session_of(collection_name: str) -> Optional[str]:
+    if not collection_name.startswith(USER_DOCS_PREFIX):
+        return None
+    return collection_name[len(USER_DOCS_PREFIX):] or None
+
+
+def build_matrix(ids: List[Any], vectors: List[List[float]], payloads: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Row-normalised float32 matrix plus per-row ids, payloads and doc_id rows."""
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, 1.0)
+    doc_rows: Dict[Any, List[int]] = {}
+    for row, payload in enumerate(payloads):
+        doc_rows.setdefault((payload or {}).get("doc_id"), []).append(row)
+    return {
+        "ids": ids,
+        "matrix": matrix,
+        "payloads": payloads,
+        "doc_rows": {doc_id: np.asarray(rows, dtype=np.int64) for doc_id, rows in doc_rows.items()},
+    }
+
+
+def top_k(matrix: np.ndarray, query: np.ndarray, limit: int, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Cosine top-k over all rows (or the given rows): (row indices, scores) best first."""
+    norm = float(np.linalg.norm(query))
+    query = query / norm if norm > 0 else query
+    scores = matrix @ query if rows is None else matrix[rows] @ query
+    candidates = np.arange(len(scores)) if rows is None else rows
+    if limit <= 0 or len(scores) == 0:
+        return candidates[:0], scores[:0]
+    if len(scores) > limit:
+        part = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        part = np.arange(len(scores))
+    order = part[np.argsort(-scores[part], kind="stable")]
+    return candidates[order], scores[order]
+
+
+def _evict(collection_name: str):
+    global _matrix_cache_bytes
+    entry = _matrix_cache.pop(collection_name, None)
+    if entry is not None:
+        _matrix_cache_bytes -= entry[2]
+
+
+def _cache(collection_name: str, generation: int, entry: Optional[Dict[str, Any]]):
+    global _matrix_cache_bytes
+    _evict(collection_name)
+    size = int(entry["matrix"].nbytes) if entry else 0
+    if size > LOCAL_VECTOR_CACHE_MAX_BYTES:
+        return
+    _matrix_cache[collection_name] = (generation, entry, size)
+    _matrix_cache_bytes += size
+    while _matrix_cache_bytes > LOCAL_VECTOR_CACHE_MAX_BYTES and _matrix_cache:
+        _, (_, _, evicted) = _matrix_cache.popitem(last=False)
+        _matrix_cache_bytes -= evicted
+        LOCAL_VECTOR_METRICS["evictions"] += 1
+
+
+def forget_collection(collection_name: str):
+    """Drop a collection's matrix from this worker (other workers follow the generation)."""
+    _evict(collection_name)
+    _load_locks.pop(collection_name, None)
+
+
+async def _load(collection_name: str) -> Optional[Dict[str, Any]]:
+    """Scroll every point with its vector, or None when the collection is above the threshold."""
+    from Rag.Rag import QDRANT_CLIENT
+
+    count = await asyncio.to_thread(QDRANT_CLIENT.count, collection_name=collection_name, exact=True)
+    if count.count > LOCAL_VECTOR_MAX_POINTS:
+        return None
+    ids, vectors, payloads = [], [], []
+    offset = None
+    while True:
+        points, offset = await asyncio.to_thread(
+            QDRANT_CLIENT.scroll,
+            collection_name=collection_name,
+            limit=1000,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        for p in points:
+            vector = p.vector.get("") if isinstance(p.vector, dict) else p.vector
+            if vector is None:
+                continue
+            ids.append(p.id)
+            vectors.append(vector)
+            payloads.append(p.payload or {})
+        if offset is None or len(ids) > LOCAL_VECTOR_MAX_POINTS:
+            break
+    if len(ids) > LOCAL_VECTOR_MAX_POINTS:
+        return None
+    return await asyncio.to_thread(build_matrix, ids, vectors, payloads)
+
+
+async def get_session_matrix(collection_name: str) -> Optional[Dict[str, Any]]:
+    """Matrix of a small session collection for its current generation, loading it on first use."""
+    session_id = _session_of(collection_name)
+    if not LOCAL_VECTOR_SEARCH_ENABLED or not session_id:
+        return None
+    generation = await get_doc_generation(session_id)
+    if not generation:
+        return None
+    cached = _matrix_cache.get(collection_name)
+    if cached is not None and cached[0] == generation:
+        _matrix_cache.move_to_end(collection_name)
+        return cached[1]
+    lock = _load_locks.setdefault(collection_name, asyncio.Lock())
+    async with lock:
+        cached = _matrix_cache.get(collection_name)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        start = time.perf_counter()
+        try:
+            entry = await _load(collection_name)
+        except Exception as e:
+            print(f"[LOCAL-VECTORS] Could not load {collection_name}: {e}")
+            return None
+        _cache(collection_name, generation, entry)
+        LOCAL_VECTOR_METRICS["loads"] += 1
+        if entry is None:
+            print(f"[LOCAL-VECTORS] {collection_name} is above {LOCAL_VECTOR_MAX_POINTS} points, using Qdrant")
+        else:
+            print(
+                f"[LOCAL-VECTORS] Loaded {len(entry['ids'])} vectors of {collection_name} "
+                f"(generation {generation}) in {(time.perf_counter() - start) * 1000:.1f}ms"
+            )
+        return entry
+
+
+async def dense_search(
+    collection_name: str,
+    query_vector: List[float],
+    limit: int,
+    doc_ids: Optional[Iterable[str]] = None,
+    with_vectors: bool = False,
+) -> List[models.ScoredPoint]:
+    """
+    Cosine search returning Qdrant ScoredPoints, optionally restricted to doc_ids.
+    Served from worker memory for small session collections, by Qdrant otherwise.
+    with_vectors attaches candidate vectors (NumPy rows on the local path).
+    """
+    doc_ids = list(doc_ids) if doc_ids is not None else None
+    entry = await get_session_matrix(collection_name)
+    if entry is not None:
+        LOCAL_VECTOR_METRICS["local_queries"] += 1
+        rows = None
+        if doc_ids is not None:
+            selected = [entry["doc_rows"][d] for d in doc_ids if d in entry["doc_rows"]]
+            rows = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+        found, scores = top_k(entry["matrix"], np.asarray(query_vector, dtype=np.float32), limit, rows)
+        # model_construct skips validation of payloads and 1536-float vectors
+        matrix = entry["matrix"]
+        return [
+            models.ScoredPoint.model_construct(
+                id=entry["ids"][r], version=0, score=float(s), payload=entry["payloads"][r],
+                vector=matrix[r] if with_vectors else None,
+            )
+            for r, s in zip(found.tolist(), scores.tolist())
+        ]
+
+    from Rag.Rag import QDRANT_CLIENT
+
+    LOCAL_VECTOR_METRICS["qdrant_queries"] += 1
+    query_filter = None
+    if doc_ids is not None:
+        query_filter = models.Filter(must=[models.FieldCondition(key="doc_id", match=models.MatchAny(any=doc_ids))])
+    return await asyncio.to_thread(
+        QDRANT_CLIENT.search,
+        collection_name=collection_name,
+        query_vector=query_vector,
+        limit=limit,
+        query_filter=query_filter,
+        with_vectors=with_vectors,
+    )
+
+
+async def benchmark_local_search(
+    sizes: Iterable[int] = (100, 500, 1000, 2000, 5000),
+    queries: int = 50,
+    limit: int = 20,
+    seed: int = 7,
+) -> List[Dict[str, Any]]:
+    """
+    Latency of top-k over random unit vectors: Qdrant search (through the
+    thread pool, as in production) against the in-process matrix product.
+    Uses temporary collections local_vector_bench_{n}, deleted afterwards.
+    Recall is the share of Qdrant's top `limit` ids that the local search returns.
+    """
+    from Rag.Rag import QDRANT_CLIENT, VECTOR_SIZE
+
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        name = f"local_vector_bench_{size}"
+        vectors = rng.standard_normal((size, VECTOR_SIZE)).astype(np.float32)
+        ids = list(range(size))
+        payloads = [{"doc_id": f"doc{i % 10}"} for i in ids]
+        try:
+            await asyncio.to_thread(
+                reset_collection,
+                QDRANT_CLIENT,
+                name,
+                vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE),
+            )
+            for i in range(0, size, 256):
+                await asyncio.to_thread(
+                    QDRANT_CLIENT.upsert,
+                    collection_name=name,
+                    points=[
+                        models.PointStruct(id=j, vector=vectors[j].tolist(), payload=payloads[j])
+                        for j in range(i, min(i + 256, size))
+                    ],
+                )
+            entry = build_matrix(ids, vectors, payloads)
+            query_vectors = rng.standard_normal((queries, VECTOR_SIZE)).astype(np.float32)
+
+            qdrant_hits, start = [], time.perf_counter()
+            for q in query_vectors:
+                found = await asyncio.to_thread(QDRANT_CLIENT.search, collection_name=name, query_vector=q.tolist(), limit=limit)
+                qdrant_hits.append({p.id for p in found})
+            qdrant_ms = (time.perf_counter() - start) / queries * 1000
+
+            local_hits, start = [], time.perf_counter()
+            for q in query_vectors:
+                rows, _ = top_k(entry["matrix"], q, limit)
+                local_hits.append({entry["ids"][r] for r in rows.tolist()})
+            local_ms = (time.perf_counter() - start) / queries * 1000
+        finally:
+            try:
+                await asyncio.to_thread(QDRANT_CLIENT.delete_collection, collection_name=name)
+            except Exception:
+                pass
+
+        recall = sum(len(a & b) / len(a) for a, b in zip(qdrant_hits, local_hits) if a) / queries
+        result = {
+            "chunks": size,
+            "qdrant_ms": round(qdrant_ms, 3),
+            "local_ms": round(local_ms, 3),
+            "recall": round(recall, 3),
+            "matrix_mb": round(entry["matrix"].nbytes / 1024 / 1024, 1),
+        }
+        print(f"[LOCAL-VECTORS-BENCH] {result}")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+
+    asyncio.run(benchmark_local_search([int(n) for n in sys.argv[1:]] or (100, 500, 1000, 2000, 5000)))
@@ -0,0 +1,257 @@
+"""
+Near-duplicate chunk detection with MinHash + LSH, run per collection before embedding.
+
+Every chunk gets a MinHash signature over word shingles. Signatures are split
+into LSH bands; chunks sharing a band bucket are candidates and count as
+duplicates when their estimated Jaccard similarity reaches NEAR_DUP_THRESHOLD.
+The first chunk seen is canonical, both within an upload and across uploads:
+
+    near_dup:{collection}:bands   hash  "{band}:{bucket}" -> canonical point id
+    near_dup:{collection}:sigs    hash  canonical point id -> signature (hex)
+    near_dup:{collection}:links   hash  duplicate (point id | "{source}#{n}") -> canonical point id
+    near_dup:{collection}:reports list  recent ingestion reports (JSON)
+
+NEAR_DUP_MODE=link stores duplicates as points carrying the canonical vector and
+a canonical_id payload field, so they keep their own citation metadata but cost
+no embedding. NEAR_DUP_MODE=skip does not store duplicates of a chunk of the
+same source in the same upload (a file's repeated boilerplate); duplicates of
+other files are stored as in link mode, so deleting or changing the file that
+holds a canonical chunk never takes another file's content with it.
+"""
+import json
+import os
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from redis_client import ensure_redis_client
+
+NEAR_DUP_MODE = os.getenv("NEAR_DUP_MODE", "link").lower()  # link | skip | off
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.85"))
+NEAR_DUP_NUM_PERM = int(os.getenv("NEAR_DUP_NUM_PERM", "128"))
+NEAR_DUP_SHINGLE_SIZE = int(os.getenv("NEAR_DUP_SHINGLE_SIZE", "5"))
+NEAR_DUP_REPORTS_KEPT = 20
+NEAR_DUP_METRICS = {"chunks": 0, "duplicates": 0, "embedding_tokens_saved": 0}
+
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(1)
+# Fixed permutations so signatures stay comparable across workers and restarts
+_PERM_A = _rng.integers(1, _PRIME, NEAR_DUP_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _PRIME, NEAR_DUP_NUM_PERM, dtype=np.uint64)
+
+# A duplicate link: ("batch", index of an earlier chunk in the same upload) or ("point", existing point id)
+Link = Optional[Tuple[str, Any]]
+
+
+def _lsh_params(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """(bands, rows) with bands * rows == num_perm whose S-curve midpoint is closest below threshold."""
+    best = (num_perm, 1)
+    best_gap = float("inf")
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        midpoint = (1 / bands) ** (1 / rows)
+        if midpoint <= threshold and threshold - midpoint < best_gap:
+            best, best_gap = (bands, rows), threshold - midpoint
+    return best
+
+
+NEAR_DUP_BANDS, NEAR_DUP_ROWS = _lsh_params(NEAR_DUP_NUM_PERM, NEAR_DUP_THRESHOLD)
+
+
+def near_dup_keys(collection_name: str) -> Dict[str, str]:
+    base = f"near_dup:{collection_name}"
+    return {name: f"{base}:{name}" for name in ("bands", "sigs", "links", "reports")}
+
+
+def minhash_signature(text: str) -> Optional[np.ndarray]:
+    """MinHash over word shingles; None for empty text."""
+    words = text.lower().split()
+    if not words:
+        return None
+    size = min(NEAR_DUP_SHINGLE_SIZE, len(words))
+    shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) & 0x7FFFFFFF for s in shingles), dtype=np.uint64)
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def band_fields(signature: np.ndarray) -> List[str]:
+    rows = NEAR_DUP_ROWS
+    return [f"{b}:{zlib.crc32(signature[b * rows:(b + 1) * rows].tobytes())}" for b in range(NEAR_DUP_BANDS)]
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(a == b))
+
+
+async def find_near_duplicates(collection_name: str, texts: List[str]) -> Tuple[List[Link], List[Optional[np.ndarray]]]:
+    """
+    Link every chunk to an earlier near-identical chunk of this upload or of the
+    collection, or None if it is new. Also returns the signatures for record_canonical().
+    """
+    signatures = [minhash_signature(t) for t in texts]
+    links: List[Link] = [None] * len(texts)
+    if NEAR_DUP_MODE == "off" or not texts:
+        return links, signatures
+
+    fields = [band_fields(sig) if sig is not None else [] for sig in signatures]
+    keys = near_dup_keys(collection_name)
+    existing: Dict[str, str] = {}
+    stored_sigs: Dict[str, np.ndarray] = {}
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        try:
+            unique_fields = list(dict.fromkeys(f for chunk_fields in fields for f in chunk_fields))
+            if unique_fields:
+                values = await redis_client.hmget(keys["bands"], unique_fields)
+                existing = {f: v for f, v in zip(unique_fields, values) if v}
+            candidate_ids = list(dict.fromkeys(existing.values()))
+            if candidate_ids:
+                raw = await redis_client.hmget(keys["sigs"], candidate_ids)
+                stored_sigs = {
+                    pid: np.frombuffer(bytes.fromhex(value), dtype=np.uint32)
+                    for pid, value in zip(candidate_ids, raw) if value
+                }
+        except Exception as e:
+            print(f"[NEAR-DUP] Could not read LSH index of {collection_name}: {e}")
+
+    batch_buckets: Dict[str, List[int]] = {}
+    for i, sig in enumerate(signatures):
+        if sig is None:
+            continue
+        best: Link = None
+        best_score = NEAR_DUP_THRESHOLD
+        for field in fields[i]:
+            pid = existing.get(field)
+            if pid is not None and pid in stored_sigs:
+                score = similarity(sig, stored_sigs[pid])
+                if score >= best_score and (best is None or score > best_score):
+                    best, best_score = ("point", pid), score
+            for j in batch_buckets.get(field, ()):
+                score = similarity(sig, signatures[j])
+                if score >= best_score and (best is None or score > best_score):
+                    best, best_score = ("batch", j), score
+        links[i] = best
+        if best is None:
+            for field in fields[i]:
+                batch_buckets.setdefault(field, []).append(i)
+    return links, signatures
+
+
+async def record_canonical(
+    collection_name: str,
+    canonical: List[Tuple[str, np.ndarray]],
+    links: Dict[str, str],
+    report: Dict[str, Any],
+    ttl: Optional[int] = None,
+):
+    """Index new canonical chunks (point id, signature), store duplicate links and the ingestion report."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    keys = near_dup_keys(collection_name)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for point_id, sig in canonical:
+                pipe.hset(keys["sigs"], point_id, sig.tobytes().hex())
+                for field in band_fields(sig):
+                    pipe.hsetnx(keys["bands"], field, point_id)
+            if links:
+                pipe.hset(keys["links"], mapping=links)
+            pipe.lpush(keys["reports"], json.dumps(report))
+            pipe.ltrim(keys["reports"], 0, NEAR_DUP_REPORTS_KEPT - 1)
+            if ttl:
+                for key in keys.values():
+                    pipe.expire(key, ttl)
+            await pipe.execute()
+    except Exception as e:
+        print(f"[NEAR-DUP] Could not update LSH index of {collection_name}: {e}")
+
+
+def build_report(collection_name: str, links: List[Link], token_counts: List[int]) -> Dict[str, Any]:
+    """Ingestion report: dedup ratio and embedding tokens saved."""
+    in_batch = sum(1 for link in links if link and link[0] == "batch")
+    existing = sum(1 for link in links if link and link[0] == "point")
+    duplicates = in_batch + existing
+    tokens_saved = sum(t or 0 for link, t in zip(links, token_counts) if link)
+    NEAR_DUP_METRICS["chunks"] += len(links)
+    NEAR_DUP_METRICS["duplicates"] += duplicates
+    NEAR_DUP_METRICS["embedding_tokens_saved"] += tokens_saved
+    return {
+        "collection": collection_name,
+        "mode": NEAR_DUP_MODE,
+        "threshold": NEAR_DUP_THRESHOLD,
+        "chunks": len(links),
+        "unique": len(links) - duplicates,
+        "duplicates_in_upload": in_batch,
+        "duplicates_of_existing": existing,
+        "dedup_ratio": round(duplicates / len(links), 4) if links else 0.0,
+        "embedding_tokens_saved": tokens_saved,
+        "at": time.time(),
+    }
+
+
+async def get_canonical(collection_name: str, duplicate: str) -> Optional[str]:
+    """Canonical point id of a duplicate (point id in link mode, "{source}#{n}" in skip mode)."""
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    return await redis_client.hget(near_dup_keys(collection_name)["links"], duplicate)
+
+
+async def get_reports(collection_name: str) -> List[Dict[str, Any]]:
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return []
+    return [json.loads(r) for r in await redis_client.lrange(near_dup_keys(collection_name)["reports"], 0, -1)]
+
+
+async def forget_points(collection_name: str, point_ids: Iterable[Any], sources: Iterable[str] = ()) -> int:
+    """
+    Drop deleted points from the index: their signatures, the band buckets they
+    own and every link from or to them (skip-mode links of the given sources too).
+    Returns the number of links removed.
+    """
+    point_ids = [str(p) for p in point_ids]
+    prefixes = tuple(f"{s}#" for s in sources if s)
+    redis_client = await ensure_redis_client()
+    if not redis_client or not (point_ids or prefixes):
+        return 0
+    keys = near_dup_keys(collection_name)
+    removed = set(point_ids)
+    try:
+        bands: Dict[str, str] = {}
+        if point_ids:
+            for pid, value in zip(point_ids, await redis_client.hmget(keys["sigs"], point_ids)):
+                if value:
+                    for field in band_fields(np.frombuffer(bytes.fromhex(value), dtype=np.uint32)):
+                        bands[field] = pid
+        owners = await redis_client.hmget(keys["bands"], list(bands)) if bands else []
+        stale_bands = [field for field, owner in zip(bands, owners) if owner in removed]
+        links = await redis_client.hgetall(keys["links"])
+        stale_links = [
+            dup for dup, canonical in links.items()
+            if dup in removed or canonical in removed or (prefixes and dup.startswith(prefixes))
+        ]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if point_ids:
+                pipe.hdel(keys["sigs"], *point_ids)
+            if stale_bands:
+                pipe.hdel(keys["bands"], *stale_bands)
+            if stale_links:
+                pipe.hdel(keys["links"], *stale_links)
+            await pipe.execute()
+        return len(stale_links)
+    except Exception as e:
+        print(f"[NEAR-DUP] Could not remove points from LSH index of {collection_name}: {e}")
+        return 0
+
+
+async def clear_near_dup_index(collection_name: str):
+    redis_client = await ensure_redis_client()
+    if redis_client:
+        await redis_client.delete(*near_dup_keys(collection_name).values())
@@ -0,0 +1,202 @@
+"""
+Qdrant client construction and lifecycle.
+
+The mode comes from the environment:
+    QDRANT_URL=http(s)://...   remote server
+    QDRANT_PATH=/data/qdrant   embedded on-disk storage (qdrant-client local mode),
+                               also the fallback when the server is unreachable
+    neither                    in-memory, lost on restart
+
+Embedded storage can be opened by one process only. The process holds an
+exclusive lock file in the storage directory, waiting up to
+QDRANT_PATH_LOCK_TIMEOUT seconds (e.g. for a reloading worker to exit), and
+fails fast if another process keeps it instead of silently indexing into
+memory. Run a single worker in this mode and a Qdrant server for multi-worker
+deployments. Local mode searches by brute force, so it suits small
+deployments and tests. The client is closed (flushing storage and releasing
+the lock) on app shutdown and at interpreter exit.
+"""
+import atexit
+import os
+import time
+from typing import Any, Dict, Optional
+
+import portalocker
+from qdrant_client import QdrantClient, models
+
+QDRANT_URL = os.getenv("QDRANT_URL", ":memory:")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_TIMEOUT = float(os.getenv("QDRANT_TIMEOUT", "60"))
+QDRANT_PATH = os.getenv("QDRANT_PATH", "")
+QDRANT_PATH_LOCK_TIMEOUT = float(os.getenv("QDRANT_PATH_LOCK_TIMEOUT", "10"))
+QDRANT_LOCK_FILENAME = "druidx.lock"
+
+QDRANT_STATUS: Dict[str, Any] = {"mode": None, "location": None, "opened_at": None, "closed_at": None}
+_path_lock: Optional[portalocker.Lock] = None
+_embedded_client: Optional[QdrantClient] = None
+
+
+def _set_status(mode: str, location: Optional[str]):
+    QDRANT_STATUS.update(mode=mode, location=location, opened_at=time.time(), closed_at=None)
+
+
+def _acquire_path_lock(path: str):
+    global _path_lock
+    os.makedirs(path, exist_ok=True)
+    lock_file = os.path.join(path, QDRANT_LOCK_FILENAME)
+    lock = portalocker.Lock(lock_file, mode="a", timeout=QDRANT_PATH_LOCK_TIMEOUT, fail_when_locked=False)
+    try:
+        handle = lock.acquire()
+    except portalocker.exceptions.LockException as e:
+        holder = ""
+        try:
+            with open(lock_file) as f:
+                holder = f.read().strip()
+        except OSError:
+            pass
+        raise RuntimeError(
+            f"Qdrant storage {path} is locked by another process{f' (pid {holder})' if holder else ''}. "
+            "Embedded mode supports a single process: run one worker or use a Qdrant server (QDRANT_URL)."
+        ) from e
+    handle.truncate(0)
+    handle.write(str(os.getpid()))
+    handle.flush()
+    _path_lock = lock
+
+
+def open_embedded_client(path: str) -> QdrantClient:
+    """Open on-disk storage at path under the process lock."""
+    global _embedded_client
+    _acquire_path_lock(path)
+    try:
+        client = QdrantClient(path=path)
+    except Exception:
+        _release_path_lock()
+        raise
+    _embedded_client = client
+    _set_status("embedded", os.path.abspath(path))
+    collections = client.get_collections().collections
+    print(f"[RAG] Opened embedded Qdrant storage at {path} ({len(collections)} collections)")
+    return client
+
+
+def open_qdrant_client() -> QdrantClient:
+    """Client for the configured mode: remote server, embedded storage or in-memory."""
+    if QDRANT_URL and QDRANT_URL != ":memory:":
+        try:
+            client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=QDRANT_TIMEOUT)
+            # Test the connection
+            client.get_collections()
+            _set_status("remote", QDRANT_URL)
+            print(f"[RAG] Connected to remote Qdrant at {QDRANT_URL}")
+            return client
+        except Exception as e:
+            print(f"[RAG] Remote Qdrant failed, falling back to {'embedded storage' if QDRANT_PATH else 'in-memory'}: {e}")
+    if QDRANT_PATH:
+        return open_embedded_client(QDRANT_PATH)
+    _set_status("memory", None)
+    print("[RAG] Using in-memory Qdrant; indexes are lost on restart (set QDRANT_PATH to persist them)")
+    return QdrantClient(":memory:", timeout=QDRANT_TIMEOUT)
+
+
+def _release_path_lock():
+    global _path_lock
+    if _path_lock is not None:
+        try:
+            _path_lock.release()
+        except Exception as e:
+            print(f"[RAG] Could not release Qdrant storage lock: {e}")
+        _path_lock = None
+
+
+def close_qdrant_client():
+    """Close embedded storage and release its lock (idempotent; remote and in-memory clients need nothing)."""
+    global _embedded_client
+    if _embedded_client is None:
+        return
+    try:
+        _embedded_client.close()
+    except Exception as e:
+        print(f"[RAG] Error closing embedded Qdrant: {e}")
+    _embedded_client = None
+    _release_path_lock()
+    QDRANT_STATUS["closed_at"] = time.time()
+    print("[RAG] Closed embedded Qdrant storage")
+
+
+atexit.register(close_qdrant_client)
+
+
+def reset_collection(client: QdrantClient, collection_name: str, **config):
+    """Drop `collection_name` if it exists and create it empty with `config` (replaces the deprecated recreate_collection)."""
+    if client.collection_exists(collection_name):
+        client.delete_collection(collection_name)
+    client.create_collection(collection_name=collection_name, **config)
+
+
+def check_persistence(path: str, points: int = 200, dim: int = 64, seed: int = 7) -> Dict[str, Any]:
+    """
+    Restart check: write a collection to embedded storage at path, close it
+    (as on shutdown), reopen and compare point count, payloads and top hit.
+    Also checks that a second open of the same path is refused while locked.
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((points, dim)).astype(np.float32)
+    name = "qdrant_persistence_check"
+    query = vectors[0].tolist()
+
+    client = open_embedded_client(path)
+    reset_collection(
+        client,
+        name,
+        vectors_config=models.VectorParams(size=dim, distance=models.Distance.COSINE),
+    )
+    client.upsert(
+        collection_name=name,
+        points=[models.PointStruct(id=i, vector=vectors[i].tolist(), payload={"n": i}) for i in range(points)],
+    )
+    before = [p.id for p in client.search(collection_name=name, query_vector=query, limit=5)]
+
+    second_open_refused = False
+    probe = portalocker.Lock(os.path.join(path, QDRANT_LOCK_FILENAME), mode="a", timeout=0.2, fail_when_locked=True)
+    try:
+        probe.acquire()
+        probe.release()
+    except portalocker.exceptions.LockException:
+        second_open_refused = True
+    close_qdrant_client()
+
+    client = open_embedded_client(path)
+    try:
+        count = client.count(collection_name=name, exact=True).count
+        after = [p.id for p in client.search(collection_name=name, query_vector=query, limit=5)]
+        payload = client.retrieve(collection_name=name, ids=[points - 1], with_payload=True)[0].payload
+        client.delete_collection(collection_name=name)
+    finally:
+        close_qdrant_client()
+
+    result = {
+        "path": os.path.abspath(path),
+        "points_written": points,
+        "points_after_restart": count,
+        "same_top_hits": before == after,
+        "payload_intact": payload == {"n": points - 1},
+        "second_open_refused": second_open_refused,
+    }
+    result["ok"] = count == points and result["same_top_hits"] and result["payload_intact"] and second_open_refused
+    print(f"[QDRANT-CHECK] {result}")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    if len(sys.argv) > 1:
+        outcome = check_persistence(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            outcome = check_persistence(tmp)
+    raise SystemExit(0 if outcome["ok"] else 1)
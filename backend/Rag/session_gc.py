@@ -0,0 +1,230 @@
+"""
+Per-session resource manifest and background garbage collector.
+
+Every Qdrant collection and Redis key created on behalf of a chat session is
+recorded in a Redis set so it can be reclaimed once the session itself has
+expired (sessions live 24h in Redis, their collections used to live forever).
+
+The sweeper runs in dry-run mode unless SESSION_GC_DRY_RUN=false: it only
+reports the points and bytes it would reclaim, so deletion is opt-in.
+
+Layout:
+    session_resources:{session_id}  set   "qdrant:<collection>" | "redis:<key>"
+    session_resources:index         zset  session_id -> last time a resource was recorded
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from redis_client import ensure_redis_client
+
+SESSION_RESOURCES_PREFIX = "session_resources"
+SESSION_RESOURCES_INDEX = "session_resources:index"
+SESSION_GC_INTERVAL_SECONDS = int(os.getenv("SESSION_GC_INTERVAL_SECONDS", "3600"))
+SESSION_GC_GRACE_SECONDS = int(os.getenv("SESSION_GC_GRACE_SECONDS", "3600"))
+SESSION_GC_DRY_RUN = os.getenv("SESSION_GC_DRY_RUN", "true").lower() == "true"
+SESSION_GC_BATCH_SIZE = int(os.getenv("SESSION_GC_BATCH_SIZE", "200"))
+USER_COLLECTION_PREFIXES = ("user_docs_", "user_images_")
+
+# Cumulative metrics for this worker, exposed through the admin endpoint
+SESSION_GC_METRICS: Dict[str, Any] = {
+    "runs": 0,
+    "sessions_reclaimed": 0,
+    "collections_deleted": 0,
+    "redis_keys_deleted": 0,
+    "points_reclaimed": 0,
+    "bytes_reclaimed": 0,
+    "last_run_at": None,
+    "last_run": None,
+}
+
+
+def session_resources_key(session_id: str) -> str:
+    return f"{SESSION_RESOURCES_PREFIX}:{session_id}"
+
+
+async def track_session_resources(
+    session_id: Optional[str],
+    collections: Iterable[str] = (),
+    redis_keys: Iterable[str] = (),
+):
+    """Record collections/keys created for a session (idempotent)."""
+    if not session_id or session_id == "default":
+        return
+    members = [f"qdrant:{c}" for c in collections if c] + [f"redis:{k}" for k in redis_keys if k]
+    if not members:
+        return
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.sadd(session_resources_key(session_id), *members)
+            pipe.zadd(SESSION_RESOURCES_INDEX, {session_id: time.time()})
+            await pipe.execute()
+    except Exception as e:
+        print(f"[SESSION-GC] Error tracking resources for session {session_id}: {e}")
+
+
+def _new_run_metrics(dry_run: bool) -> Dict[str, Any]:
+    return {
+        "dry_run": dry_run,
+        "sessions_scanned": 0,
+        "sessions_reclaimed": 0,
+        "collections_deleted": 0,
+        "redis_keys_deleted": 0,
+        "points_reclaimed": 0,
+        "bytes_reclaimed": 0,
+        "reclaimed": [],
+    }
+
+
+async def _reclaim_members(members: Iterable[str], metrics: Dict[str, Any], dry_run: bool):
+    """Delete (or, in dry-run, measure) the given manifest members."""
+    from Rag.Rag import QDRANT_CLIENT, VECTOR_SIZE
+    from Rag.chunk_registry import clear_chunk_registry
+    from Rag.bm25_index import clear_bm25_index
+    from Rag.local_vectors import forget_collection as forget_local_vectors
+    from Rag.near_dup import clear_near_dup_index
+
+    redis_client = await ensure_redis_client()
+    for member in members:
+        kind, _, name = member.partition(":")
+        if kind == "qdrant":
+            try:
+                info = await asyncio.to_thread(QDRANT_CLIENT.get_collection, collection_name=name)
+            except Exception:
+                continue  # already gone
+            points = info.points_count or 0
+            metrics["points_reclaimed"] += points
+            # Qdrant does not report on-disk size; estimate from dense float32 vectors
+            metrics["bytes_reclaimed"] += points * VECTOR_SIZE * 4
+            metrics["collections_deleted"] += 1
+            if not dry_run:
+                try:
+                    await asyncio.to_thread(QDRANT_CLIENT.delete_collection, collection_name=name)
+                    await clear_chunk_registry(name)
+                    await clear_bm25_index(name)
+                    await clear_near_dup_index(name)
+                    forget_local_vectors(name)
+                except Exception as e:
+                    print(f"[SESSION-GC] Error deleting collection {name}: {e}")
+        elif kind == "redis" and redis_client:
+            try:
+                size = await redis_client.memory_usage(name)
+            except Exception:
+                # MEMORY USAGE can be disabled (managed Redis): delete without a size
+                size = 0 if await redis_client.exists(name) else None
+            if size is None:
+                continue  # key already expired
+            metrics["bytes_reclaimed"] += size
+            metrics["redis_keys_deleted"] += 1
+            if not dry_run:
+                await redis_client.delete(name)
+
+
+async def reclaim_session_resources(session_id: str, dry_run: bool = False, metrics: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Reclaim everything recorded for one session and drop its manifest."""
+    metrics = metrics if metrics is not None else _new_run_metrics(dry_run)
+    redis_client = await ensure_redis_client()
+    if not redis_client or not session_id:
+        return metrics
+    manifest_key = session_resources_key(session_id)
+    members = await redis_client.smembers(manifest_key)
+    await _reclaim_members(members, metrics, dry_run)
+    metrics["sessions_reclaimed"] += 1
+    metrics["reclaimed"].append(session_id)
+    if not dry_run:
+        await redis_client.delete(manifest_key)
+        await redis_client.zrem(SESSION_RESOURCES_INDEX, session_id)
+    return metrics
+
+
+async def _untracked_orphan_collections(redis_client, tracked_sessions: set) -> List[str]:
+    """User collections created before the manifest existed whose session is gone."""
+    from Rag.Rag import QDRANT_CLIENT
+
+    orphans = []
+    collections_response = await asyncio.to_thread(QDRANT_CLIENT.get_collections)
+    for c in collections_response.collections:
+        for prefix in USER_COLLECTION_PREFIXES:
+            if c.name.startswith(prefix):
+                session_id = c.name[len(prefix):]
+                if session_id in tracked_sessions:
+                    break
+                if not await redis_client.exists(f"session:{session_id}"):
+                    orphans.append(c.name)
+                break
+    return orphans
+
+
+async def sweep_orphaned_session_resources(dry_run: Optional[bool] = None, include_untracked: bool = False) -> Dict[str, Any]:
+    """
+    Reclaim resources of sessions that no longer exist in Redis.
+
+    Args:
+        dry_run: Only measure what would be reclaimed (defaults to SESSION_GC_DRY_RUN)
+        include_untracked: Also reclaim user_docs_/user_images_ collections that predate
+            the manifest and belong to sessions that no longer exist
+    """
+    dry_run = SESSION_GC_DRY_RUN if dry_run is None else dry_run
+    metrics = _new_run_metrics(dry_run)
+    start = time.time()
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return metrics
+
+    # Collect candidates first so reclaiming (which edits the index) cannot shift the pages
+    cutoff = start - SESSION_GC_GRACE_SECONDS
+    candidates: List[str] = []
+    offset = 0
+    while True:
+        batch = await redis_client.zrangebyscore(
+            SESSION_RESOURCES_INDEX, "-inf", cutoff, start=offset, num=SESSION_GC_BATCH_SIZE
+        )
+        candidates.extend(batch)
+        if len(batch) < SESSION_GC_BATCH_SIZE:
+            break
+        offset += len(batch)
+
+    tracked_sessions = set(candidates)
+    for session_id in candidates:
+        metrics["sessions_scanned"] += 1
+        if await redis_client.exists(f"session:{session_id}"):
+            continue
+        await reclaim_session_resources(session_id, dry_run=dry_run, metrics=metrics)
+
+    if include_untracked:
+        try:
+            orphans = await _untracked_orphan_collections(redis_client, tracked_sessions)
+            await _reclaim_members([f"qdrant:{name}" for name in orphans], metrics, dry_run)
+        except Exception as e:
+            print(f"[SESSION-GC] Error scanning untracked collections: {e}")
+
+    metrics["duration_ms"] = round((time.time() - start) * 1000, 1)
+    if not dry_run:
+        for field in ("sessions_reclaimed", "collections_deleted", "redis_keys_deleted", "points_reclaimed", "bytes_reclaimed"):
+            SESSION_GC_METRICS[field] += metrics[field]
+    SESSION_GC_METRICS["runs"] += 1
+    SESSION_GC_METRICS["last_run_at"] = start
+    SESSION_GC_METRICS["last_run"] = {k: v for k, v in metrics.items() if k != "reclaimed"}
+    print(
+        f"[SESSION-GC] {'Dry run: would reclaim' if dry_run else 'Reclaimed'} "
+        f"{metrics['sessions_reclaimed']} sessions, {metrics['collections_deleted']} collections, "
+        f"{metrics['redis_keys_deleted']} keys, {metrics['points_reclaimed']} points, "
+        f"~{metrics['bytes_reclaimed']} bytes in {metrics['duration_ms']}ms"
+    )
+    return metrics
+
+
+async def session_gc_loop(interval: int = SESSION_GC_INTERVAL_SECONDS):
+    """Background sweeper started on application startup."""
+    while True:
+        try:
+            await sweep_orphaned_session_resources()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[SESSION-GC] Sweep failed: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,163 @@
+"""
+Qdrant-native sparse vectors with server-side hybrid fusion.
+
+With QDRANT_SPARSE_HYBRID enabled, new hybrid collections get a named sparse
+vector next to the unnamed dense one. Each chunk stores BM25 term weights
+(saturated, length-normalised term frequencies); Qdrant applies IDF itself
+(Modifier.IDF) and fuses a dense and a sparse prefetch with RRF in a single
+Query API call. The fused pool goes through the same MMR stage as the
+client-side path. Collections created without the sparse vector, and queries
+where the Query API call fails, use the client-side BM25 + RRF path.
+"""
+import asyncio
+import os
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from qdrant_client import models
+
+from Rag.bm25_index import BM25_B, BM25_K1
+
+SPARSE_HYBRID_ENABLED = os.getenv("QDRANT_SPARSE_HYBRID", "false").lower() == "true"
+SPARSE_VECTOR_NAME = os.getenv("QDRANT_SPARSE_VECTOR_NAME", "bm25")
+# Length normalisation needs an average chunk length at ingestion time (tokens after stopwords)
+SPARSE_AVG_DOC_LEN = float(os.getenv("QDRANT_SPARSE_AVG_DOC_LEN", "120"))
+
+# collection -> has the named sparse vector
+_sparse_collections: Dict[str, bool] = {}
+
+
+def term_index(term: str) -> int:
+    """Stable 31-bit id of a term (sparse vector dimension)."""
+    return zlib.crc32(term.encode("utf-8")) & 0x7FFFFFFF
+
+
+def _sparse(weights: Dict[int, float]) -> models.SparseVector:
+    indices = sorted(weights)
+    return models.SparseVector(indices=indices, values=[weights[i] for i in indices])
+
+
+def sparse_document_vector(tokens: List[str]) -> models.SparseVector:
+    """BM25 document-side weights; IDF is applied by Qdrant at query time."""
+    counts: Dict[int, int] = {}
+    for token in tokens:
+        idx = term_index(token)
+        counts[idx] = counts.get(idx, 0) + 1
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / SPARSE_AVG_DOC_LEN)
+    return _sparse({idx: tf * (BM25_K1 + 1) / (tf + norm) for idx, tf in counts.items()})
+
+
+def sparse_query_vector(tokens: List[str]) -> models.SparseVector:
+    return _sparse({term_index(token): 1.0 for token in tokens})
+
+
+def sparse_vectors_config() -> Dict[str, models.SparseVectorParams]:
+    return {SPARSE_VECTOR_NAME: models.SparseVectorParams(modifier=models.Modifier.IDF)}
+
+
+def point_vector(dense: List[float], tokens: List[str]) -> Dict[str, Any]:
+    """Vector field of a point carrying both the default dense and the named sparse vector."""
+    return {"": dense, SPARSE_VECTOR_NAME: sparse_document_vector(tokens)}
+
+
+def forget_collection(collection_name: str):
+    _sparse_collections.pop(collection_name, None)
+
+
+async def has_sparse_vectors(collection_name: str) -> bool:
+    """Whether a collection was created with the named sparse vector (cached per worker)."""
+    cached = _sparse_collections.get(collection_name)
+    if cached is not None:
+        return cached
+    from Rag.Rag import QDRANT_CLIENT
+
+    try:
+        info = await asyncio.to_thread(QDRANT_CLIENT.get_collection, collection_name)
+        sparse = info.config.params.sparse_vectors or {}
+        enabled = SPARSE_VECTOR_NAME in sparse
+    except Exception as e:
+        print(f"[SPARSE-HYBRID] Could not read config of {collection_name}: {e}")
+        return False
+    _sparse_collections[collection_name] = enabled
+    return enabled
+
+
+async def server_hybrid_search(
+    collection_name: str,
+    query_embedding: List[float],
+    query_tokens: List[str],
+    limit: int,
+    prefetch_limit: Optional[int] = None,
+    with_vectors: bool = False,
+) -> List[models.ScoredPoint]:
+    """
+    Dense + sparse prefetch fused with RRF by Qdrant; returns points best first.
+    with_vectors attaches the dense vectors (for the MMR stage).
+    """
+    from Rag.Rag import QDRANT_CLIENT
+
+    prefetch_limit = prefetch_limit or limit * 3
+    prefetch = [models.Prefetch(query=query_embedding, limit=prefetch_limit)]
+    if query_tokens:
+        prefetch.append(models.Prefetch(
+            query=sparse_query_vector(query_tokens),
+            using=SPARSE_VECTOR_NAME,
+            limit=prefetch_limit,
+        ))
+    response = await asyncio.to_thread(
+        QDRANT_CLIENT.query_points,
+        collection_name=collection_name,
+        prefetch=prefetch,
+        query=models.FusionQuery(fusion=models.Fusion.RRF),
+        limit=limit,
+        with_payload=["text"],
+        with_vectors=[""] if with_vectors else False,
+    )
+    return [p for p in response.points if p.payload and p.payload.get("text")]
+
+
+async def benchmark_hybrid_search(
+    collection_name: str,
+    queries: List[str],
+    limit: int = 5,
+    api_keys: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """
+    Run each query through the client-side path (dense search + BM25 + client
+    RRF) and the server-side Query API path. Recall is the share of the
+    client-side top `limit` that the server-side path also returns; both
+    latencies include the query embedding.
+    """
+    from Rag.Rag import _hybrid_search_rrf
+
+    if not await has_sparse_vectors(collection_name):
+        return {"error": f"{collection_name} has no '{SPARSE_VECTOR_NAME}' sparse vector"}
+
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        client = await _hybrid_search_rrf(collection_name, query, limit=limit, api_keys=api_keys, server_side=False)
+        client_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        server = await _hybrid_search_rrf(collection_name, query, limit=limit, api_keys=api_keys, server_side=True)
+        server_ms = (time.perf_counter() - start) * 1000
+
+        recall = len(set(client) & set(server)) / len(client) if client else 1.0
+        results.append({
+            "query": query,
+            "client_ms": round(client_ms, 1),
+            "server_ms": round(server_ms, 1),
+            "recall": round(recall, 3),
+        })
+
+    n = len(results) or 1
+    return {
+        "collection": collection_name,
+        "limit": limit,
+        "queries": results,
+        "mean_client_ms": round(sum(r["client_ms"] for r in results) / n, 1),
+        "mean_server_ms": round(sum(r["server_ms"] for r in results) / n, 1),
+        "mean_recall": round(sum(r["recall"] for r in results) / n, 3),
+    }
@@ -0,0 +1,288 @@
+"""
+Precomputed document summary trees.
+
+Built once per document in the background after ingestion, so "summarize this"
+requests are answered from stored nodes with a single final LLM call instead of
+a full map-reduce over every chunk.
+
+Layout:
+    summary_tree:{collection}  hash  source -> JSON document node
+                                     "__collection__" -> JSON collection node
+
+Document node: {content_hash, filename, file_type, doc_index, verbatim, summary,
+                sections: [{title, chunk_start, chunk_end, summary}], built_at}
+Collection node: {sources_hash, summary, built_at}
+
+A document node is valid while its content_hash matches the chunk registry entry
+of the same source; the collection node while its sources_hash matches the hash
+of all valid document nodes.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from redis_client import ensure_redis_client
+from Rag.chunk_registry import chunk_source_key, get_chunk_sources
+from Rag.llm_scheduler import invoke_llm
+
+SUMMARY_TREE_PREFIX = "summary_tree"
+COLLECTION_NODE_FIELD = "__collection__"
+SUMMARY_TREE_ENABLED = os.getenv("SUMMARY_TREE_ENABLED", "true").lower() == "true"
+SUMMARY_TREE_FOR_KB = os.getenv("SUMMARY_TREE_FOR_KB", "false").lower() == "true"
+SUMMARY_TREE_MODEL = os.getenv("SUMMARY_TREE_MODEL", "google/gemini-2.5-flash-lite")
+# Documents below this many words are stored verbatim (no LLM call needed)
+SUMMARY_TREE_MIN_WORDS = int(os.getenv("SUMMARY_TREE_MIN_WORDS", "1200"))
+SUMMARY_SECTION_MAX_CHARS = int(os.getenv("SUMMARY_SECTION_MAX_CHARS", "8000"))
+
+SECTION_PROMPT = """
+You are summarizing a structured academic document.
+
+### Task:
+- Automatically detect and preserve natural headings (UNIT, CHAPTER, etc.).
+- Summarize each section clearly and concisely (~200-300 words total).
+- **Even within the word limit, do not merge or remove distinct sections.**
+---
+{text}
+"""
+
+MERGE_PROMPT = """
+You are merging partial summaries of a structured textbook/document.
+
+### Task:
+- Combine them while preserving all detected headings, subheadings, and their order.
+- If similar headings appear across summaries, merge their content intelligently under one heading.
+- Ensure the final text reads like a clean, organized outline with clear section boundaries.
+- Keep the merged summary between **350 and 600 words**.
+
+---
+{text}
+"""
+
+COLLECTION_PROMPT = """
+You are writing an overview of a set of documents from their individual summaries.
+
+### Task:
+- Give each document a short paragraph under its own name, in the given order.
+- Finish with the themes the documents share, if any.
+- Keep the overview between **300 and 600 words**.
+
+---
+{text}
+"""
+
+_building: Dict[str, asyncio.Task] = {}
+
+
+def summary_tree_key(collection_name: str) -> str:
+    return f"{SUMMARY_TREE_PREFIX}:{collection_name}"
+
+
+def _sources_hash(nodes: List[Dict[str, Any]]) -> str:
+    joined = "|".join(n.get("content_hash", "") for n in nodes)
+    return hashlib.sha256(joined.encode("utf-8")).hexdigest()
+
+
+def split_sections(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Group ordered chunk payloads into sections: a new section starts at a new
+    heading or once the current one exceeds SUMMARY_SECTION_MAX_CHARS.
+    """
+    sections: List[Dict[str, Any]] = []
+    current = None
+    for i, chunk in enumerate(chunks):
+        text = chunk.get("text", "")
+        heading = chunk.get("heading")
+        new_heading = heading and current and heading != current["title"]
+        if current is None or new_heading or current["chars"] + len(text) > SUMMARY_SECTION_MAX_CHARS:
+            current = {"title": heading or (current["title"] if current else None), "chunk_start": i, "texts": [], "chars": 0}
+            sections.append(current)
+        current["texts"].append(text)
+        current["chars"] += len(text)
+        current["chunk_end"] = i
+    return sections
+
+
+async def _merge(llm, summaries: List[str]) -> str:
+    """Recursive reduce in groups of five, as in the live summarizer."""
+    if len(summaries) == 1:
+        return summaries[0]
+    if len(summaries) <= 5:
+        return await invoke_llm(llm, MERGE_PROMPT.format(text="\n\n".join(summaries)))
+    merged = await asyncio.gather(*[_merge(llm, summaries[i:i + 5]) for i in range(0, len(summaries), 5)])
+    return await _merge(llm, list(merged))
+
+
+async def build_document_node(llm, chunks: List[Dict[str, Any]], content_hash: str) -> Dict[str, Any]:
+    """Summarize one document (ordered chunk payloads) into a document node."""
+    first = chunks[0] if chunks else {}
+    node = {
+        "content_hash": content_hash,
+        "filename": first.get("filename") or "unknown",
+        "file_type": first.get("file_type") or "unknown",
+        "doc_index": first.get("doc_index"),
+        "verbatim": False,
+        "sections": [],
+        "built_at": time.time(),
+    }
+    full_text = "\n".join(c.get("text", "") for c in chunks)
+    if len(full_text.split()) < SUMMARY_TREE_MIN_WORDS:
+        node["verbatim"] = True
+        node["summary"] = full_text
+        return node
+
+    sections = split_sections(chunks)
+    section_summaries = await asyncio.gather(*[
+        invoke_llm(llm, SECTION_PROMPT.format(text="\n".join(s["texts"]))) for s in sections
+    ])
+    node["sections"] = [
+        {"title": s["title"], "chunk_start": s["chunk_start"], "chunk_end": s["chunk_end"], "summary": summary}
+        for s, summary in zip(sections, section_summaries)
+    ]
+    node["summary"] = await _merge(llm, list(section_summaries))
+    return node
+
+
+async def _store_nodes(collection_name: str, nodes: Dict[str, str], ttl: Optional[int]):
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return
+    key = summary_tree_key(collection_name)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=nodes)
+        if ttl:
+            pipe.expire(key, ttl)
+        await pipe.execute()
+
+
+async def _build_collection_node(llm, collection_name: str, ttl: Optional[int]):
+    """Refresh the collection node once every registered document has a valid node."""
+    tree = await get_valid_summary_tree(collection_name, include_collection=False)
+    if not tree or len(tree["documents"]) < 2:
+        return
+    documents = tree["documents"]
+    block = "\n\n".join(f"## {d['filename']}\n{d['summary']}" for d in documents)
+    summary = await invoke_llm(llm, COLLECTION_PROMPT.format(text=block))
+    await _store_nodes(collection_name, {
+        COLLECTION_NODE_FIELD: json.dumps({
+            "sources_hash": _sources_hash(documents),
+            "summary": summary,
+            "built_at": time.time(),
+        })
+    }, ttl)
+
+
+async def build_summary_trees(
+    collection_name: str,
+    payloads: List[Dict[str, Any]],
+    api_keys: Optional[Dict[str, str]] = None,
+    ttl: Optional[int] = None,
+):
+    """Build and store document nodes for freshly ingested chunks, then the collection node."""
+    from llm import get_llm
+    from Rag.kb_manifest import content_hash as hash_content
+
+    by_source: Dict[str, List[Dict[str, Any]]] = {}
+    for payload in payloads:
+        by_source.setdefault(chunk_source_key(payload), []).append(payload)
+    if not by_source:
+        return
+
+    llm = get_llm(SUMMARY_TREE_MODEL, 0.2, api_keys=api_keys)
+    start = time.time()
+
+    async def _one(source: str, chunks: List[Dict[str, Any]]):
+        chunks.sort(key=lambda c: c.get("chunk_index", 0))
+        digest = hash_content("\n".join(c.get("text", "") for c in chunks))
+        try:
+            node = await build_document_node(llm, chunks, digest)
+            return source, json.dumps(node)
+        except Exception as e:
+            print(f"[SUMMARY-TREE] Failed to summarize {source} in {collection_name}: {e}")
+            return source, None
+
+    results = await asyncio.gather(*[_one(s, c) for s, c in by_source.items()])
+    nodes = {source: node for source, node in results if node}
+    if nodes:
+        await _store_nodes(collection_name, nodes, ttl)
+    try:
+        await _build_collection_node(llm, collection_name, ttl)
+    except Exception as e:
+        print(f"[SUMMARY-TREE] Failed to build collection node for {collection_name}: {e}")
+    print(f"[SUMMARY-TREE] Built {len(nodes)}/{len(by_source)} document trees for {collection_name} in {time.time() - start:.1f}s")
+
+
+def schedule_summary_tree_build(
+    collection_name: str,
+    payloads: List[Dict[str, Any]],
+    api_keys: Optional[Dict[str, str]] = None,
+    ttl: Optional[int] = None,
+):
+    """Start a background build; a newer ingestion for the same collection waits for the running one."""
+    if not SUMMARY_TREE_ENABLED or not payloads:
+        return
+    previous = _building.get(collection_name)
+
+    async def _run():
+        if previous and not previous.done():
+            try:
+                await previous
+            except Exception:
+                pass
+        try:
+            await build_summary_trees(collection_name, payloads, api_keys=api_keys, ttl=ttl)
+        except Exception as e:
+            print(f"[SUMMARY-TREE] Background build failed for {collection_name}: {e}")
+
+    task = asyncio.create_task(_run())
+    _building[collection_name] = task
+    task.add_done_callback(lambda t: _building.pop(collection_name, None) if _building.get(collection_name) is t else None)
+
+
+async def remove_document_nodes(collection_name: str, sources: List[str]):
+    """Drop the nodes of deleted documents; the collection node then no longer validates."""
+    sources = [s for s in sources if s]
+    redis_client = await ensure_redis_client()
+    if redis_client and sources:
+        await redis_client.hdel(summary_tree_key(collection_name), *sources)
+
+
+async def get_valid_summary_tree(collection_name: str, include_collection: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Return {"documents": [document nodes in registry order], "collection": str | None}
+    when every registered document has a node matching its current content hash,
+    else None (callers fall back to live summarization).
+    """
+    sources = await get_chunk_sources(collection_name)
+    if not sources:
+        return None
+    redis_client = await ensure_redis_client()
+    if not redis_client:
+        return None
+    try:
+        raw = await redis_client.hgetall(summary_tree_key(collection_name))
+    except Exception as e:
+        print(f"[SUMMARY-TREE] Error reading summary tree for {collection_name}: {e}")
+        return None
+
+    documents = []
+    for source, meta in sources.items():
+        try:
+            node = json.loads(raw.get(source) or "null")
+        except (TypeError, ValueError):
+            node = None
+        if not node or not meta.get("content_hash") or node.get("content_hash") != meta["content_hash"]:
+            return None
+        documents.append(node)
+
+    collection_summary = None
+    if include_collection and len(documents) > 1:
+        try:
+            collection_node = json.loads(raw.get(COLLECTION_NODE_FIELD) or "null")
+        except (TypeError, ValueError):
+            collection_node = None
+        if collection_node and collection_node.get("sources_hash") == _sources_hash(documents):
+            collection_summary = collection_node.get("summary")
+    return {"documents": documents, "collection": collection_summary}
@@ -0,0 +1,239 @@
+"""
+Worker cache warm-up on GPT load and session creation.
+
+Without it the first chat turn pays every cold cost at once. warm_gpt() runs
+these steps concurrently, within WARMUP_BUDGET_MS:
+
+    kb          KB manifest readiness, KB JSON registry (client-side cached Redis reads),
+                collection config (sparse-vector flag, first Qdrant request); for hybrid KBs
+                without server-side sparse vectors, the BM25 index is deserialized and pinned
+                in the worker cache for WARMUP_PIN_SECONDS
+    llm         cached chat clients for the GPT's model at the temperatures first turns use
+    embeddings  cached embedding client
+    tls         keep-alive connections to OpenRouter and the embeddings API
+
+warm_session() runs the connection steps for a new session. Steps still
+running at the deadline are cancelled and reported as timed out. Reports are
+logged and the last WARMUP_REPORTS_KEPT are kept per worker.
+
+Benchmark (first-turn TTFT, each run in a fresh process, with and without warm-up):
+    python -m Rag.warmup bench < spec.json
+    spec: {"gpt_config": {...}, "query": str, "rounds": int, "api_keys": {...}}
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_BUDGET_MS = float(os.getenv("WARMUP_BUDGET_MS", "3000"))
+WARMUP_PIN_SECONDS = float(os.getenv("WARMUP_PIN_SECONDS", "1800"))
+WARMUP_LLM_TEMPERATURES = [float(t) for t in os.getenv("WARMUP_LLM_TEMPERATURES", "0.9,0.8,0.7,0.5").split(",") if t.strip()]
+WARMUP_REPORTS_KEPT = 50
+
+WARMUP_REPORTS: "deque[Dict[str, Any]]" = deque(maxlen=WARMUP_REPORTS_KEPT)
+# Background warm-ups, referenced until done so they are not garbage collected
+_background: set = set()
+
+
+async def _run_steps(kind: str, steps: Dict[str, Callable[[], Awaitable[Any]]], **context: Any) -> Dict[str, Any]:
+    """Run steps concurrently under the budget; returns the timing report."""
+    start = time.perf_counter()
+    report: Dict[str, Any] = {"kind": kind, **context, "steps": {}}
+
+    async def _one(name: str, step: Callable[[], Awaitable[Any]]):
+        step_start = time.perf_counter()
+        try:
+            detail = await step()
+            report["steps"][name] = {"ms": round((time.perf_counter() - step_start) * 1000, 1), "status": "ok"}
+            if detail:
+                report["steps"][name].update(detail)
+        except Exception as e:
+            report["steps"][name] = {"ms": round((time.perf_counter() - step_start) * 1000, 1), "status": f"error: {e}"}
+
+    tasks = {name: asyncio.create_task(_one(name, step)) for name, step in steps.items()}
+    _, pending = await asyncio.wait(tasks.values(), timeout=WARMUP_BUDGET_MS / 1000)
+    for name, task in tasks.items():
+        if task in pending:
+            task.cancel()
+            report["steps"][name] = {"ms": WARMUP_BUDGET_MS, "status": "timeout"}
+    report["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    report["at"] = time.time()
+    WARMUP_REPORTS.append(report)
+    print(f"[WARMUP] {kind} warm-up in {report['total_ms']}ms: " + ", ".join(
+        f"{name}={step['status']} {step['ms']}ms" for name, step in report["steps"].items()
+    ))
+    return report
+
+
+async def _warm_tls():
+    import llm
+    import embeddings
+
+    await asyncio.gather(llm.warm_connection(), embeddings.warm_connection())
+
+
+async def _warm_stores():
+    from redis_client import ensure_redis_client, ensure_redis_client_binary
+    from Rag.Rag import QDRANT_CLIENT
+
+    await ensure_redis_client()
+    await ensure_redis_client_binary()
+    await asyncio.to_thread(QDRANT_CLIENT.get_collections)
+
+
+async def _warm_kb(gpt_id: str, userId: str, hybrid: bool) -> Dict[str, Any]:
+    from Rag.Rag import check_kb_collection_exists
+    from Rag.kb_index import kb_collection_name, kb_owner
+    from Rag.key_registry import has_registered_keys, kb_json_scope
+    from Rag.sparse_hybrid import has_sparse_vectors
+    from Rag.bm25_index import get_bm25_index, pin_index
+
+    exists, has_data = await check_kb_collection_exists(gpt_id, userId)
+    await has_registered_keys(kb_json_scope(gpt_id, kb_owner(userId)))
+    detail: Dict[str, Any] = {"indexed": bool(exists and has_data)}
+    if not (exists and has_data):
+        return detail
+    collection_name = kb_collection_name(gpt_id, userId)
+    server_side = await has_sparse_vectors(collection_name)
+    if hybrid and not server_side:
+        index = await get_bm25_index(collection_name)
+        if index is not None:
+            detail["bm25_chunks"] = index["docs"]
+            detail["bm25_pinned"] = pin_index(collection_name, WARMUP_PIN_SECONDS)
+    return detail
+
+
+async def _warm_llm(model: str, api_keys: Optional[Dict[str, str]]) -> Dict[str, Any]:
+    from llm import get_llm
+
+    for temperature in WARMUP_LLM_TEMPERATURES:
+        get_llm(model, temperature, api_keys=api_keys)
+    return {"clients": len(WARMUP_LLM_TEMPERATURES)}
+
+
+async def _warm_embeddings(api_keys: Optional[Dict[str, str]]):
+    from embeddings import get_embedding_model
+
+    get_embedding_model(api_keys=api_keys)
+
+
+async def warm_gpt(gpt_config: Dict[str, Any], api_keys: Optional[Dict[str, str]] = None, session_id: Optional[str] = None) -> Dict[str, Any]:
+    """Prefetch what the first turn of this GPT needs; returns the timing report."""
+    api_keys = api_keys if isinstance(api_keys, dict) else None
+    gpt_id = gpt_config.get("gpt_id")
+    userId = gpt_config.get("userId")
+    steps: Dict[str, Callable[[], Awaitable[Any]]] = {
+        "llm": lambda: _warm_llm(gpt_config.get("model", "gpt-4o-mini"), api_keys),
+        "embeddings": lambda: _warm_embeddings(api_keys),
+        "tls": _warm_tls,
+    }
+    if gpt_id and userId:
+        steps["kb"] = lambda: _warm_kb(gpt_id, userId, gpt_config.get("hybridRag", False))
+    return await _run_steps("gpt", steps, gpt_id=gpt_id, session_id=session_id)
+
+
+async def warm_session(session_id: str) -> Dict[str, Any]:
+    """Open Redis, Qdrant and API connections for a new session."""
+    return await _run_steps("session", {"stores": _warm_stores, "tls": _warm_tls}, session_id=session_id)
+
+
+def schedule_warmup(coro: Awaitable[Any]):
+    """Run a warm-up in the background so the request that triggered it is not delayed."""
+    if not WARMUP_ENABLED:
+        coro.close()
+        return
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def first_turn(gpt_config: Dict[str, Any], query: str, api_keys: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    The latency-relevant part of a first KB chat turn: KB checks, retrieval and
+    the first streamed token of the answer. Returns retrieval and TTFT in ms.
+    """
+    from langchain_core.messages import HumanMessage
+    from llm import get_llm
+    from Rag.Rag import check_kb_collection_exists, _hybrid_search_rrf, _search_collection
+    from Rag.kb_index import kb_collection_name
+
+    start = time.perf_counter()
+    gpt_id, userId = gpt_config.get("gpt_id"), gpt_config.get("userId")
+    chunks: List[str] = []
+    if gpt_id and userId:
+        exists, has_data = await check_kb_collection_exists(gpt_id, userId)
+        if exists and has_data:
+            collection_name = kb_collection_name(gpt_id, userId)
+            if gpt_config.get("hybridRag", False):
+                chunks = await _hybrid_search_rrf(collection_name, query, limit=4, k=60, api_keys=api_keys)
+            else:
+                chunks = await _search_collection(collection_name, query, limit=4, api_keys=api_keys)
+    retrieval_ms = (time.perf_counter() - start) * 1000
+    chat = get_llm(gpt_config.get("model", "gpt-4o-mini"), 0.9, api_keys=api_keys)
+    context = "\n\n".join(str(c) for c in chunks)
+    async for chunk in chat.astream([HumanMessage(content=f"{context}\n\n{query}" if context else query)]):
+        if chunk.content:
+            break
+    return {
+        "retrieval_ms": round(retrieval_ms, 1),
+        "ttft_ms": round((time.perf_counter() - start) * 1000, 1),
+        "chunks": len(chunks),
+    }
+
+
+async def _measure_in_process(spec: Dict[str, Any], warm: bool) -> Dict[str, Any]:
+    import Rag.Rag  # noqa: F401  (module import and client construction are not part of a turn)
+
+    if warm:
+        await warm_gpt(spec["gpt_config"], spec.get("api_keys"))
+    return await first_turn(spec["gpt_config"], spec.get("query", "What is this knowledge base about?"), spec.get("api_keys"))
+
+
+async def benchmark_first_turn(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    First-turn TTFT with and without warm-up. Every run is a fresh worker
+    process (cold caches and connections); warm runs call warm_gpt() first,
+    as a GPT load would, and only the turn itself is timed.
+    """
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs: Dict[str, List[Dict[str, Any]]] = {"cold": [], "warm": []}
+    for _ in range(int(spec.get("rounds", 3))):
+        for mode in ("cold", "warm"):
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, "-m", "Rag.warmup", "turn", mode,
+                cwd=backend_dir, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            )
+            out, _ = await proc.communicate(json.dumps(spec).encode())
+            lines = [line for line in out.decode().splitlines() if line.startswith("{")]
+            if proc.returncode != 0 or not lines:
+                raise RuntimeError(f"{mode} run failed (exit {proc.returncode})")
+            runs[mode].append(json.loads(lines[-1]))
+
+    def _median(values: List[float]) -> float:
+        values = sorted(values)
+        return values[len(values) // 2] if values else 0.0
+
+    result = {
+        mode: {
+            "ttft_ms_median": _median([r["ttft_ms"] for r in results]),
+            "retrieval_ms_median": _median([r["retrieval_ms"] for r in results]),
+            "runs": results,
+        }
+        for mode, results in runs.items()
+    }
+    result["ttft_saved_ms"] = round(result["cold"]["ttft_ms_median"] - result["warm"]["ttft_ms_median"], 1)
+    print(f"[WARMUP-BENCH] cold {result['cold']['ttft_ms_median']}ms, warm {result['warm']['ttft_ms_median']}ms")
+    return result
+
+
+if __name__ == "__main__":
+    spec = json.loads(sys.stdin.read() or "{}")
+    if sys.argv[1:2] == ["turn"]:
+        outcome = asyncio.run(_measure_in_process(spec, warm=sys.argv[2:3] == ["warm"]))
+        print(json.dumps(outcome))
+    else:
+        print(json.dumps(asyncio.run(benchmark_first_turn(spec)), indent=2))
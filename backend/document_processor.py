@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 import pypdf
 import docx
 import json
@@ -13,19 +13,32 @@ import os
 from graph_type import GraphState
 from llm import get_llm, _extract_usage
 from langchain_core.messages import HumanMessage
-def extract_text_from_pdf(file_content: bytes) -> str:
-    """Extract text from PDF file using PyMuPDF (fitz)"""
+
+from Rag.boilerplate import strip_boilerplate, log_boilerplate_stats
+
+def extract_text_from_pdf(file_content: bytes, stats: Optional[Dict[str, Any]] = None) -> str:
+    """Extract text from PDF file using PyMuPDF (fitz), without repeated headers/footers"""
     try:
         doc = fitz.open(stream=file_content, filetype="pdf")
-        text = ""
+        pages = []
         
         for page_num in range(len(doc)):
             page = doc[page_num]
-            page_text = page.get_text()
-            if page_text.strip():  
-                text += page_text + "\n"
+            page_lines = [line for line in page.get_text().splitlines() if line.strip()]
+            # Reading order approximates vertical position
+            last = max(len(page_lines) - 1, 1)
+            pages.append([(line, i / last) for i, line in enumerate(page_lines)])
         
         doc.close()
+        keep, cleaning = strip_boilerplate(pages)
+        log_boilerplate_stats(cleaning)
+        if stats is not None:
+            stats.update(cleaning)
+        text = ""
+        for lines, mask in zip(pages, keep):
+            page_text = "\n".join(line for (line, _), kept in zip(lines, mask) if kept)
+            if page_text.strip():
+                text += page_text + "\n\n"
         return text.strip()
         
     except Exception as e:
@@ -44,6 +57,177 @@ def extract_text_from_docx(file_content: bytes) -> str:
         print(f"Error reading DOCX: {e}")
         return ""
 
+def _blocks_to_text(blocks: List[Dict[str, Any]]) -> str:
+    """Flatten extracted blocks back into plain text (pages separated by blank lines)."""
+    parts = []
+    last_page = None
+    for block in blocks:
+        if last_page is not None and block.get("page") != last_page:
+            parts.append("")
+        parts.append(block["text"])
+        last_page = block.get("page")
+    return "\n".join(parts).strip()
+
+def extract_blocks_from_pdf(file_content: bytes, stats: Optional[Dict[str, Any]] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Extract text plus structural blocks from a PDF using PyMuPDF.
+
+    Returns (text, blocks) where each block is
+    {"type": "heading" | "paragraph" | "table", "text": str, "page": int (1-based), "level": int | None}.
+    Headings are detected from font size relative to the body text (and bold short lines).
+    Repeated headers, footers, page numbers and boilerplate are removed (see
+    strip_boilerplate); if `stats` is given, the cleaning stats are written to it.
+    """
+    try:
+        doc = fitz.open(stream=file_content, filetype="pdf")
+    except Exception as e:
+        print(f"Error reading PDF with PyMuPDF: {e}")
+        return "", []
+
+    raw_blocks = []
+    size_chars: Dict[float, int] = {}
+    page_count = len(doc)
+    try:
+        for page_num in range(page_count):
+            page = doc[page_num]
+            page_height = page.rect.height or 1.0
+            table_rects = []
+            if hasattr(page, "find_tables"):
+                try:
+                    for table in page.find_tables().tables:
+                        rows = [" | ".join((cell or "").strip() for cell in row) for row in table.extract()]
+                        rows = [r for r in rows if r.strip(" |")]
+                        if rows:
+                            table_rects.append(fitz.Rect(table.bbox))
+                            raw_blocks.append({"type": "table", "text": "\n".join(rows), "page": page_num + 1, "y": table.bbox[1]})
+                except Exception as e:
+                    print(f"[PDF] Table detection failed on page {page_num + 1}: {e}")
+
+            for block in page.get_text("dict").get("blocks", []):
+                if block.get("type") != 0:
+                    continue  # image block
+                if any(fitz.Rect(block["bbox"]).intersects(r) for r in table_rects):
+                    continue
+                lines = []
+                positions = []
+                max_size = 0.0
+                all_bold = True
+                for line in block.get("lines", []):
+                    spans = [s for s in line.get("spans", []) if s.get("text", "").strip()]
+                    if not spans:
+                        continue
+                    lines.append("".join(s["text"] for s in line["spans"]).strip())
+                    positions.append((line["bbox"][1] + line["bbox"][3]) / 2 / page_height)
+                    for s in spans:
+                        size = round(s.get("size", 0), 1)
+                        size_chars[size] = size_chars.get(size, 0) + len(s["text"])
+                        max_size = max(max_size, size)
+                        all_bold = all_bold and bool(s.get("flags", 0) & 16)
+                text = "\n".join(lines).strip()
+                if text:
+                    raw_blocks.append({
+                        "type": "paragraph", "text": text, "page": page_num + 1,
+                        "y": block["bbox"][1], "size": max_size, "bold": all_bold, "lines": len(lines),
+                        "line_texts": lines, "line_positions": positions,
+                    })
+    finally:
+        doc.close()
+
+    raw_blocks = _strip_block_boilerplate(raw_blocks, page_count, stats)
+    if not raw_blocks:
+        return "", []
+
+    body_size = max(size_chars, key=size_chars.get) if size_chars else 0
+    heading_sizes = sorted({b["size"] for b in raw_blocks if b.get("size", 0) >= body_size * 1.15}, reverse=True)
+    blocks = []
+    for b in sorted(raw_blocks, key=lambda b: (b["page"], b["y"])):
+        block = {"type": b["type"], "text": b["text"], "page": b["page"], "level": None}
+        short = b["type"] == "paragraph" and b["lines"] <= 2 and len(b["text"]) <= 200
+        if short and b["size"] in heading_sizes:
+            block["type"] = "heading"
+            block["level"] = heading_sizes.index(b["size"]) + 1
+        elif short and b["bold"] and not b["text"].endswith("."):
+            block["type"] = "heading"
+            block["level"] = len(heading_sizes) + 1
+        blocks.append(block)
+    return _blocks_to_text(blocks), blocks
+
+def _strip_block_boilerplate(raw_blocks: List[Dict[str, Any]], page_count: int, stats: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop boilerplate lines from paragraph blocks (tables are kept whole) and empty blocks."""
+    pages: List[List[Tuple[str, float]]] = [[] for _ in range(page_count)]
+    owners: List[List[Tuple[Dict[str, Any], int]]] = [[] for _ in range(page_count)]
+    for b in raw_blocks:
+        if b["type"] != "paragraph":
+            continue
+        for i, (text, position) in enumerate(zip(b["line_texts"], b["line_positions"])):
+            pages[b["page"] - 1].append((text, position))
+            owners[b["page"] - 1].append((b, i))
+    keep, cleaning = strip_boilerplate(pages)
+    log_boilerplate_stats(cleaning)
+    if stats is not None:
+        stats.update(cleaning)
+
+    dropped: Dict[int, set] = {}
+    for page_owners, mask in zip(owners, keep):
+        for (b, i), kept in zip(page_owners, mask):
+            if not kept:
+                dropped.setdefault(id(b), set()).add(i)
+    cleaned = []
+    for b in raw_blocks:
+        removed = dropped.get(id(b))
+        if removed:
+            lines = [line for i, line in enumerate(b["line_texts"]) if i not in removed]
+            b = {**b, "text": "\n".join(lines).strip(), "lines": len(lines)}
+            if not b["text"]:
+                continue
+        cleaned.append(b)
+    return cleaned
+
+def extract_blocks_from_docx(file_content: bytes) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Extract text plus structural blocks from a DOCX in body order.
+    Headings come from paragraph styles ("Heading N", "Title"); pages are counted
+    from explicit and last-rendered page breaks.
+    """
+    try:
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+
+        doc = docx.Document(BytesIO(file_content))
+    except Exception as e:
+        print(f"Error reading DOCX: {e}")
+        return "", []
+
+    blocks = []
+    page = 1
+    for child in doc.element.body.iterchildren():
+        tag = child.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            paragraph = Paragraph(child, doc)
+            xml = child.xml
+            text = paragraph.text.strip()
+            if text:
+                style = (paragraph.style.name if paragraph.style is not None else "") or ""
+                level = None
+                if style == "Title":
+                    level = 1
+                elif style.startswith("Heading"):
+                    digits = "".join(ch for ch in style if ch.isdigit())
+                    level = int(digits) if digits else 1
+                blocks.append({"type": "heading" if level else "paragraph", "text": text, "page": page, "level": level})
+            # Word writes both markers for the same break when it has rendered the page
+            page += max(xml.count("lastRenderedPageBreak"), xml.count('w:type="page"'))
+        elif tag == "tbl":
+            table = Table(child, doc)
+            rows = []
+            for row in table.rows:
+                cells = [cell.text.strip() for cell in row.cells]
+                if any(cells):
+                    rows.append(" | ".join(cells))
+            if rows:
+                blocks.append({"type": "table", "text": "\n".join(rows), "page": page, "level": None})
+    return _blocks_to_text(blocks), blocks
+
 def extract_text_from_txt(file_content: bytes) -> str:
     """Extract text from TXT file"""
     try:
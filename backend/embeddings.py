@@ -14,9 +14,25 @@ _persistent_http_client = httpx.Client(
     },
 )
 
+# Async twin used by aembed_query / aembed_documents
+_persistent_async_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0),
+    headers={
+        "Connection": "keep-alive",
+        "User-Agent": "DruidX-Embedding-Service/1.0"
+    },
+)
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+
 _cached_embedding_models: dict = {}
 
 
+async def warm_connection():
+    """Open the keep-alive connection to the embeddings API before the first query."""
+    await _persistent_async_http_client.head(OPENAI_BASE_URL)
+
+
 def get_embedding_model(model: str = "text-embedding-3-small", api_keys: dict = None) -> OpenAIEmbeddings:
     """
     Get or create cached OpenAIEmbeddings instance with shared HTTP client.
@@ -45,6 +61,7 @@ def get_embedding_model(model: str = "text-embedding-3-small", api_keys: dict =
         embedding_kwargs = {
             "model": model,
             "http_client": _persistent_http_client,
+            "http_async_client": _persistent_async_http_client,
             "show_progress_bar": False
         }
         if api_key:
@@ -2,6 +2,7 @@
 import os
 from langchain_openai import ChatOpenAI
 from typing import Dict, Any, Optional
+import hashlib
 import httpx
 from api_keys_util import get_openrouter_api_key
 
@@ -13,8 +14,23 @@ _persistent_http_client = httpx.Client(
         "User-Agent": "DruidX-LLM-Agent/1.0"
     },
 )
+# Async twin for astream/ainvoke; the sync client above only serves blocking calls
+_persistent_async_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(30.0),
+    headers={
+        "Connection": "keep-alive",
+        "User-Agent": "DruidX-LLM-Agent/1.0"
+    },
+)
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 _cached_llms = {}
 
+
+async def warm_connection():
+    """Open the keep-alive connection to OpenRouter (TLS + HTTP/2 setup) before the first request."""
+    await _persistent_async_http_client.head(OPENROUTER_BASE_URL)
+
 def _extract_usage(ai_message):
     """
     Returns a dict: {"input_tokens": int, "output_tokens": int, "total_tokens": int}
@@ -76,16 +92,20 @@ def get_llm(model_name: str, temperature: float = 0.3, api_keys: Optional[Dict[s
     - Includes stream_options to get token usage
     """
     global _cached_llms
-    # Cache key includes api_keys to avoid using wrong keys
-    cache_key = f"{model_name}_{temperature}_{id(api_keys) if api_keys else 'env'}"
+    # Cache key includes the resolved key (hashed) so sessions never share a client built with other keys;
+    # the api_keys dict is re-read from Redis every turn, so its id() would never hit
+    api_key = get_openrouter_api_key(api_keys)
+    key_digest = hashlib.sha256(api_key.encode()).hexdigest()[:16] if api_key else "none"
+    cache_key = f"{model_name}_{temperature}_{key_digest}"
     if cache_key in _cached_llms:
         return _cached_llms[cache_key]
     llm = ChatOpenAI(
         model=model_name,
-        openai_api_base="https://openrouter.ai/api/v1",
-        openai_api_key=get_openrouter_api_key(api_keys),
+        openai_api_base=OPENROUTER_BASE_URL,
+        openai_api_key=api_key,
         temperature=temperature,
         http_client=_persistent_http_client,
+        http_async_client=_persistent_async_http_client,
         default_headers={
             "HTTP-Referer": os.getenv("APP_URL", "http://localhost"),
             "X-Title": os.getenv("APP_NAME", "My LangGraph App"),
@@ -2,17 +2,18 @@ from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Tuple
 import asyncio
 import os
 import sys
 import platform
 import uuid
+import hmac
 from datetime import datetime, timedelta
 import json
 import httpx
 import subprocess
-from redis_client import ensure_redis_client, ensure_redis_client_binary
+from redis_client import ensure_redis_client, ensure_redis_client_binary, start_turn_metrics, finish_turn_metrics
 
 try:
     from livekit.api import AccessToken, VideoGrants
@@ -26,7 +27,7 @@ except ImportError:
     except ImportError:
         LIVEKIT_AVAILABLE = False
         print("Warning: livekit package not available. Voice features will be disabled.")
-from document_processor import extract_text_from_pdf, extract_text_from_docx, extract_text_from_txt, extract_text_from_json
+from document_processor import extract_blocks_from_pdf, extract_blocks_from_docx, extract_text_from_txt, extract_text_from_json
 from graph import graph
 from graph_type import GraphState
 from DeepResearch.deepresearch_graph import deep_research_graph
@@ -56,6 +57,11 @@ async def startup_event():
     port = os.getenv("PORT", "8000")
     print(f"[Startup] Server will run on port: {port}")
     print(f"[Startup] PORT environment variable: {os.getenv('PORT', 'NOT SET')}")
+    global _session_gc_task
+    if os.getenv("SESSION_GC_ENABLED", "true").lower() == "true":
+        from Rag.session_gc import session_gc_loop, SESSION_GC_DRY_RUN
+        _session_gc_task = asyncio.create_task(session_gc_loop())
+        print(f"[Startup] Session resource garbage collector started ({'dry run' if SESSION_GC_DRY_RUN else 'deleting'})")
 
 app.add_middleware(
     CORSMiddleware,
@@ -65,9 +71,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Shared token for the /api/admin/* endpoints (X-Admin-Token header); unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+@app.middleware("http")
+async def require_admin_token(request: Request, call_next):
+    if request.url.path.startswith("/api/admin/"):
+        if not ADMIN_TOKEN:
+            return JSONResponse(status_code=403, content={"detail": "Admin endpoints are disabled (ADMIN_TOKEN is not set)"})
+        token = request.headers.get("x-admin-token", "")
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return JSONResponse(status_code=401, content={"detail": "Invalid admin token"})
+    return await call_next(request)
+
 _agent_worker_process: Optional[subprocess.Popen] = None
 _agent_worker_lock = asyncio.Lock()
 _active_voice_rooms: Dict[str, Dict[str, Any]] = {}  
+_session_gc_task: Optional[asyncio.Task] = None
 
 
 # Fallback in-memory sessions storage (used when Redis is not available)
@@ -96,8 +116,7 @@ class SessionManager:
         if redis_client:
             print("[SessionManager] Storing session in Redis (async)//////////////////////////////////////////////////////")
             session_key = f"session:{session_id}"
-            await redis_client.set(session_key, json.dumps(session_data))
-            await redis_client.expire(session_key, 86400)
+            await redis_client.set(session_key, json.dumps(session_data), ex=86400)
         else:
             global sessions
             sessions[session_id] = session_data
@@ -124,8 +143,7 @@ class SessionManager:
         redis_client = await ensure_redis_client()
         if redis_client:
             session_key = f"session:{session_id}"
-            await redis_client.set(session_key, json.dumps(session_data))
-            await redis_client.expire(session_key, 86400) 
+            await redis_client.set(session_key, json.dumps(session_data), ex=86400)
         else:
             global sessions
             sessions[session_id] = session_data
@@ -179,6 +197,8 @@ async def create_session():
     """Create a new chat session"""
     session_id = await SessionManager.create_session()
     session = await SessionManager.get_session(session_id)
+    from Rag.warmup import schedule_warmup, warm_session
+    schedule_warmup(warm_session(session_id))
     return SessionInfo(session_id=session_id, created_at=session["created_at"])
 
 @app.get("/api/sessions/{session_id}", response_model=Dict[str, Any])
@@ -198,31 +218,42 @@ async def set_gpt_config(session_id: str, gpt_config: dict):
     # print(f". instruction",  session["instruction"])
 
     if session.get("kb"):
-        try:
-            from Rag.Rag import preprocess_kb_documents
-            hybrid_rag = gpt_config.get("hybridRag", False)
-            gpt_id = gpt_config.get("gpt_id")
-            userId = gpt_config.get("userId")
-            
-            if gpt_id and userId:
-                print(f"[MAIN] Pre-processing KB with {len(session['kb'])} documents for gpt_id={gpt_id}, userId={userId}")
-                await preprocess_kb_documents(
-                    session["kb"], 
-                    gpt_id, 
-                    userId,
-                    is_hybrid=hybrid_rag
-                )
-                print(f"✅ [MAIN] Pre-processed KB documents with embeddings")
-            else:
-                print(f"⚠️ [MAIN] Warning: Missing gpt_id or userId in gpt_config, skipping KB preprocessing")
-        except Exception as e:
-            print(f"⚠️ [MAIN] Warning: Failed to pre-process KB documents: {e}")
-            import traceback
-            traceback.print_exc()
+        await _sync_session_kb(session)
+    from Rag.warmup import schedule_warmup, warm_gpt
+    schedule_warmup(warm_gpt(gpt_config, session.get("api_keys"), session_id))
     
     await SessionManager.update_session(session_id, session)
     return {"message": "GPT configuration updated", "gpt_config": gpt_config}
 
+async def _sync_session_kb(session: dict, replace: bool = False):
+    """
+    Sync the GPT's KB index with the session's KB list: adds and changes, plus
+    removals when replace says the list is the GPT's complete KB.
+    """
+    try:
+        from Rag.Rag import preprocess_kb_documents
+        gpt_config = session.get("gpt_config", {})
+        hybrid_rag = gpt_config.get("hybridRag", False)
+        gpt_id = gpt_config.get("gpt_id")
+        userId = gpt_config.get("userId")
+        
+        if gpt_id and userId:
+            print(f"[MAIN] Pre-processing KB with {len(session['kb'])} documents for gpt_id={gpt_id}, userId={userId}")
+            await preprocess_kb_documents(
+                session["kb"], 
+                gpt_id, 
+                userId,
+                is_hybrid=hybrid_rag,
+                replace=replace
+            )
+            print(f"✅ [MAIN] Pre-processed KB documents with embeddings")
+        else:
+            print(f"⚠️ [MAIN] Warning: Missing gpt_id or userId in gpt_config, skipping KB preprocessing")
+    except Exception as e:
+        print(f"⚠️ [MAIN] Warning: Failed to pre-process KB documents: {e}")
+        import traceback
+        traceback.print_exc()
+
 @app.post("/api/sessions/{session_id}/api-keys")
 async def set_api_keys(session_id: str, request: dict):
     """Set API keys for a session"""
@@ -238,6 +269,38 @@ async def set_api_keys(session_id: str, request: dict):
     await SessionManager.update_session(session_id, session)
     return {"message": "API keys updated", "key_count": len(api_keys)}
 
+async def _download_document(file_url: str) -> bytes:
+    file_content, _ = await _download_document_with_version(file_url)
+    return file_content
+
+async def _download_document_with_version(file_url: str) -> Tuple[bytes, str]:
+    """File bytes and their source version (ETag / Last-Modified, see Rag.kb_sync)."""
+    from Rag.kb_sync import response_source_version
+    async with httpx.AsyncClient() as client:
+        response = await client.get(file_url, timeout=30.0)
+        response.raise_for_status()
+        return response.content, response_source_version(response.headers)
+
+async def _head_source_version(file_url: str) -> str:
+    from Rag.kb_sync import response_source_version
+    async with httpx.AsyncClient() as client:
+        response = await client.head(file_url, timeout=10.0, follow_redirects=True)
+        response.raise_for_status()
+        return response_source_version(response.headers)
+
+def _kb_placeholder(doc: dict) -> dict:
+    """Session KB entry of an already-embedded file (metadata only; the sync leaves it unchanged)."""
+    return {
+        "id": doc.get("id"),
+        "filename": doc.get("filename"),
+        "file_url": doc.get("file_url"),
+        "file_type": doc.get("file_type"),
+        "size": doc.get("size"),
+        "source_hash": doc.get("source_hash", ""),
+        "source_version": doc.get("source_version", ""),
+        "content": ""  # No content needed, already embedded
+    }
+
 @app.post("/api/sessions/{session_id}/add-documents")
 async def add_documents_by_url(session_id: str, request: dict):
     """Add documents by URL"""
@@ -253,6 +316,15 @@ async def add_documents_by_url(session_id: str, request: dict):
     print(f"Documents to process: {len(documents)}")
     print(f"Document type: {doc_type}")
     
+    # "replace": the documents are the GPT's complete KB, so unlisted files are removed from the index
+    replace = doc_type == "kb" and bool(request.get("replace", False))
+    if replace:
+        session["kb"] = []
+    # Downloaded bytes and source versions of already-embedded KB files that changed, reused by processing
+    prefetched: Dict[str, Tuple[bytes, str]] = {}
+    # Already-embedded KB files, kept listed (as placeholders) if their processing fails
+    existing_file_urls: set = set()
+
     # For KB documents, check which files are already embedded BEFORE processing
     if doc_type == "kb":
         gpt_config = session.get("gpt_config", {})
@@ -262,31 +334,35 @@ async def add_documents_by_url(session_id: str, request: dict):
         if gpt_id and userId:
             try:
                 from Rag.Rag import get_existing_kb_file_urls
+                from Rag.kb_index import kb_collection_name
+                from Rag.kb_manifest import get_kb_manifest
+                from Rag.kb_sync import check_kb_sources
                 existing_file_urls = await get_existing_kb_file_urls(gpt_id, userId)
                 if existing_file_urls:
                     print(f"[MAIN] Found {len(existing_file_urls)} already-embedded KB files, filtering before processing...")
-                    # Separate already-embedded and new documents
-                    already_embedded_docs = [doc for doc in documents if doc.get("file_url") in existing_file_urls]
-                    documents = [doc for doc in documents if doc.get("file_url") not in existing_file_urls]
+                    manifest = await get_kb_manifest(kb_collection_name(gpt_id, userId)) or {}
+                    known_docs = [doc for doc in documents if doc.get("file_url") in existing_file_urls]
+                    # Skip processing when the source version (or, failing that, the downloaded bytes) is unchanged
+                    already_embedded_docs, prefetched = await check_kb_sources(
+                        known_docs, manifest, _head_source_version, _download_document_with_version
+                    )
+                    skipped_urls = {doc["file_url"] for doc in already_embedded_docs}
+                    documents = [doc for doc in documents if doc.get("file_url") not in skipped_urls]
                     
                     # Add already-embedded docs to session KB without processing (just metadata)
                     if already_embedded_docs:
                         for doc in already_embedded_docs:
-                            session.setdefault("kb", []).append({
-                                "id": doc.get("id"),
-                                "filename": doc.get("filename"),
-                                "file_url": doc.get("file_url"),
-                                "file_type": doc.get("file_type"),
-                                "size": doc.get("size"),
-                                "content": ""  # No content needed, already embedded
-                            })
+                            session.setdefault("kb", []).append(_kb_placeholder(doc))
                         print(f"[MAIN] Added {len(already_embedded_docs)} already-embedded KB documents to session (skipped processing)")
                     
                     if not documents:
                         print(f"[MAIN] All KB documents already embedded, skipping processing")
+                        if replace:
+                            # Still sync so files dropped from the KB are deleted from the index
+                            await _sync_session_kb(session, replace=True)
                         await SessionManager.update_session(session_id, session)
                         return {"message": "All documents already embedded", "documents": already_embedded_docs}
-                    print(f"[MAIN] Processing {len(documents)} new KB documents (skipped {len(already_embedded_docs)} already embedded)")
+                    print(f"[MAIN] Processing {len(documents)} new or changed KB documents (skipped {len(already_embedded_docs)} already embedded)")
             except Exception as e:
                 print(f"⚠️ [MAIN] Warning: Failed to check existing KB files: {e}")
                 # Continue with processing all documents if check fails
@@ -304,11 +380,9 @@ async def add_documents_by_url(session_id: str, request: dict):
             print(f"[Parallel] Processing document {index + 1}/{len(documents)}: {filename}")
             print(f"[Parallel] File type from request: {file_type}")
             
-            async with httpx.AsyncClient() as client:
-                response = await client.get(file_url, timeout=30.0)
-                response.raise_for_status()
-                file_content = response.content
-                print(f"[Parallel] Downloaded {len(file_content)} bytes from {filename}")
+            fetched = prefetched.pop(file_url, None)
+            file_content, source_version = fetched if fetched else await _download_document_with_version(file_url)
+            print(f"[Parallel] Downloaded {len(file_content)} bytes from {filename}")
 
             file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
             is_image = (
@@ -319,6 +393,8 @@ async def add_documents_by_url(session_id: str, request: dict):
             print(f"[Parallel] Detected file extension: {file_extension}, is_image: {is_image}")
 
             content = ""
+            blocks = None
+            cleaning: Dict[str, Any] = {}
             if is_image:
                 content = f"[Image file: {filename}]"  
                 
@@ -338,11 +414,11 @@ async def add_documents_by_url(session_id: str, request: dict):
                 if not content.strip():
                     print(f"⚠️ Warning: JSON {filename} appears to be empty or unreadable")
             elif file_type == "application/pdf" or file_extension == 'pdf':
-                content = await asyncio.to_thread(extract_text_from_pdf, file_content)
+                content, blocks = await asyncio.to_thread(extract_blocks_from_pdf, file_content, cleaning)
                 if not content.strip():
                     print(f"⚠️ Warning: PDF {filename} appears to be empty or unreadable")
             elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document" or file_extension == 'docx':
-                content = await asyncio.to_thread(extract_text_from_docx, file_content)
+                content, blocks = await asyncio.to_thread(extract_blocks_from_docx, file_content)
                 if not content.strip():
                     print(f"⚠️ Warning: DOCX {filename} appears to be empty or unreadable")
             elif file_type == "application/json":
@@ -363,6 +439,18 @@ async def add_documents_by_url(session_id: str, request: dict):
                     "file_url": doc["file_url"],
                     "size": doc["size"]
                 }
+                if doc_type == "kb":
+                    from Rag.kb_manifest import content_hash
+                    from Rag.kb_sync import listed_source_version
+                    processed_doc["source_hash"] = content_hash(file_content)
+                    processed_doc["source_version"] = listed_source_version(doc) or source_version
+                if blocks:
+                    # Structural blocks feed the chunker only; stripped before the session is saved
+                    processed_doc["blocks"] = blocks
+                if cleaning.get("bytes_removed"):
+                    processed_doc["boilerplate_removed"] = {
+                        k: cleaning[k] for k in ("pages", "bytes_before", "bytes_removed", "lines_removed")
+                    }
                 print(f"✅ [Parallel] Successfully processed: {filename} ({'image metadata stored' if is_image else f'{len(content)} chars'})")
                 return processed_doc
             else:
@@ -463,31 +551,20 @@ async def add_documents_by_url(session_id: str, request: dict):
             traceback.print_exc()
             
     elif doc_type == "kb":
-        session["kb"].extend(processed_docs)
+        session.setdefault("kb", []).extend(processed_docs)
+        processed_urls = {d.get("file_url") for d in processed_docs}
+        failed_existing = [
+            doc for doc in documents
+            if doc.get("file_url") in existing_file_urls and doc.get("file_url") not in processed_urls
+        ]
+        if failed_existing:
+            # Keep them listed so a failed download is not taken for a removal
+            session["kb"].extend(_kb_placeholder(doc) for doc in failed_existing)
         print(f"Added {len(processed_docs)} documents to kb")
-        try:
-            from Rag.Rag import preprocess_kb_documents
-            gpt_config = session.get("gpt_config", {})
-            hybrid_rag = gpt_config.get("hybridRag", False)
-            gpt_id = gpt_config.get("gpt_id")
-            userId = gpt_config.get("userId")
-            
-            if gpt_id and userId:
-                print(f"[MAIN] Pre-processing KB with {len(session['kb'])} documents for gpt_id={gpt_id}, userId={userId}")
-                await preprocess_kb_documents(
-                    session["kb"], 
-                    gpt_id, 
-                    userId,
-                    is_hybrid=hybrid_rag
-                )
-                print(f"✅ [MAIN] Pre-processed KB documents with embeddings")
-            else:
-                print(f"⚠️ [MAIN] Warning: Missing gpt_id or userId in gpt_config, skipping KB preprocessing")
-        except Exception as e:
-            print(f"⚠️ [MAIN] Warning: Failed to pre-process KB documents: {e}")
-            import traceback
-            traceback.print_exc()
+        await _sync_session_kb(session, replace=replace)
     
+    for d in processed_docs:
+        d.pop("blocks", None)
     await SessionManager.update_session(session_id, session)
     
     print(f"Session KB docs count after update: {len(session.get('kb', []))}")
@@ -667,6 +744,7 @@ async def stream_chat(session_id: str, request: ChatRequest):
                 async def run_graph():
                     nonlocal final_state
                     nonlocal stream_error_message
+                    redis_metrics_token = start_turn_metrics()
                     try:
                         print("🔥 STARTING DIRECT GRAPH EXECUTION")
                         async for node_result in graph.astream(state):
@@ -686,6 +764,7 @@ async def stream_chat(session_id: str, request: ChatRequest):
                         })
                     finally:
                         print("🔥 DIRECT GRAPH EXECUTION COMPLETED")
+                        finish_turn_metrics(redis_metrics_token, session_id)
                         await queue.put(None)  # Signal completion
                 
                 async def consume_and_yield():
@@ -781,8 +860,6 @@ async def stream_chat(session_id: str, request: ChatRequest):
             
                 if "new_uploaded_docs" in session:
                     session["new_uploaded_docs"] = []
-                from Rag.Rag import preprocess_user_documents, clear_user_doc_cache, preprocess_images, clear_image_cache
-                await clear_user_doc_cache(session_id)    
                 await SessionManager.update_session(session_id, session)
                 
                 yield f"data: {json.dumps({'type': 'done', 'data': {'session_id': session_id}})}\n\n"
@@ -1087,8 +1164,6 @@ async def stream_deep_research(session_id: str, request: ChatRequest):
                 
                 if "new_uploaded_docs" in session:
                     session["new_uploaded_docs"] = []
-                from Rag.Rag import preprocess_user_documents, clear_user_doc_cache, preprocess_images, clear_image_cache
-                await clear_user_doc_cache(session_id)     
                 await SessionManager.update_session(session_id, session)
                 yield f"data: {json.dumps({'type': 'done', 'data': {'session_id': session_id}})}\n\n"
                 
@@ -1182,12 +1257,171 @@ async def delete_session(session_id: str):
         await clear_image_cache(session_id)
         # clear_json_documents is already called by clear_user_doc_cache, but being explicit
         await clear_json_documents(session_id=session_id)
+        from Rag.session_gc import reclaim_session_resources
+        await reclaim_session_resources(session_id)
         print(f"[MAIN] Cleared all caches for deleted session {session_id}")
     except Exception as e:
         print(f"[MAIN] Warning: Error clearing caches for session {session_id}: {e}")
     
     return {"message": "Session deleted successfully"}
 
+@app.post("/api/admin/session-gc")
+async def run_session_gc(request: dict = None):
+    """
+    Run the session resource sweeper once.
+    Accepts: {"dry_run": bool, "include_untracked": bool}
+    """
+    request = request or {}
+    from Rag.session_gc import sweep_orphaned_session_resources, SESSION_GC_METRICS
+    try:
+        metrics = await sweep_orphaned_session_resources(
+            dry_run=request.get("dry_run", True),
+            include_untracked=request.get("include_untracked", False)
+        )
+        return {"run": metrics, "totals": SESSION_GC_METRICS}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Session GC failed: {str(e)}")
+
+@app.get("/api/admin/redis-metrics")
+async def get_redis_metrics():
+    """Redis round trips per chat turn and those saved by the client-side cache, aggregated since startup."""
+    from redis_client import REDIS_METRICS
+    turns = REDIS_METRICS["turns"] or 1
+    return {
+        **REDIS_METRICS,
+        "avg_round_trips_per_turn": round(REDIS_METRICS["round_trips"] / turns, 2),
+        "avg_round_trips_saved_per_turn": round(REDIS_METRICS["round_trips_saved"] / turns, 2),
+    }
+
+@app.post("/api/admin/key-registries/rebuild")
+async def rebuild_key_registries(request: dict = None):
+    """
+    Repair JSON document key registries with an incremental SCAN (run once after upgrading).
+    Accepts: {"dry_run": bool}
+    """
+    request = request or {}
+    from Rag.key_registry import rebuild_registries
+    try:
+        return await rebuild_registries(dry_run=request.get("dry_run", True))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Key registry rebuild failed: {str(e)}")
+
+@app.post("/api/admin/hybrid-benchmark")
+async def run_hybrid_benchmark(request: dict):
+    """
+    Compare client-side and server-side (Qdrant Query API) hybrid search on a collection.
+    Accepts: {"collection_name": str, "queries": [str], "limit": int}
+    """
+    from Rag.sparse_hybrid import benchmark_hybrid_search
+    collection_name = request.get("collection_name")
+    queries = request.get("queries") or []
+    if not collection_name or not queries:
+        raise HTTPException(status_code=400, detail="collection_name and queries are required")
+    try:
+        return await benchmark_hybrid_search(collection_name, queries, limit=request.get("limit", 5))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Hybrid benchmark failed: {str(e)}")
+
+@app.post("/api/admin/local-vector-benchmark")
+async def run_local_vector_benchmark(request: dict = None):
+    """
+    Compare Qdrant search with the in-process matrix search on temporary collections.
+    Accepts: {"sizes": [int], "queries": int, "limit": int}
+    """
+    from Rag.local_vectors import benchmark_local_search, LOCAL_VECTOR_METRICS
+    request = request or {}
+    try:
+        results = await benchmark_local_search(
+            sizes=request.get("sizes") or (100, 500, 1000, 2000, 5000),
+            queries=request.get("queries", 50),
+            limit=request.get("limit", 20),
+        )
+        return {"results": results, "metrics": LOCAL_VECTOR_METRICS}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Local vector benchmark failed: {str(e)}")
+
+@app.get("/api/admin/near-dup-report/{collection_name}")
+async def get_near_dup_report(collection_name: str):
+    """Recent near-duplicate ingestion reports of a collection (dedup ratio, embedding tokens saved)."""
+    from Rag.near_dup import get_reports, NEAR_DUP_METRICS
+    return {"collection": collection_name, "reports": await get_reports(collection_name), "totals": NEAR_DUP_METRICS}
+
+@app.get("/api/admin/kb/sync-report/{collection_name}")
+async def get_kb_sync_report(collection_name: str):
+    """Recent KB sync reports of a collection (files added, changed, removed; points deleted)."""
+    from Rag.kb_sync import get_sync_reports
+    return {"collection": collection_name, "reports": await get_sync_reports(collection_name)}
+
+@app.get("/api/admin/warmup-reports")
+async def get_warmup_reports():
+    """Recent cache warm-up reports of this worker (per-step time and status)."""
+    from Rag.warmup import WARMUP_REPORTS, WARMUP_BUDGET_MS
+    return {"budget_ms": WARMUP_BUDGET_MS, "reports": list(WARMUP_REPORTS)}
+
+@app.post("/api/admin/warmup-benchmark")
+async def warmup_benchmark(request: dict):
+    """
+    First-turn TTFT with and without warm-up, each run in a fresh worker process.
+    Accepts: {"gpt_config": {...}, "query": str, "rounds": int (default 3), "api_keys": {...}}
+    """
+    from Rag.warmup import benchmark_first_turn
+    if not request or not request.get("gpt_config"):
+        raise HTTPException(status_code=400, detail="gpt_config is required")
+    try:
+        return await benchmark_first_turn(request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Warm-up benchmark failed: {e}")
+
+@app.post("/api/admin/kb/snapshot/export")
+async def export_kb_snapshots(request: dict = None):
+    """
+    Snapshot KB collections (points, vectors, manifest, BM25, near-dup and summary state).
+    Accepts: {"collections": [str] (default: every kb_* collection), "upload": bool}
+    """
+    from Rag.kb_snapshot import export_kb_snapshot, export_all_kb_snapshots
+    request = request or {}
+    upload = request.get("upload", False)
+    try:
+        if request.get("collections"):
+            return {"snapshots": [await export_kb_snapshot(c, upload=upload) for c in request["collections"]]}
+        return {"snapshots": await export_all_kb_snapshots(upload=upload)}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"KB snapshot export failed: {e}")
+
+@app.post("/api/admin/kb/snapshot/restore")
+async def restore_kb_snapshots(request: dict):
+    """
+    Restore KB collections from snapshots without embedding calls, then verify point counts.
+    Accepts: {"sources": [snapshot file name in KB_SNAPSHOT_DIR or kb_snapshots/ storage key], "collection": optional kb_* target}
+    """
+    from Rag.kb_snapshot import restore_kb_snapshot
+    sources = request.get("sources") or []
+    if not sources:
+        raise HTTPException(status_code=400, detail="sources is required")
+    try:
+        return {"restored": [await restore_kb_snapshot(s, request.get("collection")) for s in sources]}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"KB snapshot restore failed: {e}")
+
+@app.post("/api/admin/kb/migrate-shared")
+async def migrate_shared_kb(request: dict = None):
+    """
+    Collapse per-user KB collections into one shared index per GPT.
+    Accepts: {"dry_run": bool} (default true: report only)
+    """
+    from Rag.kb_index import migrate_per_user_kb_collections
+    request = request or {}
+    try:
+        return await migrate_per_user_kb_collections(dry_run=request.get("dry_run", True))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"KB migration failed: {e}")
+
 # MCP Endpoints
 @app.get("/api/mcp/available-tools")
 async def get_available_mcp_tools():
@@ -1552,18 +1786,24 @@ async def shutdown_event():
     """Cleanup on application shutdown"""
     print("Application shutting down. Cleaning up agent worker...")
     await _stop_agent_worker()
+    if _session_gc_task:
+        _session_gc_task.cancel()
+    from Rag.qdrant_store import close_qdrant_client
+    close_qdrant_client()
     print("Cleanup complete.")
 
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
+    from Rag.qdrant_store import QDRANT_STATUS
     return {
         "status": "healthy",
         "openai_configured": bool(os.getenv("OPENAI_API_KEY")),
         "livekit_configured": bool(os.getenv("LIVEKIT_API_KEY")),
         "timestamp": datetime.now().isoformat(),
         "active_voice_rooms": len(_active_voice_rooms),
-        "agent_worker_running": _agent_worker_process is not None and _agent_worker_process.poll() is None
+        "agent_worker_running": _agent_worker_process is not None and _agent_worker_process.poll() is None,
+        "qdrant": QDRANT_STATUS,
     }
 
 if __name__ == "__main__":
@@ -1,11 +1,300 @@
 import redis.asyncio as redis
 import os
 import asyncio
+import time
+from collections import OrderedDict
+from contextvars import ContextVar, Token
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from dotenv import load_dotenv
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 
 load_dotenv()
 
 REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MGET_BATCH_SIZE = int(os.getenv("REDIS_MGET_BATCH_SIZE", "500"))
+
+# Connection pool and retry policy
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "10"))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "true").lower() == "true"
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+REDIS_RETRY_ATTEMPTS = int(os.getenv("REDIS_RETRY_ATTEMPTS", "3"))
+REDIS_RETRY_BACKOFF_BASE = float(os.getenv("REDIS_RETRY_BACKOFF_BASE", "0.05"))
+REDIS_RETRY_BACKOFF_CAP = float(os.getenv("REDIS_RETRY_BACKOFF_CAP", "1.0"))
+
+# Client-side caching of read-mostly keys, invalidated by the server (CLIENT TRACKING BCAST)
+REDIS_CLIENT_CACHE_ENABLED = os.getenv("REDIS_CLIENT_CACHE_ENABLED", "true").lower() == "true"
+REDIS_CLIENT_CACHE_PREFIXES = tuple(
+    p.strip() for p in os.getenv(
+        "REDIS_CLIENT_CACHE_PREFIXES",
+        "session:,kb_manifest:,kb_manifest_meta:,doc_generation:,key_registry:,chunk_sources:,summary_tree:"
+    ).split(",") if p.strip()
+)
+REDIS_CLIENT_CACHE_MAX_ENTRIES = int(os.getenv("REDIS_CLIENT_CACHE_MAX_ENTRIES", "10000"))
+# Upper bound on staleness if an invalidation message is ever lost
+REDIS_CLIENT_CACHE_TTL_SECONDS = float(os.getenv("REDIS_CLIENT_CACHE_TTL_SECONDS", "300"))
+_CACHEABLE_COMMANDS = {"GET", "HGET", "HGETALL", "HMGET", "SMEMBERS", "SCARD", "LRANGE"}
+_MULTI_KEY_WRITES = {"DEL", "UNLINK"}
+
+# Round trips of the current chat turn (None outside a turn) and totals across turns
+_turn_round_trips: ContextVar[Optional[Dict[str, int]]] = ContextVar("redis_turn_round_trips", default=None)
+REDIS_METRICS: Dict[str, Any] = {
+    "turns": 0,
+    "round_trips": 0,
+    "commands": 0,
+    "max_round_trips_per_turn": 0,
+    "round_trips_saved": 0,
+    "client_cache_hits": 0,
+    "client_cache_invalidations": 0,
+}
+
+
+def _record_round_trip(commands: int = 1):
+    stats = _turn_round_trips.get()
+    if stats is not None:
+        stats["round_trips"] += 1
+        stats["commands"] += commands
+
+
+def _record_cache_hit():
+    REDIS_METRICS["client_cache_hits"] += 1
+    stats = _turn_round_trips.get()
+    if stats is not None:
+        stats["cache_hits"] += 1
+
+
+def start_turn_metrics() -> Token:
+    """Start counting Redis round trips for the current turn (tasks spawned later inherit it)."""
+    return _turn_round_trips.set({"round_trips": 0, "commands": 0, "cache_hits": 0})
+
+
+def finish_turn_metrics(token: Token, label: str = "") -> Dict[str, int]:
+    """Stop counting, fold the turn into REDIS_METRICS and return its counts."""
+    stats = _turn_round_trips.get() or {"round_trips": 0, "commands": 0, "cache_hits": 0}
+    _turn_round_trips.reset(token)
+    REDIS_METRICS["turns"] += 1
+    REDIS_METRICS["round_trips"] += stats["round_trips"]
+    REDIS_METRICS["commands"] += stats["commands"]
+    REDIS_METRICS["round_trips_saved"] += stats["cache_hits"]
+    REDIS_METRICS["max_round_trips_per_turn"] = max(REDIS_METRICS["max_round_trips_per_turn"], stats["round_trips"])
+    print(
+        f"[Redis] Turn {label}: {stats['round_trips']} round trips, {stats['commands']} commands, "
+        f"{stats['cache_hits']} served from the client-side cache"
+    )
+    return stats
+
+
+def _pool_kwargs(decode_responses: bool) -> Dict[str, Any]:
+    return {
+        "decode_responses": decode_responses,
+        "max_connections": REDIS_MAX_CONNECTIONS,
+        "timeout": REDIS_POOL_TIMEOUT,
+        "socket_timeout": REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": REDIS_SOCKET_CONNECT_TIMEOUT,
+        "socket_keepalive": REDIS_SOCKET_KEEPALIVE,
+        "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+        "retry": Retry(ExponentialBackoff(cap=REDIS_RETRY_BACKOFF_CAP, base=REDIS_RETRY_BACKOFF_BASE), REDIS_RETRY_ATTEMPTS),
+        "retry_on_error": [redis.ConnectionError, redis.TimeoutError],
+    }
+
+
+def _make_pool(decode_responses: bool) -> redis.BlockingConnectionPool:
+    """Bounded pool: callers wait up to REDIS_POOL_TIMEOUT for a free connection instead of failing."""
+    if REDIS_URL:
+        return redis.BlockingConnectionPool.from_url(REDIS_URL, **_pool_kwargs(decode_responses))
+    return redis.BlockingConnectionPool(
+        host=os.getenv("REDIS_HOST", "localhost"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        db=0,
+        **_pool_kwargs(decode_responses)
+    )
+
+
+class _ClientSideCache:
+    """
+    Worker-local cache of read replies for keys under REDIS_CLIENT_CACHE_PREFIXES.
+
+    A dedicated connection subscribes to __redis__:invalidate and another enables
+    CLIENT TRACKING ... REDIRECT <subscriber> BCAST PREFIX ..., so the server
+    announces every change to a whitelisted key made by any client. Writes issued
+    by this worker also drop their keys locally right away. Replies are only
+    stored if no invalidation arrived while the read was in flight.
+    """
+
+    def __init__(self, pool: redis.BlockingConnectionPool):
+        self._pool = pool
+        self._entries: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._by_key: Dict[str, set] = {}
+        self._connections: List[Any] = []
+        self._task: Optional[asyncio.Task] = None
+        self.enabled = False
+        self.epoch = 0
+
+    @staticmethod
+    def _cacheable_key(key: Any) -> bool:
+        return isinstance(key, str) and key.startswith(REDIS_CLIENT_CACHE_PREFIXES)
+
+    def lookup(self, args: Tuple) -> Tuple[bool, Any]:
+        if not self.enabled or len(args) < 2 or str(args[0]).upper() not in _CACHEABLE_COMMANDS:
+            return False, None
+        try:
+            entry = self._entries.get(args)
+        except TypeError:
+            return False, None
+        if entry is None:
+            return False, None
+        if entry[0] < time.monotonic():
+            self._drop(args[1])
+            return False, None
+        self._entries.move_to_end(args)
+        value = entry[1]
+        return True, value.copy() if isinstance(value, (dict, list, set)) else value
+
+    def after_command(self, args: Tuple, result: Any, epoch: int):
+        if len(args) < 2:
+            return
+        command = str(args[0]).upper()
+        if command in _CACHEABLE_COMMANDS:
+            if self.enabled and epoch == self.epoch and self._cacheable_key(args[1]):
+                try:
+                    self._store(args, result)
+                except TypeError:
+                    pass
+            return
+        self.invalidate(args[1:] if command in _MULTI_KEY_WRITES else args[1:2])
+
+    def after_pipeline(self, command_stack: List[Any]):
+        for args, _ in command_stack:
+            if len(args) >= 2 and str(args[0]).upper() not in _CACHEABLE_COMMANDS:
+                self.invalidate(args[1:] if str(args[0]).upper() in _MULTI_KEY_WRITES else args[1:2])
+
+    def _store(self, args: Tuple, value: Any):
+        self._entries[args] = (time.monotonic() + REDIS_CLIENT_CACHE_TTL_SECONDS, value.copy() if isinstance(value, (dict, list, set)) else value)
+        self._entries.move_to_end(args)
+        self._by_key.setdefault(args[1], set()).add(args)
+        while len(self._entries) > REDIS_CLIENT_CACHE_MAX_ENTRIES:
+            evicted, _ = self._entries.popitem(last=False)
+            self._by_key.get(evicted[1], set()).discard(evicted)
+
+    def _drop(self, key: str):
+        for args in self._by_key.pop(key, ()):
+            self._entries.pop(args, None)
+
+    def invalidate(self, keys: Iterable[Any]):
+        for key in keys:
+            if self._cacheable_key(key):
+                self.epoch += 1
+                self._drop(key)
+
+    def flush(self):
+        self.epoch += 1
+        self._entries.clear()
+        self._by_key.clear()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _open_connection(self):
+        # Dedicated connections outside the pool, without a read timeout (they idle between messages)
+        connection = self._pool.connection_class(**{**self._pool.connection_kwargs, "socket_timeout": None})
+        await connection.connect()
+        self._connections.append(connection)
+        return connection
+
+    async def _close(self):
+        self.enabled = False
+        self.flush()
+        for connection in self._connections:
+            try:
+                await connection.disconnect()
+            except Exception:
+                pass
+        self._connections = []
+
+    async def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                subscriber = await self._open_connection()
+                await subscriber.send_command("CLIENT", "ID")
+                subscriber_id = await subscriber.read_response()
+                await subscriber.send_command("SUBSCRIBE", "__redis__:invalidate")
+                await subscriber.read_response()
+
+                tracker = await self._open_connection()
+                prefixes = [part for prefix in REDIS_CLIENT_CACHE_PREFIXES for part in ("PREFIX", prefix)]
+                await tracker.send_command("CLIENT", "TRACKING", "on", "REDIRECT", subscriber_id, "BCAST", *prefixes)
+                await tracker.read_response()
+
+                self.flush()
+                self.enabled = True
+                backoff = 1.0
+                print(f"[Redis] Client-side caching enabled for {', '.join(REDIS_CLIENT_CACHE_PREFIXES)}")
+                while True:
+                    message = await subscriber.read_response()
+                    if not isinstance(message, list) or len(message) < 3 or message[0] not in ("message", b"message"):
+                        continue
+                    keys = message[2]
+                    REDIS_METRICS["client_cache_invalidations"] += 1
+                    if keys is None:
+                        self.flush()
+                    else:
+                        self.invalidate(k.decode() if isinstance(k, bytes) else k for k in keys)
+            except asyncio.CancelledError:
+                await self._close()
+                raise
+            except Exception as e:
+                print(f"[Redis] Client-side cache invalidation stream lost, caching paused: {e}")
+                await self._close()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+
+class _CountingRedis(redis.Redis):
+    """
+    Redis client that records one round trip per command or executed pipeline
+    and, when given a client-side cache, serves whitelisted reads from it.
+    """
+
+    _client_cache: Optional[_ClientSideCache] = None
+
+    async def execute_command(self, *args, **options):
+        cache = self._client_cache
+        epoch = 0
+        if cache is not None:
+            hit, value = cache.lookup(args)
+            if hit:
+                _record_cache_hit()
+                return value
+            epoch = cache.epoch
+        _record_round_trip()
+        result = await super().execute_command(*args, **options)
+        if cache is not None:
+            cache.after_command(args, result, epoch)
+        return result
+
+    def pipeline(self, transaction: bool = True, shard_hint: Optional[str] = None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        cache = self._client_cache
+
+        async def _counted_execute(raise_on_error: bool = True):
+            stack = list(pipe.command_stack)
+            if stack:
+                _record_round_trip(len(stack))
+            try:
+                return await execute(raise_on_error)
+            finally:
+                if cache is not None:
+                    cache.after_pipeline(stack)
+
+        pipe.execute = _counted_execute
+        return pipe
+
 
 redis_client = None
 redis_client_binary = None
@@ -25,40 +314,34 @@ def _get_lock():
             _initialization_lock = asyncio.Lock()
     return _initialization_lock
 
+async def _connect(decode_responses: bool) -> "_CountingRedis":
+    client = _CountingRedis(connection_pool=_make_pool(decode_responses))
+    await client.ping()
+    return client
+
 async def _initialize_redis_client():
     """Initialize the async Redis client"""
     global redis_client
     lock = _get_lock()
     async with lock:
         if redis_client is None:
-            if REDIS_URL:
-                try:
-                    redis_client = await redis.from_url(REDIS_URL, decode_responses=True)
-                    await redis_client.ping()
-                    print("[Redis] Successfully connected to Redis from URL (async).")
-                except redis.exceptions.ConnectionError as e:
-                    print(f"[Redis] Could not connect to Redis using URL: {e}")
-                    redis_client = None
-                except Exception as e:
-                    print(f"[Redis] An unexpected error occurred when connecting with URL: {e}")
-                    redis_client = None
-            else:
+            if not REDIS_URL:
                 print("[Redis] REDIS_URL not found. Falling back to local Redis instance on localhost:6379.")
-                try:
-                    redis_client = redis.Redis(
-                        host=os.getenv("REDIS_HOST", "localhost"), 
-                        port=int(os.getenv("REDIS_PORT", 6379)), 
-                        db=0,
-                        decode_responses=True
-                    )
-                    await redis_client.ping()
-                    print("[Redis] Successfully connected to local Redis (async).")
-                except redis.exceptions.ConnectionError as e:
-                    print(f"[Redis] Could not connect to local Redis: {e}")
-                    redis_client = None
-                except Exception as e:
-                    print(f"[Redis] An unexpected error occurred with local Redis connection: {e}")
-                    redis_client = None
+            try:
+                redis_client = await _connect(decode_responses=True)
+                print(
+                    f"[Redis] Successfully connected to Redis (async, pool of {REDIS_MAX_CONNECTIONS}, "
+                    f"{REDIS_RETRY_ATTEMPTS} retries)."
+                )
+                if REDIS_CLIENT_CACHE_ENABLED:
+                    redis_client._client_cache = _ClientSideCache(redis_client.connection_pool)
+                    redis_client._client_cache.start()
+            except redis.ConnectionError as e:
+                print(f"[Redis] Could not connect to Redis: {e}")
+                redis_client = None
+            except Exception as e:
+                print(f"[Redis] An unexpected error occurred when connecting to Redis: {e}")
+                redis_client = None
     return redis_client
 
 async def _initialize_redis_client_binary():
@@ -67,23 +350,10 @@ async def _initialize_redis_client_binary():
     lock = _get_lock()
     async with lock:
         if redis_client_binary is None:
-            if REDIS_URL:
-                try:
-                    redis_client_binary = await redis.from_url(REDIS_URL, decode_responses=False)
-                    await redis_client_binary.ping()
-                except Exception:
-                    redis_client_binary = None
-            else:
-                try:
-                    redis_client_binary = redis.Redis(
-                        host=os.getenv("REDIS_HOST", "localhost"), 
-                        port=int(os.getenv("REDIS_PORT", 6379)), 
-                        db=0,
-                        decode_responses=False
-                    )
-                    await redis_client_binary.ping()
-                except Exception:
-                    redis_client_binary = None
+            try:
+                redis_client_binary = await _connect(decode_responses=False)
+            except Exception:
+                redis_client_binary = None
     return redis_client_binary
 
 async def ensure_redis_client():
@@ -97,3 +367,15 @@ async def ensure_redis_client_binary():
     if redis_client_binary is None:
         await _initialize_redis_client_binary()
     return redis_client_binary
+
+
+async def mget(keys: Iterable[str], binary: bool = False) -> List[Any]:
+    """Values of many keys in one MGET per REDIS_MGET_BATCH_SIZE keys (None for missing keys)."""
+    keys = list(keys)
+    client = await (ensure_redis_client_binary() if binary else ensure_redis_client())
+    if not client or not keys:
+        return [None] * len(keys)
+    values: List[Any] = []
+    for i in range(0, len(keys), REDIS_MGET_BATCH_SIZE):
+        values.extend(await client.mget(keys[i:i + REDIS_MGET_BATCH_SIZE]))
+    return values
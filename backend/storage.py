@@ -113,6 +113,22 @@ class CloudflareR2Storage:
         except Exception:
             return None
 
+    def upload_local_file(self, local_path: str, key: str) -> Tuple[bool, str]:
+        """Upload a local file (e.g. a KB snapshot) under key, without scheduled deletion."""
+        if self.use_local_fallback or not self.r2:
+            try:
+                target = f"local_storage/{key}"
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(local_path, target)
+                return True, f"file://{os.path.abspath(target)}"
+            except Exception as e:
+                return False, str(e)
+        try:
+            self.r2.upload_file(local_path, self.bucket_name, key)
+            return True, f"https://{self.bucket_name}.{self.account_id}.r2.cloudflarestorage.com/{key}"
+        except Exception as e:
+            return False, str(e)
+
     def download_file(self, key: str, local_download_path: str) -> bool:
         is_user = key.startswith("user_docs/")
         if not self.use_local_fallback and self.r2:
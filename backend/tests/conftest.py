@@ -0,0 +1,70 @@
+"""
+Shared fixtures: a fakeredis server behind the app's Redis client, the
+in-memory Qdrant client of Rag.Rag, and deterministic fake embeddings.
+"""
+import hashlib
+import os
+import re
+import sys
+
+# Before any app module reads its configuration
+os.environ["QDRANT_URL"] = ":memory:"
+os.environ.pop("QDRANT_PATH", None)
+os.environ["REDIS_CLIENT_CACHE_ENABLED"] = "false"
+os.environ["SUMMARY_TREE_FOR_KB"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakeredis
+import numpy as np
+import pytest
+import redis.asyncio as redis
+from fakeredis.aioredis import FakeAsyncRedisConnection
+
+import redis_client
+
+
+def fake_redis_client(server: fakeredis.FakeServer, decode_responses: bool = True) -> "redis_client._CountingRedis":
+    pool = redis.ConnectionPool(connection_class=FakeAsyncRedisConnection, server=server, decode_responses=decode_responses)
+    return redis_client._CountingRedis(connection_pool=pool)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Fresh fakeredis server behind ensure_redis_client() and ensure_redis_client_binary()."""
+    server = fakeredis.FakeServer()
+    client = fake_redis_client(server)
+    monkeypatch.setattr(redis_client, "redis_client", client)
+    monkeypatch.setattr(redis_client, "redis_client_binary", fake_redis_client(server, decode_responses=False))
+    return client
+
+
+def fake_embedding(text: str, dim: int = 1536) -> list:
+    """Unit-norm hashed bag of words: texts sharing words get similar vectors."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+@pytest.fixture
+def rag(fake_redis, monkeypatch):
+    """Rag.Rag with fake embeddings, an empty in-memory Qdrant and cold worker caches."""
+    from Rag import Rag as rag_module
+    from Rag import bm25_index, local_vectors, session_docs, sparse_hybrid
+
+    async def _embed_chunks(texts, batch_size=200, api_keys=None):
+        return [fake_embedding(t) for t in texts]
+
+    async def _embed_query(query, api_keys=None):
+        return fake_embedding(query)
+
+    monkeypatch.setattr(rag_module, "embed_chunks_parallel", _embed_chunks)
+    monkeypatch.setattr(rag_module, "embed_query", _embed_query)
+    for cache in (bm25_index._index_cache, bm25_index._pinned, local_vectors._matrix_cache,
+                  session_docs._session_doc_cache, sparse_hybrid._sparse_collections):
+        cache.clear()
+    yield rag_module
+    client = rag_module.QDRANT_CLIENT
+    for collection in client.get_collections().collections:
+        client.delete_collection(collection.name)
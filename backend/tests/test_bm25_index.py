@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from Rag import bm25_index
+from Rag.bm25_index import (
+    BM25_CACHE_METRICS,
+    _reference_scores,
+    bm25_search,
+    get_bm25_index,
+    index_chunks,
+    remove_sources,
+    score_matrix,
+    weight_matrix,
+)
+
+
+def _corpus(n_docs: int, vocab: int, seed: int):
+    rng = np.random.default_rng(seed)
+    lengths = np.maximum(rng.poisson(12, n_docs), 1)
+    doc_of_token = np.repeat(np.arange(n_docs), lengths)
+    term_of_token = (rng.zipf(1.3, int(lengths.sum())) - 1) % vocab
+    tf = sparse.csr_matrix(
+        (np.ones(len(term_of_token), dtype=np.int64), (term_of_token, doc_of_token)), shape=(vocab, n_docs)
+    )
+    tf.sum_duplicates()
+    return tf, lengths.astype(np.float64)
+
+
+def _reference_ranking(tf, doc_lengths, idf, rows, limit):
+    avgdl = float(doc_lengths.mean())
+    postings = {
+        str(r): dict(zip(tf.indices[tf.indptr[r]:tf.indptr[r + 1]].tolist(), tf.data[tf.indptr[r]:tf.indptr[r + 1]].tolist()))
+        for r in rows
+    }
+    scores = _reference_scores(postings, doc_lengths, {str(r): float(idf[r]) for r in rows}, avgdl)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit], scores
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("limit", [1, 5, 50])
+def test_csr_scoring_matches_reference(seed, limit):
+    tf, doc_lengths = _corpus(2000, 300, seed)
+    matrix, idf = weight_matrix(tf, doc_lengths, tf.shape[1], float(doc_lengths.mean()))
+    rng = np.random.default_rng(seed + 100)
+    present = np.flatnonzero(np.diff(tf.indptr))
+    for _ in range(10):
+        rows = sorted(set(rng.choice(present, size=3).tolist()))
+        expected, all_scores = _reference_ranking(tf, doc_lengths, idf, rows, limit)
+        columns, scores, total = score_matrix(matrix, idf, rows, limit)
+        assert columns.tolist() == [c for c, _ in expected]
+        np.testing.assert_allclose(scores, [s for _, s in expected], rtol=1e-9)
+        assert total == pytest.approx(sum(all_scores.values()))
+
+
+def test_ties_resolve_by_column_across_the_cutoff():
+    # Ten identical chunks: every score ties, so the top 3 are the first three columns
+    tf = sparse.csr_matrix(np.ones((1, 10), dtype=np.int64))
+    matrix, idf = weight_matrix(tf, np.full(10, 5.0), 10, 5.0)
+    columns, _, _ = score_matrix(matrix, idf, [0], 3)
+    assert columns.tolist() == [0, 1, 2]
+
+
+async def test_bm25_search_ranks_indexed_chunks(fake_redis):
+    await index_chunks("c1", [
+        ("p1", "a.txt", ["refund", "policy", "refund"]),
+        ("p2", "a.txt", ["shipping", "policy"]),
+        ("p3", "b.txt", ["refund", "window", "days", "policy", "terms"]),
+    ])
+    ranked, mean = await bm25_search("c1", ["refund"], limit=5)
+    assert [pid for pid, _ in ranked] == ["p1", "p3"]
+    assert mean > 0
+
+
+@pytest.fixture
+def empty_cache(fake_redis):
+    bm25_index._index_cache.clear()
+    bm25_index._pinned.clear()
+    bm25_index._index_cache_bytes = 0
+    yield fake_redis
+    bm25_index._index_cache.clear()
+    bm25_index._pinned.clear()
+    bm25_index._index_cache_bytes = 0
+
+
+async def test_cached_index_is_reused_until_the_version_changes(empty_cache):
+    await index_chunks("c1", [("p1", "a.txt", ["alpha", "beta"]), ("p2", "b.txt", ["beta"])])
+    misses, hits = BM25_CACHE_METRICS["misses"], BM25_CACHE_METRICS["hits"]
+    first = await get_bm25_index("c1")
+    assert await get_bm25_index("c1") is first
+    assert (BM25_CACHE_METRICS["misses"], BM25_CACHE_METRICS["hits"]) == (misses + 1, hits + 1)
+
+    # A write in any worker bumps the version; the next read reloads
+    await remove_sources("c1", ["b.txt"])
+    reloaded = await get_bm25_index("c1")
+    assert reloaded is not first and reloaded["docs"] == 1
+    assert BM25_CACHE_METRICS["misses"] == misses + 2
+
+
+async def test_cache_evicts_least_recently_used_over_the_cap(empty_cache, monkeypatch):
+    for name in ("c1", "c2", "c3"):
+        await index_chunks(name, [(f"{name}-p", "a.txt", ["alpha", "beta", "gamma"])])
+    size = bm25_index._index_nbytes(await get_bm25_index("c1"))
+    monkeypatch.setattr(bm25_index, "BM25_CACHE_MAX_BYTES", size * 2)
+    await get_bm25_index("c2")
+    await get_bm25_index("c1")
+    await get_bm25_index("c3")
+    assert list(bm25_index._index_cache) == ["c1", "c3"]
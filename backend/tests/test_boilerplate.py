@@ -0,0 +1,64 @@
+import pytest
+
+from Rag.boilerplate import strip_boilerplate
+
+
+def _page(n: int, body, head=None, foot=None):
+    """Lines of one page as (text, position): head at the top, foot at the bottom."""
+    lines = [(head, 0.0)] if head else []
+    lines += [(text, 0.2 + 0.6 * i / max(len(body) - 1, 1)) for i, text in enumerate(body)]
+    lines += [(foot, 1.0)] if foot else []
+    return lines
+
+
+def _kept(pages, keep):
+    return [[text for (text, _), k in zip(lines, mask) if k] for lines, mask in zip(pages, keep)]
+
+
+def test_running_heads_alternating_odd_and_even_pages_are_removed():
+    pages = [
+        _page(n, [f"Body text of page {n} talks about topic {n}."],
+              head="Chapter 3: Payment Terms" if n % 2 else "ACME Corp Annual Report 2023")
+        for n in range(1, 11)
+    ]
+    keep, stats = strip_boilerplate(pages)
+    assert _kept(pages, keep) == [[f"Body text of page {n} talks about topic {n}."] for n in range(1, 11)]
+    assert stats["lines_removed"] == 10
+
+
+@pytest.mark.parametrize("footer", ["Page {n} of 12", "- {n} -", "{n}"])
+def test_page_number_footers_are_removed(footer):
+    pages = [_page(n, [f"Section {n} explains item {n}."], foot=footer.format(n=n)) for n in range(1, 13)]
+    keep, _ = strip_boilerplate(pages)
+    assert all(lines == [f"Section {n} explains item {n}."] for n, lines in enumerate(_kept(pages, keep), start=1))
+
+
+def test_repeated_body_sentence_of_a_short_document_is_kept():
+    sentence = "Please refer to the appendix for the full table of results."
+    pages = [_page(n, [f"Findings of study {n}.", sentence], foot=f"Page {n} of 3") for n in range(1, 4)]
+    keep, _ = strip_boilerplate(pages)
+    assert _kept(pages, keep) == [[f"Findings of study {n}.", sentence] for n in range(1, 4)]
+
+
+def test_repeated_body_disclaimer_of_a_long_document_is_removed():
+    disclaimer = "Confidential - not for distribution outside the company."
+    pages = [_page(n, [f"Quarter {n} revenue grew.", disclaimer]) for n in range(1, 11)]
+    keep, _ = strip_boilerplate(pages)
+    # Body lines that differ only in their numbers are content, not a repeated line
+    assert _kept(pages, keep) == [[f"Quarter {n} revenue grew."] for n in range(1, 11)]
+
+
+def test_stats_report_bytes_lines_and_patterns():
+    pages = [_page(n, [f"Unique content {n}."], head="ACME Handbook", foot=f"Page {n} of 4") for n in range(1, 5)]
+    keep, stats = strip_boilerplate(pages)
+    before = sum(len(text.encode()) + 1 for lines in pages for text, _ in lines)
+    kept = sum(len(text.encode()) + 1 for lines in _kept(pages, keep) for text in lines)
+    assert stats["pages"] == 4 and stats["lines_removed"] == 8
+    assert stats["bytes_before"] == before and stats["bytes_removed"] == before - kept
+    assert set(stats["top_patterns"]) == {"acme handbook", "page # of #"}
+
+
+def test_documents_below_the_minimum_are_untouched():
+    pages = [_page(n, ["Same line on both pages here."], head="Header") for n in range(1, 3)]
+    keep, stats = strip_boilerplate(pages)
+    assert all(all(mask) for mask in keep) and stats["lines_removed"] == 0
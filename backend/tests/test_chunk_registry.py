@@ -0,0 +1,70 @@
+import itertools
+
+import pytest
+from qdrant_client import models
+
+from Rag import chunk_registry
+from Rag.chunk_registry import (
+    chunk_ids_key,
+    get_chunk_sources,
+    get_doc_index_map,
+    get_point_ids_for_sources,
+    register_chunks,
+    unregister_sources,
+)
+from Rag.kb_manifest import content_hash
+
+COLLECTION = "user_docs_s1"
+
+
+def _points(source: str, order, doc_index=None, prefix=None):
+    """Points of one source, given in `order` of chunk_index (ingestion order is not chunk order)."""
+    return [
+        models.PointStruct(id=f"{prefix or source}-{i}", vector=[0.0], payload={
+            "doc_id": source, "doc_index": doc_index, "filename": f"{source}.txt", "file_type": "txt",
+            "chunk_index": i, "text": f"{source} chunk {i}",
+        })
+        for i in order
+    ]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Strictly increasing ingestion times, one per register_chunks call."""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(chunk_registry.time, "time", lambda: float(next(ticks)))
+
+
+async def test_point_ids_follow_chunk_index(fake_redis):
+    await register_chunks(COLLECTION, _points("a", [2, 0, 1]) + _points("b", [1, 0]))
+    ids = await get_point_ids_for_sources(COLLECTION, ["b", "a", "missing"])
+    assert ids == {"b": ["b-0", "b-1"], "a": ["a-0", "a-1", "a-2"], "missing": []}
+
+    meta = (await get_chunk_sources(COLLECTION))["a"]
+    assert meta["count"] == 3 and meta["filename"] == "a.txt"
+    assert meta["content_hash"] == content_hash("a chunk 0\na chunk 1\na chunk 2")
+
+
+async def test_sources_are_ordered_by_doc_index_then_ingestion_time(fake_redis, clock):
+    await register_chunks(COLLECTION, _points("kb_late", [0]))
+    await register_chunks(COLLECTION, _points("third", [0], doc_index=3))
+    await register_chunks(COLLECTION, _points("kb_later", [0]))
+    await register_chunks(COLLECTION, _points("first", [0], doc_index=1))
+    await register_chunks(COLLECTION, _points("second", [0], doc_index=2))
+    assert list(await get_chunk_sources(COLLECTION)) == ["first", "second", "third", "kb_late", "kb_later"]
+    assert await get_doc_index_map(COLLECTION) == {1: "first", 2: "second", 3: "third"}
+
+
+async def test_registering_a_source_again_replaces_its_ids(fake_redis):
+    await register_chunks(COLLECTION, _points("a", [0, 1, 2]))
+    await register_chunks(COLLECTION, _points("a", [0], prefix="a2"))
+    assert await get_point_ids_for_sources(COLLECTION, ["a"]) == {"a": ["a2-0"]}
+    assert (await get_chunk_sources(COLLECTION))["a"]["count"] == 1
+
+
+async def test_unregister_drops_only_the_given_sources(fake_redis):
+    await register_chunks(COLLECTION, _points("a", [0, 1], doc_index=1) + _points("b", [0], doc_index=2))
+    await unregister_sources(COLLECTION, ["a", ""])
+    assert list(await get_chunk_sources(COLLECTION)) == ["b"]
+    assert not await fake_redis.exists(chunk_ids_key(COLLECTION, "a"))
+    assert await get_point_ids_for_sources(COLLECTION, ["a", "b"]) == {"a": [], "b": ["b-0"]}
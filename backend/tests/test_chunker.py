@@ -0,0 +1,60 @@
+import re
+
+import pytest
+
+from Rag.chunker import chunk_blocks, chunk_document
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _chunked_words(chunks) -> set:
+    return set().union(*(_words(c["text"]) for c in chunks)) if chunks else set()
+
+
+DOCUMENTS = [
+    "1.5 million users signed up in 2023 and 2.5 times more",
+    "CHAPTER 1\n\n2.1 Payment terms\nInvoices are due within 30 days.\n\n2.2 Late fees\n\n# Trailing heading",
+    "UNIT IV\n\n# Setup\n## Install\nRun the installer.\n## Configure\n\n# Usage\n" + "Body sentence here. " * 200,
+    "Revenue grew.\f3.4 Outlook\nWe expect 12.5 percent growth.\n\n| a | b |\n| 1 | 2 |",
+]
+
+
+@pytest.mark.parametrize("content", DOCUMENTS)
+@pytest.mark.parametrize("max_tokens", [16, 64, 256])
+def test_chunking_never_drops_text(content, max_tokens):
+    chunks = chunk_document(content, max_tokens=max_tokens, overlap_tokens=4)
+    assert _words(content) <= _chunked_words(chunks)
+
+
+def test_bold_pdf_headings_are_kept_in_chunk_text():
+    blocks = [
+        {"type": "heading", "text": "Refund Policy", "page": 1, "level": 1},
+        {"type": "heading", "text": "Eligibility", "page": 1, "level": 2},
+        {"type": "heading", "text": "Exceptions", "page": 2, "level": 2},
+        {"type": "paragraph", "text": "Digital goods are final sale.", "page": 2, "level": None},
+    ]
+    chunks = chunk_blocks(blocks, max_tokens=64, overlap_tokens=0)
+    assert [c["text"] for c in chunks] == [
+        "Refund Policy > Eligibility",
+        "Refund Policy > Exceptions\n\nDigital goods are final sale.",
+    ]
+    assert chunks[1]["heading_path"] == ["Refund Policy", "Exceptions"]
+    assert chunks[1]["page_start"] == 2
+
+
+def test_numbered_sentence_is_body_text():
+    chunks = chunk_document("1.5 million users signed up in 2023 and 2.5 times more")
+    assert len(chunks) == 1 and chunks[0]["heading_path"] == []
+
+
+def test_numbered_title_is_a_heading():
+    chunks = chunk_document("2.1 Payment terms\nInvoices are due within 30 days.")
+    assert chunks[0]["heading_path"] == ["2.1 Payment terms"]
+    assert chunks[0]["text"].startswith("2.1 Payment terms\n\n")
+
+
+def test_chunks_with_heading_prefix_stay_within_budget():
+    content = "# A fairly long section heading\n" + "word " * 500
+    assert all(c["token_count"] <= 64 for c in chunk_document(content, max_tokens=64, overlap_tokens=8))
@@ -0,0 +1,78 @@
+import pytest
+
+from Rag.chunker import count_tokens
+from Rag.context_packer import (
+    context_budget,
+    dedupe_items,
+    merge_neighbours,
+    pack_documents,
+    pack_items,
+    pack_texts,
+    record_packed_tokens,
+)
+
+
+def _item(text, score, source=None, chunk_index=None):
+    return {"text": text, "score": score, "source": source, "chunk_index": chunk_index}
+
+
+def _paragraph(n: int, words: int = 60) -> str:
+    return " ".join(f"p{n}w{w}" for w in range(words)) + "."
+
+
+def test_contained_chunks_are_dropped():
+    items = [
+        _item("Refunds are issued within 14 days of the request.", 0.9),
+        _item("refunds are  issued within 14 days", 0.5),
+        _item("Refunds are issued within 14 days of the request.", 0.4),
+        _item("Shipping takes two days.", 0.3),
+    ]
+    kept, dropped = dedupe_items(items)
+    assert [i["score"] for i in kept] == [0.9, 0.3] and dropped == 2
+
+
+def test_adjacent_chunks_merge_with_overlap_removed_once():
+    seam = "the overlapping sentence shared by both chunks"
+    items = [
+        _item(f"First part of the policy, {seam}", 0.4, "u/a", 3),
+        _item(f"{seam} and the second part.", 0.8, "u/a", 4),
+        _item("Unrelated later chunk.", 0.2, "u/a", 7),
+        _item("Other file.", 0.6, "u/b", 5),
+    ]
+    merged, merges = merge_neighbours(items)
+    assert merges == 1
+    run = next(i for i in merged if i["source"] == "u/a" and i["chunk_index"] == 3)
+    assert run["text"] == f"First part of the policy, {seam} and the second part."
+    assert run["text"].count(seam) == 1
+    assert run["chunk_end"] == 4 and run["score"] == 0.8
+    assert len(merged) == 3
+
+
+@pytest.mark.parametrize("route", ["rag_user", "rag_kb", "simple_kb"])
+def test_packed_tokens_never_exceed_the_route_budget(route):
+    budget = context_budget(route)
+    items = [_item(_paragraph(n, words=40 + n * 37), 1.0 / (n + 1), f"u/{n % 3}", n) for n in range(60)]
+    packed, stats = pack_items(items, budget)
+    assert stats["packed_tokens"] <= budget
+    assert sum(count_tokens(i["text"]) for i in packed) == stats["packed_tokens"]
+    assert [i["score"] for i in packed] == sorted((i["score"] for i in packed), reverse=True)
+
+    texts, text_stats = pack_texts([_paragraph(n, words=500) for n in range(40)], route)
+    assert sum(count_tokens(t) for t in texts) <= budget == text_stats["budget_tokens"]
+
+
+def test_documents_keep_their_order_and_the_budget():
+    documents = [_paragraph(n, words=400) for n in range(10)]
+    packed, stats = pack_documents(documents, "rag_json", budget_tokens=2000)
+    assert packed[:-1] == documents[:len(packed) - 1]
+    assert packed[-1].endswith("[truncated to fit the context budget]")
+    assert stats["items_truncated"] == 1
+    assert sum(count_tokens(d) for d in packed) == stats["packed_tokens"] <= 2000
+
+
+def test_context_tokens_accumulate_across_calls():
+    state = {"token_usage": None}
+    record_packed_tokens(state, "rag_kb", {"packed_tokens": 120})
+    record_packed_tokens(state, "simple_json", {"packed_tokens": 30})
+    assert state["token_usage"]["context_tokens"] == 150
+    record_packed_tokens(None, "rag_kb", {"packed_tokens": 10})
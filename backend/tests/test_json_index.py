@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from Rag import json_index
+from Rag.json_index import JSON_UNIT_MAX_CHARS, split_units
+from tests.conftest import fake_embedding
+
+
+def _unit_text(units) -> str:
+    parts = []
+    for unit in units:
+        try:
+            value = json.loads(unit["json"])
+        except ValueError:
+            value = unit["json"]
+        parts.append(value if isinstance(value, str) else unit["json"])
+    return "".join(parts)
+
+
+def test_long_scalars_become_continuation_units():
+    note = "".join(f"sentence {n}. " for n in range(1000))
+    units = split_units({"id": 1, "note": note})
+    note_units = [u for u in units if u["path"].startswith("$.note")]
+    assert len(note_units) > 1
+    assert "".join(json.loads(u["json"]) for u in note_units) == note
+    assert all(len(u["json"]) <= JSON_UNIT_MAX_CHARS + 2 for u in note_units)
+
+
+def test_unit_paths_are_unique():
+    document = {"config": {f"key{i}": "v" * 100 for i in range(60)}, "items": list(range(2000)), "text": "x" * 5000}
+    units = split_units(document)
+    paths = [u["path"] for u in units]
+    assert len(paths) == len(set(paths))
+    assert "$.config (part 1/" in paths[0]
+    # Nothing is dropped: every key and value survives in some unit
+    combined = _unit_text(units)
+    assert all(f"key{i}" in combined for i in range(60))
+    assert "x" * 5000 in combined
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    import embeddings
+
+    async def _embed_chunks(texts, batch_size=200, api_keys=None):
+        return [fake_embedding(t) for t in texts]
+
+    async def _embed_query(query, api_keys=None):
+        return fake_embedding(query)
+
+    monkeypatch.setattr(embeddings, "embed_chunks_parallel", _embed_chunks)
+    monkeypatch.setattr(embeddings, "embed_query", _embed_query)
+
+
+async def test_benchmark_reduces_prompt_tokens(rag, fake_embeddings):
+    result = await json_index.benchmark_json_index(size_mb=0.5)
+    assert result["query_tokens_max"] * 10 < result["whole_tokens"]
+    assert result["compressed_index_bytes"] < result["bytes"]
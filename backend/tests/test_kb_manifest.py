@@ -0,0 +1,28 @@
+from Rag.kb_manifest import get_kb_manifest, kb_manifest_ready, record_kb_files
+
+
+async def _index_one_file(rag):
+    await rag.preprocess_kb_documents(
+        [{"file_url": "u/a", "filename": "a.txt", "content": "apples grow on trees"}], "gpt1", "owner", replace=True
+    )
+    return rag.kb_collection_name("gpt1", "owner")
+
+
+async def test_ready_manifest_with_collection_reports_data(rag):
+    await _index_one_file(rag)
+    assert await rag.check_kb_collection_exists("gpt1", "owner") == (True, True)
+
+
+async def test_stale_manifest_of_missing_collection_is_cleared(rag):
+    collection = await _index_one_file(rag)
+    rag.QDRANT_CLIENT.delete_collection(collection)
+    assert await rag.check_kb_collection_exists("gpt1", "owner") == (False, False)
+    assert await get_kb_manifest(collection) is None
+
+
+async def test_manifest_without_points_falls_back_to_qdrant(rag):
+    collection = await _index_one_file(rag)
+    # Manifest disagrees with Qdrant (records no points for an indexed file)
+    await record_kb_files(collection, {"u/a": {"content_hash": "", "chunk_count": 0}})
+    assert await kb_manifest_ready(collection) is False
+    assert await rag.check_kb_collection_exists("gpt1", "owner") == (True, True)
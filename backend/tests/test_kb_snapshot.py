@@ -0,0 +1,40 @@
+import pytest
+
+from Rag import kb_snapshot
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(kb_snapshot, "KB_SNAPSHOT_DIR", str(tmp_path))
+    return tmp_path
+
+
+async def test_export_and_restore_round_trip(rag, snapshot_dir):
+    await rag.preprocess_kb_documents(
+        [{"file_url": "u/a", "filename": "a.txt", "content": "apples grow on trees"}], "gpt1", "owner", replace=True
+    )
+    collection = rag.kb_collection_name("gpt1", "owner")
+    exported = await kb_snapshot.export_kb_snapshot(collection)
+    rag.QDRANT_CLIENT.delete_collection(collection)
+
+    report = await kb_snapshot.restore_kb_snapshot(f"{collection}.jsonl.gz")
+    assert report["ok"] and report["points"] == exported["points"] > 0
+
+
+@pytest.mark.parametrize("name", ["../kb_x", "kb_x/../../etc", "/tmp/kb_x", "session_abc", "", None])
+def test_rejects_non_kb_collection_names(name):
+    with pytest.raises(ValueError):
+        kb_snapshot.snapshot_path(name)
+
+
+@pytest.mark.parametrize("source", [
+    "/etc/passwd", "../kb_x.jsonl.gz", "sub/kb_x.jsonl.gz", "kb_snapshots/../kb_x.jsonl.gz", "kb_x.json", ".jsonl.gz",
+])
+async def test_rejects_sources_outside_snapshot_dir(snapshot_dir, source):
+    with pytest.raises(ValueError):
+        await kb_snapshot.restore_kb_snapshot(source)
+
+
+async def test_rejects_restore_into_non_kb_collection(snapshot_dir):
+    with pytest.raises(ValueError):
+        await kb_snapshot.restore_kb_snapshot("kb_x.jsonl.gz", collection_name="session_abc")
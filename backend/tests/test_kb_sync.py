@@ -0,0 +1,130 @@
+import asyncio
+
+from Rag import kb_sync
+from Rag.kb_manifest import content_hash, get_kb_manifest
+from Rag.kb_sync import check_kb_sources, plan_kb_sync
+
+
+def _doc(url, content="", **extra):
+    return {"id": url, "filename": url.rsplit("/", 1)[-1], "file_url": url, "content": content, **extra}
+
+
+def test_incremental_plan_never_removes():
+    manifest = {"u/a": {"content_hash": content_hash("alpha")}, "u/b": {"content_hash": content_hash("beta")}}
+    plan = plan_kb_sync([_doc("u/a", "alpha changed"), _doc("u/c", "gamma")], manifest)
+    assert plan["removed"] == []
+    assert [d["file_url"] for d in plan["changed"]] == ["u/a"]
+    assert [d["file_url"] for d in plan["added"]] == ["u/c"]
+
+
+def test_replace_plan_removes_unlisted():
+    manifest = {"u/a": {"content_hash": content_hash("alpha")}, "u/b": {"content_hash": content_hash("beta")}}
+    plan = plan_kb_sync([_doc("u/a")], manifest, replace=True)
+    assert plan["removed"] == ["u/b"]
+    assert plan["unchanged"] == ["u/a"]
+
+
+def test_placeholder_with_new_source_hash_is_rehashed():
+    manifest = {"u/a": {"content_hash": content_hash("alpha"), "source_hash": "old"}}
+    plan = plan_kb_sync([_doc("u/a", source_hash="new")], manifest)
+    assert plan["unchanged"] == ["u/a"]
+    assert [d["file_url"] for d in plan["rehash"]] == ["u/a"]
+
+
+def test_placeholder_with_new_source_version_is_rehashed():
+    manifest = {"u/a": {"content_hash": content_hash("alpha"), "source_version": "etag:1"}}
+    plan = plan_kb_sync([_doc("u/a", source_version="etag:2")], manifest)
+    assert [d["file_url"] for d in plan["rehash"]] == ["u/a"]
+
+
+class _Origin:
+    """File server stand-in: HEAD returns the version, downloads are counted."""
+
+    def __init__(self, files):
+        self.files = files
+        self.heads = self.downloads = self.active = self.peak = 0
+
+    async def head(self, file_url):
+        self.heads += 1
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        return self.files[file_url][1]
+
+    async def download(self, file_url):
+        self.downloads += 1
+        return self.files[file_url]
+
+
+async def test_unchanged_versions_are_not_downloaded(monkeypatch):
+    monkeypatch.setattr(kb_sync, "KB_SOURCE_CHECK_CONCURRENCY", 4)
+    files = {f"u/{i}": (b"bytes %d" % i, f"etag:{i}") for i in range(40)}
+    manifest = {url: {"source_hash": content_hash(body), "source_version": version} for url, (body, version) in files.items()}
+    origin = _Origin(files)
+    unchanged, changed = await check_kb_sources([_doc(url) for url in files], manifest, origin.head, origin.download)
+    assert len(unchanged) == 40 and changed == {}
+    assert origin.downloads == 0 and origin.peak <= 4
+
+
+async def test_changed_version_downloads_only_that_file():
+    files = {"u/a": (b"alpha", "etag:a"), "u/b": (b"beta v2", "etag:b2"), "u/c": (b"gamma", "etag:c2")}
+    manifest = {
+        "u/a": {"source_hash": content_hash(b"alpha"), "source_version": "etag:a"},
+        "u/b": {"source_hash": content_hash(b"beta"), "source_version": "etag:b1"},
+        # New ETag, same bytes (e.g. re-uploaded): unchanged, and the new version is adopted
+        "u/c": {"source_hash": content_hash(b"gamma"), "source_version": "etag:c1"},
+    }
+    origin = _Origin(files)
+    unchanged, changed = await check_kb_sources([_doc(url) for url in files], manifest, origin.head, origin.download)
+    assert origin.downloads == 2
+    assert changed == {"u/b": (b"beta v2", "etag:b2")}
+    assert {d["file_url"]: d["source_version"] for d in unchanged} == {"u/a": "etag:a", "u/c": "etag:c2"}
+
+
+async def test_caller_supplied_signal_skips_the_head_request():
+    files = {"u/a": (b"alpha", "")}
+    manifest = {"u/a": {"source_hash": content_hash(b"alpha"), "source_version": "updated:2024-05-01"}}
+    origin = _Origin(files)
+    unchanged, _ = await check_kb_sources([_doc("u/a", updated_at="2024-05-01")], manifest, origin.head, origin.download)
+    assert len(unchanged) == 1 and origin.heads == origin.downloads == 0
+
+
+async def test_partial_session_list_keeps_other_files(rag):
+    files = [_doc("u/a", "apples grow on trees"), _doc("u/b", "bananas grow in bunches")]
+    await rag.preprocess_kb_documents(files, "gpt1", "owner", replace=True)
+    collection = rag.kb_collection_name("gpt1", "owner")
+
+    # Another session adds one file incrementally: nothing else is deleted
+    report = await rag.preprocess_kb_documents([_doc("u/c", "cherries are red")], "gpt1", "owner")
+    assert report["removed"] == []
+    assert set(await get_kb_manifest(collection)) == {"u/a", "u/b", "u/c"}
+
+    # The full list (replace) drops files no longer in the KB, even one listed before
+    report = await rag.preprocess_kb_documents([_doc("u/a"), _doc("u/c")], "gpt1", "owner", replace=True)
+    assert report["removed"] == ["u/b"]
+    assert set(await get_kb_manifest(collection)) == {"u/a", "u/c"}
+    remaining = {p.payload["file_url"] for p in rag.QDRANT_CLIENT.scroll(collection, limit=100)[0]}
+    assert remaining == {"u/a", "u/c"}
+
+
+async def test_changed_content_at_same_url_is_reembedded(rag):
+    await rag.preprocess_kb_documents([_doc("u/a", "old policy text")], "gpt1", "owner", replace=True)
+    collection = rag.kb_collection_name("gpt1", "owner")
+    report = await rag.preprocess_kb_documents([_doc("u/a", "new policy text")], "gpt1", "owner", replace=True)
+    assert report["changed"] == ["u/a"]
+    texts = [p.payload["text"] for p in rag.QDRANT_CLIENT.scroll(collection, limit=100)[0]]
+    assert any("new policy" in t for t in texts) and not any("old policy" in t for t in texts)
+
+
+async def test_same_version_is_reindexed_after_collection_loss(rag):
+    files = [_doc("u/a", "apples grow on trees")]
+    await rag.preprocess_kb_documents(files, "gpt1", "owner", replace=True)
+    collection = rag.kb_collection_name("gpt1", "owner")
+    assert await rag.preprocess_kb_documents(files, "gpt1", "owner", replace=True) is None
+
+    # In-memory Qdrant restarted: the Redis manifest and version survive, the collection does not
+    rag.QDRANT_CLIENT.delete_collection(collection)
+    report = await rag.preprocess_kb_documents(files, "gpt1", "owner", replace=True)
+    assert report["added"] == ["u/a"]
+    assert rag.QDRANT_CLIENT.count(collection).count > 0
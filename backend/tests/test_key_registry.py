@@ -0,0 +1,52 @@
+import pytest
+
+from Rag.key_registry import get_registered_keys, rebuild_registries, registry_key, user_json_scope
+
+
+def _json_doc(name, content='{"a": 1}'):
+    return {"filename": name, "file_type": "json", "file_url": f"u/{name}", "content": content}
+
+
+@pytest.fixture
+def no_keyspace_scans(fake_redis, monkeypatch):
+    """Fail the test if the hot path scans the keyspace."""
+    def _forbidden(*args, **kwargs):
+        raise AssertionError("keyspace scan on the hot path")
+
+    monkeypatch.setattr(fake_redis, "keys", _forbidden)
+    monkeypatch.setattr(fake_redis, "scan_iter", _forbidden)
+    return fake_redis
+
+
+async def test_json_documents_are_found_through_the_registry(rag, no_keyspace_scans):
+    for name in ("a.json", "b.json"):
+        assert await rag.store_json_document(_json_doc(name), is_kb=False, session_id="s1")
+    assert await get_registered_keys(user_json_scope("s1")) == ["user_json:s1:u/a.json", "user_json:s1:u/b.json"]
+    assert len(await rag.get_json_documents(is_kb=False, session_id="s1")) == 2
+
+    await rag.clear_json_documents(session_id="s1")
+    assert await rag.get_json_documents(is_kb=False, session_id="s1") == []
+    assert not await no_keyspace_scans.exists(registry_key(user_json_scope("s1")), "user_json:s1:u/a.json")
+
+
+async def test_expired_documents_leave_the_registry(rag, fake_redis):
+    await rag.store_json_document(_json_doc("a.json"), is_kb=True, gpt_id="g1", userId="owner")
+    await rag.store_json_document(_json_doc("b.json"), is_kb=True, gpt_id="g1", userId="owner")
+    scope = f"kb_json:g1_{rag.kb_owner('owner')}"
+    await fake_redis.delete(f"{scope}:u/a.json")
+
+    assert len(await rag.get_json_documents(is_kb=True, gpt_id="g1", userId="owner")) == 1
+    assert await get_registered_keys(scope) == [f"{scope}:u/b.json"]
+
+
+async def test_rebuild_repairs_missing_and_stale_members(fake_redis):
+    await fake_redis.set("user_json:s1:u/a.json", "{}", ex=600)
+    await fake_redis.sadd(registry_key("user_json:s1"), "user_json:s1:u/gone.json")
+
+    report = await rebuild_registries(dry_run=True)
+    assert (report["keys_added"], report["stale_removed"]) == (1, 1)
+    assert await get_registered_keys("user_json:s1") == ["user_json:s1:u/gone.json"]
+
+    await rebuild_registries(dry_run=False)
+    assert await get_registered_keys("user_json:s1") == ["user_json:s1:u/a.json"]
+    assert 0 < await fake_redis.ttl(registry_key("user_json:s1")) <= 600
@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, List
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from Rag import llm_scheduler
+
+LLM_DELAY = 0.02
+
+
+class SleepyChat(BaseChatModel):
+    """Answers after LLM_DELAY with a reply derived from the prompt, streamed word by word."""
+
+    @property
+    def _llm_type(self) -> str:
+        return "sleepy"
+
+    @staticmethod
+    def _reply(messages: List[Any]) -> str:
+        digest = hashlib.md5(messages[-1].content.encode()).hexdigest()
+        return f"summary {digest[:6]} of {len(messages[-1].content)} chars"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(LLM_DELAY)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(LLM_DELAY)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(LLM_DELAY)
+        for word in self._reply(messages).split(" "):
+            await asyncio.sleep(0)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"{word} "))
+
+
+def _chunks() -> List[dict]:
+    """Three documents long enough for the map/reduce (hierarchical) mode."""
+    chunks = []
+    for doc in range(3):
+        for index in range(30):
+            words = " ".join(f"d{doc}c{index}w{w}" for w in range(500))
+            chunks.append({"doc_id": f"doc{doc}", "filename": f"doc{doc}.txt", "file_type": "txt",
+                           "chunk_index": index, "text": words})
+    return chunks
+
+
+@pytest.fixture
+def summarizer(rag, fake_redis, monkeypatch):
+    import api_keys_util
+
+    async def _no_keys(session_id):
+        return {}
+
+    async def _no_tree(collection_name):
+        return None
+
+    async def _registered(collection_name):
+        return _chunks()
+
+    monkeypatch.setattr(api_keys_util, "get_api_keys_from_session", _no_keys)
+    monkeypatch.setattr(rag, "get_valid_summary_tree", _no_tree)
+    monkeypatch.setattr(rag, "_fetch_registered_chunks", _registered)
+    monkeypatch.setattr(rag, "get_llm", lambda *args, **kwargs: SleepyChat())
+    monkeypatch.setattr(llm_scheduler, "_rate_limiter", llm_scheduler._RateLimiter(0))
+
+    async def _run(concurrency: int):
+        monkeypatch.setattr(llm_scheduler, "_semaphore", asyncio.Semaphore(concurrency))
+        await fake_redis.hset("user_doc_cache:s1", mapping={"collection_name": "user_docs_s1"})
+        streamed: List[str] = []
+
+        async def _collect(chunk: str):
+            streamed.append(chunk)
+
+        start = time.perf_counter()
+        output = await rag.hierarchical_summarize({"session_id": "s1", "_chunk_callback": _collect})
+        return output, "".join(streamed), time.perf_counter() - start
+
+    return _run
+
+
+async def test_concurrent_summaries_match_sequential_and_are_faster(summarizer):
+    sequential_output, sequential_stream, sequential_seconds = await summarizer(1)
+    output, stream, seconds = await summarizer(8)
+
+    assert output == sequential_output
+    assert stream == sequential_stream
+    positions = [stream.index(f"Document {n + 1}: doc{n}.txt") for n in range(3)]
+    assert positions == sorted(positions)
+    assert sequential_seconds / seconds > 3
+
+
+async def test_ordered_stream_buffers_later_slots():
+    emitted: List[str] = []
+
+    async def _collect(chunk: str):
+        emitted.append(chunk)
+
+    stream = llm_scheduler.OrderedStream(_collect, 3)
+    await stream.callback(2)("c")
+    await stream.callback(1)("b")
+    await stream.finish(2)
+    assert emitted == []
+    await stream.callback(0)("a")
+    await stream.finish(0)
+    await stream.finish(1)
+    assert emitted == ["a", "b", "c"]
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from qdrant_client import models
+
+from Rag import local_vectors
+from Rag.local_vectors import LOCAL_VECTOR_METRICS, benchmark_local_search, dense_search
+from Rag.session_docs import bump_doc_generation
+
+COLLECTION = "user_docs_s1"
+
+
+def _upsert(rag, vectors, start=0):
+    rag.QDRANT_CLIENT.upsert(COLLECTION, points=[
+        models.PointStruct(id=start + i, vector=v.tolist(), payload={"doc_id": f"doc{(start + i) % 4}", "text": f"chunk {start + i}"})
+        for i, v in enumerate(vectors)
+    ])
+
+
+@pytest.fixture
+def session_collection(rag):
+    rng = np.random.default_rng(3)
+    rag.QDRANT_CLIENT.create_collection(
+        COLLECTION, vectors_config=models.VectorParams(size=rag.VECTOR_SIZE, distance=models.Distance.COSINE)
+    )
+    _upsert(rag, rng.standard_normal((300, rag.VECTOR_SIZE)).astype(np.float32))
+    return rag, rng
+
+
+async def test_benchmark_recall_is_exact(rag):
+    [result] = await benchmark_local_search(sizes=(300,), queries=20, limit=10)
+    assert result["recall"] == 1.0
+
+
+@pytest.mark.parametrize("doc_ids", [None, ["doc1", "doc3"], ["missing"]])
+async def test_local_search_matches_qdrant(session_collection, doc_ids):
+    rag, rng = session_collection
+    await bump_doc_generation("s1")
+    query_filter = None
+    if doc_ids is not None:
+        query_filter = models.Filter(must=[models.FieldCondition(key="doc_id", match=models.MatchAny(any=doc_ids))])
+    for query in rng.standard_normal((10, rag.VECTOR_SIZE)).astype(np.float32):
+        local_queries = LOCAL_VECTOR_METRICS["local_queries"]
+        local = await dense_search(COLLECTION, query.tolist(), 10, doc_ids=doc_ids)
+        assert LOCAL_VECTOR_METRICS["local_queries"] == local_queries + 1
+        expected = rag.QDRANT_CLIENT.search(COLLECTION, query_vector=query.tolist(), limit=10, query_filter=query_filter)
+        assert [p.id for p in local] == [p.id for p in expected]
+        np.testing.assert_allclose([p.score for p in local], [p.score for p in expected], atol=1e-5)
+        assert [p.payload for p in local] == [p.payload for p in expected]
+
+
+async def test_new_generation_reloads_the_matrix(session_collection):
+    rag, rng = session_collection
+    await bump_doc_generation("s1")
+    query = rng.standard_normal(rag.VECTOR_SIZE).astype(np.float32)
+    await dense_search(COLLECTION, query.tolist(), 5)
+
+    # An upload adds the query's own vector and bumps the generation
+    _upsert(rag, [query], start=1000)
+    await bump_doc_generation("s1")
+    assert (await dense_search(COLLECTION, query.tolist(), 5))[0].id == 1000
+
+
+async def test_large_collections_and_sessions_without_generation_use_qdrant(session_collection, monkeypatch):
+    rag, rng = session_collection
+    query = rng.standard_normal(rag.VECTOR_SIZE).astype(np.float32).tolist()
+    qdrant_queries = LOCAL_VECTOR_METRICS["qdrant_queries"]
+    await dense_search(COLLECTION, query, 5)
+    assert LOCAL_VECTOR_METRICS["qdrant_queries"] == qdrant_queries + 1
+
+    monkeypatch.setattr(local_vectors, "LOCAL_VECTOR_MAX_POINTS", 100)
+    await bump_doc_generation("s1")
+    await dense_search(COLLECTION, query, 5)
+    assert LOCAL_VECTOR_METRICS["qdrant_queries"] == qdrant_queries + 2
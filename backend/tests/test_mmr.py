@@ -0,0 +1,65 @@
+import time
+
+import numpy as np
+
+from Rag.mmr import mmr_rerank, mmr_select, rank_relevance, stack_vectors
+
+
+def _unit(*weights):
+    vector = np.zeros(8, dtype=np.float32)
+    vector[:len(weights)] = weights
+    return vector / np.linalg.norm(vector)
+
+
+def test_lambda_one_keeps_relevance_order():
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((30, 16)).astype(np.float32)
+    query = rng.standard_normal(16).astype(np.float32)
+    relevance = vectors @ query / np.linalg.norm(vectors, axis=1) / np.linalg.norm(query)
+    assert mmr_select(query, vectors, 10, lambda_mult=1.0) == np.argsort(-relevance, kind="stable")[:10].tolist()
+
+
+def test_near_duplicates_are_pushed_down():
+    query = _unit(1, 1, 0)
+    vectors = [_unit(1, 0.9, 0), _unit(1, 0.9, 0.01), _unit(1, 0.88, 0), _unit(0.6, 1, 0)]
+    # Relevance alone takes the three copies first; MMR takes one copy and the distinct vector
+    assert mmr_select(query, vectors, 2, lambda_mult=1.0)[1] in (1, 2)
+    assert mmr_select(query, vectors, 2, lambda_mult=0.5) == [0, 3]
+
+
+def test_zero_vectors_are_kept_and_never_redundant():
+    items = ["a", "a copy", "b", "missing"]
+    vectors = stack_vectors([[1.0, 0.0], [1.0, 0.0], [0.0, 1.0], None])
+    assert vectors[3].tolist() == [0.0, 0.0]
+    picked = mmr_rerank(None, items, vectors, 4, lambda_mult=0.5, relevance=rank_relevance(4))
+    assert sorted(picked) == sorted(items)
+    assert picked.index("missing") < picked.index("a copy")
+
+
+def test_stack_vectors_handles_named_and_wrong_sized_vectors():
+    matrix = stack_vectors([{"": [1.0, 2.0], "bm25": None}, [3.0], np.array([5.0, 6.0])], 2)
+    assert matrix.tolist() == [[1.0, 2.0], [0.0, 0.0], [5.0, 6.0]]
+
+
+def test_200_candidates_stay_within_latency_bound():
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((200, 1536)).astype(np.float32)
+    query = rng.standard_normal(1536).astype(np.float32)
+    as_lists = vectors.tolist()
+    items = list(range(200))
+    mmr_rerank(query, items, as_lists, 20)
+
+    start = time.perf_counter()
+    for _ in range(20):
+        mmr_select(query, vectors, 20)
+    select_ms = (time.perf_counter() - start) / 20 * 1000
+
+    start = time.perf_counter()
+    for _ in range(5):
+        picked = mmr_rerank(query, items, as_lists, 20)
+    rerank_ms = (time.perf_counter() - start) / 5 * 1000
+
+    assert len(set(picked)) == 20
+    assert select_ms < 5
+    # Includes converting 200 x 1536 Python floats, as from a remote Qdrant
+    assert rerank_ms < 50
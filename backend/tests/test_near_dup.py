@@ -0,0 +1,43 @@
+import pytest
+
+from Rag import near_dup
+
+SHARED = " ".join(f"clause{n} of the shared confidentiality terms applies" for n in range(12))
+
+
+@pytest.fixture
+def skip_mode(rag, monkeypatch):
+    monkeypatch.setattr(near_dup, "NEAR_DUP_MODE", "skip")
+    monkeypatch.setattr(rag, "NEAR_DUP_MODE", "skip")
+    return rag
+
+
+def _doc(url, content):
+    return {"id": url, "filename": url.rsplit("/", 1)[-1], "file_url": url, "content": content}
+
+
+def _texts(rag, collection, file_url):
+    points = rag.QDRANT_CLIENT.scroll(collection, limit=100)[0]
+    return [p.payload["text"] for p in points if p.payload["file_url"] == file_url]
+
+
+async def test_skip_mode_drops_duplicates_within_one_file(skip_mode):
+    rag = skip_mode
+    await rag.preprocess_kb_documents([_doc("u/c", f"# Terms\n{SHARED}\n\n# Terms\n{SHARED}")], "gpt1", "owner", replace=True)
+    assert len(_texts(rag, rag.kb_collection_name("gpt1", "owner"), "u/c")) == 1
+
+
+async def test_deleting_canonical_file_keeps_other_files_duplicates(skip_mode):
+    rag = skip_mode
+    files = [
+        _doc("u/a", f"# Terms\n{SHARED}"),
+        _doc("u/b", f"# Terms\n{SHARED}\n\n# Pricing\nPlans start at ten dollars per seat."),
+    ]
+    await rag.preprocess_kb_documents(files, "gpt1", "owner", replace=True)
+    collection = rag.kb_collection_name("gpt1", "owner")
+    assert len(_texts(rag, collection, "u/b")) == 2
+
+    await rag.preprocess_kb_documents(files[1:], "gpt1", "owner", replace=True)
+    texts = _texts(rag, collection, "u/b")
+    assert any("clause11" in t for t in texts)
+    assert _texts(rag, collection, "u/a") == []
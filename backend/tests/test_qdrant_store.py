@@ -0,0 +1,31 @@
+import pytest
+
+from Rag import qdrant_store
+from Rag.qdrant_store import QDRANT_STATUS, check_persistence, close_qdrant_client, open_embedded_client
+
+
+@pytest.fixture(autouse=True)
+def closed_after(monkeypatch):
+    monkeypatch.setattr(qdrant_store, "QDRANT_PATH_LOCK_TIMEOUT", 0.2)
+    yield
+    close_qdrant_client()
+
+
+def test_collections_survive_a_restart(tmp_path):
+    result = check_persistence(str(tmp_path))
+    assert result["ok"], result
+
+
+def test_second_open_of_locked_storage_fails_fast(tmp_path):
+    open_embedded_client(str(tmp_path))
+    with pytest.raises(RuntimeError, match="locked by another process"):
+        open_embedded_client(str(tmp_path))
+
+
+def test_unreachable_server_falls_back_to_embedded_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(qdrant_store, "QDRANT_URL", "http://127.0.0.1:9")
+    monkeypatch.setattr(qdrant_store, "QDRANT_TIMEOUT", 1.0)
+    monkeypatch.setattr(qdrant_store, "QDRANT_PATH", str(tmp_path))
+    client = qdrant_store.open_qdrant_client()
+    assert QDRANT_STATUS["mode"] == "embedded"
+    assert client.get_collections().collections == []
@@ -0,0 +1,139 @@
+import asyncio
+
+import fakeredis
+import pytest
+import redis.asyncio as redis
+
+from redis_client import REDIS_METRICS, _ClientSideCache
+from tests.conftest import fake_redis_client
+
+
+class ScriptedConnection:
+    """Stands in for the tracking and subscriber connections: replies come from a queue."""
+
+    def __init__(self, replies):
+        self.replies: asyncio.Queue = asyncio.Queue()
+        for reply in replies:
+            self.replies.put_nowait(reply)
+        self.sent = []
+        self.closed = False
+
+    async def send_command(self, *args):
+        self.sent.append(args)
+
+    async def read_response(self):
+        reply = await self.replies.get()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    async def disconnect(self):
+        self.closed = True
+
+
+@pytest.fixture
+async def cached_client(monkeypatch):
+    """A client with a client-side cache whose invalidation stream is scripted, plus a second plain client."""
+    server = fakeredis.FakeServer()
+    client = fake_redis_client(server)
+    other = fake_redis_client(server)
+    cache = _ClientSideCache(client.connection_pool)
+    subscriber = ScriptedConnection([7, ["subscribe", "__redis__:invalidate", 1]])
+    tracker = ScriptedConnection(["OK"])
+    scripted = iter([subscriber, tracker])
+
+    async def _open_connection():
+        connection = next(scripted)
+        cache._connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(cache, "_open_connection", _open_connection)
+    client._client_cache = cache
+    cache.start()
+    for _ in range(100):
+        if cache.enabled:
+            break
+        await asyncio.sleep(0)
+    assert cache.enabled
+    yield client, other, cache, subscriber, tracker
+    cache._task.cancel()
+    await asyncio.gather(cache._task, return_exceptions=True)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_tracking_is_enabled_with_bcast_prefixes(cached_client):
+    _, _, _, subscriber, tracker = cached_client
+    assert subscriber.sent[1] == ("SUBSCRIBE", "__redis__:invalidate")
+    command = tracker.sent[0]
+    assert command[:6] == ("CLIENT", "TRACKING", "on", "REDIRECT", 7, "BCAST")
+    assert "session:" in command
+
+
+async def test_reads_are_cached_until_the_server_invalidates(cached_client):
+    client, other, _, subscriber, _ = cached_client
+    await other.set("session:a", "1")
+    hits = REDIS_METRICS["client_cache_hits"]
+    assert await client.get("session:a") == "1"
+    assert await client.get("session:a") == "1"
+    assert REDIS_METRICS["client_cache_hits"] == hits + 1
+
+    # Another worker writes: the cached reply is served until the invalidation arrives
+    await other.set("session:a", "2")
+    assert await client.get("session:a") == "1"
+    subscriber.replies.put_nowait(["message", "__redis__:invalidate", ["session:a"]])
+    await _settle()
+    assert await client.get("session:a") == "2"
+
+
+async def test_local_writes_invalidate_immediately(cached_client):
+    client, _, _, _, _ = cached_client
+    await client.set("kb_manifest:c1", "v1")
+    assert await client.get("kb_manifest:c1") == "v1"
+    await client.set("kb_manifest:c1", "v2")
+    assert await client.get("kb_manifest:c1") == "v2"
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.delete("kb_manifest:c1")
+        await pipe.execute()
+    assert await client.get("kb_manifest:c1") is None
+
+
+async def test_keys_outside_the_prefixes_are_not_cached(cached_client):
+    client, other, _, _, _ = cached_client
+    await other.set("json_doc:a", "1")
+    assert await client.get("json_doc:a") == "1"
+    await other.set("json_doc:a", "2")
+    assert await client.get("json_doc:a") == "2"
+
+
+async def test_flush_message_and_disconnect_clear_the_cache(cached_client):
+    client, other, cache, subscriber, tracker = cached_client
+    await other.set("session:a", "1")
+    await client.get("session:a")
+    subscriber.replies.put_nowait(["message", "__redis__:invalidate", None])
+    await _settle()
+    assert cache.lookup(("GET", "session:a")) == (False, None)
+
+    await client.get("session:a")
+    assert cache.lookup(("GET", "session:a"))[0]
+    # Losing the invalidation stream disables and flushes the cache until it reconnects
+    subscriber.replies.put_nowait(redis.ConnectionError("connection reset"))
+    await _settle()
+    assert not cache.enabled
+    assert subscriber.closed and tracker.closed
+    await other.set("session:a", "2")
+    assert await client.get("session:a") == "2"
+
+
+def test_reply_is_not_stored_when_invalidated_in_flight():
+    cache = _ClientSideCache(None)
+    cache.enabled = True
+    epoch = cache.epoch
+    cache.invalidate(["session:a"])
+    cache.after_command(("GET", "session:a"), "stale", epoch)
+    assert cache.lookup(("GET", "session:a")) == (False, None)
+    cache.after_command(("GET", "session:a"), "fresh", cache.epoch)
+    assert cache.lookup(("GET", "session:a")) == (True, "fresh")
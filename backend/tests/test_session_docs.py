@@ -0,0 +1,53 @@
+import asyncio
+
+from Rag.session_docs import (
+    benchmark_second_turn,
+    bump_doc_generation,
+    doc_generation_key,
+    get_cached_doc_state,
+    get_doc_generation,
+    set_cached_doc_state,
+)
+
+
+async def test_generation_is_monotonic_across_expiry(fake_redis):
+    first = await bump_doc_generation("s1")
+    second = await bump_doc_generation("s1")
+    assert second == first + 1
+    set_cached_doc_state("s1", "json_keys", second, ["user_json:s1:a"])
+
+    # The counter expires with the session's documents, then a new upload arrives
+    # (a TTL later in practice; a few milliseconds move the clock seed past the old counter)
+    await fake_redis.delete(doc_generation_key("s1"))
+    await asyncio.sleep(0.01)
+    third = await bump_doc_generation("s1")
+    assert third > second
+    assert await get_doc_generation("s1") == third
+    assert get_cached_doc_state("s1", "json_keys", third) is None
+
+
+async def test_second_turn_reuses_document_state(rag):
+    result = await benchmark_second_turn(documents=20, rounds=2)
+    assert result["documents"] == 20
+    # Kept caches save the JSON document reads and the vector matrix load of the turn
+    assert result["warm_round_trips"] < result["cleared_round_trips"]
+
+
+async def test_hydration_is_one_round_trip_per_turn(rag, fake_redis):
+    from redis_client import finish_turn_metrics, start_turn_metrics
+
+    for n in range(5):
+        doc = {"filename": f"d{n}.json", "file_type": "json", "file_url": f"u/d{n}.json", "content": '{"n": %d}' % n}
+        assert await rag.store_json_document(doc, is_kb=False, session_id="s1")
+    await fake_redis.hset("user_doc_cache:s1", mapping={"collection_name": "user_docs_s1", "document_count": "5"})
+    generation = await bump_doc_generation("s1")
+
+    token = start_turn_metrics()
+    state = await rag._hydrate_session_docs("s1")
+    stats = finish_turn_metrics(token, "hydration")
+
+    assert stats["round_trips"] == 1 and stats["commands"] == 3
+    assert state["cache"]["collection_name"] == "user_docs_s1"
+    assert state["generation"] == generation
+    assert state["json_keys"] == [f"user_json:s1:u/d{n}.json" for n in range(5)]
+    assert get_cached_doc_state("s1", "json_keys", state["generation"]) == state["json_keys"]
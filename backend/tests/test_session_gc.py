@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from qdrant_client import models
+
+from Rag import session_gc
+from Rag.session_gc import (
+    SESSION_RESOURCES_INDEX,
+    session_resources_key,
+    sweep_orphaned_session_resources,
+    track_session_resources,
+)
+
+
+def _collection(client, name: str, points: int = 3):
+    client.create_collection(name, vectors_config=models.VectorParams(size=4, distance=models.Distance.COSINE))
+    client.upsert(name, points=[models.PointStruct(id=i, vector=[1.0, 0.0, 0.0, float(i)]) for i in range(points)])
+
+
+def _collections(client) -> set:
+    return {c.name for c in client.get_collections().collections}
+
+
+@pytest.fixture
+async def sessions(rag, fake_redis):
+    """Two sessions with a collection and a key each; s_live still has its session:{id} key."""
+    for session_id in ("s_live", "s_gone"):
+        _collection(rag.QDRANT_CLIENT, f"user_docs_{session_id}")
+        await fake_redis.set(f"bm25_index:user_docs_{session_id}", "x" * 100)
+        await track_session_resources(
+            session_id, collections=[f"user_docs_{session_id}"], redis_keys=[f"bm25_index:user_docs_{session_id}"]
+        )
+    await fake_redis.set("session:s_live", "{}")
+    # Both manifests were last touched two hours ago
+    await fake_redis.zadd(SESSION_RESOURCES_INDEX, {"s_live": time.time() - 7200, "s_gone": time.time() - 7200})
+    return rag.QDRANT_CLIENT
+
+
+async def test_expired_session_is_reclaimed_and_live_one_kept(sessions, fake_redis):
+    metrics = await sweep_orphaned_session_resources(dry_run=False)
+    assert metrics["reclaimed"] == ["s_gone"]
+    assert _collections(sessions) == {"user_docs_s_live"}
+    assert await fake_redis.exists("bm25_index:user_docs_s_live")
+    assert not await fake_redis.exists("bm25_index:user_docs_s_gone", session_resources_key("s_gone"))
+    assert await fake_redis.zscore(SESSION_RESOURCES_INDEX, "s_gone") is None
+
+
+async def test_expired_session_within_grace_period_is_kept(sessions, fake_redis, monkeypatch):
+    monkeypatch.setattr(session_gc, "SESSION_GC_GRACE_SECONDS", 3 * 3600)
+    metrics = await sweep_orphaned_session_resources(dry_run=False)
+    assert metrics["sessions_scanned"] == 0 and metrics["reclaimed"] == []
+    assert _collections(sessions) == {"user_docs_s_live", "user_docs_s_gone"}
+
+    monkeypatch.setattr(session_gc, "SESSION_GC_GRACE_SECONDS", 3600)
+    assert (await sweep_orphaned_session_resources(dry_run=False))["reclaimed"] == ["s_gone"]
+
+
+async def test_dry_run_reports_without_deleting(sessions, fake_redis, rag):
+    metrics = await sweep_orphaned_session_resources()
+    assert metrics["dry_run"] and metrics["reclaimed"] == ["s_gone"]
+    assert metrics["points_reclaimed"] == 3
+    # fakeredis has no MEMORY USAGE, so only the vector estimate is counted
+    assert metrics["bytes_reclaimed"] == 3 * rag.VECTOR_SIZE * 4
+    assert metrics["collections_deleted"] == metrics["redis_keys_deleted"] == 1
+    assert _collections(sessions) == {"user_docs_s_live", "user_docs_s_gone"}
+    assert await fake_redis.exists("bm25_index:user_docs_s_gone", session_resources_key("s_gone")) == 2
+
+
+async def test_untracked_sweep_only_touches_user_collections(rag, fake_redis):
+    client = rag.QDRANT_CLIENT
+    for name in ("user_docs_old", "user_images_old", "user_docs_live", "kb_gpt1_owner", "session_old"):
+        _collection(client, name, points=1)
+    await fake_redis.set("session:live", "{}")
+    metrics = await sweep_orphaned_session_resources(dry_run=False, include_untracked=True)
+    assert metrics["collections_deleted"] == 2
+    assert _collections(client) == {"user_docs_live", "kb_gpt1_owner", "session_old"}
@@ -0,0 +1,53 @@
+import pytest
+
+from Rag import sparse_hybrid
+from Rag.mmr import dense_vector
+
+FILES = [
+    {"file_url": f"u/{name}", "filename": f"{name}.txt", "content": content}
+    for name, content in [
+        ("apples", "Apples grow on trees in orchards and ripen in autumn."),
+        ("bananas", "Bananas grow in bunches on tropical plants."),
+        ("invoices", "Invoices are due within 30 days of the billing date."),
+        ("refunds", "Refunds for digital goods are not offered after download."),
+        ("shipping", "Orders ship within two business days from the warehouse."),
+        ("returns", "Physical goods can be returned within 30 days for a refund."),
+    ]
+]
+QUERIES = ["when are invoices due", "do apples grow on trees", "refund for goods", "shipping days"]
+
+
+@pytest.fixture
+async def sparse_kb(rag, monkeypatch):
+    monkeypatch.setattr(rag, "SPARSE_HYBRID_ENABLED", True)
+    await rag.preprocess_kb_documents(FILES, "gpt1", "owner", is_hybrid=True, replace=True)
+    collection = rag.kb_collection_name("gpt1", "owner")
+    assert await sparse_hybrid.has_sparse_vectors(collection)
+    return collection
+
+
+@pytest.mark.parametrize("query", QUERIES)
+async def test_server_side_fusion_matches_client_side_rrf(rag, sparse_kb, query):
+    client = await rag._hybrid_search_rrf(sparse_kb, query, limit=3, server_side=False)
+    server = await rag._hybrid_search_rrf(sparse_kb, query, limit=3, server_side=True)
+    assert len(server) == len(client) == 3
+    assert server[0] == client[0]
+    assert len(set(server) & set(client)) >= 2
+
+
+async def test_server_side_points_carry_dense_vectors_for_mmr(rag, sparse_kb):
+    query = QUERIES[0]
+    points = await sparse_hybrid.server_hybrid_search(
+        sparse_kb, await rag.embed_query(query), rag.tokenize(query), 4, with_vectors=True
+    )
+    assert len(points) == 4
+    assert all(len(dense_vector(p.vector)) == rag.VECTOR_SIZE for p in points)
+
+
+async def test_failed_server_side_fusion_falls_back_to_client_side(rag, sparse_kb, monkeypatch):
+    async def _broken(*args, **kwargs):
+        raise AttributeError("np.NINF was removed")
+
+    monkeypatch.setattr(rag, "server_hybrid_search", _broken)
+    expected = await rag._hybrid_search_rrf(sparse_kb, QUERIES[0], limit=3, server_side=False)
+    assert await rag._hybrid_search_rrf(sparse_kb, QUERIES[0], limit=3) == expected != []
@@ -0,0 +1,80 @@
+import pytest
+from qdrant_client import models
+
+from Rag.chunk_registry import register_chunks
+from Rag.summary_tree import build_summary_trees, get_valid_summary_tree, summary_tree_key
+from tests.test_llm_scheduler import SleepyChat
+
+CALLS = []
+
+
+class CountingChat(SleepyChat):
+    """SleepyChat that records every completion, however it is requested."""
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        CALLS.append("generate")
+        return await super()._agenerate(messages, stop, run_manager, **kwargs)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        CALLS.append("stream")
+        async for chunk in super()._astream(messages, stop, run_manager, **kwargs):
+            yield chunk
+
+
+def _points(doc: int, chunks: int = 4, words: int = 400, edited: bool = False):
+    return [
+        models.PointStruct(id=doc * 100 + i, vector=[1.0], payload={
+            "file_url": f"u/doc{doc}", "doc_id": f"doc{doc}", "doc_index": doc + 1, "filename": f"doc{doc}.txt", "file_type": "txt",
+            "chunk_index": i, "heading": f"Part {i // 2}",
+            "text": ("edited " if edited and i == 0 else "") + " ".join(f"d{doc}c{i}w{w}" for w in range(words)),
+        })
+        for i in range(chunks)
+    ]
+
+
+@pytest.fixture
+async def tree(fake_redis, monkeypatch):
+    import api_keys_util
+    import llm
+    from Rag import Rag as rag_module
+
+    async def _no_keys(session_id):
+        return {}
+
+    monkeypatch.setattr(api_keys_util, "get_api_keys_from_session", _no_keys)
+    monkeypatch.setattr(llm, "get_llm", lambda *args, **kwargs: CountingChat())
+    monkeypatch.setattr(rag_module, "get_llm", lambda *args, **kwargs: CountingChat())
+    collection = "user_docs_s1"
+    points = _points(0) + _points(1)
+    await register_chunks(collection, points)
+    await build_summary_trees(collection, [p.payload for p in points])
+    CALLS.clear()
+    return collection
+
+
+async def test_stored_tree_answers_a_summary_with_one_llm_call(tree, fake_redis):
+    from Rag.Rag import hierarchical_summarize
+
+    stored = await get_valid_summary_tree(tree)
+    assert [d["filename"] for d in stored["documents"]] == ["doc0.txt", "doc1.txt"]
+    assert stored["collection"] and not stored["documents"][0]["verbatim"]
+
+    await fake_redis.hset("user_doc_cache:s1", mapping={"collection_name": tree})
+    summary = await hierarchical_summarize({"session_id": "s1"})
+    assert summary and len(CALLS) == 1
+
+
+async def test_changed_chunk_invalidates_the_tree(tree):
+    await register_chunks(tree, _points(1, edited=True))
+    assert await get_valid_summary_tree(tree) is None
+
+
+async def test_deleting_a_document_drops_its_node(rag, tree, fake_redis):
+    from Rag.kb_sync import delete_kb_files
+
+    rag.QDRANT_CLIENT.create_collection(tree, vectors_config=models.VectorParams(size=1, distance=models.Distance.DOT))
+    rag.QDRANT_CLIENT.upsert(tree, points=_points(0) + _points(1))
+    await delete_kb_files(tree, ["u/doc1"])
+    assert not await fake_redis.hexists(summary_tree_key(tree), "u/doc1")
+    remaining = await get_valid_summary_tree(tree)
+    assert [d["filename"] for d in remaining["documents"]] == ["doc0.txt"]
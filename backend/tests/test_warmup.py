@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from Rag import bm25_index, warmup
+
+
+async def test_steps_over_budget_are_cancelled_and_reported(monkeypatch):
+    monkeypatch.setattr(warmup, "WARMUP_BUDGET_MS", 100)
+    cancelled = asyncio.Event()
+
+    async def _fast():
+        return {"items": 3}
+
+    async def _slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def _broken():
+        raise ValueError("no credentials")
+
+    report = await warmup._run_steps("gpt", {"fast": _fast, "slow": _slow, "broken": _broken}, gpt_id="g1")
+    await asyncio.sleep(0)
+    steps = report["steps"]
+    assert steps["fast"]["status"] == "ok" and steps["fast"]["items"] == 3
+    assert steps["slow"]["status"] == "timeout"
+    assert steps["broken"]["status"] == "error: no credentials"
+    assert report["total_ms"] < 1000
+    assert cancelled.is_set()
+    assert warmup.WARMUP_REPORTS[-1] is report
+
+
+@pytest.fixture
+def offline_steps(monkeypatch):
+    async def _nothing(*args, **kwargs):
+        return None
+
+    for name in ("_warm_tls", "_warm_llm", "_warm_embeddings"):
+        monkeypatch.setattr(warmup, name, _nothing)
+
+
+async def test_gpt_warmup_pins_the_kb_bm25_index(rag, offline_steps):
+    await rag.preprocess_kb_documents(
+        [{"file_url": "u/a", "filename": "a.txt", "content": "apples grow on trees"}],
+        "gpt1", "owner", is_hybrid=True, replace=True,
+    )
+    collection = rag.kb_collection_name("gpt1", "owner")
+    bm25_index._evict_cached_index(collection)
+
+    report = await warmup.warm_gpt({"gpt_id": "gpt1", "userId": "owner", "hybridRag": True})
+    kb = report["steps"]["kb"]
+    assert kb["status"] == "ok" and kb["indexed"] and kb["bm25_pinned"]
+    assert collection in bm25_index._index_cache and collection in bm25_index._pinned
+
+
+async def test_gpt_warmup_without_kb_skips_the_kb_step(rag, offline_steps):
+    report = await warmup.warm_gpt({"gpt_id": "gpt2", "userId": "owner"})
+    kb = report["steps"]["kb"]
+    assert kb["status"] == "ok" and not kb["indexed"] and "bm25_pinned" not in kb
+
+
+async def test_disabled_warmup_does_not_run(monkeypatch):
+    monkeypatch.setattr(warmup, "WARMUP_ENABLED", False)
+    ran = []
+
+    async def _step():
+        ran.append(True)
+
+    warmup.schedule_warmup(_step())
+    await asyncio.sleep(0)
+    assert ran == [] and not warmup._background
@@ -239,6 +239,8 @@ export function useChatSession(): ChatSessionHook {
               size: 0,
             })),
             doc_type: "kb",
+            // The GPT's full KB list: lets the backend drop files removed from it
+            replace: true,
           };
 
           try {